@@ -0,0 +1,78 @@
+"""Compare the startup of the bundle with the pip-installed entry point.
+
+Each variant runs the same command several times, and the smallest and median wall times are
+printed. The noise only adds time, so the smallest is the most telling. Measure the hot path with
+a key already stored by the agent (after a first run, so that the agent state is cached), e.g.:
+
+    python scripts/build_bundle.py
+    python scripts/bench_startup.py ~/.ssh/id_ed25519
+
+Usage: python scripts/bench_startup.py [--runs N] [--bundle PATH] arg ...
+"""
+
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def timings(cmd: List[str], runs: int) -> Optional[List[float]]:
+    """Run a command several times and get its wall times, or None if it fails."""
+    results = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        completed = subprocess.run(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        results.append(time.perf_counter() - started_at)
+        if completed.returncode:
+            sys.stderr.write(f"{cmd[0]} failed: {completed.stderr.decode(errors='replace')}")
+            return None
+    return results
+
+
+def main() -> None:
+    """Command line entry point."""
+    parser = ArgumentParser(description="Compare the startup of the bundle and the pip install.")
+    parser.add_argument("--runs", type=int, default=20, help="the runs of each variant")
+    parser.add_argument(
+        "--bundle",
+        type=Path,
+        default=ROOT / "dist" / "ssh-agent-add-id" / "ssh-agent-add-id",
+        help="the bundle launcher (default: the one of scripts/build_bundle.py)",
+    )
+    parser.add_argument("args", nargs="+", help="the arguments of the measured command")
+    args = parser.parse_args()
+
+    variants = [
+        ("interpreter only (python -I -S -c pass)", [sys.executable, "-I", "-S", "-c", "pass"])
+    ]
+    entry_point = shutil.which("ssh-agent-add-id")
+    if entry_point:
+        variants.append((f"pip entry point ({entry_point})", [entry_point, *args.args]))
+    else:
+        sys.stderr.write("The pip entry point is not installed (pip install .)\n")
+    if args.bundle.is_file():
+        variants.append((f"bundle ({args.bundle})", [str(args.bundle), *args.args]))
+    else:
+        sys.stderr.write(f"{args.bundle} not found (python scripts/build_bundle.py)\n")
+
+    for name, cmd in variants:
+        results = timings(cmd, args.runs)
+        if results:
+            sys.stdout.write(
+                f"{name}: min {min(results) * 1000:.1f} ms, "
+                + f"median {statistics.median(results) * 1000:.1f} ms{os.linesep}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Build a self-contained bundle of ssh-agent-add-id, launched with a fast, isolated startup.
+
+The bundle is a directory holding the package and its dependencies, all precompiled for the
+building interpreter (unchecked hash-based .pyc files, so that the sources are never stat'ed), and
+a launcher which runs them with ``python -I -S``: no site-packages scan, no .pth file, no user
+site and no PYTHON* variable. pydantic-core is a compiled extension, which cannot be imported from
+a zip archive, hence a directory rather than a zipapp.
+
+The dependencies are copied from the current environment, where the package must be installed
+(e.g. ``pdm install``), so the bundle only runs with the same interpreter.
+
+Usage: python scripts/build_bundle.py [--output DIR]
+"""
+
+from argparse import ArgumentParser
+import compileall
+from importlib import metadata
+import os
+from pathlib import Path
+import py_compile
+import re
+import shutil
+import sys
+from typing import List, Set
+
+
+ROOT = Path(__file__).resolve().parent.parent
+DIST_NAME = "ssh-agent-add-id"
+LAUNCHER = """#!{python} -IS
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "lib"))
+
+from ssh_agent_add_id.__main__ import main
+
+main()
+"""
+
+
+def dependencies(name: str) -> List[metadata.Distribution]:
+    """Get the installed distributions required by a distribution, recursively (no extras)."""
+    found: List[metadata.Distribution] = []
+    seen: Set[str] = set()
+    pending = [req for req in metadata.distribution(name).requires or [] if "extra ==" not in req]
+
+    while pending:
+        match = re.match(r"[A-Za-z0-9._-]+", pending.pop())
+        dep_name = re.sub(r"[-_.]+", "-", match.group(0)).lower() if match else ""
+        if not dep_name or dep_name in seen:
+            continue
+        seen.add(dep_name)
+
+        # Not installed: required by an environment marker that does not apply
+        try:
+            dist = metadata.distribution(dep_name)
+        except metadata.PackageNotFoundError:
+            continue
+        found.append(dist)
+        pending += [req for req in dist.requires or [] if "extra ==" not in req]
+
+    return found
+
+
+def copy_distribution(dist: metadata.Distribution, lib: Path) -> None:
+    """Copy the installed files of a distribution, except its scripts and bytecode."""
+    for file in dist.files or []:
+        if file.parts[0] == ".." or "__pycache__" in file.parts:
+            continue
+        target = lib / file
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(file.locate(), target)
+
+
+def build(output: Path) -> Path:
+    """Build the bundle into a directory, replacing it.
+
+    Returns:
+        Path: The launcher path.
+    """
+    if output.exists():
+        shutil.rmtree(output)
+    lib = output / "lib"
+
+    shutil.copytree(
+        ROOT / "src" / "ssh_agent_add_id",
+        lib / "ssh_agent_add_id",
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+    for dist in dependencies(DIST_NAME):
+        copy_distribution(dist, lib)
+
+    # Unchecked: the .pyc files are used as they are, without reading the sources
+    if not compileall.compile_dir(
+        str(lib), quiet=1, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH
+    ):
+        raise RuntimeError("The bundle cannot be compiled")
+
+    launcher = output / DIST_NAME
+    launcher.write_text(LAUNCHER.format(python=sys.executable), encoding="utf-8")
+    launcher.chmod(0o755)
+    return launcher
+
+
+def main() -> None:
+    """Command line entry point."""
+    parser = ArgumentParser(description="Build a self-contained bundle of ssh-agent-add-id.")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=ROOT / "dist" / DIST_NAME,
+        help="the bundle directory (default: dist/ssh-agent-add-id)",
+    )
+    args = parser.parse_args()
+
+    launcher = build(args.output)
+    sys.stdout.write(f"Bundle built: {launcher}{os.linesep}")
+
+
+if __name__ == "__main__":
+    main()
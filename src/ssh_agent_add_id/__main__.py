@@ -1,4 +1,27 @@
-from ssh_agent_add_id.cli import main
+import sys
+
+from ssh_agent_add_id import profiling
+
+
+def main() -> None:
+    """Command line entry point, which starts profiling before the imports with --profile."""
+    _, profile_path, profile_memory = profiling.split_profile_args(sys.argv[1:])
+    if profile_path is None:
+        # The identity is usually stored already, which is answered before importing the CLI
+        from ssh_agent_add_id import fast_path
+
+        if fast_path.run(sys.argv[1:]):
+            return
+
+        from ssh_agent_add_id.cli import main as cli_main
+
+        cli_main()
+        return
+
+    with profiling.profile(profile_path or None, profile_memory):
+        from ssh_agent_add_id.cli import main as cli_main
+
+        cli_main()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+from typing import List
+
+
+def _rotl8(value: int, shift: int) -> int:
+    return ((value << shift) | (value >> (8 - shift))) & 0xFF
+
+
+def _xtime(value: int) -> int:
+    value <<= 1
+    return (value ^ 0x1B) & 0xFF if value & 0x100 else value
+
+
+def _gf_mul(a: int, b: int) -> int:
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a = _xtime(a)
+        b >>= 1
+    return result
+
+
+def _build_sbox() -> List[int]:
+    sbox = [0x63] * 256
+    p = q = 1
+    # p and q iterate over the multiplicative group, q being the inverse of p
+    while True:
+        p = p ^ _xtime(p)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        sbox[p] = q ^ _rotl8(q, 1) ^ _rotl8(q, 2) ^ _rotl8(q, 3) ^ _rotl8(q, 4) ^ 0x63
+        if p == 1:
+            return sbox
+
+
+_SBOX = _build_sbox()
+_INV_SBOX = [_SBOX.index(value) for value in range(256)]
+
+_MUL2 = [_gf_mul(value, 2) for value in range(256)]
+_MUL3 = [_gf_mul(value, 3) for value in range(256)]
+_MUL9 = [_gf_mul(value, 9) for value in range(256)]
+_MUL11 = [_gf_mul(value, 11) for value in range(256)]
+_MUL13 = [_gf_mul(value, 13) for value in range(256)]
+_MUL14 = [_gf_mul(value, 14) for value in range(256)]
+
+# Source index of each state byte after ShiftRows and InvShiftRows (the state is stored column by
+# column)
+_SHIFT_ROWS = [(i % 4) + 4 * (((i // 4) + (i % 4)) % 4) for i in range(16)]
+_INV_SHIFT_ROWS = [(i % 4) + 4 * (((i // 4) - (i % 4)) % 4) for i in range(16)]
+
+BLOCK_SIZE = 16
+
+
+def _expand_key(key: bytes) -> List[List[int]]:
+    """Compute the round keys (16 bytes each) of an AES-128, AES-192 or AES-256 key."""
+    if len(key) not in (16, 24, 32):
+        raise ValueError(f"Invalid AES key length: {len(key)}")
+
+    key_words = len(key) // 4
+    rounds = key_words + 6
+    words = [list(key[i : i + 4]) for i in range(0, len(key), 4)]
+    rcon = 1
+
+    for i in range(key_words, 4 * (rounds + 1)):
+        word = list(words[i - 1])
+        if i % key_words == 0:
+            word = [_SBOX[b] for b in word[1:] + word[:1]]
+            word[0] ^= rcon
+            rcon = _xtime(rcon)
+        elif key_words > 6 and i % key_words == 4:
+            word = [_SBOX[b] for b in word]
+        words.append([a ^ b for a, b in zip(words[i - key_words], word)])
+
+    return [sum(words[4 * r : 4 * r + 4], []) for r in range(rounds + 1)]
+
+
+def _encrypt_block(round_keys: List[List[int]], block: bytes) -> List[int]:
+    """Encrypt a single 16-byte block."""
+    state = [b ^ k for b, k in zip(block, round_keys[0])]
+
+    for round_key in round_keys[1:-1]:
+        state = [_SBOX[state[i]] for i in _SHIFT_ROWS]
+        mixed = []
+        for c in range(0, 16, 4):
+            a0, a1, a2, a3 = state[c : c + 4]
+            mixed += [
+                _MUL2[a0] ^ _MUL3[a1] ^ a2 ^ a3,
+                a0 ^ _MUL2[a1] ^ _MUL3[a2] ^ a3,
+                a0 ^ a1 ^ _MUL2[a2] ^ _MUL3[a3],
+                _MUL3[a0] ^ a1 ^ a2 ^ _MUL2[a3],
+            ]
+        state = [b ^ k for b, k in zip(mixed, round_key)]
+
+    return [_SBOX[state[i]] ^ k for i, k in zip(_SHIFT_ROWS, round_keys[-1])]
+
+
+def _decrypt_block(round_keys: List[List[int]], block: bytes) -> List[int]:
+    """Decrypt a single 16-byte block."""
+    state = [b ^ k for b, k in zip(block, round_keys[-1])]
+
+    for round_key in reversed(round_keys[1:-1]):
+        state = [_INV_SBOX[state[i]] ^ k for i, k in zip(_INV_SHIFT_ROWS, round_key)]
+        mixed = []
+        for c in range(0, 16, 4):
+            a0, a1, a2, a3 = state[c : c + 4]
+            mixed += [
+                _MUL14[a0] ^ _MUL11[a1] ^ _MUL13[a2] ^ _MUL9[a3],
+                _MUL9[a0] ^ _MUL14[a1] ^ _MUL11[a2] ^ _MUL13[a3],
+                _MUL13[a0] ^ _MUL9[a1] ^ _MUL14[a2] ^ _MUL11[a3],
+                _MUL11[a0] ^ _MUL13[a1] ^ _MUL9[a2] ^ _MUL14[a3],
+            ]
+        state = mixed
+
+    return [_INV_SBOX[state[i]] ^ k for i, k in zip(_INV_SHIFT_ROWS, round_keys[0])]
+
+
+def aes_cbc_decrypt(key: bytes, iv: bytes, data: bytes) -> bytes:
+    """Decrypt data encrypted with AES in CBC mode, without padding.
+
+    This is a plain Python implementation: the private section of a key file only holds a few
+    hundred bytes, so it is fast enough and does not require a cryptography library.
+
+    Args:
+        key (bytes): The AES key (16, 24 or 32 bytes).
+        iv (bytes): The 16-byte initialization vector.
+        data (bytes): The encrypted data, whose length is a multiple of 16.
+
+    Raises:
+        ValueError: If a length is not valid.
+
+    Returns:
+        bytes: The decrypted data.
+    """
+    if len(iv) != BLOCK_SIZE or len(data) % BLOCK_SIZE:
+        raise ValueError("Invalid AES-CBC data length")
+
+    round_keys = _expand_key(key)
+    previous = iv
+    out = bytearray()
+
+    for i in range(0, len(data), BLOCK_SIZE):
+        block = data[i : i + BLOCK_SIZE]
+        out += bytes(a ^ b for a, b in zip(_decrypt_block(round_keys, block), previous))
+        previous = block
+
+    return bytes(out)
+
+
+def aes_ctr_decrypt(key: bytes, iv: bytes, data: bytes) -> bytes:
+    """Decrypt data encrypted with AES in CTR mode, the default cipher of OpenSSH private keys.
+
+    The counter is the whole 16-byte initialization vector, incremented as a big-endian integer.
+
+    Args:
+        key (bytes): The AES key (16, 24 or 32 bytes).
+        iv (bytes): The 16-byte initial counter.
+        data (bytes): The encrypted data.
+
+    Raises:
+        ValueError: If a length is not valid.
+
+    Returns:
+        bytes: The decrypted data.
+    """
+    if len(iv) != BLOCK_SIZE:
+        raise ValueError("Invalid AES-CTR counter length")
+
+    round_keys = _expand_key(key)
+    counter = int.from_bytes(iv, "big")
+    out = bytearray()
+
+    for i in range(0, len(data), BLOCK_SIZE):
+        keystream = _encrypt_block(round_keys, counter.to_bytes(BLOCK_SIZE, "big"))
+        out += bytes(a ^ b for a, b in zip(data[i : i + BLOCK_SIZE], keystream))
+        counter = (counter + 1) % (1 << 128)
+
+    return bytes(out)
@@ -0,0 +1,290 @@
+import socket
+import struct
+from typing import List, Optional, Tuple
+
+from ssh_agent_add_id import cancellation, deadline, profiling
+from ssh_agent_add_id.constants import AGENT_PIPELINE_DEPTH
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.wire import WireReader, pack_uint32
+
+
+# Message numbers from draft-miller-ssh-agent
+SSH_AGENT_FAILURE = 5
+SSH_AGENT_SUCCESS = 6
+SSH_AGENTC_REQUEST_IDENTITIES = 11
+SSH_AGENT_IDENTITIES_ANSWER = 12
+SSH_AGENTC_ADD_IDENTITY = 17
+SSH_AGENTC_ADD_ID_CONSTRAINED = 25
+
+SSH_AGENT_CONSTRAIN_LIFETIME = 1
+SSH_AGENT_CONSTRAIN_CONFIRM = 2
+
+MAX_MESSAGE_LEN = 256 * 1024
+
+# The socket errors of a busy or restarting agent (or relay): refused, reset or full backlog
+_TRANSIENT_ERRORS = (BlockingIOError, ConnectionError)
+
+
+class AgentError(Exception):
+    """Raised when the SSH agent cannot be reached or replies unexpectedly."""
+
+
+class TransientAgentError(AgentError):
+    """Raised when the SSH agent fails in a way that a retry may not meet again.
+
+    E.g. a refused or reset connection, or a failure reply to a request that cannot fail.
+    """
+
+
+class AgentClient:
+    """Minimal SSH agent protocol client talking directly to the agent UNIX socket."""
+
+    def __init__(self, sock_path: str, timeout: Optional[float] = None) -> None:
+        """Set the agent socket to connect to.
+
+        Args:
+            sock_path (str): The agent socket path, usually the SSH_AUTH_SOCK value.
+            timeout (Optional[float]): The socket timeout in seconds.
+        """
+        self.sock_path = sock_path
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        #
+
+    def __enter__(self) -> "AgentClient":  # noqa: D105
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:  # noqa: D105
+        self.close()
+
+    def connect(self) -> None:
+        """Connect to the agent socket if not already connected.
+
+        Raises:
+            AgentError: If the connection fails.
+            DeadlineExceededError: If the deadline has passed.
+        """
+        if self._sock:
+            return
+
+        timeout = deadline.remaining(self.timeout)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            with profiling.blocked(profiling.AGENT):
+                sock.connect(self.sock_path)
+        except OSError as err:
+            sock.close()
+            deadline.timed_out()
+            error_type = TransientAgentError if isinstance(err, _TRANSIENT_ERRORS) else AgentError
+            raise error_type(f"Cannot connect to the SSH agent at {self.sock_path}: {err}") from err
+
+        self._sock = sock
+        #
+
+    def close(self) -> None:
+        """Close the connection."""
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+            #
+
+    def peer_pid(self) -> int:
+        """Get the pid of the agent process from the socket peer credentials.
+
+        Raises:
+            AgentError: If the connection fails.
+
+        Returns:
+            int: The agent pid, or 0 if the platform does not provide it.
+        """
+        so_peercred = getattr(socket, "SO_PEERCRED", None)
+        if so_peercred is None:
+            return 0
+
+        self.connect()
+        assert self._sock
+
+        try:
+            creds = self._sock.getsockopt(socket.SOL_SOCKET, so_peercred, struct.calcsize("3i"))
+        except OSError:
+            return 0
+
+        return struct.unpack("3i", creds)[0]
+        #
+
+    def request(self, msg_type: int, payload: bytes = b"") -> Tuple[int, bytes]:
+        """Send a request and wait for its reply.
+
+        Args:
+            msg_type (int): The request message number.
+            payload (bytes): The request content.
+
+        Raises:
+            AgentError: If the I/O with the agent fails.
+            DeadlineExceededError: If the deadline has passed.
+
+        Returns:
+            Tuple[int, bytes]: The reply message number and its content.
+        """
+        return self.request_many([(msg_type, payload)])[0]
+        #
+
+    def request_many(
+        self, requests: List[Tuple[int, bytes]], depth: int = AGENT_PIPELINE_DEPTH
+    ) -> List[Tuple[int, bytes]]:
+        """Send several requests back-to-back and read their replies in order.
+
+        Up to `depth` requests are written before the first reply is read, so a remote (forwarded)
+        agent costs about one round trip per batch instead of one per request.
+
+        Args:
+            requests (List[Tuple[int, bytes]]): The request message numbers and contents.
+            depth (int): The maximal number of requests waiting for their replies.
+
+        Raises:
+            AgentError: If the I/O with the agent fails.
+            DeadlineExceededError: If the deadline has passed.
+
+        Returns:
+            List[Tuple[int, bytes]]: The reply message numbers and contents, in request order.
+        """
+        self.connect()
+        assert self._sock
+
+        replies: List[Tuple[int, bytes]] = []
+        sent = 0
+
+        try:
+            self._sock.settimeout(deadline.remaining(self.timeout))
+            with profiling.blocked(profiling.AGENT):
+                while len(replies) < len(requests):
+                    # Fill the pipeline up to its depth with a single write
+                    batch = requests[sent : len(replies) + depth]
+                    if batch:
+                        self._sock.sendall(
+                            b"".join(
+                                struct.pack(">IB", len(payload) + 1, msg_type) + payload
+                                for msg_type, payload in batch
+                            )
+                        )
+                        sent += len(batch)
+
+                    length = struct.unpack(">I", self._recv_exact(4))[0]
+                    if not 0 < length <= MAX_MESSAGE_LEN:
+                        raise AgentError(f"Invalid SSH agent reply length: {length}")
+                    reply = self._recv_exact(length)
+                    replies.append((reply[0], reply[1:]))
+
+        except OSError as err:
+            self.close()
+            deadline.timed_out()
+            error_type = TransientAgentError if isinstance(err, _TRANSIENT_ERRORS) else AgentError
+            raise error_type(f"SSH agent I/O error: {err}") from err
+        except BaseException:
+            # A reply may have been partially read: the connection cannot be reused
+            self.close()
+            raise
+
+        return replies
+        #
+
+    def list_identities(self) -> List[PublicKey]:
+        """Get the identities currently stored by the agent.
+
+        Raises:
+            AgentError: If the agent request fails.
+
+        Returns:
+            List[PublicKey]: The stored public keys.
+        """
+        msg_type, payload = self.request(SSH_AGENTC_REQUEST_IDENTITIES)
+        # Overloaded relays (WSL, gpg-agent) answer a failure to a request that cannot fail
+        if msg_type == SSH_AGENT_FAILURE:
+            raise TransientAgentError("The SSH agent failed to list its identities")
+        if msg_type != SSH_AGENT_IDENTITIES_ANSWER:
+            raise AgentError(f"Unexpected SSH agent reply to identities request: {msg_type}")
+
+        try:
+            reader = WireReader(payload)
+            identities = []
+            for _ in range(reader.read_uint32()):
+                blob = reader.read_string()
+                comment = reader.read_string().decode("utf-8", errors="replace")
+                identities.append(PublicKey.from_blob(blob, comment))
+        except ValueError as err:
+            raise AgentError(f"Malformed SSH agent identities answer: {err}") from err
+
+        return identities
+        #
+
+    def add_identity(
+        self, identity: bytes, lifetime: Optional[int] = None, confirm: bool = False
+    ) -> None:
+        """Add a decrypted identity to the agent.
+
+        Args:
+            identity (bytes): The key type, private fields and comment of the identity.
+            lifetime (Optional[int]): The maximum lifetime of the identity in the agent, in
+                seconds.
+            confirm (bool): Whether the agent must confirm each use of the identity.
+
+        Raises:
+            AgentError: If the agent request fails or the agent refuses the identity.
+        """
+        if not self.add_identities([identity], lifetime, confirm)[0]:
+            raise AgentError("The SSH agent refused to add the identity")
+            #
+
+    def add_identities(
+        self, identities: List[bytes], lifetime: Optional[int] = None, confirm: bool = False
+    ) -> List[bool]:
+        """Add several decrypted identities to the agent with pipelined requests.
+
+        Args:
+            identities (List[bytes]): The key type, private fields and comment of each identity.
+            lifetime (Optional[int]): The maximum lifetime of the identities in the agent, in
+                seconds.
+            confirm (bool): Whether the agent must confirm each use of the identities.
+
+        Raises:
+            AgentError: If the agent requests fail.
+
+        Returns:
+            List[bool]: Whether each identity has been accepted by the agent.
+        """
+        constraints = b""
+        if lifetime is not None:
+            constraints += bytes([SSH_AGENT_CONSTRAIN_LIFETIME]) + pack_uint32(lifetime)
+        if confirm:
+            constraints += bytes([SSH_AGENT_CONSTRAIN_CONFIRM])
+
+        msg_type = SSH_AGENTC_ADD_ID_CONSTRAINED if constraints else SSH_AGENTC_ADD_IDENTITY
+        replies = self.request_many([(msg_type, identity + constraints) for identity in identities])
+
+        return [reply_type == SSH_AGENT_SUCCESS for reply_type, _ in replies]
+        #
+
+    def _recv_exact(self, size: int) -> bytes:
+        """Read exactly `size` bytes from the socket.
+
+        Raises:
+            AgentError: If the agent closes the connection.
+            SignalException: If a signal has been received.
+        """
+        assert self._sock
+
+        chunks = []
+        while size:
+            # Wait for the reply with the cancellation token, so that a signal ends the wait at once
+            if not cancellation.wait([self._sock.fileno()], self._sock.gettimeout()):
+                raise socket.timeout("timed out")
+
+            chunk = self._sock.recv(size)
+            if not chunk:
+                raise TransientAgentError("SSH agent closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        return b"".join(chunks)
@@ -0,0 +1,106 @@
+from dataclasses import asdict, dataclass, fields
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+from ssh_agent_add_id.constants import APP_NAME, STATE_TTL
+
+
+NATIVE = "native"
+SUBPROCESS = "subprocess"
+
+
+@dataclass
+class Backend:
+    """How to talk to the SSH agent, as chosen by the doctor subcommand from measurements.
+
+    Without a saved choice, the defaults keep the historical behavior (ssh-add subprocesses). A
+    choice only applies to the agent it was measured with, see :func:`current`.
+    """
+
+    agent_io: str = SUBPROCESS
+    """:data:`NATIVE` to check the identities through the agent socket, or :data:`SUBPROCESS` to
+    run ssh-add."""
+    ssh_add_test: bool = True
+    """Whether ssh-add supports -T (OpenSSH 8.2+), otherwise the identities are listed with -L."""
+    state_ttl: float = STATE_TTL
+    """How long the cached agent state is trusted, in seconds."""
+    proxy: bool = False
+    """Whether a local caching proxy is recommended (slow or forwarded agent)."""
+    sock_path: str = ""
+    """The agent socket the measurements were made with, empty to apply to every agent."""
+
+    @property
+    def path(self) -> Path:
+        """Path: The file where the choice is saved."""
+        return backend_path()
+        #
+
+    def save(self) -> None:
+        """Atomically write the choice, which the next invocations use automatically.
+
+        Raises:
+            OSError: If the file cannot be written.
+        """
+        global _backend
+
+        path = self.path
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(asdict(self), file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+        _backend = self
+        #
+
+
+_backend: Optional[Backend] = None
+
+
+def backend_path() -> Path:
+    """Get the path of the saved backend choice, under $XDG_CONFIG_HOME."""
+    config_home = os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return Path(config_home) / APP_NAME / "backend.json"
+
+
+def current(sock_path: Optional[str] = None) -> Backend:
+    """Get the backend of an agent: the saved choice, read once per process, or the defaults.
+
+    A choice measured on another agent (e.g. a local one, when this one is forwarded) does not
+    apply: the defaults are used, except for the ssh-add capabilities, which do not depend on it.
+
+    Args:
+        sock_path (Optional[str]): The agent socket path, $SSH_AUTH_SOCK by default.
+
+    Returns:
+        Backend: The backend to use with the agent.
+    """
+    saved = _saved()
+    if sock_path is None:
+        sock_path = os.getenv("SSH_AUTH_SOCK", "")
+
+    if saved.sock_path and saved.sock_path != sock_path:
+        return Backend(ssh_add_test=saved.ssh_add_test)
+    return saved
+
+
+def _saved() -> Backend:
+    """Get the saved backend choice, read once per process, or the defaults if there is none."""
+    global _backend
+
+    if _backend is None:
+        _backend = Backend()
+        try:
+            with open(backend_path(), encoding="utf-8") as file:
+                data = json.load(file)
+            names = {field.name for field in fields(Backend)}
+            _backend = Backend(**{key: value for key, value in data.items() if key in names})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as err:
+            logging.debug(f"backend.current ignored invalid backend file: {err}")
+
+    return _backend
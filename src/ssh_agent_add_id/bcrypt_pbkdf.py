@@ -0,0 +1,221 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.synchronize import Event
+import os
+import struct
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from ssh_agent_add_id import cancellation
+
+
+HASH_SIZE = 32
+"""The output size of bcrypt_hash, i.e. of each output block of bcrypt_pbkdf."""
+
+_MASK = 0xFFFFFFFF
+_MAGIC = struct.unpack(">8I", b"OxychromaticBlowfishSwatDynamite")
+# The P-array and the 4 S-boxes of Blowfish are initialized with the hex digits of pi
+_PI_WORDS = 18 + 4 * 256
+
+# Set in the worker processes, when the parent has been cancelled
+_stop: Optional[Event] = None
+
+
+class CancelledDerivationError(Exception):
+    """Raised in a worker process whose derivation has been cancelled by the parent."""
+
+
+def bcrypt_pbkdf(password: bytes, salt: bytes, rounds: int, length: int) -> bytes:
+    """Derive a key like OpenSSH does for its encrypted private keys.
+
+    The bcrypt C extension is used if it is installed (``pip install ssh-agent-add-id[openssh]``).
+    Otherwise the output blocks, which are independent, are derived in parallel by plain Python
+    worker processes, still several seconds for the default 16 rounds.
+
+    Args:
+        password (bytes): The passphrase.
+        salt (bytes): The salt of the key file.
+        rounds (int): The rounds of the key file.
+        length (int): The length of the derived key.
+
+    Raises:
+        SignalException: If a signal has been received.
+        ValueError: If a parameter is not valid.
+
+    Returns:
+        bytes: The derived key.
+    """
+    if rounds < 1 or not password or not salt or not 0 < length <= HASH_SIZE * HASH_SIZE:
+        raise ValueError("Invalid bcrypt_pbkdf parameters")
+
+    native_kdf = _native_kdf()
+    if native_kdf:
+        cancellation.check()
+        return native_kdf(password, salt, length, rounds, ignore_few_rounds=True)
+
+    # Each block gives every stride-th byte of the key
+    stride = (length + HASH_SIZE - 1) // HASH_SIZE
+    blocks = _derive_blocks(hashlib.sha512(password).digest(), salt, rounds, stride)
+
+    key = bytearray(length)
+    for index, block in enumerate(blocks):
+        for i in range(index, length, stride):
+            key[i] = block[i // stride]
+    return bytes(key)
+
+
+def has_native_engine() -> bool:
+    """Check if the bcrypt C extension is installed, which derives keys as fast as ssh-add."""
+    return _native_kdf() is not None
+
+
+def bcrypt_hash(sha2pass: bytes, sha2salt: bytes) -> bytes:
+    """Compute the bcrypt_hash function of bcrypt_pbkdf, from the SHA-512 digests."""
+    p, s0, s1, s2, s3 = (list(words) for words in _initial_state())
+    key = struct.unpack(">16I", sha2pass)
+    salt = struct.unpack(">16I", sha2salt)
+
+    _expand(p, s0, s1, s2, s3, key, salt)
+    for _ in range(64):
+        _expand(p, s0, s1, s2, s3, salt)
+        _expand(p, s0, s1, s2, s3, key)
+
+    cdata = list(_MAGIC)
+    for _ in range(64):
+        for i in range(0, 8, 2):
+            cdata[i], cdata[i + 1] = _encrypt(p, s0, s1, s2, s3, cdata[i], cdata[i + 1])
+
+    return struct.pack("<8I", *cdata)
+
+
+def _native_kdf() -> Optional[Callable[..., bytes]]:
+    """Get the kdf function of the bcrypt C extension, or None if it is not installed."""
+    try:
+        import bcrypt
+    except ImportError:
+        return None
+    return bcrypt.kdf
+
+
+def _derive_blocks(sha2pass: bytes, salt: bytes, rounds: int, count: int) -> List[bytes]:
+    """Derive the output blocks, in parallel worker processes if there are several."""
+    workers = min(count, os.cpu_count() or 1)
+    block = functools.partial(_derive_block, sha2pass, salt, rounds)
+    if workers == 1:
+        return [block(index, cancellation.check) for index in range(count)]
+
+    # Computed once before forking, rather than in each worker
+    _initial_state()
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    with ProcessPoolExecutor(workers, context, _init_worker, (stop,)) as pool:
+        try:
+            return cancellation.pool_map(pool, block, range(count))
+        except BaseException:
+            # The running workers watch this event between two rounds
+            stop.set()
+            raise
+
+
+def _init_worker(stop: Event) -> None:
+    global _stop
+    _stop = stop
+
+
+def _check_stop() -> None:
+    if _stop is not None and _stop.is_set():
+        raise CancelledDerivationError()
+
+
+def _derive_block(
+    sha2pass: bytes,
+    salt: bytes,
+    rounds: int,
+    index: int,
+    check: Callable[[], None] = _check_stop,
+) -> bytes:
+    """Derive an output block, calling `check` between two rounds to stop early."""
+    sha2salt = hashlib.sha512(salt + struct.pack(">I", index + 1)).digest()
+    out = tmp = bcrypt_hash(sha2pass, sha2salt)
+    for _ in range(rounds - 1):
+        check()
+        tmp = bcrypt_hash(sha2pass, hashlib.sha512(tmp).digest())
+        out = bytes(a ^ b for a, b in zip(out, tmp))
+    logging.debug(f"bcrypt_pbkdf derived the block {index} in process {os.getpid()}")
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def _initial_state() -> Tuple[Tuple[int, ...], ...]:
+    """Compute the initial P-array and S-boxes of Blowfish from the hex digits of pi."""
+    bits = _PI_WORDS * 32 + 64
+    one = 1 << bits
+
+    def arctan_inverse(x: int) -> int:
+        total = term = one // x
+        n, sign = 1, 1
+        while term:
+            term //= x * x
+            n, sign = n + 2, -sign
+            total += sign * (term // n)
+        return total
+
+    # Machin's formula, then the fractional part
+    pi = 16 * arctan_inverse(5) - 4 * arctan_inverse(239) - (3 << bits)
+    words = [(pi >> (bits - 32 * (i + 1))) & _MASK for i in range(_PI_WORDS)]
+    return (tuple(words[:18]),) + tuple(
+        tuple(words[18 + 256 * box : 18 + 256 * (box + 1)]) for box in range(4)
+    )
+
+
+def _encrypt(
+    p: Sequence[int],
+    s0: Sequence[int],
+    s1: Sequence[int],
+    s2: Sequence[int],
+    s3: Sequence[int],
+    left: int,
+    right: int,
+) -> Tuple[int, int]:
+    """Encrypt a Blowfish block."""
+    for i in range(0, 16, 2):
+        left ^= p[i]
+        right ^= p[i + 1] ^ (
+            (
+                ((s0[left >> 24] + s1[(left >> 16) & 0xFF]) ^ s2[(left >> 8) & 0xFF])
+                + s3[left & 0xFF]
+            )
+            & _MASK
+        )
+        left ^= (
+            ((s0[right >> 24] + s1[(right >> 16) & 0xFF]) ^ s2[(right >> 8) & 0xFF])
+            + s3[right & 0xFF]
+        ) & _MASK
+    return right ^ p[17], left ^ p[16]
+
+
+def _expand(
+    p: List[int],
+    s0: List[int],
+    s1: List[int],
+    s2: List[int],
+    s3: List[int],
+    key: Sequence[int],
+    data: Sequence[int] = (),
+) -> None:
+    """Expand the Blowfish state with a 16-word key, and 16 words of data (zeros if empty)."""
+    for i in range(18):
+        p[i] ^= key[i % 16]
+
+    left = right = 0
+    j = 0
+    for box in (p, s0, s1, s2, s3):
+        for k in range(0, len(box), 2):
+            if data:
+                left ^= data[j]
+                right ^= data[j + 1]
+                j = (j + 2) % 16
+            left, right = _encrypt(p, s0, s1, s2, s3, left, right)
+            box[k], box[k + 1] = left, right
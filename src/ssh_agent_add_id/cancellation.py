@@ -0,0 +1,353 @@
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from functools import partial
+import os
+import select
+import subprocess
+from subprocess import CompletedProcess, Popen, TimeoutExpired
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from ssh_agent_add_id import deadline
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class CancelToken:
+    """A cancellation request, set when a signal is received, that the blocking operations watch.
+
+    Instead of raising an exception in whatever code happens to run when a signal is received, the
+    waits on sockets, subprocesses and worker threads also watch the token pipe, and raise a
+    SignalException at that well-defined point. Once cancelled, a token stays cancelled: its pipe
+    is never drained, so that all the waiting threads wake up. The waits are also bounded by the
+    deadline, if any, and raise a DeadlineExceededError once it has passed.
+    """
+
+    def __init__(self) -> None:  # noqa: D107
+        self.signal_num: Optional[int] = None
+        self.interruptible = 0
+        self._cancel_r, self._cancel_w = os.pipe()
+
+        # Written by the C signal handler, so that the main thread wakes up to run the Python one
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        #
+
+    @property
+    def wakeup_fd(self) -> int:
+        """int: The file descriptor to give to :func:`signal.set_wakeup_fd`."""
+        return self._wakeup_w
+        #
+
+    @property
+    def cancelled(self) -> bool:
+        """bool: Whether a signal has been received."""
+        return self.signal_num is not None
+        #
+
+    def cancel(self, signal_num: int) -> None:
+        """Request the cancellation of the running operations (called by the signal handler).
+
+        Args:
+            signal_num (int): The received signal.
+        """
+        if self.signal_num is None:
+            self.signal_num = signal_num
+            os.write(self._cancel_w, b"\0")
+            #
+
+    def check(self) -> None:
+        """Raise a SignalException if the token has been cancelled."""
+        if self.signal_num is not None:
+            # errors requires pydantic, which the fast paths avoid importing
+            from ssh_agent_add_id.errors import SignalException
+
+            raise SignalException(self.signal_num)
+            #
+
+    def wait(self, fds: Sequence[int], timeout: Optional[float] = None) -> List[int]:
+        """Wait until some file descriptors are readable or the timeout expires.
+
+        Args:
+            fds (Sequence[int]): The file descriptors to wait for.
+            timeout (Optional[float]): The maximal wait, in seconds, or None to wait indefinitely.
+
+        Raises:
+            DeadlineExceededError: If the deadline has passed.
+            SignalException: If the token has been cancelled.
+
+        Returns:
+            List[int]: The readable file descriptors, none if the timeout has expired.
+        """
+        timeout = deadline.remaining(timeout)
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        watched = [*fds, self._cancel_r]
+        if threading.current_thread() is threading.main_thread():
+            watched.append(self._wakeup_r)
+
+        while True:
+            self.check()
+
+            remaining = None if expires_at is None else max(expires_at - time.monotonic(), 0)
+            readable, _, _ = select.select(watched, [], [], remaining)
+
+            # The Python signal handler runs in the main thread before the next iteration
+            if self._wakeup_r in readable:
+                self._drain_wakeup()
+                continue
+
+            self.check()
+            if not readable:
+                deadline.timed_out()
+                return []
+
+            ready = [fd for fd in readable if fd != self._cancel_r]
+            if ready:
+                return ready
+            #
+
+    def close(self) -> None:
+        """Close the token pipes."""
+        for fd in (self._cancel_r, self._cancel_w, self._wakeup_r, self._wakeup_w):
+            os.close(fd)
+            #
+
+    def _drain_wakeup(self) -> None:
+        """Empty the wakeup pipe."""
+        try:
+            while os.read(self._wakeup_r, 1024):
+                pass
+        except BlockingIOError:
+            pass
+            #
+
+
+_token: Optional[CancelToken] = None
+_token_lock = threading.Lock()
+
+
+def current() -> CancelToken:
+    """Get the cancellation token of the process, creating it on first use."""
+    global _token
+
+    with _token_lock:
+        if _token is None:
+            _token = CancelToken()
+        return _token
+        #
+
+
+def check() -> None:
+    """Raise an exception if a signal has been received or the deadline has passed.
+
+    This is meant to be called before starting some work, or between the steps of a long
+    computation.
+
+    Raises:
+        DeadlineExceededError: If the deadline has passed.
+        SignalException: If a signal has been received.
+    """
+    if _token:
+        _token.check()
+    deadline.check()
+
+
+def wait(fds: Sequence[int], timeout: Optional[float] = None) -> List[int]:
+    """Wait until some file descriptors are readable, unless a signal is received.
+
+    See :meth:`CancelToken.wait`.
+    """
+    return current().wait(fds, timeout)
+
+
+def sleep(seconds: float) -> None:
+    """Sleep, unless a signal is received or the deadline passes.
+
+    Raises:
+        DeadlineExceededError: If the deadline has passed.
+        SignalException: If a signal has been received.
+    """
+    current().wait([], seconds)
+
+
+@contextmanager
+def interruptible() -> Iterator[None]:
+    """Let a signal interrupt the enclosed code at once.
+
+    This is meant for the waits which cannot watch the token, e.g. reading a passphrase on the
+    terminal. The expiry of the deadline interrupts it too.
+
+    Raises:
+        DeadlineExceededError: If the deadline has passed.
+        SignalException: If a signal has been received.
+    """
+    token = current()
+    token.check()
+    deadline.check()
+
+    token.interruptible += 1
+    try:
+        yield
+    finally:
+        token.interruptible -= 1
+
+
+def read(fd: int, timeout: Optional[float] = None, until: bytes = b"") -> bytes:
+    """Read a file descriptor until its end, stopping as soon as a signal is received.
+
+    Args:
+        fd (int): The file descriptor, e.g. a pipe or a socket.
+        timeout (Optional[float]): The maximal wait, in seconds.
+        until (bytes): Stop reading once this has been read, e.g. the end of a line, rather than
+            waiting for the end of the file.
+
+    Raises:
+        OSError: If the file descriptor cannot be read.
+        SignalException: If a signal has been received.
+        TimeoutError: If the timeout has expired.
+
+    Returns:
+        bytes: The content read.
+    """
+    expires_at = None if timeout is None else time.monotonic() + timeout
+    chunks: List[bytes] = []
+
+    while True:
+        remaining = None if expires_at is None else max(expires_at - time.monotonic(), 0)
+        if not wait([fd], remaining):
+            raise TimeoutError(f"Timed out reading file descriptor {fd}")
+
+        chunk = os.read(fd, 64 * 1024)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if until and until in chunk:
+            break
+
+    return b"".join(chunks)
+
+
+def communicate(popen: Popen, timeout: Optional[float] = None) -> Tuple[Any, Any]:
+    """Read the outputs of a process until it exits, stopping as soon as a signal is received.
+
+    This is :meth:`subprocess.Popen.communicate` without input, watching the cancellation token.
+
+    Args:
+        popen (Popen): The process, with its outputs as pipes (in binary mode) or not captured.
+        timeout (Optional[float]): The maximal wait, in seconds.
+
+    Raises:
+        SignalException: If a signal has been received.
+        TimeoutExpired: If the timeout has expired.
+
+    Returns:
+        Tuple[Any, Any]: The standard output and error, or None if they are not captured.
+    """
+    expires_at = None if timeout is None else time.monotonic() + timeout
+    if popen.stdin:
+        popen.stdin.close()
+
+    streams = {stream.fileno(): stream for stream in (popen.stdout, popen.stderr) if stream}
+    chunks: Dict[int, List[bytes]] = {fd: [] for fd in streams}
+    outputs = [stream.fileno() if stream else None for stream in (popen.stdout, popen.stderr)]
+
+    while streams:
+        remaining = None if expires_at is None else expires_at - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutExpired(popen.args, timeout or 0)
+
+        for fd in wait(list(streams), remaining):
+            data = os.read(fd, 64 * 1024)
+            if data:
+                chunks[fd].append(data)
+            else:
+                streams.pop(fd).close()
+
+    # The outputs are closed: the process is exiting
+    popen.wait(None if expires_at is None else max(expires_at - time.monotonic(), 0))
+
+    stdout, stderr = (None if fd is None else b"".join(chunks[fd]) for fd in outputs)
+    return stdout, stderr
+
+
+def run(cmd: List[str], timeout: Optional[float] = None, **kwargs: Any) -> CompletedProcess:  # noqa: ANN401
+    """Run a command like :func:`subprocess.run`, killing it as soon as a signal is received.
+
+    Args:
+        cmd (List[str]): The command.
+        timeout (Optional[float]): The maximal run time, in seconds.
+        **kwargs (Any): The other :class:`subprocess.Popen` arguments.
+
+    Raises:
+        SignalException: If a signal has been received.
+        TimeoutExpired: If the timeout has expired.
+
+    Returns:
+        CompletedProcess: The completed process.
+    """
+    with subprocess.Popen(cmd, **kwargs) as popen:
+        try:
+            stdout, stderr = communicate(popen, timeout)
+        except BaseException:
+            popen.kill()
+            raise
+
+    return CompletedProcess(popen.args, popen.returncode, stdout, stderr)
+
+
+def pool_map(pool: Executor, fn: Callable[[T], R], items: Iterable[T]) -> List[R]:
+    """Run a function on some items in a pool, stopping as soon as a signal is received.
+
+    Like :meth:`Executor.map`, the results are in item order. Once a signal is received, the jobs
+    which have not started yet are cancelled, the running ones are expected to watch the token. A
+    worker may still pick a queued job before it is cancelled: the job then checks the token first
+    and does not run the function.
+
+    Raises:
+        DeadlineExceededError: If the deadline has passed.
+        SignalException: If a signal has been received.
+
+    Returns:
+        List[R]: The results, in item order.
+    """
+    futures = [pool.submit(partial(_checked_call, fn), item) for item in items]
+
+    read_fd, write_fd = os.pipe()
+    lock = threading.Lock()
+    closed = False
+
+    def notify(_: Future) -> None:
+        with lock:
+            if not closed:
+                os.write(write_fd, b"\0")
+
+    try:
+        for future in futures:
+            future.add_done_callback(notify)
+
+        while not all(future.done() for future in futures):
+            wait([read_fd])
+            os.read(read_fd, 1024)
+
+        return [future.result() for future in futures]
+
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+    finally:
+        with lock:
+            closed = True
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+def _checked_call(fn: Callable[[T], R], item: T) -> R:
+    """Call a pool_map function unless a signal has been received (module-level to be pickled)."""
+    check()
+    return fn(item)
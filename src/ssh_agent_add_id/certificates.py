@@ -0,0 +1,262 @@
+from dataclasses import dataclass
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.constants import CERT_RENEW_MARGIN
+from ssh_agent_add_id.keys import PRIVATE_KEY_FIELDS, PublicKey, load_public_key
+from ssh_agent_add_id.wire import WireReader, pack_string
+
+
+CERT_SUFFIX = "-cert.pub"
+# A valid_before meaning that the certificate never expires
+FOREVER = 0xFFFFFFFFFFFFFFFF
+
+_CERT_TYPE_SUFFIX = "-cert-v01@openssh.com"
+# Number of public fields of each key type, in its public key blob and in its certificates
+_PUBLIC_FIELDS = {
+    "ssh-ed25519": 1,
+    "ssh-rsa": 2,
+    "ssh-dss": 4,
+    "ecdsa-sha2-nistp256": 2,
+    "ecdsa-sha2-nistp384": 2,
+    "ecdsa-sha2-nistp521": 2,
+    "sk-ssh-ed25519@openssh.com": 2,
+    "sk-ecdsa-sha2-nistp256@openssh.com": 3,
+}
+# Number of leading private key fields replaced by the certificate in an add identity request
+_CERT_REPLACED_FIELDS = {
+    "ssh-ed25519": 0,
+    "ssh-rsa": 2,
+    "ssh-dss": 4,
+    "ecdsa-sha2-nistp256": 2,
+    "ecdsa-sha2-nistp384": 2,
+    "ecdsa-sha2-nistp521": 2,
+    "sk-ssh-ed25519@openssh.com": 2,
+    "sk-ecdsa-sha2-nistp256@openssh.com": 3,
+}
+
+
+@dataclass(frozen=True)
+class Certificate:
+    """An OpenSSH certificate (``<type>-cert-v01@openssh.com``) of a public key."""
+
+    public_key: PublicKey
+    """The certificate itself, as stored in its file and listed by the agent."""
+    key_blob: bytes
+    """The blob of the certified public key."""
+    key_id: str
+    principals: Tuple[str, ...]
+    valid_after: int
+    valid_before: int
+    """The expiry timestamp, :data:`FOREVER` if the certificate never expires."""
+
+    @property
+    def fingerprint(self) -> str:
+        """str: The fingerprint of the certificate blob, as listed by the agent."""
+        return self.public_key.fingerprint
+        #
+
+    def is_valid(self, at: Optional[float] = None) -> bool:
+        """Check that the validity window of the certificate includes a time (now by default)."""
+        at = time.time() if at is None else at
+        return self.valid_after <= at < self.valid_before
+        #
+
+
+def parse_certificate(public_key: PublicKey) -> Certificate:
+    """Parse the certificate fields of a public key of a certificate type.
+
+    The signature is not verified, the certificate is only read to know its validity window.
+
+    Args:
+        public_key (PublicKey): The certificate, as read from its file or listed by the agent.
+
+    Raises:
+        ValueError: If the public key is not a valid certificate.
+
+    Returns:
+        Certificate: The certificate.
+    """
+    key_type = public_key.key_type
+    plain_type = key_type[: -len(_CERT_TYPE_SUFFIX)]
+    if not key_type.endswith(_CERT_TYPE_SUFFIX) or plain_type not in _PUBLIC_FIELDS:
+        # The security key types end with @openssh.com, which the certificate type replaces
+        plain_type += "@openssh.com"
+        if not key_type.endswith(_CERT_TYPE_SUFFIX) or plain_type not in _PUBLIC_FIELDS:
+            raise ValueError(f"Unsupported certificate type: {key_type}")
+
+    reader = WireReader(public_key.blob)
+    reader.read_string()  # Type
+    reader.read_string()  # Nonce
+    key_blob = pack_string(plain_type.encode()) + b"".join(
+        pack_string(reader.read_string()) for _ in range(_PUBLIC_FIELDS[plain_type])
+    )
+    reader.read_uint64()  # Serial
+    reader.read_uint32()  # Certificate type (user or host)
+    key_id = reader.read_string().decode(errors="replace")
+    principals_reader = WireReader(reader.read_string())
+    principals = []
+    while principals_reader.remaining:
+        principals.append(principals_reader.read_string().decode(errors="replace"))
+    valid_after = reader.read_uint64()
+    valid_before = reader.read_uint64()
+
+    return Certificate(public_key, key_blob, key_id, tuple(principals), valid_after, valid_before)
+
+
+def certificate_path(priv_key_path: str) -> str:
+    """Get the path of the certificate paired with a private key, like ssh looks for it."""
+    return priv_key_path + CERT_SUFFIX
+
+
+def paired_certificate(priv_key_path: str, key_blob: bytes = b"") -> Optional[Certificate]:
+    """Load the certificate paired with a private key, if it is currently valid.
+
+    Args:
+        priv_key_path (str): The private key path.
+        key_blob (bytes): The public key blob of the private key, to check that the certificate
+            certifies it.
+
+    Returns:
+        Optional[Certificate]: The certificate, or None if there is none, or if it is invalid,
+            expired or not yet valid (the key is then used without it).
+    """
+    path = certificate_path(priv_key_path)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        cert = parse_certificate(load_public_key(path))
+    except (OSError, ValueError) as err:
+        logging.debug(f"paired_certificate ignores {path}: {err}")
+        return None
+
+    if key_blob and cert.key_blob != key_blob:
+        logging.debug(f"paired_certificate ignores {path}: it certifies another key")
+        return None
+    if not cert.is_valid():
+        logging.debug(f"paired_certificate ignores {path}: outside of its validity window")
+        return None
+
+    return cert
+
+
+def cache_lifetime(cert: Certificate, lifetime: Optional[int] = None) -> Optional[int]:
+    """Get how long the agent state can trust that a certificate is stored.
+
+    The certificate expiry is a natural deadline: the agent does not need to be queried until
+    shortly before it, when a renewed certificate may have to be added.
+
+    Args:
+        cert (Certificate): The certificate.
+        lifetime (Optional[int]): The lifetime constraint it has just been added with, if any.
+
+    Returns:
+        Optional[int]: The seconds to trust the certificate for, or `lifetime` if the certificate
+            never expires or is about to.
+    """
+    if cert.valid_before == FOREVER:
+        return lifetime
+
+    remaining = int(cert.valid_before - CERT_RENEW_MARGIN - time.time())
+    if remaining <= 0:
+        logging.debug(f"cache_lifetime: the certificate {cert.key_id} expires soon")
+        return lifetime
+
+    return remaining if lifetime is None else min(remaining, lifetime)
+
+
+def certificate_identity(identity: bytes, cert: Certificate) -> bytes:
+    """Build the add identity request of a certificate from the one of its private key.
+
+    The certificate replaces the key type and the leading public fields of the private key.
+
+    Args:
+        identity (bytes): The key type, private fields and comment of the private key.
+        cert (Certificate): The certificate of the key.
+
+    Raises:
+        ValueError: If the identity is malformed or of an unsupported type.
+
+    Returns:
+        bytes: The certificate type, certificate, remaining private fields and comment.
+    """
+    reader = WireReader(identity)
+    key_type = reader.read_string().decode("ascii", errors="replace")
+    if key_type not in _CERT_REPLACED_FIELDS:
+        raise ValueError(f"Unsupported private key type: {key_type}")
+
+    fields = []
+    for field in PRIVATE_KEY_FIELDS[key_type]:
+        fields.append(
+            bytes([reader.read_byte()]) if field == "b" else pack_string(reader.read_string())
+        )
+    comment = reader.read_bytes(reader.remaining)
+
+    return (
+        pack_string(cert.public_key.key_type.encode())
+        + pack_string(cert.public_key.blob)
+        + b"".join(fields[_CERT_REPLACED_FIELDS[key_type] :])
+        + comment
+    )
+
+
+def with_certificate(priv_key_path: str, identity: bytes, key_blob: bytes) -> List[bytes]:
+    """Get the identities to add for a private key decrypted in-process.
+
+    ssh-add adds the certificate paired with a private key along with it, so do the keys added
+    through the agent socket.
+
+    Args:
+        priv_key_path (str): The private key path.
+        identity (bytes): The key type, private fields and comment of the private key.
+        key_blob (bytes): The public key blob of the private key.
+
+    Returns:
+        List[bytes]: The identity, followed by the one of its certificate if it is valid.
+    """
+    cert = paired_certificate(priv_key_path, key_blob)
+    if not cert:
+        return [identity]
+
+    try:
+        return [identity, certificate_identity(identity, cert)]
+    except ValueError as err:
+        logging.debug(f"with_certificate ignores the certificate of {priv_key_path}: {err}")
+        return [identity]
+
+
+def add_with_certificate(
+    client: AgentClient,
+    priv_key_path: str,
+    identity: bytes,
+    key_blob: bytes,
+    lifetime: Optional[int] = None,
+    confirm: bool = False,
+) -> None:
+    """Add a decrypted private key to the agent, with its paired certificate if it is valid.
+
+    Both identities are added with pipelined requests. A certificate refused by the agent is only
+    logged, the key being usable without it.
+
+    Args:
+        client (AgentClient): The connected agent client.
+        priv_key_path (str): The private key path.
+        identity (bytes): The key type, private fields and comment of the private key.
+        key_blob (bytes): The public key blob of the private key.
+        lifetime (Optional[int]): The maximum lifetime of the identities in the agent, in seconds.
+        confirm (bool): Whether the agent must confirm each use of the identities.
+
+    Raises:
+        AgentError: If the agent request fails or the agent refuses the private key.
+    """
+    accepted = client.add_identities(
+        with_certificate(priv_key_path, identity, key_blob), lifetime, confirm
+    )
+    if not accepted[0]:
+        raise AgentError("The SSH agent refused to add the identity")
+    if not all(accepted):
+        logging.debug(f"add_with_certificate: the certificate of {priv_key_path} was refused")
@@ -1,28 +1,236 @@
+import contextlib
+import functools
 import logging
 import os
 import sys
+import time
+from typing import List, Optional
 
+from ssh_agent_add_id import deadline, profiling
+from ssh_agent_add_id.agent_client import AgentError
+from ssh_agent_add_id.certificates import (
+    Certificate,
+    cache_lifetime,
+    certificate_path,
+    paired_certificate,
+)
 from ssh_agent_add_id.cli_arguments import CliArguments
+from ssh_agent_add_id.constants import (
+    DAEMON_COMMAND,
+    DEADLINE_EXIT_CODE,
+    DOCTOR_COMMAND,
+    EXEC_COMMAND,
+    HOOK_COMMAND,
+    LIST_COMMAND,
+    PROXY_COMMAND,
+)
+from ssh_agent_add_id.daemon import serve
+from ssh_agent_add_id.doctor import run_doctor
 from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.fanout import (
+    ADDED,
+    FAILED,
+    STORED,
+    AgentResult,
+    ensure_identity_on_agents,
+)
+from ssh_agent_add_id.inventory import list_identities
+from ssh_agent_add_id.keys import is_ppk_file, load_public_key
+from ssh_agent_add_id.output import JSONL, JsonlWriter
+from ssh_agent_add_id.passphrase import add_identity_unattended
+from ssh_agent_add_id.proxy import run_proxy
+from ssh_agent_add_id.scan import ensure_scanned_identities, scan_keys
+from ssh_agent_add_id.shell_hook import generate_hook
+from ssh_agent_add_id.shim import run_exec
 from ssh_agent_add_id.signal_handler import SignalHandler
 from ssh_agent_add_id.ssh_agent import SSHAgent
+from ssh_agent_add_id.state import record_identity
+from ssh_agent_add_id.watcher import IdentityWatcher
+from ssh_agent_add_id.workspace import workspace_keys
 
 
 def main() -> None:
     """Command line entry point."""
     args = CliArguments()
+    records = JsonlWriter(sys.stdout) if args.output == JSONL else None
 
+    # The standard output only carries the records of the jsonl output, the messages (e.g. from
+    # ssh-add) going to the standard error
+    with contextlib.redirect_stdout(sys.stderr) if records else contextlib.nullcontext():
+        # The script entry point has already started profiling, before the imports
+        if args.profile_path is not None and not profiling.is_active():
+            with profiling.profile(args.profile_path or None, args.profile_memory):
+                _run(args, records)
+        else:
+            _run(args, records)
+
+
+def _run(args: CliArguments, records: Optional[JsonlWriter] = None) -> None:
+    """Run the command given by the CLI arguments.
+
+    Args:
+        args (CliArguments): The parsed CLI arguments.
+        records (Optional[JsonlWriter]): The writer of the jsonl output, if requested.
+
+    Raises:
+        SystemExit: If the command fails.
+    """
     SignalHandler()
 
     try:
-        agent = SSHAgent()
-        agent.check()
+        if args.deadline:
+            deadline.start(args.deadline)
+
+        if args.command == EXEC_COMMAND:
+            run_exec(args)
+
+        if args.command == PROXY_COMMAND:
+            run_proxy(args.exec_command, args.host)
+
+        if args.command == DAEMON_COMMAND:
+            if not serve(args.idle_timeout):
+                sys.stdout.write(f"The daemon is already running.{os.linesep}")
+            return
+
+        if args.command == DOCTOR_COMMAND:
+            report = run_doctor(os.getenv("SSH_AUTH_SOCK", ""), args.priv_key_paths)
+            sys.stdout.write(f"{report}{os.linesep}")
+            if args.save:
+                report.backend.save()
+                sys.stdout.write(f"Backend saved to {report.backend.path}{os.linesep}")
+            return
+
+        if args.command == HOOK_COMMAND:
+            hook = generate_hook(
+                args.shell, str(args.resolve_priv_key_path()), str(args.resolve_pub_key_path())
+            )
+            sys.stdout.write(hook)
+            return
+
+        if args.command == LIST_COMMAND:
+            SSHAgent().check()
+            identities = list_identities(os.environ["SSH_AUTH_SOCK"], args.key_dirs)
+            if not identities:
+                sys.stdout.write(f"The agent has no identities.{os.linesep}")
+            for identity in identities:
+                sys.stdout.write(f"{identity}{os.linesep}")
+            return
+
+        if args.scan_dirs or args.workspace_dir is not None:
+            SSHAgent().check()
+
+            if args.workspace_dir is not None:
+                keys = workspace_keys(args.workspace_dir)
+                if not keys:
+                    sys.stdout.write(
+                        f"No key needed by the remotes of {args.workspace_dir}{os.linesep}"
+                    )
+                    return
+            else:
+                keys = scan_keys(args.scan_dirs)
+                if not keys:
+                    raise FileNotFoundError("No private key found")
+
+            results = ensure_scanned_identities(
+                os.environ["SSH_AUTH_SOCK"],
+                keys,
+                args.lifetime,
+                args.confirm,
+                args.passphrase_chain,
+                records.write_key_result if records else None,
+            )
+            if not records:
+                for result in results:
+                    sys.stdout.write(f"{result}{os.linesep}")
+            if any(result.status == FAILED for result in results):
+                raise ExitCodeError(1)
+            return
 
         priv_key_path = args.resolve_priv_key_path()
         pub_key_path = args.resolve_pub_key_path()
+        lifetime = None
+
+        # ssh-add cannot read PuTTY keys, so they are checked and added without it
+        if args.agent_socks or is_ppk_file(str(priv_key_path)):
+            agent_socks = args.agent_socks
+            if not agent_socks:
+                SSHAgent().check()
+                agent_socks = [os.environ["SSH_AUTH_SOCK"]]
+
+            results = ensure_identity_on_agents(
+                agent_socks,
+                str(priv_key_path),
+                str(pub_key_path),
+                args.lifetime,
+                args.confirm,
+                args.passphrase_chain,
+                functools.partial(records.write_agent_result, str(priv_key_path))
+                if records
+                else None,
+            )
+            if not records and args.agent_socks:
+                for result in results:
+                    sys.stdout.write(f"{result}{os.linesep}")
+            elif not records:
+                # A PuTTY key is reported like the other keys on the default agent
+                _write_default_agent_result(results[0], str(priv_key_path))
+            if any(result.status == FAILED for result in results):
+                raise ExitCodeError(1)
+
+        else:
+            agent = SSHAgent()
+            agent.check()
+            started_at = time.perf_counter()
+            cert = _paired_certificate(str(priv_key_path), str(pub_key_path))
+
+            try:
+                added = _add_identity_if_missing(
+                    args, agent, str(priv_key_path), str(pub_key_path), cert
+                )
+            except Exception as err:
+                if records:
+                    records.write(
+                        str(priv_key_path),
+                        _fingerprint(str(pub_key_path)),
+                        FAILED,
+                        time.perf_counter() - started_at,
+                        str(err) or type(err).__name__,
+                    )
+                raise
+
+            if records:
+                records.write(
+                    str(priv_key_path),
+                    _fingerprint(str(pub_key_path)),
+                    ADDED if added else STORED,
+                    time.perf_counter() - started_at,
+                )
+            if added:
+                lifetime = args.lifetime
 
-        if not agent.is_identity_stored(str(pub_key_path)):
-            agent.add_identity(str(priv_key_path))
+            # Let the prompt hooks know that this agent has the identity (and until when)
+            try:
+                if cert:
+                    record_identity(
+                        os.getenv("SSH_AUTH_SOCK", ""),
+                        certificate_path(str(priv_key_path)),
+                        cache_lifetime(cert, lifetime),
+                    )
+                else:
+                    record_identity(os.getenv("SSH_AUTH_SOCK", ""), str(pub_key_path), lifetime)
+            except (AgentError, OSError, ValueError) as err:
+                logging.debug(f"record_identity failed: {err}")
+
+        if args.watch:
+            watcher = IdentityWatcher(
+                os.getenv("SSH_AUTH_SOCK", ""),
+                str(priv_key_path),
+                str(pub_key_path),
+                lifetime=args.lifetime,
+                confirm=args.confirm,
+                passphrase_chain=args.passphrase_chain,
+            )
+            watcher.run()
 
     except ExitCodeError as err:
         logging.debug(f"ExitCodeError[{err.exit_code}] cause: {type(err.__context__).__name__}")
@@ -32,6 +240,11 @@ def main() -> None:
 
         sys.exit(err.exit_code)
 
+    # Distinct from the failures, so that callers can tell that the operation took too long
+    except deadline.DeadlineExceededError as err:
+        sys.stderr.write(str(err) + os.linesep)
+        sys.exit(DEADLINE_EXIT_CODE)
+
     except BaseException as err:
         logging.debug(f"BaseException cause: {type(err.__context__).__name__}")
 
@@ -41,6 +254,74 @@ def main() -> None:
 
         sys.exit(1)
 
+    finally:
+        deadline.clear()
+
+
+def _add_identity_if_missing(
+    args: CliArguments,
+    agent: SSHAgent,
+    priv_key_path: str,
+    pub_key_path: str,
+    cert: Optional[Certificate] = None,
+) -> bool:
+    """Add the identity to the agent of SSH_AUTH_SOCK if it is not stored yet.
+
+    A key paired with a valid certificate is stored only if this very certificate is.
+
+    Returns:
+        bool: True if the identity has been added, False if it was already stored.
+    """
+    if agent.is_identity_stored(certificate_path(priv_key_path) if cert else pub_key_path):
+        return False
+
+    # The passphrase providers are tried before prompting
+    passphrases: List[str] = []
+    if args.passphrase_chain:
+        fingerprint = load_public_key(pub_key_path).fingerprint
+        passphrases = args.passphrase_chain.passphrases(priv_key_path, fingerprint)
+
+    if add_identity_unattended(
+        os.getenv("SSH_AUTH_SOCK", ""),
+        priv_key_path,
+        passphrases,
+        args.lifetime,
+        args.confirm,
+    ):
+        sys.stdout.write(f"Identity added: {priv_key_path}{os.linesep}")
+    else:
+        agent.add_identity(priv_key_path, args.lifetime, args.confirm)
+
+    return True
+
+
+def _write_default_agent_result(result: AgentResult, priv_key_path: str) -> None:
+    """Report the outcome on the agent of SSH_AUTH_SOCK with the messages of the ssh-add path."""
+    if result.status == ADDED:
+        sys.stdout.write(f"Identity added: {priv_key_path}{os.linesep}")
+    elif result.status == STORED:
+        sys.stdout.write(f"This identity has already been added to the SSH agent.{os.linesep}")
+    elif result.error:
+        sys.stderr.write(f"{result.error}{os.linesep}")
+
+
+def _paired_certificate(priv_key_path: str, pub_key_path: str) -> Optional[Certificate]:
+    """Get the valid certificate paired with a private key, or None."""
+    try:
+        return paired_certificate(priv_key_path, load_public_key(pub_key_path).blob)
+    except (OSError, ValueError) as err:
+        logging.debug(f"_paired_certificate failed: {err}")
+        return None
+
+
+def _fingerprint(pub_key_path: str) -> str:
+    """Get the fingerprint of a public key for the jsonl output, or an empty string."""
+    try:
+        return load_public_key(pub_key_path).fingerprint
+    except (OSError, ValueError) as err:
+        logging.debug(f"_fingerprint failed: {err}")
+        return ""
+
 
 if __name__ == "__main__":
     main()  # pragma: no cover
@@ -1,11 +1,92 @@
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 import logging
 from pathlib import Path
+import re
 import sys
-from typing import Optional
+from typing import List, Optional
 
 from ssh_agent_add_id import __version__
-from ssh_agent_add_id.constants import APP_DESCRIPTION, APP_NAME
+from ssh_agent_add_id.constants import (
+    APP_DESCRIPTION,
+    APP_NAME,
+    DAEMON_COMMAND,
+    DAEMON_IDLE_TIMEOUT,
+    DEADLINE_EXIT_CODE,
+    DOCTOR_COMMAND,
+    EXEC_COMMAND,
+    HOOK_COMMAND,
+    LIST_COMMAND,
+    PROXY_COMMAND,
+)
+from ssh_agent_add_id.keys import is_ppk_file
+from ssh_agent_add_id.output import JSONL, OUTPUT_FORMATS, TEXT
+from ssh_agent_add_id.passphrase import PassphraseChain, PassphraseProvider, parse_passphrase_source
+from ssh_agent_add_id.profiling import split_profile_args
+from ssh_agent_add_id.shell_hook import SHELLS
+
+
+_TIME_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def _parse_lifetime(value: str) -> int:
+    """Convert a lifetime in the sshd_config(5) time format (e.g. 90, 1h30m) into seconds.
+
+    Raises:
+        ArgumentTypeError: If the value is not a valid positive lifetime.
+    """
+    if not re.fullmatch(r"(\d+[smhdw]?)+", value.lower()):
+        raise ArgumentTypeError(f"invalid lifetime: '{value}'")
+
+    seconds = sum(
+        int(number) * _TIME_UNITS[unit]
+        for number, unit in re.findall(r"(\d+)([smhdw]?)", value.lower())
+    )
+    if seconds <= 0:
+        raise ArgumentTypeError(f"invalid lifetime: '{value}'")
+
+    return seconds
+
+
+def _parse_idle_timeout(value: str) -> int:
+    """Convert an --idle-timeout value in the sshd_config(5) time format into seconds.
+
+    Raises:
+        ArgumentTypeError: If the value is not a valid positive duration.
+    """
+    try:
+        return _parse_lifetime(value)
+    except ArgumentTypeError:
+        raise ArgumentTypeError(f"invalid idle timeout: '{value}'") from None
+
+
+def _parse_deadline(value: str) -> float:
+    """Convert a --deadline value into a positive number of seconds.
+
+    Raises:
+        ArgumentTypeError: If the value is not a valid positive number.
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = 0
+
+    # NaN and infinity are not valid timeouts
+    if not 0 < seconds < float("inf"):
+        raise ArgumentTypeError(f"invalid deadline: '{value}'")
+
+    return seconds
+
+
+def _parse_passphrase_source(value: str) -> PassphraseProvider:
+    """Convert a --passphrase-from value into a passphrase provider.
+
+    Raises:
+        ArgumentTypeError: If the value is not a valid passphrase source.
+    """
+    try:
+        return parse_passphrase_source(value)
+    except ValueError as err:
+        raise ArgumentTypeError(str(err)) from err
 
 
 class CliArguments:
@@ -15,26 +96,337 @@ class CliArguments:
     _priv_key_path: Optional[Path] = None
     _pub_key_path: Optional[Path] = None
 
+    command: Optional[str] = None
+    """The subcommand name, or None for the default behavior (add the identity if needed)."""
+
+    exec_command: List[str]
+    """The command to execute once the identity is ensured (exec subcommand), or through the
+    agent proxy (proxy subcommand)."""
+
+    profile_path: Optional[str] = None
+    """The pstats file path given with --profile (empty for the default path), or None."""
+
+    profile_memory: bool = False
+    """Whether --profile-memory has been given."""
+
     def __init__(self) -> None:
         """Setup an :class:`argparse.ArgumentParser` and parse the given CLI arguments."""
-        parser = ArgumentParser(prog=APP_NAME, description=APP_DESCRIPTION)
+        # --profile=PATH cannot be parsed by argparse without also accepting "--profile PATH"
+        argv, self.profile_path, self.profile_memory = split_profile_args(sys.argv[1:])
+        self.exec_command = []
+
+        if argv[:1] == [EXEC_COMMAND]:
+            self.command = EXEC_COMMAND
+            parser = ArgumentParser(
+                prog=f"{APP_NAME} {EXEC_COMMAND}",
+                usage="%(prog)s [-h] [-t LIFETIME] [-c] [--passphrase-from SOURCE] "
+                + "[--deadline SECONDS] [--verbose] priv_key_path [pub_key_path] -- command ...",
+                description="Ensure that the identity has been added to the SSH agent, then "
+                + "execute the given command, e.g. GIT_SSH_COMMAND='"
+                + f"{APP_NAME} {EXEC_COMMAND} ~/.ssh/id_ed25519 -- ssh'.",
+            )
+            argv = argv[1:]
+
+        elif argv[:1] == [PROXY_COMMAND]:
+            self.command = PROXY_COMMAND
+            parser = ArgumentParser(
+                prog=f"{APP_NAME} {PROXY_COMMAND}",
+                usage="%(prog)s [-h] [--host [USER@]HOST[:PORT]] [--verbose] -- command ...",
+                description="Execute an ssh command through an agent proxy that only exposes the "
+                + "identities relevant to its host, the most recently successful first, so that "
+                + "the first key offered authenticates, e.g. GIT_SSH_COMMAND='"
+                + f"{APP_NAME} {PROXY_COMMAND} -- ssh'. The relevant identities are learned from "
+                + "the previous connections, and read from the IdentityFile options of "
+                + "~/.ssh/config.",
+            )
+            parser.add_argument(
+                "--host",
+                metavar="[USER@]HOST[:PORT]",
+                help="the target to filter the identities for (default: $SSH_AGENT_ADD_ID_HOST, "
+                + "or else the destination of the ssh command)",
+            )
+            argv = argv[1:]
+
+        elif argv[:1] == [DOCTOR_COMMAND]:
+            self.command = DOCTOR_COMMAND
+            parser = ArgumentParser(
+                prog=f"{APP_NAME} {DOCTOR_COMMAND}",
+                description="Measure the environment (startup, ssh-add and agent socket latencies, "
+                + "key derivation cost of the given keys), then save the fastest backend, which "
+                + "the next invocations use automatically.",
+            )
+            parser.add_argument(
+                "priv_key_paths",
+                nargs="*",
+                metavar="priv_key_path",
+                help="a private key file whose key derivation cost is measured",
+            )
+            parser.add_argument(
+                "--no-save",
+                action="store_false",
+                dest="save",
+                help="only print the measurements and the backend choice",
+            )
+            argv = argv[1:]
+
+        elif argv[:1] == [DAEMON_COMMAND]:
+            self.command = DAEMON_COMMAND
+            parser = ArgumentParser(
+                prog=f"{APP_NAME} {DAEMON_COMMAND}",
+                description="Answer the invocations whose identity is not known to be stored by "
+                + "the agent state, keeping the public keys and the agents warm, and add the keys "
+                + "that need no passphrase. The daemon listens on the socket passed by systemd "
+                + f"socket activation, or else on its own socket, which {APP_NAME} starts the "
+                + "daemon on when SSH_AGENT_ADD_ID_DAEMON=1. It exits once idle, saving a "
+                + "snapshot that the next activation starts from.",
+            )
+            parser.add_argument(
+                "--idle-timeout",
+                type=_parse_idle_timeout,
+                default=DAEMON_IDLE_TIMEOUT,
+                metavar="DURATION",
+                help="exit after DURATION without any request, in seconds or in the "
+                + f"sshd_config(5) time format (default: {int(DAEMON_IDLE_TIMEOUT)})",
+            )
+            argv = argv[1:]
+
+        elif argv[:1] == [HOOK_COMMAND]:
+            self.command = HOOK_COMMAND
+            parser = ArgumentParser(
+                prog=f"{APP_NAME} {HOOK_COMMAND}",
+                description="Print a shell prompt hook that ensures that the identity has been "
+                + "added to the SSH agent, e.g. "
+                + f'eval "$({APP_NAME} {HOOK_COMMAND} bash ~/.ssh/id_ed25519)".',
+            )
+            parser.add_argument("shell", choices=SHELLS, help="the shell to generate the hook for")
+            argv = argv[1:]
+
+        elif argv[:1] == [LIST_COMMAND]:
+            self.command = LIST_COMMAND
+            parser = ArgumentParser(
+                prog=f"{APP_NAME} {LIST_COMMAND}",
+                description="List the identities stored by the SSH agent with their type, size, "
+                + "comment and the local private key files they come from, found through an "
+                + "index of the given directories refreshed from the modified files only.",
+            )
+            parser.add_argument(
+                "key_dirs",
+                nargs="*",
+                metavar="DIR",
+                help="a directory of private key files (default: ~/.ssh)",
+            )
+            argv = argv[1:]
+
+        else:
+            parser = ArgumentParser(prog=APP_NAME, description=APP_DESCRIPTION)
+            parser.add_argument(
+                "--watch",
+                action="store_true",
+                help="keep running and add the identity again whenever the agent loses it",
+            )
+            parser.add_argument(
+                "--agent-sock",
+                action="append",
+                default=[],
+                dest="agent_socks",
+                metavar="SOCK",
+                help="an agent socket to add the identity to, instead of SSH_AUTH_SOCK "
+                + "(can be repeated to add it to several agents at once)",
+            )
+            parser.add_argument(
+                "--scan",
+                action="append",
+                nargs="?",
+                const="~/.ssh",
+                dest="scan_dirs",
+                metavar="DIR",
+                help="add all the private keys found under DIR (default: ~/.ssh) instead of "
+                + "priv_key_path (can be repeated)",
+            )
+            parser.add_argument(
+                "--workspace",
+                nargs="?",
+                const=".",
+                dest="workspace_dir",
+                metavar="DIR",
+                help="add only the keys that ssh would use for the SSH remotes of the git "
+                + "repository holding DIR (default: the current directory), as resolved through "
+                + "~/.ssh/config, instead of priv_key_path",
+            )
+            parser.add_argument(
+                "--output",
+                choices=OUTPUT_FORMATS,
+                default=TEXT,
+                help="the output format: jsonl writes one JSON record per key (path, fingerprint, "
+                + "action, latency, error) to the standard output as soon as it is resolved, the "
+                + "other messages going to the standard error",
+            )
+
+        # The command to execute follows the first "--"
+        if self.command in (EXEC_COMMAND, PROXY_COMMAND):
+            if "--" in argv:
+                sep_index = argv.index("--")
+                argv, self.exec_command = argv[:sep_index], argv[sep_index + 1 :]
+            if not self.exec_command:
+                parser.error("the command to execute is missing after '--'")
 
         # fmt: off
-        parser.add_argument("priv_key_path", help="the path of the private key file")
-        parser.add_argument("pub_key_path", nargs="?",
-            help="the path of the public key file in case its filename is not <priv_key_path>.pub")
+        if self.command not in (DAEMON_COMMAND, DOCTOR_COMMAND, LIST_COMMAND, PROXY_COMMAND):
+            parser.add_argument("priv_key_path", nargs="?" if self.command is None else None,
+                help="the path of the private key file")
+            parser.add_argument("pub_key_path", nargs="?", help="the path of the public key file "
+                + "in case its filename is not <priv_key_path>.pub")
+        if self.command not in (
+            DAEMON_COMMAND, DOCTOR_COMMAND, HOOK_COMMAND, LIST_COMMAND, PROXY_COMMAND
+        ):
+            parser.add_argument("-t", "--lifetime", type=_parse_lifetime,
+                help="the maximum lifetime of the identity in the agent, in seconds or in the "
+                + "sshd_config(5) time format (e.g. 1h30m)")
+            parser.add_argument("-c", "--confirm", action="store_true",
+                help="require the agent to confirm each use of the identity")
+            parser.add_argument("--passphrase-from", action="append", default=[],
+                type=_parse_passphrase_source, dest="passphrase_providers", metavar="SOURCE",
+                help="get the passphrase without prompting from env:VAR, fd:N, cmd:COMMAND (called "
+                + "with the key path) or store[:PATH] (a JSON file mapping key fingerprints or "
+                + "paths to passphrases); can be repeated, the prompt being the last resort")
+            parser.add_argument("--deadline", type=_parse_deadline, metavar="SECONDS",
+                help="the maximum wall time of the whole operation (agent I/O, ssh-add, key "
+                + f"derivation and prompts), exiting with code {DEADLINE_EXIT_CODE} when it is "
+                + "exceeded")
         parser.add_argument("--verbose", action="store_true", help="print some extra info")
+        parser.add_argument("--profile", action="store_true",
+            help="write a CPU profile of the run to PATH with --profile=PATH (a temporary file by "
+            + "default) and print a summary with the time spent blocked on the agent, "
+            + "subprocesses and prompts")
+        parser.add_argument("--profile-memory", action="store_true",
+            help="profile the memory allocations too")
         parser.add_argument("--version", action="version", version=f"{parser.prog} {__version__}")
         # fmt: on
 
-        self._args = parser.parse_args()
+        self._args = parser.parse_args(argv)
+        if self.watch and self.agent_socks:
+            parser.error("--watch cannot be used with --agent-sock")
+        if self.watch and self.deadline:
+            parser.error("--watch cannot be used with --deadline")
+        if self.watch and self.output == JSONL:
+            parser.error("--watch cannot be used with --output jsonl")
+        if self.scan_dirs or self.workspace_dir is not None:
+            option = "--scan" if self.scan_dirs else "--workspace"
+            if self.scan_dirs and self.workspace_dir is not None:
+                parser.error("--scan cannot be used with --workspace")
+            if self._args.priv_key_path:
+                parser.error(f"{option} cannot be used with priv_key_path")
+            if self.watch or self.agent_socks:
+                parser.error(f"{option} cannot be used with --watch or --agent-sock")
+        elif (
+            self.command not in (DAEMON_COMMAND, DOCTOR_COMMAND, LIST_COMMAND, PROXY_COMMAND)
+            and not self._args.priv_key_path
+        ):
+            parser.error("the following arguments are required: priv_key_path")
 
+        # The standard output of an executed command must not be polluted (e.g. ssh run by git),
+        # nor the records of the jsonl output
+        log_stream = (
+            sys.stderr
+            if self.command in (EXEC_COMMAND, PROXY_COMMAND) or self.output == JSONL
+            else sys.stdout
+        )
         log_level = logging.DEBUG if self._args.verbose else logging.ERROR
-        logging.basicConfig(format="%(message)s", level=log_level, stream=sys.stdout)
+        logging.basicConfig(format="%(message)s", level=log_level, stream=log_stream)
 
         logging.debug(f"args: {self._args._get_kwargs()}")
         #
 
+    @property
+    def lifetime(self) -> Optional[int]:
+        """Optional[int]: The lifetime constraint of the identity in seconds, if any."""
+        return getattr(self._args, "lifetime", None)
+        #
+
+    @property
+    def confirm(self) -> bool:
+        """bool: Whether the confirm constraint has been given."""
+        return getattr(self._args, "confirm", False)
+        #
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """Optional[float]: The maximum wall time of the operation in seconds, if any."""
+        return getattr(self._args, "deadline", None)
+        #
+
+    @property
+    def passphrase_chain(self) -> PassphraseChain:
+        """PassphraseChain: The passphrase providers given with --passphrase-from."""
+        return PassphraseChain(getattr(self._args, "passphrase_providers", []))
+        #
+
+    @property
+    def agent_socks(self) -> List[str]:
+        """List[str]: The agent sockets given with --agent-sock."""
+        return getattr(self._args, "agent_socks", [])
+        #
+
+    @property
+    def scan_dirs(self) -> List[str]:
+        """List[str]: The directories given with --scan."""
+        return getattr(self._args, "scan_dirs", None) or []
+        #
+
+    @property
+    def workspace_dir(self) -> Optional[str]:
+        """Optional[str]: The directory given with --workspace, if any."""
+        return getattr(self._args, "workspace_dir", None)
+        #
+
+    @property
+    def output(self) -> str:
+        """str: The output format given with --output."""
+        return getattr(self._args, "output", TEXT)
+        #
+
+    @property
+    def watch(self) -> bool:
+        """bool: Whether the --watch flag has been given."""
+        return getattr(self._args, "watch", False)
+        #
+
+    @property
+    def idle_timeout(self) -> float:
+        """float: The idle timeout of the daemon subcommand, in seconds."""
+        return getattr(self._args, "idle_timeout", DAEMON_IDLE_TIMEOUT)
+        #
+
+    @property
+    def host(self) -> Optional[str]:
+        """Optional[str]: The target given with --host to the proxy subcommand, if any."""
+        return getattr(self._args, "host", None)
+        #
+
+    @property
+    def priv_key_paths(self) -> List[str]:
+        """List[str]: The private key paths of the doctor subcommand."""
+        return getattr(self._args, "priv_key_paths", [])
+        #
+
+    @property
+    def key_dirs(self) -> List[str]:
+        """List[str]: The directories of the list subcommand, ~/.ssh by default."""
+        return getattr(self._args, "key_dirs", None) or ["~/.ssh"]
+        #
+
+    @property
+    def save(self) -> bool:
+        """bool: Whether the doctor subcommand saves its backend choice (no --no-save)."""
+        return getattr(self._args, "save", True)
+        #
+
+    @property
+    def shell(self) -> str:
+        """str: The shell argument of the hook subcommand."""
+        return self._args.shell
+        #
+
     def resolve_priv_key_path(self) -> Path:
         """Get the Path object of the private key from the priv_key_path argument.
 
@@ -57,6 +449,8 @@ class CliArguments:
     def resolve_pub_key_path(self) -> Path:
         """Get the Path object of the public key from the priv_key_path or pub_key_path arguments.
 
+        The private key path itself is used for a PuTTY key file without <priv_key_path>.pub.
+
         Raises:
             FileNotFoundError: If the resulting path does not exist.
 
@@ -75,6 +469,10 @@ class CliArguments:
                     priv_key_path = self.resolve_priv_key_path()
                 self._pub_key_path = priv_key_path.with_suffix(".pub")
 
+                # A PuTTY key file also holds the public key
+                if not self._pub_key_path.exists() and is_ppk_file(str(priv_key_path)):
+                    self._pub_key_path = priv_key_path
+
             if not self._pub_key_path.exists():
                 raise FileNotFoundError(f"{self._pub_key_path} not found")
 
@@ -1,6 +1,38 @@
 from typing import Final
 
 
+AGENT_BREAKER_COOLDOWN: Final[float] = 5.0
+AGENT_BREAKER_THRESHOLD: Final[int] = 5
+AGENT_PIPELINE_DEPTH: Final[int] = 16
+AGENT_RETRY_ATTEMPTS: Final[int] = 3
+AGENT_RETRY_BASE_DELAY: Final[float] = 0.05
+AGENT_RETRY_MAX_DELAY: Final[float] = 1.0
 APP_DESCRIPTION: Final[str] = "A wrapper for ssh-add that checks whether a key has already been \
 added to the SSH agent rather than prompting for the passphrase every time."
 APP_NAME: Final[str] = "ssh-agent-add-id"
+CERT_RENEW_MARGIN: Final[float] = 300.0
+DAEMON_COMMAND: Final[str] = "daemon"
+DAEMON_IDLE_TIMEOUT: Final[float] = 900.0
+DAEMON_REQUEST_TIMEOUT: Final[float] = 5.0
+DAEMON_SPAWN_TIMEOUT: Final[float] = 2.0
+DEADLINE_EXIT_CODE: Final[int] = 124
+DOCTOR_COMMAND: Final[str] = "doctor"
+DOCTOR_PROXY_RTT: Final[float] = 0.05
+DOCTOR_RUNS: Final[int] = 5
+DOCTOR_SLOW_AGENT_RTT: Final[float] = 0.005
+EXEC_COMMAND: Final[str] = "exec"
+HISTORY_MAX_LOSSES: Final[int] = 8
+HISTORY_MAX_SIZE: Final[int] = 65536
+HISTORY_MIN_TTL: Final[float] = 5.0
+HISTORY_TTL_FRACTION: Final[float] = 0.25
+HOOK_COMMAND: Final[str] = "hook"
+LIST_COMMAND: Final[str] = "list"
+PASSPHRASE_COMMAND_TIMEOUT: Final[float] = 30.0
+PROFILE_TOP_N: Final[int] = 15
+PROXY_COMMAND: Final[str] = "proxy"
+PROXY_POLL_INTERVAL: Final[float] = 1.0
+STATE_EXPIRY_MARGIN: Final[float] = 5.0
+STATE_SLOW_AGENT_TTL: Final[float] = 300.0
+STATE_TTL: Final[float] = 60.0
+WATCH_MAX_INTERVAL: Final[float] = 60.0
+WATCH_MIN_INTERVAL: Final[float] = 1.0
@@ -0,0 +1,437 @@
+import base64
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.certificates import add_with_certificate, cache_lifetime, paired_certificate
+from ssh_agent_add_id.constants import (
+    DAEMON_IDLE_TIMEOUT,
+    DAEMON_REQUEST_TIMEOUT,
+    DAEMON_SPAWN_TIMEOUT,
+)
+from ssh_agent_add_id.keys import PublicKey, load_public_key, unlock_private_key
+from ssh_agent_add_id.state import AgentState, agent_pid, is_identity_cached, state_dir
+
+
+SPAWN_ENV = "SSH_AGENT_ADD_ID_DAEMON"
+"""Set to 1 to start the daemon on the first connection, when it is not running."""
+
+# The first file descriptor passed by systemd (SD_LISTEN_FDS_START)
+_LISTEN_FDS_START = 3
+_SNAPSHOT_VERSION = 1
+
+
+class DaemonAnswer(NamedTuple):
+    """The answer of the daemon to an ensure request."""
+
+    stored: bool
+    """Whether the agent stores the identity, possibly just added by the daemon."""
+    added: bool = False
+    error: str = ""
+
+
+def daemon_sock_path() -> Path:
+    """Get the path of the daemon socket, in the state directory.
+
+    Raises:
+        PermissionError: If the state directory is owned by another user.
+    """
+    return state_dir() / "daemon.sock"
+
+
+def ask(
+    priv_key_path: str, pub_key_path: str, sock_path: str, spawn: bool = False
+) -> Optional[DaemonAnswer]:
+    """Ask the daemon to ensure that an agent stores an identity.
+
+    The daemon only adds the keys that do not need a passphrase, the other ones are left to the
+    caller. Nothing is asked if the daemon is not running, unless `spawn` is True: it is then
+    started in the background, detached from the caller, and asked once it listens.
+
+    Args:
+        priv_key_path (str): The private key path of the identity.
+        pub_key_path (str): The public key path of the identity.
+        sock_path (str): The agent socket path.
+        spawn (bool): Whether to start the daemon if it is not running.
+
+    Raises:
+        SignalException: If a signal has been received while waiting for the answer.
+
+    Returns:
+        Optional[DaemonAnswer]: The answer, or None if the daemon cannot be reached.
+    """
+    try:
+        path = daemon_sock_path()
+        conn = _connect(path)
+        if not conn and spawn:
+            conn = _spawn(path)
+        if not conn:
+            return None
+
+        with conn:
+            conn.settimeout(DAEMON_REQUEST_TIMEOUT)
+            request = {"priv": priv_key_path, "pub": pub_key_path, "agent": sock_path}
+            conn.sendall(json.dumps(request).encode() + b"\n")
+            data = json.loads(cancellation.read(conn.fileno(), DAEMON_REQUEST_TIMEOUT, b"\n"))
+        return DaemonAnswer(bool(data["stored"]), bool(data.get("added")), data.get("error", ""))
+
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logging.debug(f"daemon.ask failed: {err}")
+        return None
+
+
+def _connect(path: Path) -> Optional[socket.socket]:
+    """Connect to the daemon socket, or return None if no daemon listens on it."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(str(path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    return conn
+
+
+def _spawn(path: Path) -> Optional[socket.socket]:
+    """Start the daemon in its own session, then connect to it once it listens."""
+    logging.debug("daemon.ask starts the daemon")
+
+    # The directory of the package also holds its dependencies in the startup bundle, whose
+    # launcher sets sys.path itself
+    lib_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = os.pathsep.join(filter(None, [lib_dir, os.getenv("PYTHONPATH")]))
+    subprocess.Popen(
+        [sys.executable, "-m", "ssh_agent_add_id", "daemon"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        # Not a key file that the fast path would try to read
+        cwd=path.parent,
+        env=dict(os.environ, PYTHONPATH=python_path),
+        start_new_session=True,
+    )
+
+    expires_at = time.monotonic() + DAEMON_SPAWN_TIMEOUT
+    while time.monotonic() < expires_at:
+        conn = _connect(path)
+        if conn:
+            return conn
+        cancellation.sleep(0.01)
+
+    logging.debug("daemon.ask gave up waiting for the daemon")
+    return None
+
+
+def listen_fds() -> List[socket.socket]:
+    """Get the listening sockets passed by systemd socket activation, if any.
+
+    The LISTEN_PID and LISTEN_FDS variables (see sd_listen_fds(3)) are only honored if they are
+    meant for the current process, and are removed so that the child processes ignore them.
+
+    Returns:
+        List[socket.socket]: The passed sockets, none if the process has not been socket activated.
+    """
+    try:
+        if int(os.getenv("LISTEN_PID", "0")) != os.getpid():
+            return []
+        count = int(os.getenv("LISTEN_FDS", "0"))
+    except ValueError:
+        return []
+    finally:
+        for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+            os.environ.pop(name, None)
+
+    socks = []
+    for fd in range(_LISTEN_FDS_START, _LISTEN_FDS_START + count):
+        os.set_inheritable(fd, False)
+        socks.append(socket.socket(fileno=fd))
+    return socks
+
+
+def serve(idle_timeout: float = DAEMON_IDLE_TIMEOUT) -> bool:
+    """Run the daemon until it has been idle for `idle_timeout` seconds or a signal is received.
+
+    The listening sockets are those passed by systemd socket activation, or else the daemon
+    socket bound by the daemon itself, which is then removed on exit. A lock on the state directory
+    keeps a single self-started daemon, when several clients start one at once.
+
+    Args:
+        idle_timeout (float): The seconds without any request after which the daemon exits.
+
+    Raises:
+        OSError: If the daemon socket cannot be bound.
+
+    Returns:
+        bool: False if another daemon is already running.
+    """
+    listeners = listen_fds()
+    if listeners:
+        Daemon(listeners, idle_timeout).run()
+        return True
+
+    path = daemon_sock_path()
+    lock_fd = os.open(path.with_name("daemon.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.debug("serve: another daemon is running")
+            return False
+
+        # Left by a daemon that has not exited cleanly
+        path.unlink(missing_ok=True)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(str(path))
+            os.chmod(path, 0o600)
+            listener.listen()
+            Daemon([listener], idle_timeout).run()
+        finally:
+            listener.close()
+            path.unlink(missing_ok=True)
+
+    finally:
+        os.close(lock_fd)
+
+    return True
+
+
+class Daemon:
+    """Answer the ensure requests of the clients, keeping the public keys and agents warm.
+
+    A request is a JSON line with the private and public key paths of an identity and the agent
+    socket path, answered by a JSON line. The identity is checked like the CLI does (agent state,
+    then the agent itself, over a connection kept open), and added if its key does not need a
+    passphrase. The parsed public keys and the agents are saved into a snapshot on exit, so that
+    the next activation starts with the public keys parsed and the agent states refreshed.
+    """
+
+    def __init__(
+        self,
+        listeners: List[socket.socket],
+        idle_timeout: float = DAEMON_IDLE_TIMEOUT,
+        snapshot_path: Optional[Path] = None,
+    ) -> None:
+        """Set the sockets to answer on.
+
+        Args:
+            listeners (List[socket.socket]): The listening sockets.
+            idle_timeout (float): The seconds without any request after which the daemon exits.
+            snapshot_path (Optional[Path]): The snapshot path, in the state directory by default.
+        """
+        self.listeners = listeners
+        self.idle_timeout = idle_timeout
+        self.snapshot_path = snapshot_path or state_dir() / "daemon.json"
+
+        # The parsed public keys by path, with the modification time and size of their file
+        self._public_keys: Dict[str, Tuple[int, int, PublicKey]] = {}
+        self._clients: Dict[str, AgentClient] = {}
+        self._sock_ids: Dict[str, str] = {}
+        #
+
+    def run(self) -> None:
+        """Answer the requests until the daemon is idle or a signal is received."""
+        # errors requires pydantic, which the fast paths avoid importing
+        from ssh_agent_add_id.errors import SignalException
+
+        self.load_snapshot()
+        for listener in self.listeners:
+            listener.setblocking(False)
+        by_fd = {listener.fileno(): listener for listener in self.listeners}
+
+        try:
+            while True:
+                readable = cancellation.wait(list(by_fd), self.idle_timeout)
+                if not readable:
+                    logging.debug(f"Daemon idle for {self.idle_timeout}s, exiting")
+                    return
+                for fd in readable:
+                    self.accept(by_fd[fd])
+
+        except SignalException as err:
+            logging.debug(f"Daemon stopped: {err}")
+
+        finally:
+            self.save_snapshot()
+            for client in self._clients.values():
+                client.close()
+                #
+
+    def accept(self, listener: socket.socket) -> None:
+        """Answer the request of a pending connection."""
+        try:
+            conn, _ = listener.accept()
+        except BlockingIOError:
+            return
+
+        with conn:
+            conn.settimeout(DAEMON_REQUEST_TIMEOUT)
+            try:
+                request = json.loads(
+                    cancellation.read(conn.fileno(), DAEMON_REQUEST_TIMEOUT, b"\n")
+                )
+                answer = self.ensure(request["priv"], request["pub"], request["agent"])
+            except (ValueError, KeyError, TypeError) as err:
+                answer = DaemonAnswer(False, error=f"Invalid request: {err}")
+            except OSError as err:
+                logging.debug(f"Daemon.accept failed: {err}")
+                return
+
+            try:
+                conn.sendall(json.dumps(answer._asdict()).encode() + b"\n")
+            except OSError as err:
+                logging.debug(f"Daemon.accept cannot answer: {err}")
+                #
+
+    def ensure(self, priv_key_path: str, pub_key_path: str, sock_path: str) -> DaemonAnswer:
+        """Ensure that an agent stores an identity, adding it if its key needs no passphrase.
+
+        Args:
+            priv_key_path (str): The private key path of the identity.
+            pub_key_path (str): The public key path of the identity.
+            sock_path (str): The agent socket path.
+
+        Returns:
+            DaemonAnswer: Whether the agent stores the identity.
+        """
+        try:
+            public_key = self.public_key(pub_key_path)
+            cert = paired_certificate(priv_key_path, public_key.blob)
+            fingerprint = cert.fingerprint if cert else public_key.fingerprint
+            if is_identity_cached(sock_path, fingerprint):
+                return DaemonAnswer(True)
+
+            state = self.refresh(sock_path)
+            if fingerprint in state.fingerprints:
+                if cert:
+                    state.add(fingerprint, cache_lifetime(cert))
+                return DaemonAnswer(True)
+
+            try:
+                private_key = unlock_private_key(priv_key_path, prompt=False)
+            except ValueError:
+                private_key = None
+            if not private_key:
+                return DaemonAnswer(False)
+
+            add_with_certificate(
+                self._clients[sock_path],
+                priv_key_path,
+                private_key.identity,
+                private_key.public_key.blob,
+            )
+            state.add(fingerprint, cache_lifetime(cert) if cert else None)
+            return DaemonAnswer(True, added=True)
+
+        except (AgentError, OSError, ValueError) as err:
+            self._forget(sock_path)
+            return DaemonAnswer(False, error=str(err))
+            #
+
+    def public_key(self, pub_key_path: str) -> PublicKey:
+        """Get a public key, parsed again only if its file has changed.
+
+        Raises:
+            OSError: If the public key cannot be read.
+            ValueError: If the public key is not valid.
+        """
+        st = os.stat(pub_key_path)
+        cached = self._public_keys.get(pub_key_path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+
+        public_key = load_public_key(pub_key_path)
+        self._public_keys[pub_key_path] = (st.st_mtime_ns, st.st_size, public_key)
+        return public_key
+        #
+
+    def refresh(self, sock_path: str, force: bool = True) -> AgentState:
+        """Get the state of an agent, with its identities listed again.
+
+        With `force` False, a fresh state is returned as is. The connection to the agent is kept
+        open, and opened again if its socket has been replaced.
+
+        Raises:
+            AgentError: If the agent cannot be queried.
+            OSError: If the agent socket does not exist.
+        """
+        state = AgentState.load(sock_path)
+        if self._sock_ids.get(sock_path) != state.sock_id:
+            self._forget(sock_path)
+            self._sock_ids[sock_path] = state.sock_id
+        if not force and state.is_fresh():
+            return state
+
+        client = self._clients.get(sock_path)
+        if not client:
+            client = self._clients[sock_path] = AgentClient(sock_path, DAEMON_REQUEST_TIMEOUT)
+        identities = client.list_identities()
+        state.update((identity.fingerprint for identity in identities), agent_pid(client))
+        return state
+        #
+
+    def _forget(self, sock_path: str) -> None:
+        """Close the connection to an agent and forget it."""
+        client = self._clients.pop(sock_path, None)
+        if client:
+            client.close()
+        self._sock_ids.pop(sock_path, None)
+        #
+
+    def load_snapshot(self) -> None:
+        """Parse the public keys and refresh the agent states of the previous activation."""
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data["version"] != _SNAPSHOT_VERSION:
+                return
+            public_keys = {
+                path: (int(mtime_ns), int(size), PublicKey.from_blob(base64.b64decode(blob)))
+                for path, (mtime_ns, size, blob) in data["public_keys"].items()
+            }
+            agents = [str(sock_path) for sock_path in data["agents"]]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logging.debug(f"Daemon.load_snapshot ignored invalid snapshot: {err}")
+            return
+
+        self._public_keys.update(public_keys)
+        for sock_path in agents:
+            try:
+                self.refresh(sock_path, force=False)
+            except (AgentError, OSError) as err:
+                logging.debug(f"Daemon.load_snapshot skips the agent {sock_path}: {err}")
+                #
+
+    def save_snapshot(self) -> None:
+        """Atomically write the parsed public keys and the agents into the snapshot.
+
+        The identities of the agents are not duplicated: they are in the agent state files.
+        """
+        data = {
+            "version": _SNAPSHOT_VERSION,
+            "public_keys": {
+                path: [mtime_ns, size, base64.b64encode(public_key.blob).decode()]
+                for path, (mtime_ns, size, public_key) in self._public_keys.items()
+            },
+            "agents": sorted(self._sock_ids),
+        }
+
+        path = self.snapshot_path
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            logging.debug(f"Daemon.save_snapshot failed: {err}")
@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+import signal
+import threading
+import time
+from types import FrameType
+from typing import Any, Iterator, Optional
+
+
+class DeadlineExceededError(Exception):
+    """Raised when the deadline of the operations has passed."""
+
+
+class Deadline:
+    """A point in time after which no blocking operation may go on."""
+
+    def __init__(self, seconds: float) -> None:
+        """Set the deadline.
+
+        Args:
+            seconds (float): The total wall time allowed from now, in seconds.
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        #
+
+    def remaining(self) -> float:
+        """Get the time left before the deadline.
+
+        Raises:
+            DeadlineExceededError: If the deadline has passed.
+
+        Returns:
+            float: The time left, in seconds.
+        """
+        remaining = self.expires_at - time.monotonic()
+        if remaining <= 0:
+            raise self.error()
+        return remaining
+        #
+
+    def error(self) -> DeadlineExceededError:
+        """Get the error to raise when a bounded operation has run out of time."""
+        return DeadlineExceededError(f"Deadline of {self.seconds:g}s exceeded")
+
+
+_deadline: Optional[Deadline] = None
+_previous_handler: Any = None
+
+# Timers may fire slightly before the requested time
+_TIMEOUT_TOLERANCE = 0.01
+
+
+def start(seconds: float) -> Deadline:
+    """Bound all the following blocking operations by a single deadline.
+
+    The waits watching the cancellation token (agent socket, subprocesses, worker threads) are
+    bounded by the remaining time, and the in-process key derivation checks it between rounds. From
+    the main thread, a timer also interrupts the :func:`cancellation.interruptible` code at once
+    (e.g. passphrase prompts).
+
+    Args:
+        seconds (float): The total wall time allowed from now, in seconds.
+
+    Returns:
+        Deadline: The started deadline.
+    """
+    global _deadline, _previous_handler
+
+    clear()
+    _deadline = Deadline(seconds)
+
+    if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+        _previous_handler = signal.signal(signal.SIGALRM, _alarm_handler)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    return _deadline
+
+
+def clear() -> None:
+    """Remove the deadline, e.g. before the process is replaced (timers survive exec)."""
+    global _deadline, _previous_handler
+
+    if _deadline and _previous_handler is not None:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, _previous_handler)
+        _previous_handler = None
+
+    _deadline = None
+
+
+@contextmanager
+def bounded(seconds: Optional[float]) -> Iterator[None]:
+    """Bound the enclosed operations by a deadline, if `seconds` is not None."""
+    if seconds is None:
+        yield
+        return
+
+    start(seconds)
+    try:
+        yield
+    finally:
+        clear()
+
+
+def remaining(timeout: Optional[float] = None) -> Optional[float]:
+    """Bound a timeout by the time left before the deadline, if any.
+
+    Args:
+        timeout (Optional[float]): The timeout of the operation, or None if it has none.
+
+    Raises:
+        DeadlineExceededError: If the deadline has passed.
+
+    Returns:
+        Optional[float]: The smallest of the timeout and the time left.
+    """
+    if not _deadline:
+        return timeout
+
+    left = _deadline.remaining()
+    return left if timeout is None else min(timeout, left)
+
+
+def check() -> None:
+    """Raise a DeadlineExceededError if the deadline has passed."""
+    remaining()
+
+
+def timed_out() -> None:
+    """Raise a DeadlineExceededError if an operation timed out because of the deadline.
+
+    Only the timeouts shortened by the deadline are turned into a DeadlineExceededError, so this
+    does nothing if the deadline is still some time away.
+    """
+    if _deadline and _deadline.expires_at - time.monotonic() <= _TIMEOUT_TOLERANCE:
+        raise _deadline.error()
+
+
+def _alarm_handler(signum: int, frame: Optional[FrameType]) -> None:
+    """The SIGALRM handler throws a DeadlineExceededError within interruptible code only.
+
+    The other code runs on until its next wait or check of the deadline, so that it is never
+    interrupted halfway, e.g. while writing a state file or cleaning up.
+    """
+    # Already imported by then, which makes this import safe in a signal handler
+    from ssh_agent_add_id import cancellation
+
+    token = cancellation._token
+    if token and token.interruptible:
+        raise _deadline.error() if _deadline else DeadlineExceededError("Deadline exceeded")
@@ -0,0 +1,289 @@
+from dataclasses import dataclass
+import fnmatch
+import logging
+import os
+import shutil
+import statistics
+from subprocess import DEVNULL, PIPE, TimeoutExpired
+import sys
+import time
+from typing import List, Optional, Tuple
+
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.aes import BLOCK_SIZE
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.backend import NATIVE, SUBPROCESS, Backend
+from ssh_agent_add_id.constants import (
+    DOCTOR_PROXY_RTT,
+    DOCTOR_RUNS,
+    DOCTOR_SLOW_AGENT_RTT,
+    STATE_SLOW_AGENT_TTL,
+    STATE_TTL,
+)
+from ssh_agent_add_id.keys import OPENSSH_CIPHERS, can_decrypt_openssh, load_private_key
+from ssh_agent_add_id.ppk import BadPassphraseError
+
+
+# A subprocess measurement that takes longer is reported as failed
+_COMMAND_TIMEOUT = 10.0
+# The sockets forwarded by sshd (ssh -A)
+_FORWARDED_SOCK_PATTERN = "*/ssh-*/agent.*"
+
+
+@dataclass
+class Measurement:
+    """A measured cost, or why it could not be measured."""
+
+    name: str
+    seconds: Optional[float] = None
+    detail: str = ""
+
+    def __str__(self) -> str:  # noqa: D105
+        if self.seconds is None:
+            return f"{self.name}: {self.detail or 'n/a'}"
+        return f"{self.name}: {self.seconds * 1000:.1f} ms" + (
+            f" ({self.detail})" if self.detail else ""
+        )
+
+
+@dataclass
+class DoctorReport:
+    """The measurements of the environment and the backend chosen from them."""
+
+    measurements: List[Measurement]
+    backend: Backend
+    reasons: List[str]
+
+    def __str__(self) -> str:  # noqa: D105
+        lines = [str(measurement) for measurement in self.measurements]
+        lines += [
+            f"backend: {self.backend.agent_io} agent I/O, state TTL {self.backend.state_ttl:g}s, "
+            + f"ssh-add -T {'supported' if self.backend.ssh_add_test else 'not supported'}",
+            f"proxy: {'recommended' if self.backend.proxy else 'not needed'}",
+        ]
+        lines += [f"  {reason}" for reason in self.reasons]
+        return os.linesep.join(lines)
+
+
+def run_doctor(sock_path: str, priv_key_paths: List[str]) -> DoctorReport:
+    """Measure the environment and choose the fastest backend for it.
+
+    Args:
+        sock_path (str): The agent socket, usually the SSH_AUTH_SOCK value (may be empty).
+        priv_key_paths (List[str]): The private keys whose key derivation cost is measured.
+
+    Raises:
+        SignalException: If a signal has been received.
+
+    Returns:
+        DoctorReport: The measurements and the chosen backend, which is not saved.
+    """
+    import_time = measure_import_time()
+    ssh_add, ssh_version, ssh_add_test = measure_ssh_add()
+    connect, list_rtt = measure_agent(sock_path)
+    kdfs = [measure_kdf(path) for path in priv_key_paths]
+
+    backend, reasons = choose_backend(sock_path, ssh_add, connect, list_rtt, ssh_add_test)
+    measurements = [import_time, ssh_version, ssh_add, connect, list_rtt, *kdfs]
+    return DoctorReport(measurements, backend, reasons)
+
+
+def choose_backend(
+    sock_path: str,
+    ssh_add: Measurement,
+    connect: Measurement,
+    list_rtt: Measurement,
+    ssh_add_test: bool,
+) -> Tuple[Backend, List[str]]:
+    """Choose the backend from the measurements.
+
+    Args:
+        sock_path (str): The agent socket.
+        ssh_add (Measurement): The spawn and round trip cost of ssh-add.
+        connect (Measurement): The agent socket connection latency.
+        list_rtt (Measurement): The identities listing round trip through the agent socket.
+        ssh_add_test (bool): Whether ssh-add supports -T.
+
+    Returns:
+        Tuple[Backend, List[str]]: The backend and the reasons of the choice.
+    """
+    backend = Backend(ssh_add_test=ssh_add_test, sock_path=sock_path)
+    reasons = []
+
+    if connect.seconds is None or list_rtt.seconds is None:
+        backend.agent_io = SUBPROCESS
+        reasons.append("the agent socket cannot be used directly, ssh-add is used")
+        return backend, reasons
+
+    native = connect.seconds + list_rtt.seconds
+    if ssh_add.seconds is not None and ssh_add.seconds <= native:
+        backend.agent_io = SUBPROCESS
+        reasons.append("ssh-add is not slower than the agent socket")
+    else:
+        backend.agent_io = NATIVE
+        reasons.append("the agent socket is faster than spawning ssh-add")
+
+    # The cached state saves a round trip, which is worth keeping longer on a slow agent
+    if list_rtt.seconds >= DOCTOR_SLOW_AGENT_RTT:
+        backend.state_ttl = STATE_SLOW_AGENT_TTL
+        reasons.append("slow agent round trips, the agent state is trusted longer")
+    else:
+        backend.state_ttl = STATE_TTL
+
+    forwarded = bool(os.getenv("SSH_CONNECTION")) and fnmatch.fnmatch(
+        sock_path, _FORWARDED_SOCK_PATTERN
+    )
+    if forwarded or list_rtt.seconds >= DOCTOR_PROXY_RTT:
+        backend.proxy = True
+        reasons.append(
+            "the agent is forwarded" if forwarded else "the agent round trips are very slow"
+        )
+
+    return backend, reasons
+
+
+def measure_import_time() -> Measurement:
+    """Measure the startup cost of the package, in a fresh interpreter."""
+    # The smallest timings, since the noise only adds time
+    base = _timings([sys.executable, "-c", "pass"])
+    full = _timings([sys.executable, "-c", "import ssh_agent_add_id.cli"])
+    if base is None or full is None:
+        return Measurement("import time", None, "the interpreter cannot be run")
+    return Measurement("import time", max(min(full) - min(base), 0.0))
+
+
+def measure_ssh_add() -> Tuple[Measurement, Measurement, bool]:
+    """Measure the cost of an ssh-add round trip to the agent, and get the OpenSSH version.
+
+    Returns:
+        Tuple[Measurement, Measurement, bool]: The ssh-add cost, the OpenSSH version (as detail)
+            and whether ssh-add supports -T.
+    """
+    if not shutil.which("ssh-add"):
+        return (
+            Measurement("ssh-add round trip", None, "ssh-add not found"),
+            Measurement("OpenSSH version", None, "unknown"),
+            False,
+        )
+
+    timings = _timings(["ssh-add", "-l"])
+    ssh_add = Measurement("ssh-add round trip", statistics.median(timings) if timings else None)
+
+    output = "".join(_capture(["ssh", "-V"]) or ()).strip()
+    version = output.splitlines()[0] if output else "unknown"
+
+    # Older versions reject the option itself, whereas newer ones fail to load /dev/null
+    completed = _capture(["ssh-add", "-T", os.devnull])
+    usage = completed[1].lower() if completed else ""
+    test_supported = bool(completed) and not any(
+        word in usage for word in ("illegal option", "unknown option", "invalid option", "usage:")
+    )
+
+    return ssh_add, Measurement("OpenSSH version", None, version), test_supported
+
+
+def measure_agent(sock_path: str) -> Tuple[Measurement, Measurement]:
+    """Measure the agent socket connection latency and identities listing round trip.
+
+    Returns:
+        Tuple[Measurement, Measurement]: The connection and listing measurements, without value if
+            the socket cannot be used.
+    """
+    connects: List[float] = []
+    lists: List[float] = []
+    count = 0
+
+    try:
+        for _ in range(DOCTOR_RUNS):
+            client = AgentClient(sock_path, _COMMAND_TIMEOUT)
+            started_at = time.perf_counter()
+            client.connect()
+            connected_at = time.perf_counter()
+            try:
+                count = len(client.list_identities())
+            finally:
+                client.close()
+            connects.append(connected_at - started_at)
+            lists.append(time.perf_counter() - connected_at)
+
+    except AgentError as err:
+        logging.debug(f"measure_agent error: {err}")
+        return (
+            Measurement("agent connect", None, str(err) if sock_path else "SSH_AUTH_SOCK not set"),
+            Measurement("agent list round trip", None),
+        )
+
+    return (
+        Measurement("agent connect", statistics.median(connects)),
+        Measurement("agent list round trip", statistics.median(lists), f"identities: {count}"),
+    )
+
+
+def measure_kdf(priv_key_path: str) -> Measurement:
+    """Measure the key derivation cost of a private key, with a wrong passphrase.
+
+    The cost does not depend on the passphrase. The OpenSSH keys are only measured when the bcrypt
+    extension derives them in-process, otherwise their bcrypt rounds are reported.
+    """
+    from ssh_agent_add_id.bcrypt_pbkdf import bcrypt_pbkdf, has_native_engine
+
+    name = f"KDF {priv_key_path}"
+    try:
+        private_key = load_private_key(os.path.expanduser(priv_key_path))
+    except (OSError, ValueError) as err:
+        return Measurement(name, None, str(err))
+
+    if not private_key.encrypted:
+        return Measurement(name, 0.0, "not encrypted")
+    if not private_key.ppk:
+        rounds = f"bcrypt, {private_key.kdf_rounds} rounds" if private_key.kdf_rounds else "unknown"
+        if not can_decrypt_openssh(private_key):
+            return Measurement(name, None, f"{rounds}, derived by ssh-add")
+        if not has_native_engine():
+            return Measurement(name, None, f"{rounds}, derived in-process")
+
+    cancellation.check()
+    started_at = time.perf_counter()
+    try:
+        if private_key.ppk:
+            private_key.ppk.decrypt("\0")
+        else:
+            key_size = OPENSSH_CIPHERS[private_key.cipher][0] + BLOCK_SIZE
+            bcrypt_pbkdf(b"\0", private_key.kdf_salt, private_key.kdf_rounds, key_size)
+    except BadPassphraseError:
+        pass
+    except ValueError as err:
+        return Measurement(name, None, str(err))
+
+    seconds = time.perf_counter() - started_at
+    if private_key.ppk:
+        return Measurement(name, seconds, f"PuTTY {private_key.ppk.version}")
+    return Measurement(name, seconds, f"{rounds}, derived in-process")
+
+
+def _timings(cmd: List[str]) -> Optional[List[float]]:
+    """Run a command several times and get its wall times, or None if it cannot be run."""
+    timings = []
+    for _ in range(DOCTOR_RUNS):
+        started_at = time.perf_counter()
+        try:
+            cancellation.run(
+                cmd, timeout=_COMMAND_TIMEOUT, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL
+            )
+        except (OSError, TimeoutExpired) as err:
+            logging.debug(f"doctor cannot run {cmd}: {err}")
+            return None
+        timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+def _capture(cmd: List[str]) -> Optional[Tuple[str, str]]:
+    """Run a command and get its outputs, or None if it cannot be run."""
+    try:
+        completed = cancellation.run(
+            cmd, timeout=_COMMAND_TIMEOUT, stdin=DEVNULL, stdout=PIPE, stderr=PIPE
+        )
+    except (OSError, TimeoutExpired) as err:
+        logging.debug(f"doctor cannot run {cmd}: {err}")
+        return None
+    return completed.stdout.decode(errors="replace"), completed.stderr.decode(errors="replace")
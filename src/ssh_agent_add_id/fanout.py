@@ -0,0 +1,242 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import getpass
+import logging
+import os
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from ssh_agent_add_id import cancellation, profiling
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.certificates import add_with_certificate
+from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.keys import (
+    PASSPHRASE_ATTEMPTS,
+    load_private_key,
+    load_public_key,
+    unlock_private_key,
+)
+from ssh_agent_add_id.passphrase import PassphraseChain
+from ssh_agent_add_id.ssh_agent import SSHAgent
+from ssh_agent_add_id.state import AgentState, agent_pid, is_identity_cached
+
+
+ADDED = "added"
+FAILED = "failed"
+STORED = "stored"
+
+
+@dataclass
+class AgentResult:
+    """The outcome of ensuring that an identity is stored by one agent."""
+
+    sock_path: str
+    status: str
+    """One of :data:`STORED`, :data:`ADDED` or :data:`FAILED`."""
+    error: str = ""
+    fingerprint: str = field(default="", compare=False)
+    latency: float = field(default=0.0, compare=False)
+    """The seconds elapsed since the start of the operation until the agent was resolved."""
+
+    def __str__(self) -> str:  # noqa: D105
+        return f"{self.sock_path}: {self.status}" + (f" ({self.error})" if self.error else "")
+
+
+def ensure_identity_on_agents(
+    sock_paths: List[str],
+    priv_key_path: str,
+    pub_key_path: str,
+    lifetime: Optional[int] = None,
+    confirm: bool = False,
+    passphrase_chain: Optional[PassphraseChain] = None,
+    on_result: Optional[Callable[[AgentResult], None]] = None,
+) -> List[AgentResult]:
+    """Ensure that an identity is stored by several agents at once.
+
+    The agents are queried in parallel. A key that can be decrypted in-process (an unencrypted
+    OpenSSH key or a PuTTY key) is then added by the tool itself to all the agents missing it, in
+    parallel. Otherwise, the passphrase is prompted only once, checked by adding the identity to
+    a first agent, then ssh-add is run for all the other agents in parallel. The passphrases of the
+    providers are tried before prompting.
+
+    Each result is passed to `on_result` as soon as its agent is resolved, possibly from another
+    thread.
+
+    Args:
+        sock_paths (List[str]): The agent socket paths.
+        priv_key_path (str): The private key path of the identity.
+        pub_key_path (str): The public key path of the identity.
+        lifetime (Optional[int]): The lifetime constraint of the identity, in seconds.
+        confirm (bool): Whether to add the identity with the confirm constraint.
+        passphrase_chain (Optional[PassphraseChain]): The passphrase providers to try before
+            prompting.
+        on_result (Optional[Callable[[AgentResult], None]]): Called with each result as soon as
+            it is known.
+
+    Raises:
+        ExitCodeError: If a signal has been received.
+        OSError: If the public key cannot be read.
+        ValueError: If the public key is not valid.
+
+    Returns:
+        List[AgentResult]: The result for each agent, in the order of `sock_paths`.
+    """
+    started_at = time.perf_counter()
+    fingerprint = load_public_key(pub_key_path).fingerprint
+    results: Dict[str, AgentResult] = {}
+
+    def resolve(result: AgentResult) -> None:
+        result.fingerprint = fingerprint
+        result.latency = time.perf_counter() - started_at
+        results[result.sock_path] = result
+        # An empty status is a missing identity, not resolved yet
+        if result.status and on_result:
+            on_result(result)
+
+    with ThreadPoolExecutor(max_workers=len(sock_paths) or 1) as pool:
+        cancellation.pool_map(
+            pool, lambda path: resolve(_check_agent(path, fingerprint)), sock_paths
+        )
+        missing = [path for path in sock_paths if not results[path].status]
+        if not missing:
+            return [results[path] for path in sock_paths]
+
+        passphrases: List[str] = []
+        if passphrase_chain:
+            passphrases = passphrase_chain.passphrases(priv_key_path, fingerprint)
+
+        try:
+            private_key = unlock_private_key(priv_key_path, passphrases)
+        except ValueError as err:
+            for path in missing:
+                resolve(AgentResult(path, FAILED, str(err)))
+            return [results[path] for path in sock_paths]
+
+        # Decrypted in-process: no need for ssh-add
+        if private_key:
+            identity, key_blob = private_key.identity, private_key.public_key.blob
+
+            def add(path: str) -> AgentResult:
+                with AgentClient(path) as client:
+                    add_with_certificate(
+                        client, priv_key_path, identity, key_blob, lifetime, confirm
+                    )
+                return _added(path, fingerprint, lifetime)
+
+            cancellation.pool_map(pool, lambda path: resolve(_try_add(path, add, True)), missing)
+
+            return [results[path] for path in sock_paths]
+
+        agent = SSHAgent()
+        encrypted = _is_encrypted(priv_key_path)
+        passphrase = ""
+
+        def add_with_ssh_add(path: str) -> AgentResult:
+            agent.add_identity(priv_key_path, lifetime, confirm, passphrase, path)
+            return _added(path, fingerprint, lifetime)
+
+        # Check the passphrase by adding the identity to a first agent: the passphrases of the
+        # providers first, then prompting again if needed
+        if encrypted:
+            error = ""
+            candidates: List[Optional[str]] = [*passphrases, *[None] * PASSPHRASE_ATTEMPTS]
+            for candidate in candidates:
+                if candidate is None:
+                    with profiling.blocked(profiling.PROMPT), cancellation.interruptible():
+                        passphrase = getpass.getpass(f"Enter passphrase for {priv_key_path}: ")
+                else:
+                    passphrase = candidate
+                try:
+                    resolve(_try_add(missing[0], add_with_ssh_add))
+                    missing = missing[1:]
+                    break
+                except ValueError as err:
+                    error = str(err)
+                    if candidate is None:
+                        sys.stderr.write(error + os.linesep)
+            else:
+                for path in missing:
+                    resolve(AgentResult(path, FAILED, error))
+                missing = []
+
+        cancellation.pool_map(
+            pool, lambda path: resolve(_try_add(path, add_with_ssh_add, True)), missing
+        )
+
+    return [results[path] for path in sock_paths]
+
+
+def _check_agent(sock_path: str, fingerprint: str) -> AgentResult:
+    """Check if an agent stores an identity, with its state file or by querying it.
+
+    Returns:
+        AgentResult: The STORED or FAILED result, or a result with an empty status if the
+            identity is missing.
+    """
+    if is_identity_cached(sock_path, fingerprint):
+        return AgentResult(sock_path, STORED)
+
+    try:
+        state = AgentState.load(sock_path)
+        if state.has_identity(fingerprint):
+            return AgentResult(sock_path, STORED)
+
+        with AgentClient(sock_path) as client:
+            identities = client.list_identities()
+            state.update((identity.fingerprint for identity in identities), agent_pid(client))
+
+    except (AgentError, OSError) as err:
+        return AgentResult(sock_path, FAILED, str(err))
+
+    return AgentResult(sock_path, STORED if fingerprint in state.fingerprints else "")
+
+
+def _added(sock_path: str, fingerprint: str, lifetime: Optional[int]) -> AgentResult:
+    """Record an identity that has just been added into the agent state."""
+    try:
+        AgentState.load(sock_path).add(fingerprint, lifetime)
+    except OSError as err:
+        logging.debug(f"ensure_identity_on_agents cannot record the identity: {err}")
+
+    return AgentResult(sock_path, ADDED)
+
+
+def _try_add(
+    sock_path: str, add: Callable[[str], AgentResult], catch_value_error: bool = False
+) -> AgentResult:
+    """Add an identity to an agent, turning its failure into a FAILED result.
+
+    Raises:
+        ExitCodeError: If a signal has been received.
+        ValueError: If the passphrase is rejected and `catch_value_error` is False.
+    """
+    try:
+        return add(sock_path)
+
+    except ExitCodeError as err:
+        if err.exit_code == 130:
+            raise
+        return AgentResult(sock_path, FAILED, str(err))
+
+    except ValueError as err:
+        if not catch_value_error:
+            raise
+        return AgentResult(sock_path, FAILED, str(err))
+
+    except (AgentError, OSError, RuntimeError) as err:
+        return AgentResult(sock_path, FAILED, str(err))
+
+
+def _is_encrypted(priv_key_path: str) -> bool:
+    """Check if a private key file requires a passphrase."""
+    try:
+        return load_private_key(priv_key_path).encrypted
+    except OSError:
+        return True
+    except ValueError:
+        pass
+
+    with open(priv_key_path, encoding="utf-8", errors="replace") as file:
+        # Encrypted PEM and PKCS#8 key files
+        return "ENCRYPTED" in file.read()
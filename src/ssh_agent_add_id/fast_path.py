@@ -0,0 +1,93 @@
+import logging
+import os
+from pathlib import Path
+import sys
+from typing import List, Optional
+
+from ssh_agent_add_id import daemon, history
+from ssh_agent_add_id.certificates import paired_certificate
+from ssh_agent_add_id.constants import EXEC_COMMAND
+from ssh_agent_add_id.keys import is_ppk_file, load_public_key
+from ssh_agent_add_id.state import is_identity_cached
+
+
+def run(argv: List[str]) -> bool:
+    """Answer a command from the agent state segment, without importing the CLI.
+
+    The identity is usually stored already, which the shared segment of the agent state tells
+    without agent I/O. Answering before importing the CLI (argparse, pydantic, pexpect) keeps the
+    startup of the shims and tasks short. Only the plain forms are handled, without any option:
+    ``priv_key_path [pub_key_path]`` and ``exec priv_key_path [pub_key_path] -- command ...``.
+    On a miss, the daemon is asked if it is running (or started, with SSH_AGENT_ADD_ID_DAEMON=1),
+    which may also add a key that needs no passphrase. Anything else is left to the CLI. A key
+    paired with a valid certificate is only known to be stored along with this very certificate.
+
+    Args:
+        argv (List[str]): The CLI arguments, without the program name.
+
+    Returns:
+        bool: True if the identity is known to be stored (or has been added by the daemon), in
+            which case the command of the exec subcommand has replaced the process.
+    """
+    command: List[str] = []
+    if argv[:1] == [EXEC_COMMAND]:
+        if "--" not in argv:
+            return False
+        sep_index = argv.index("--")
+        argv, command = argv[1:sep_index], argv[sep_index + 1 :]
+        if not command:
+            return False
+
+    if not 1 <= len(argv) <= 2 or any(arg.startswith("-") for arg in argv):
+        return False
+
+    pub_key_path = _pub_key_path(*argv)
+    sock_path = os.getenv("SSH_AUTH_SOCK")
+    if not pub_key_path or not sock_path:
+        return False
+
+    try:
+        public_key = load_public_key(pub_key_path)
+    except (OSError, ValueError):
+        return False
+    priv_key_path = str(Path(argv[0]).expanduser().resolve())
+    cert = paired_certificate(priv_key_path, public_key.blob)
+    fingerprint = cert.fingerprint if cert else public_key.fingerprint
+    added = False
+    if not is_identity_cached(sock_path, fingerprint):
+        spawn = os.getenv(daemon.SPAWN_ENV) == "1"
+        answer = daemon.ask(priv_key_path, pub_key_path, sock_path, spawn)
+        if not answer or not answer.stored:
+            return False
+        added = answer.added
+
+    if command:
+        history.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execvp(command[0], command)
+
+    if added:
+        print(f"Identity added: {priv_key_path}")
+    else:
+        print("This identity has already been added to the SSH agent.")
+    return True
+
+
+def _pub_key_path(priv_key_path: str, pub_key_path: Optional[str] = None) -> Optional[str]:
+    """Resolve the public key path like the CLI does, or None if a key file does not exist."""
+    priv_path = Path(priv_key_path).expanduser().resolve()
+    if not priv_path.exists():
+        return None
+
+    if pub_key_path:
+        pub_path = Path(pub_key_path).expanduser().resolve()
+    else:
+        pub_path = priv_path.with_suffix(".pub")
+        if not pub_path.exists() and is_ppk_file(str(priv_path)):
+            pub_path = priv_path
+
+    if not pub_path.exists():
+        logging.debug(f"fast_path: {pub_path} not found")
+        return None
+    return str(pub_path)
@@ -0,0 +1,367 @@
+import atexit
+from collections import defaultdict
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, DefaultDict, Dict, Iterable, List, Optional, Tuple
+
+from ssh_agent_add_id import backend
+from ssh_agent_add_id.constants import (
+    APP_NAME,
+    HISTORY_MAX_LOSSES,
+    HISTORY_MAX_SIZE,
+    HISTORY_MIN_TTL,
+    HISTORY_TTL_FRACTION,
+)
+
+
+APPEARED = "appeared"
+COUNTS = "counts"
+HIT = "hit"
+LOST = "lost"
+QUERY = "query"
+
+
+def history_path() -> Path:
+    """Get the path of the history log, under $XDG_STATE_HOME so that it survives reboots."""
+    state_home = os.getenv("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return Path(state_home) / APP_NAME / "history.log"
+
+
+_pending_hits: DefaultDict[str, int] = defaultdict(int)
+_pending_lock = threading.Lock()
+
+
+def record(event: str, sock_path: str, fingerprint: str = "") -> None:
+    """Append an event to the history log.
+
+    Each event is a single JSON line written with one O_APPEND write, so the concurrent
+    invocations do not need to lock the log. The hits are only counted, then written at once by
+    :func:`flush`, so that answering from the agent state does no I/O. The failures are only
+    logged.
+
+    Args:
+        event (str): One of :data:`HIT` (answered by the agent state), :data:`QUERY` (identities
+            listed by the agent), :data:`APPEARED` or :data:`LOST`.
+        sock_path (str): The agent socket path.
+        fingerprint (str): The fingerprint of the identity, if the event is about one.
+    """
+    if event == HIT:
+        with _pending_lock:
+            if not _pending_hits:
+                atexit.register(flush)
+            _pending_hits[sock_path] += 1
+        return
+
+    _append([{"t": time.time(), "ev": event, "agent": sock_path, "fp": fingerprint}])
+
+
+def flush() -> None:
+    """Write the hits counted by the process, e.g. before it is replaced by another command.
+
+    This runs at exit too, and the hits are also written along with the next agent listing.
+    """
+    events = _take_hits()
+    if events:
+        _append(events)
+
+
+def record_listing(
+    sock_path: str,
+    previous: Iterable[str],
+    last_seen: float,
+    current: Iterable[str],
+) -> None:
+    """Record a listing of the agent identities, compared to the previous one of the state.
+
+    Without previous listing, e.g. for an agent restarted on the same socket path (whose new
+    socket has no state yet), the identities still loaded on this path according to the history
+    are compared instead, so that the losses of a restart are learned too.
+
+    Args:
+        sock_path (str): The agent socket path.
+        previous (Iterable[str]): The fingerprints of the previous listing.
+        last_seen (float): The timestamp of the previous listing, 0 if there was none.
+        current (Iterable[str]): The fingerprints just listed.
+    """
+    previous, current = set(previous), set(current)
+    now = time.time()
+    if not last_seen:
+        summary = _summary()
+        last_seen = summary.listed.get(sock_path, 0.0)
+        previous = {fp for fp, key in summary.keys.get(sock_path, {}).items() if key.appeared}
+
+    events = _take_hits()
+    events.append({"t": now, "ev": QUERY, "agent": sock_path, "fp": ""})
+    events += [
+        {"t": now, "ev": APPEARED, "agent": sock_path, "fp": fp}
+        for fp in sorted(current - previous)
+    ]
+    if last_seen:
+        events += [
+            {"t": now, "ev": LOST, "agent": sock_path, "fp": fp, "seen": last_seen}
+            for fp in sorted(previous - current)
+        ]
+    _append(events)
+
+
+def learned_ttls(
+    sock_path: str, fingerprints: Iterable[str], default_ttl: float
+) -> Dict[str, float]:
+    """Derive the time during which a listing can be trusted for each identity of an agent.
+
+    The lifetime of an identity is known from its losses: from when it appeared to the last
+    listing that still had it. The TTL is a fraction of its shortest recent lifetime, but never
+    more than the default TTL: a removal by another tool or an agent restart cannot be foreseen,
+    so the history only shortens the TTL of the identities that often vanish.
+
+    Args:
+        sock_path (str): The agent socket path.
+        fingerprints (Iterable[str]): The fingerprints of the identities.
+        default_ttl (float): The TTL of the identities without history.
+
+    Returns:
+        Dict[str, float]: The TTL in seconds of the identities already lost, by fingerprint.
+    """
+    keys = _summary().keys.get(sock_path, {})
+
+    ttls = {}
+    for fingerprint in fingerprints:
+        ttl = _ttl(keys[fingerprint], default_ttl) if fingerprint in keys else None
+        if ttl is not None:
+            ttls[fingerprint] = ttl
+
+    return ttls
+
+
+def compact() -> None:
+    """Rewrite the history log with its summary.
+
+    The counts, the latest appearance and the recent losses of each identity are kept. The events
+    appended by other processes during the compaction may be lost.
+
+    Raises:
+        OSError: If the log cannot be rewritten.
+    """
+    summary = _summary()
+    now = time.time()
+
+    events: List[Dict[str, Any]] = [
+        {
+            "t": now,
+            "ev": COUNTS,
+            "agent": agent,
+            "fp": "",
+            "hits": hits,
+            "queries": queries,
+            "listed": summary.listed.get(agent, 0.0),
+        }
+        for agent, (hits, queries) in summary.counts.items()
+    ]
+    for agent, keys in summary.keys.items():
+        for fp, key in keys.items():
+            # The lifetimes are kept since the appearances of the lost streaks are dropped
+            events += [
+                {"t": lost_at, "ev": LOST, "agent": agent, "fp": fp, "seen": seen, "lifetime": lt}
+                for lost_at, seen, lt in key.losses
+            ]
+            if key.appeared:
+                events.append({"t": key.appeared, "ev": APPEARED, "agent": agent, "fp": fp})
+
+    path = history_path()
+    # Unique per thread too: the threads of a process may write it concurrently
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.writelines(json.dumps(event, ensure_ascii=False) + "\n" for event in events)
+    os.replace(tmp_path, path)
+
+
+def summary_lines() -> List[str]:
+    """Describe the history for an audit: the hit rate of each agent and the lifetime of its keys.
+
+    Returns:
+        List[str]: The summary lines, empty if there is no history.
+    """
+    flush()
+    summary = _summary()
+    if not summary.counts and not summary.keys:
+        return []
+
+    lines = [f"  agent state history ({history_path()}):"]
+    for agent in sorted(set(summary.counts) | set(summary.keys)):
+        hits, queries = summary.counts.get(agent, (0, 0))
+        rate = f"{hits / (hits + queries):.0%}" if hits + queries else "n/a"
+        lines.append(f"    {agent}: {hits} hits, {queries} agent queries ({rate} hit rate)")
+
+        default_ttl = backend.current(agent).state_ttl
+        for fp, key in sorted(summary.keys.get(agent, {}).items()):
+            lifetime = f", shortest lifetime {min(key.lifetimes):.0f}s" if key.lifetimes else ""
+            ttl = _ttl(key, default_ttl)
+            learned = f", learned TTL {ttl:.0f}s" if ttl is not None else ""
+            lines.append(f"      {fp}: {len(key.losses)} losses{lifetime}{learned}")
+
+    return lines
+
+
+class _Key:
+    """The history of an identity on an agent."""
+
+    def __init__(self) -> None:
+        self.appeared = 0.0
+        self.losses: List[Tuple[float, float, Optional[float]]] = []
+        """The recent losses: when, the last time seen and the lifetime (if known)."""
+
+    @property
+    def lifetimes(self) -> List[float]:
+        """List[float]: The known lifetimes of the recent losses."""
+        return [lifetime for _, _, lifetime in self.losses if lifetime is not None]
+
+
+class _Summary:
+    """The history aggregated by agent and identity."""
+
+    def __init__(self) -> None:
+        self.counts: Dict[str, Tuple[int, int]] = {}
+        """The (hits, queries) counts by agent."""
+        self.listed: Dict[str, float] = {}
+        """The timestamp of the last listing by agent."""
+        self.keys: DefaultDict[str, DefaultDict[str, _Key]] = defaultdict(lambda: defaultdict(_Key))
+
+
+def _ttl(key: _Key, default_ttl: float) -> Optional[float]:
+    """Derive the TTL of an identity from its lifetimes, or None if it has never been lost."""
+    if not key.lifetimes:
+        return None
+    return min(max(min(key.lifetimes) * HISTORY_TTL_FRACTION, HISTORY_MIN_TTL), default_ttl)
+
+
+def _summarize(events: Iterable[Dict[str, Any]], summary: Optional[_Summary] = None) -> _Summary:
+    """Aggregate the history events, in log order, onto a previous summary if given."""
+    summary = summary or _Summary()
+    counts: DefaultDict[str, List[int]] = defaultdict(lambda: [0, 0])
+    for agent, (hits, queries) in summary.counts.items():
+        counts[agent] = [hits, queries]
+
+    for event in events:
+        try:
+            agent, ev, fp = event["agent"], event["ev"], event["fp"]
+            if ev == HIT:
+                counts[agent][0] += 1
+            elif ev == QUERY:
+                counts[agent][1] += 1
+                summary.listed[agent] = float(event["t"])
+            elif ev == COUNTS:
+                counts[agent][0] += int(event["hits"])
+                counts[agent][1] += int(event["queries"])
+                if event.get("listed"):
+                    summary.listed[agent] = float(event["listed"])
+            elif ev == APPEARED:
+                summary.keys[agent][fp].appeared = float(event["t"])
+            elif ev == LOST:
+                key = summary.keys[agent][fp]
+                lost_at, seen = float(event["t"]), float(event["seen"])
+                lifetime = event.get("lifetime")
+                if lifetime is None and key.appeared and seen >= key.appeared:
+                    lifetime = seen - key.appeared
+                lifetime = None if lifetime is None else float(lifetime)
+                key.losses = (key.losses + [(lost_at, seen, lifetime)])[-HISTORY_MAX_LOSSES:]
+                key.appeared = 0.0
+        except (KeyError, TypeError, ValueError) as err:
+            logging.debug(f"history ignored an invalid event: {err}")
+
+    summary.counts = {agent: (hits, queries) for agent, (hits, queries) in counts.items()}
+    return summary
+
+
+_summary_cache: Optional[Tuple[Tuple[int, int, int], _Summary]] = None
+
+
+def _summary() -> _Summary:
+    """Summarize the history log, again only if it has changed since the last time."""
+    global _summary_cache
+
+    try:
+        stat = history_path().stat()
+    except OSError:
+        return _Summary()
+
+    cache_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if _summary_cache and _summary_cache[0] == cache_key:
+        return _summary_cache[1]
+
+    summary = _summarize(_read())
+    _summary_cache = (cache_key, summary)
+    return summary
+
+
+def _take_hits() -> List[Dict[str, Any]]:
+    """Get the hits counted by the process as events, one per agent, and reset them."""
+    with _pending_lock:
+        hits = dict(_pending_hits)
+        _pending_hits.clear()
+
+    now = time.time()
+    return [
+        {"t": now, "ev": COUNTS, "agent": agent, "fp": "", "hits": count, "queries": 0}
+        for agent, count in hits.items()
+    ]
+
+
+def _read() -> List[Dict[str, Any]]:
+    """Read the history events, skipping the invalid lines."""
+    events = []
+    try:
+        with open(history_path(), encoding="utf-8") as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(event, dict):
+                    events.append(event)
+    except FileNotFoundError:
+        pass
+    except OSError as err:
+        logging.debug(f"history cannot be read: {err}")
+
+    return events
+
+
+def _append(events: List[Dict[str, Any]]) -> None:
+    """Append some events to the history log with a single write, compacting it once too large."""
+    global _summary_cache
+
+    path = history_path()
+    data = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events).encode()
+
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            before = os.fstat(fd)
+            os.write(fd, data)
+            after = os.fstat(fd)
+        finally:
+            os.close(fd)
+    except OSError as err:
+        logging.debug(f"history cannot be written: {err}")
+        return
+
+    # The cached summary is brought up to date rather than read again, unless another process
+    # has written the log meanwhile
+    if (
+        _summary_cache
+        and _summary_cache[0] == (before.st_ino, before.st_size, before.st_mtime_ns)
+        and after.st_size == before.st_size + len(data)
+    ):
+        summary = _summarize(events, _summary_cache[1])
+        _summary_cache = ((after.st_ino, after.st_size, after.st_mtime_ns), summary)
+
+    if after.st_size > HISTORY_MAX_SIZE:
+        try:
+            compact()
+        except OSError as err:
+            logging.debug(f"history cannot be compacted: {err}")
@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.agent_client import AgentClient
+from ssh_agent_add_id.certificates import parse_certificate
+from ssh_agent_add_id.constants import APP_NAME
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.scan import sniff_key_file, walk_files
+
+
+_INDEX_VERSION = 1
+
+
+@dataclass
+class IndexEntry:
+    """A file of the key index, with what identifies its version."""
+
+    mtime_ns: int
+    size: int
+    fingerprint: str
+    """The fingerprint of the private key, empty if the file is not a readable private key."""
+
+
+@dataclass
+class LoadedIdentity:
+    """An identity stored by the agent, with the local private key files it comes from."""
+
+    public_key: PublicKey
+    priv_key_paths: List[str]
+
+    def __str__(self) -> str:  # noqa: D105
+        key = self.public_key
+        lines = [f"{key.bits} {key.fingerprint} {key.comment or '(no comment)'} ({key.key_type})"]
+        lines += [f"  {path}" for path in self.priv_key_paths] or ["  (no local key file)"]
+        return os.linesep.join(lines)
+
+
+class KeyIndex:
+    """A persistent reverse index of the private key files, by fingerprint.
+
+    The index is refreshed incrementally: only the files whose mtime or size has changed since the
+    previous refresh are read again, so that it stays cheap with hundreds of key files. The files
+    which are not private keys are indexed too, so that they are not read again either.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, IndexEntry]] = None) -> None:
+        """Setup the index.
+
+        Args:
+            entries (Optional[Dict[str, IndexEntry]]): The indexed files, by path.
+        """
+        self.entries: Dict[str, IndexEntry] = dict(entries or {})
+        #
+
+    @property
+    def path(self) -> Path:
+        """Path: The file where the index is saved."""
+        return index_path()
+        #
+
+    @classmethod
+    def load(cls) -> "KeyIndex":
+        """Read the saved index, or get an empty one if it is missing or invalid."""
+        try:
+            with open(index_path(), encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("version") != _INDEX_VERSION:
+                return cls()
+            return cls(
+                {
+                    path: IndexEntry(int(mtime_ns), int(size), str(fingerprint))
+                    for path, (mtime_ns, size, fingerprint) in data["files"].items()
+                }
+            )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as err:
+            logging.debug(f"KeyIndex.load ignored an invalid index: {err}")
+
+        return cls()
+
+    def refresh(self, roots: List[str]) -> bool:
+        """Index the files under some directories, reading only the new or modified ones.
+
+        The files are read in a thread pool. The files no longer found under the directories are
+        dropped from the index.
+
+        Args:
+            roots (List[str]): The directories to index recursively.
+
+        Raises:
+            FileNotFoundError: If a directory does not exist.
+
+        Returns:
+            bool: Whether the index has changed.
+        """
+        stats: Dict[str, Tuple[int, int]] = {}
+        for root in roots:
+            root = os.path.expanduser(root)
+            if not os.path.isdir(root):
+                raise FileNotFoundError(f"{root} not found")
+            for path in walk_files(root):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stats[os.path.abspath(path)] = (stat.st_mtime_ns, stat.st_size)
+
+        changed = [
+            path
+            for path, (mtime_ns, size) in sorted(stats.items())
+            if (entry := self.entries.get(path)) is None
+            or (entry.mtime_ns, entry.size) != (mtime_ns, size)
+        ]
+        with ThreadPoolExecutor() as pool:
+            sniffed = cancellation.pool_map(pool, sniff_key_file, changed)
+
+        entries = {path: entry for path, entry in self.entries.items() if path in stats}
+        dropped = len(self.entries) - len(entries)
+        for path, key in zip(changed, sniffed):
+            fingerprint = key.public_key.fingerprint if key else ""
+            entries[path] = IndexEntry(*stats[path], fingerprint)
+        self.entries = entries
+
+        logging.debug(
+            f"KeyIndex.refresh read {len(changed)} of {len(stats)} file(s), dropped {dropped}"
+        )
+
+        return bool(changed or dropped)
+
+    def paths_by_fingerprint(self) -> Dict[str, List[str]]:
+        """Get the private key files of each fingerprint (the reverse index).
+
+        Returns:
+            Dict[str, List[str]]: The sorted private key paths, by fingerprint.
+        """
+        paths: Dict[str, List[str]] = {}
+        for path, entry in sorted(self.entries.items()):
+            if entry.fingerprint:
+                paths.setdefault(entry.fingerprint, []).append(path)
+        return paths
+
+    def save(self) -> None:
+        """Atomically write the index.
+
+        Raises:
+            OSError: If the file cannot be written.
+        """
+        path = self.path
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        data = {
+            "version": _INDEX_VERSION,
+            "files": {
+                path: [entry.mtime_ns, entry.size, entry.fingerprint]
+                for path, entry in self.entries.items()
+            },
+        }
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        #
+
+
+def index_path() -> Path:
+    """Get the path of the key index, under $XDG_CACHE_HOME since it can be rebuilt."""
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home) / APP_NAME / "key-index.json"
+
+
+def list_identities(sock_path: str, roots: List[str]) -> List[LoadedIdentity]:
+    """List the identities stored by the agent, with the local private key files they come from.
+
+    A certificate is listed with the files of the private key it certifies. The key index of the
+    directories is refreshed first, then saved (a failure to save it is only logged).
+
+    Args:
+        sock_path (str): The agent socket path.
+        roots (List[str]): The directories of the private key files.
+
+    Raises:
+        AgentError: If the identities cannot be listed.
+        FileNotFoundError: If a directory does not exist.
+        OSError: If the agent socket cannot be read.
+
+    Returns:
+        List[LoadedIdentity]: The identities, in the agent order.
+    """
+    index = KeyIndex.load()
+    if index.refresh(roots):
+        try:
+            index.save()
+        except OSError as err:
+            logging.debug(f"list_identities cannot save the key index: {err}")
+    paths = index.paths_by_fingerprint()
+
+    with AgentClient(sock_path) as client:
+        identities = client.list_identities()
+
+    return [LoadedIdentity(key, paths.get(_key_fingerprint(key), [])) for key in identities]
+
+
+def _key_fingerprint(public_key: PublicKey) -> str:
+    """Get the fingerprint of the private key of an identity, i.e. the certified key's one."""
+    try:
+        return PublicKey.from_blob(parse_certificate(public_key).key_blob).fingerprint
+    except ValueError:
+        return public_key.fingerprint
@@ -0,0 +1,85 @@
+import json
+import threading
+from typing import Any, Dict, Optional, TextIO
+
+from ssh_agent_add_id.fanout import AgentResult
+from ssh_agent_add_id.scan import KeyResult
+
+
+JSONL = "jsonl"
+TEXT = "text"
+OUTPUT_FORMATS = (TEXT, JSONL)
+
+
+class JsonlWriter:
+    """Write one JSON record per key, as soon as it is resolved (JSON Lines).
+
+    Each record is flushed on its own, so that a caller reading the stream can act on the fast keys
+    while the slow ones (ssh-add, prompts) are still pending. The records may be written from
+    several threads.
+    """
+
+    def __init__(self, stream: TextIO) -> None:
+        """Setup the writer.
+
+        Args:
+            stream (TextIO): The stream to write the records to, usually the standard output.
+        """
+        self._stream = stream
+        self._lock = threading.Lock()
+        #
+
+    def write(
+        self,
+        priv_key_path: str,
+        fingerprint: str,
+        action: str,
+        latency: float,
+        error: str = "",
+        agent: Optional[str] = None,
+    ) -> None:
+        """Write and flush the record of a key.
+
+        Args:
+            priv_key_path (str): The private key path.
+            fingerprint (str): The SHA256 fingerprint of the key (empty if unknown).
+            action (str): One of "stored", "added" or "failed".
+            latency (float): The seconds elapsed since the start of the operation until the key
+                was resolved.
+            error (str): The error of a failed key.
+            agent (Optional[str]): The agent socket, for the operations on several agents.
+        """
+        record: Dict[str, Any] = {
+            "path": priv_key_path,
+            "fingerprint": fingerprint or None,
+            "action": action,
+            "latency": round(latency, 6),
+            "error": error or None,
+        }
+        if agent is not None:
+            record["agent"] = agent
+
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._stream.write(line)
+            self._stream.flush()
+        #
+
+    def write_key_result(self, result: KeyResult) -> None:
+        """Write the record of a key of a scan or workspace operation."""
+        self.write(
+            result.priv_key_path, result.fingerprint, result.status, result.latency, result.error
+        )
+        #
+
+    def write_agent_result(self, priv_key_path: str, result: AgentResult) -> None:
+        """Write the record of the key on one of several agents."""
+        self.write(
+            priv_key_path,
+            result.fingerprint,
+            result.status,
+            result.latency,
+            result.error,
+            result.sock_path,
+        )
+        #
@@ -0,0 +1,282 @@
+from abc import ABC, abstractmethod
+import json
+import logging
+import os
+from pathlib import Path
+import shlex
+import subprocess
+from subprocess import DEVNULL, PIPE
+import sys
+import threading
+from typing import Dict, List, Optional
+
+from ssh_agent_add_id import cancellation, deadline, profiling
+from ssh_agent_add_id.agent_client import AgentClient
+from ssh_agent_add_id.certificates import add_with_certificate
+from ssh_agent_add_id.constants import APP_NAME, PASSPHRASE_COMMAND_TIMEOUT
+from ssh_agent_add_id.keys import unlock_private_key
+from ssh_agent_add_id.ssh_agent import SSHAgent
+
+
+class PassphraseProvider(ABC):
+    """A source of passphrases that does not prompt the user."""
+
+    @abstractmethod
+    def get(self, priv_key_path: str, fingerprint: str) -> List[str]:
+        """Get the candidate passphrases of a private key.
+
+        Args:
+            priv_key_path (str): The private key path.
+            fingerprint (str): The SHA256 fingerprint of the key.
+
+        Raises:
+            OSError: If the source cannot be read.
+            ValueError: If the source content is not valid.
+
+        Returns:
+            List[str]: The candidate passphrases, possibly none.
+        """
+
+
+class EnvProvider(PassphraseProvider):
+    """The passphrase held by an environment variable."""
+
+    def __init__(self, var_name: str) -> None:  # noqa: D107
+        self.var_name = var_name
+
+    def get(self, priv_key_path: str, fingerprint: str) -> List[str]:  # noqa: D102
+        passphrase = os.getenv(self.var_name)
+        return [passphrase] if passphrase else []
+
+
+class FdProvider(PassphraseProvider):
+    """The passphrases read from a file descriptor, one per line.
+
+    The file descriptor is read once, the first time a passphrase is needed, until its writer
+    closes it or a signal is received.
+    """
+
+    def __init__(self, fd: int) -> None:  # noqa: D107
+        self.fd = fd
+        self._lines: Optional[List[str]] = None
+        self._lock = threading.Lock()
+
+    def get(self, priv_key_path: str, fingerprint: str) -> List[str]:  # noqa: D102
+        with self._lock:
+            if self._lines is None:
+                content = cancellation.read(self.fd).decode("utf-8")
+                self._lines = [line for line in content.splitlines() if line]
+            return self._lines
+
+
+class CommandProvider(PassphraseProvider):
+    """The passphrase printed by a helper command, called with the private key path.
+
+    The key fingerprint is also given in the SSH_AGENT_ADD_ID_FINGERPRINT environment variable.
+    """
+
+    def __init__(self, command: str) -> None:  # noqa: D107
+        self.command = shlex.split(command)
+        if not self.command:
+            raise ValueError("The passphrase command is empty")
+
+    def get(self, priv_key_path: str, fingerprint: str) -> List[str]:  # noqa: D102
+        cmd = self.command + [priv_key_path]
+        logging.debug(f"CommandProvider command: {cmd}")
+
+        try:
+            with profiling.blocked(profiling.SUBPROCESS):
+                completed = cancellation.run(
+                    cmd,
+                    stdin=DEVNULL,
+                    stdout=PIPE,
+                    env=dict(os.environ, SSH_AGENT_ADD_ID_FINGERPRINT=fingerprint),
+                    timeout=deadline.remaining(PASSPHRASE_COMMAND_TIMEOUT),
+                )
+        except subprocess.TimeoutExpired as err:
+            deadline.timed_out()
+            raise OSError(f"The passphrase command timed out: {shlex.join(cmd)}") from err
+
+        # A helper without a passphrase for this key exits with an error code
+        if completed.returncode != 0:
+            logging.debug(f"CommandProvider returncode: {completed.returncode}")
+            return []
+
+        lines = completed.stdout.decode("utf-8").splitlines()
+        return lines[:1] if lines and lines[0] else []
+
+
+class StoreProvider(PassphraseProvider):
+    """The passphrases of a local JSON store, mapping key fingerprints or paths to passphrases.
+
+    Like ssh does with private keys, the store is ignored unless only its owner can read it.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:  # noqa: D107
+        self.path = Path(path).expanduser() if path else default_store_path()
+        self._store: Optional[Dict[str, str]] = None
+        self._lock = threading.Lock()
+
+    def get(self, priv_key_path: str, fingerprint: str) -> List[str]:  # noqa: D102
+        with self._lock:
+            if self._store is None:
+                self._store = self._load()
+
+        passphrase = self._store.get(fingerprint) or self._store.get(
+            str(Path(priv_key_path).expanduser().resolve())
+        )
+        return [passphrase] if passphrase else []
+
+    def _load(self) -> Dict[str, str]:
+        """Read the store file, checking its permissions."""
+        st = self.path.stat()
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise PermissionError(f"{self.path} must only be accessible by its owner")
+
+        try:
+            store = json.loads(self.path.read_text(encoding="utf-8"))
+        except json.JSONDecodeError as err:
+            raise ValueError(f"Invalid passphrase store {self.path}: {err}") from err
+
+        if not isinstance(store, dict):
+            raise ValueError(f"Invalid passphrase store {self.path}: not an object")
+
+        # Key paths are resolved so that any spelling of a path matches
+        return {
+            key if key.startswith("SHA256:") else str(Path(key).expanduser().resolve()): value
+            for key, value in store.items()
+            if isinstance(value, str)
+        }
+
+
+class PassphraseChain:
+    """The passphrase providers to try, in order, before prompting the user."""
+
+    def __init__(self, providers: Optional[List[PassphraseProvider]] = None) -> None:
+        """Set the providers.
+
+        Args:
+            providers (Optional[List[PassphraseProvider]]): The providers, in order.
+        """
+        self.providers = providers or []
+        #
+
+    def __bool__(self) -> bool:  # noqa: D105
+        return bool(self.providers)
+
+    def passphrases(self, priv_key_path: str, fingerprint: str) -> List[str]:
+        """Get the candidate passphrases of a private key from all the providers.
+
+        A provider that fails is reported on stderr and skipped.
+
+        Args:
+            priv_key_path (str): The private key path.
+            fingerprint (str): The SHA256 fingerprint of the key.
+
+        Returns:
+            List[str]: The distinct candidate passphrases, in provider order.
+        """
+        passphrases: List[str] = []
+        for provider in self.providers:
+            try:
+                candidates = provider.get(priv_key_path, fingerprint)
+            except (OSError, ValueError) as err:
+                sys.stderr.write(f"Passphrase provider error: {err}{os.linesep}")
+                continue
+
+            passphrases += [item for item in candidates if item not in passphrases]
+
+        logging.debug(f"PassphraseChain {len(passphrases)} passphrase(s) for {priv_key_path}")
+
+        return passphrases
+        #
+
+
+def default_store_path() -> Path:
+    """Get the default path of the passphrase store, under $XDG_CONFIG_HOME."""
+    config_home = os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return Path(config_home) / APP_NAME / "passphrases.json"
+
+
+def parse_passphrase_source(source: str) -> PassphraseProvider:
+    """Build a passphrase provider from its description.
+
+    Args:
+        source (str): ``env:VAR``, ``fd:N``, ``cmd:COMMAND``, ``store`` or ``store:PATH``.
+
+    Raises:
+        ValueError: If the description is not valid.
+
+    Returns:
+        PassphraseProvider: The provider.
+    """
+    kind, _, value = source.partition(":")
+
+    if kind == "env" and value:
+        return EnvProvider(value)
+    if kind == "fd" and value.isdigit():
+        return FdProvider(int(value))
+    if kind == "cmd" and value:
+        return CommandProvider(value)
+    if kind == "store":
+        return StoreProvider(value or None)
+
+    raise ValueError(f"invalid passphrase source: '{source}'")
+
+
+def add_identity_unattended(
+    sock_path: str,
+    priv_key_path: str,
+    passphrases: List[str],
+    lifetime: Optional[int] = None,
+    confirm: bool = False,
+) -> bool:
+    """Try to add an encrypted identity with some passphrases, without prompting the user.
+
+    A key that can be decrypted in-process is added through the agent socket (with its paired
+    certificate), otherwise ssh-add is answered with each passphrase until one is accepted.
+
+    Args:
+        sock_path (str): The agent socket path.
+        priv_key_path (str): The private key path.
+        passphrases (List[str]): The candidate passphrases.
+        lifetime (Optional[int]): The lifetime constraint of the identity, in seconds.
+        confirm (bool): Whether to add the identity with the confirm constraint.
+
+    Raises:
+        AgentError: If the agent refuses the identity.
+        ExitCodeError: If ssh-add fails or a signal has been received.
+        RuntimeError: If ssh-add does not run as expected.
+
+    Returns:
+        bool: True if the identity has been added, False if no passphrase has been accepted.
+    """
+    if not passphrases:
+        return False
+
+    try:
+        private_key = unlock_private_key(priv_key_path, passphrases, prompt=False)
+    except ValueError:
+        return False
+
+    if private_key:
+        with AgentClient(sock_path) as client:
+            add_with_certificate(
+                client,
+                priv_key_path,
+                private_key.identity,
+                private_key.public_key.blob,
+                lifetime,
+                confirm,
+            )
+        return True
+
+    agent = SSHAgent()
+    for passphrase in passphrases:
+        try:
+            agent.add_identity(priv_key_path, lifetime, confirm, passphrase, sock_path)
+            return True
+        except ValueError:
+            logging.debug(f"add_identity_unattended passphrase rejected for {priv_key_path}")
+
+    return False
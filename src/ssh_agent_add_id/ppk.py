@@ -0,0 +1,189 @@
+import base64
+import binascii
+import hashlib
+import hmac
+from typing import Dict, List
+
+from ssh_agent_add_id.aes import aes_cbc_decrypt
+from ssh_agent_add_id.wire import WireReader, pack_string
+
+
+PPK_MAGIC = "PuTTY-User-Key-File-"
+
+_ARGON2_TYPES = {"Argon2d": "D", "Argon2i": "I", "Argon2id": "ID"}
+
+
+class BadPassphraseError(ValueError):
+    """Raised when a key file cannot be decrypted with the given passphrase."""
+
+
+class PPKFile:
+    """A PuTTY private key file, in the PPK format version 2 or 3."""
+
+    def __init__(self, content: str) -> None:
+        """Parse the content of a PPK file.
+
+        Args:
+            content (str): The key file text.
+
+        Raises:
+            ValueError: If the text is not a valid PPK file.
+        """
+        lines = content.strip().splitlines()
+        headers: Dict[str, str] = {}
+        blobs: Dict[str, bytes] = {}
+
+        try:
+            index = 0
+            while index < len(lines):
+                name, _, value = lines[index].partition(":")
+                name, value = name.strip(), value.strip()
+                index += 1
+                # Public-Lines and Private-Lines are followed by the base64 lines of the blob
+                if name.endswith("-Lines"):
+                    count = int(value)
+                    blobs[name[: -len("-Lines")]] = base64.b64decode(
+                        "".join(lines[index : index + count]), validate=True
+                    )
+                    index += count
+                else:
+                    headers[name] = value
+
+            version, key_type = next(
+                (name[len(PPK_MAGIC) :], value) for name, value in headers.items()
+            )
+            self.version = int(version)
+            self.key_type = key_type
+            self.encryption = headers["Encryption"]
+            self.comment = headers.get("Comment", "")
+            self.public_blob = blobs["Public"]
+            self.private_blob = blobs["Private"]
+            self.private_mac = bytes.fromhex(headers["Private-MAC"])
+        except (KeyError, StopIteration, binascii.Error) as err:
+            raise ValueError("Invalid PuTTY key file") from err
+
+        if not lines[0].startswith(PPK_MAGIC) or self.version not in (2, 3):
+            raise ValueError("Unsupported PuTTY key file format")
+        if self.encryption not in ("none", "aes256-cbc"):
+            raise ValueError(f"Unsupported PuTTY key file encryption: {self.encryption}")
+
+        self._headers = headers
+        #
+
+    @property
+    def encrypted(self) -> bool:
+        """bool: Whether the private key is protected by a passphrase."""
+        return self.encryption != "none"
+        #
+
+    def decrypt(self, passphrase: str = "") -> bytes:
+        """Decrypt the private key and check its integrity.
+
+        Args:
+            passphrase (str): The passphrase, ignored if the key is not encrypted.
+
+        Raises:
+            BadPassphraseError: If the MAC does not match, i.e. the passphrase is wrong.
+            ValueError: If the key type or the key derivation function is not supported.
+
+        Returns:
+            bytes: The key type, private fields and comment, as sent to the agent by an add
+                identity request.
+        """
+        secret = passphrase.encode() if self.encrypted else b""
+
+        if self.version == 2:
+            cipher_key = (
+                hashlib.sha1(b"\0\0\0\0" + secret).digest()
+                + hashlib.sha1(b"\0\0\0\1" + secret).digest()
+            )[:32]
+            iv = bytes(16)
+            mac_key = hashlib.sha1(b"putty-private-key-file-mac-key" + secret).digest()
+            digest = "sha1"
+        else:
+            cipher_key, iv, mac_key = bytes(32), bytes(16), b""
+            if self.encrypted:
+                derived = self._argon2(secret)
+                cipher_key, iv, mac_key = derived[:32], derived[32:48], derived[48:]
+            digest = "sha256"
+
+        private_blob = self.private_blob
+        if self.encrypted:
+            private_blob = aes_cbc_decrypt(cipher_key, iv, private_blob)
+
+        mac_data = b"".join(
+            pack_string(value)
+            for value in (
+                self.key_type.encode(),
+                self.encryption.encode(),
+                self.comment.encode(),
+                self.public_blob,
+                private_blob,
+            )
+        )
+        if not hmac.compare_digest(hmac.new(mac_key, mac_data, digest).digest(), self.private_mac):
+            raise BadPassphraseError("Wrong passphrase or corrupted PuTTY key file")
+
+        return self._agent_identity(private_blob)
+        #
+
+    def _argon2(self, secret: bytes) -> bytes:
+        """Derive the cipher key, IV and MAC key of a PPK version 3 file.
+
+        Raises:
+            ValueError: If argon2-cffi is not installed or the parameters are not valid.
+        """
+        try:
+            from argon2.low_level import Type, hash_secret_raw
+        except ImportError as err:
+            raise ValueError(
+                "Decrypting PuTTY key files version 3 requires argon2-cffi: "
+                + "pip install ssh-agent-add-id[ppk]"
+            ) from err
+
+        try:
+            return hash_secret_raw(
+                secret,
+                bytes.fromhex(self._headers["Argon2-Salt"]),
+                time_cost=int(self._headers["Argon2-Passes"]),
+                memory_cost=int(self._headers["Argon2-Memory"]),
+                parallelism=int(self._headers["Argon2-Parallelism"]),
+                hash_len=80,
+                type=getattr(Type, _ARGON2_TYPES[self._headers["Key-Derivation"]]),
+            )
+        except KeyError as err:
+            raise ValueError(f"Invalid PuTTY key file Argon2 parameter: {err}") from err
+            #
+
+    def _agent_identity(self, private_blob: bytes) -> bytes:
+        """Convert the public and private blobs into the agent identity format.
+
+        Raises:
+            ValueError: If the key type is not supported or a blob is malformed.
+        """
+        public = WireReader(self.public_blob)
+        public.read_string()  # Key type
+        private = WireReader(private_blob)
+
+        def read(reader: WireReader, count: int) -> List[bytes]:
+            return [reader.read_string() for _ in range(count)]
+
+        if self.key_type == "ssh-rsa":
+            e, n = read(public, 2)
+            d, p, q, iqmp = read(private, 4)
+            fields = [n, e, d, iqmp, p, q]
+        elif self.key_type == "ssh-dss":
+            fields = read(public, 4) + read(private, 1)
+        elif self.key_type.startswith("ecdsa-sha2-"):
+            fields = read(public, 2) + read(private, 1)
+        elif self.key_type == "ssh-ed25519":
+            (public_key,) = read(public, 1)
+            # PuTTY stores the private key as a little-endian integer, without trailing zeros
+            (private_key,) = read(private, 1)
+            fields = [public_key, private_key.ljust(32, b"\0") + public_key]
+        else:
+            raise ValueError(f"Unsupported PuTTY key type: {self.key_type}")
+
+        return b"".join(pack_string(value) for value in [self.key_type.encode(), *fields]) + (
+            pack_string(self.comment.encode())
+        )
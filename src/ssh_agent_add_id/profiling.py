@@ -0,0 +1,194 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+from typing import DefaultDict, Iterator, List, Optional, Tuple
+
+from ssh_agent_add_id.constants import APP_NAME, PROFILE_TOP_N
+
+
+AGENT = "agent socket"
+PROMPT = "user prompt"
+SUBPROCESS = "subprocesses"
+
+
+class ProfileSession:
+    """Profile a whole run: CPU time with cProfile, and optionally memory with tracemalloc.
+
+    cProfile measures CPU time rather than wall time, so that waiting for the agent, ssh-add or
+    the user does not pollute the profile. That wall time is accounted apart with :func:`blocked`.
+    """
+
+    def __init__(self, path: Optional[str] = None, memory: bool = False) -> None:
+        """Set the profile output.
+
+        Args:
+            path (Optional[str]): The pstats file path, or None for a file in the temporary
+                directory.
+            memory (bool): Whether to trace the memory allocations too.
+        """
+        # Imported only when profiling, so that normal runs do not pay for them at startup
+        import cProfile
+        import tempfile
+
+        self.path = path or os.path.join(tempfile.gettempdir(), f"{APP_NAME}-{os.getpid()}.pstats")
+        self.memory = memory
+        self.blocked: DefaultDict[str, float] = defaultdict(float)
+
+        self._profile = cProfile.Profile(time.process_time)
+        self._lock = threading.Lock()
+        self._started_at = 0.0
+        self._cpu_started_at = 0.0
+        #
+
+    def start(self) -> None:
+        """Start profiling."""
+        if self.memory:
+            import tracemalloc
+
+            tracemalloc.start()
+
+        self._started_at = time.perf_counter()
+        self._cpu_started_at = time.process_time()
+        self._profile.enable()
+        #
+
+    def stop(self) -> None:
+        """Stop profiling, write the pstats file and print a summary to stderr.
+
+        The summary also audits the agent state history (its hit rate and the learned TTLs), and
+        the retries and circuit breakers of the agent operations.
+        """
+        import io
+        import pstats
+        import tracemalloc
+
+        from ssh_agent_add_id import history, retry
+
+        self._profile.disable()
+        wall_time = time.perf_counter() - self._started_at
+        cpu_time = time.process_time() - self._cpu_started_at
+
+        lines = [f"{APP_NAME} profile: {wall_time:.3f}s wall time, {cpu_time:.3f}s CPU time"]
+        lines += [f"  blocked on {name}: {seconds:.3f}s" for name, seconds in self.blocked.items()]
+        lines += history.summary_lines()
+        lines += retry.summary_lines()
+
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            lines.append(f"  memory peak: {peak / 1024:.1f} KiB, top allocations:")
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+                lines.append(f"    {stat}")
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_N)
+        lines.append(stream.getvalue().strip("\n"))
+
+        try:
+            stats.dump_stats(self.path)
+            lines.append(f"Profile written to {self.path}")
+        except OSError as err:
+            lines.append(f"Cannot write the profile: {err}")
+
+        sys.stderr.write(os.linesep.join(lines) + os.linesep)
+        #
+
+    def add_blocked(self, name: str, seconds: float) -> None:
+        """Account some wall time spent blocked (thread-safe)."""
+        with self._lock:
+            self.blocked[name] += seconds
+            #
+
+
+_session: Optional[ProfileSession] = None
+
+
+def is_active() -> bool:
+    """Check if a profiling session is running."""
+    return _session is not None
+
+
+@contextmanager
+def profile(path: Optional[str] = None, memory: bool = False) -> Iterator[ProfileSession]:
+    """Profile the enclosed code, writing the results when it ends (even with sys.exit).
+
+    Args:
+        path (Optional[str]): The pstats file path, or None for a file in the temporary directory.
+        memory (bool): Whether to trace the memory allocations too.
+
+    Yields:
+        ProfileSession: The running session.
+    """
+    global _session
+
+    session = ProfileSession(path, memory)
+    _session = session
+    session.start()
+
+    try:
+        yield session
+    finally:
+        if _session is session:
+            stop()
+
+
+def stop() -> None:
+    """Stop the running profiling session, if any, e.g. before the process is replaced."""
+    global _session
+
+    if _session:
+        _session.stop()
+        _session = None
+
+
+@contextmanager
+def blocked(name: str) -> Iterator[None]:
+    """Account the wall time of the enclosed code as blocked on `name`, when profiling."""
+    session = _session
+    if not session:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        session.add_blocked(name, time.perf_counter() - started_at)
+
+
+def split_profile_args(argv: List[str]) -> Tuple[List[str], Optional[str], bool]:
+    """Extract the profiling options from the command line arguments.
+
+    ``--profile`` only accepts its optional path as ``--profile=PATH``, so that a following key
+    path is not mistaken for it. The arguments of an executed command (after "--") are kept.
+
+    Args:
+        argv (List[str]): The command line arguments, without the program name.
+
+    Returns:
+        Tuple[List[str], Optional[str], bool]: The other arguments, the profile path (empty for the
+            default path, None if not profiling) and whether to trace the memory allocations.
+    """
+    end = argv.index("--") if "--" in argv else len(argv)
+    others = []
+    path: Optional[str] = None
+    memory = False
+
+    for arg in argv[:end]:
+        if arg == "--profile":
+            path = path or ""
+        elif arg.startswith("--profile="):
+            path = arg[len("--profile=") :]
+        elif arg == "--profile-memory":
+            path = path or ""
+            memory = True
+        else:
+            others.append(arg)
+
+    return others + argv[end:], path, memory
@@ -0,0 +1,520 @@
+import json
+import logging
+import os
+from pathlib import Path
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, NoReturn, Optional, Tuple
+
+from ssh_agent_add_id import cancellation, deadline, history, profiling
+from ssh_agent_add_id.agent_client import (
+    MAX_MESSAGE_LEN,
+    SSH_AGENT_FAILURE,
+    SSH_AGENT_IDENTITIES_ANSWER,
+    SSH_AGENTC_REQUEST_IDENTITIES,
+    AgentClient,
+    AgentError,
+)
+from ssh_agent_add_id.certificates import certificate_path
+from ssh_agent_add_id.constants import APP_NAME, PROXY_POLL_INTERVAL
+from ssh_agent_add_id.errors import SignalException
+from ssh_agent_add_id.keys import PublicKey, load_public_key
+from ssh_agent_add_id.ssh_config import SSHConfig
+from ssh_agent_add_id.state import state_dir
+from ssh_agent_add_id.wire import WireReader, pack_string, pack_uint32
+
+
+HOST_ENV = "SSH_AGENT_ADD_ID_HOST"
+"""Set to ``[user@]host[:port]`` to filter the identities for this target, instead of reading it
+from the ssh command."""
+
+SSH_AGENTC_SIGN_REQUEST = 13
+SSH_AGENT_SIGN_RESPONSE = 14
+
+# The ssh options followed by an argument (see ssh(1) synopsis)
+_SSH_ARG_OPTIONS = "BbcDEeFIiJLlmOoPpQRSWw"
+_TABLE_VERSION = 1
+
+
+class Target(NamedTuple):
+    """The destination of an ssh connection, as given to ssh."""
+
+    host: str
+    user: Optional[str] = None
+    port: Optional[int] = None
+
+
+class Identity(NamedTuple):
+    """An identity listed by the agent."""
+
+    blob: bytes
+    comment: bytes
+    fingerprint: str
+
+
+def hosts_path() -> Path:
+    """Get the path of the learned host table, under $XDG_STATE_HOME so that it survives reboots."""
+    state_home = os.getenv("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return Path(state_home) / APP_NAME / "hosts.json"
+
+
+def parse_target(value: str) -> Target:
+    """Parse a ``[user@]host[:port]`` target, or an ``ssh://[user@]host[:port]`` URL.
+
+    Raises:
+        ValueError: If the port is not a number.
+    """
+    value = value[len("ssh://") :].rstrip("/") if value.startswith("ssh://") else value
+    user, _, host = value.rpartition("@")
+    port = None
+    if host.count(":") == 1:
+        host, port_value = host.split(":")
+        port = int(port_value)
+
+    return Target(host, user or None, port)
+
+
+def parse_ssh_target(command: List[str]) -> Optional[Target]:
+    """Get the destination of an ssh command, as git runs it (e.g. ``ssh -p 2222 git@host cmd``).
+
+    Args:
+        command (List[str]): The ssh command and its arguments.
+
+    Returns:
+        Optional[Target]: The destination, or None if there is none.
+    """
+    options: Dict[str, str] = {}
+    args = iter(command[1:])
+
+    for arg in args:
+        if arg == "--":
+            arg = next(args, "")
+        elif arg.startswith("-") and len(arg) > 1:
+            # Options can be grouped, e.g. -vp 2222 or -vp2222
+            for index, option in enumerate(arg[1:], 1):
+                if option in _SSH_ARG_OPTIONS:
+                    value = arg[index + 1 :] or next(args, "")
+                    if option == "o":
+                        keyword, _, value = value.replace("=", " ", 1).partition(" ")
+                        option = keyword.strip().lower()
+                    options.setdefault(option, value.strip())
+                    break
+            continue
+
+        if not arg:
+            return None
+        if arg.startswith("ssh://"):
+            try:
+                target = parse_target(arg)
+            except ValueError:
+                return None
+        else:
+            # A colon does not introduce a port in an ssh destination
+            user, _, host = arg.rpartition("@")
+            target = Target(host, user or None)
+
+        user = target.user or options.get("l") or options.get("user")
+        port = options.get("p") or options.get("port") or ""
+        return Target(target.host, user, target.port or (int(port) if port.isdigit() else None))
+
+    return None
+
+
+class HostTable:
+    """The identities that have authenticated to each host, learned from the proxied signatures.
+
+    The agent only signs for ssh once the server has accepted the public key offered, so a
+    signature is a success of that identity on that host. A connection whose filtered identities
+    have not signed anything is a failure: the next connection to that host is offered all the
+    identities, the relevant ones first, until one succeeds again.
+    """
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        """Load the table.
+
+        Args:
+            path (Optional[Path]): The table file path, under $XDG_STATE_HOME by default.
+        """
+        self.path = path or hosts_path()
+        self.hosts: Dict[str, Dict[str, Any]] = {}
+        self.load()
+        #
+
+    def load(self) -> None:
+        """Read the table, empty if there is none or if it cannot be parsed."""
+        self.hosts = {}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data["version"] == _TABLE_VERSION:
+                self.hosts = dict(data["hosts"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logging.debug(f"HostTable.load ignored invalid table file: {err}")
+            #
+
+    def successes(self, host_key: str) -> List[str]:
+        """Get the fingerprints that have authenticated to a host, the most recent first."""
+        keys: Dict[str, float] = self.hosts.get(host_key, {}).get("keys", {})
+        return sorted(keys, key=lambda fp: keys[fp], reverse=True)
+
+    def has_failed(self, host_key: str) -> bool:
+        """Check if the last filtered connection to a host has failed."""
+        entry = self.hosts.get(host_key, {})
+        return entry.get("failed_at", 0.0) > max(entry.get("keys", {}).values(), default=0.0)
+
+    def record(self, host_key: str, fingerprint: str = "") -> None:
+        """Record a success of an identity on a host, or a failure without `fingerprint`.
+
+        The table is read again before being updated, since concurrent connections write it too.
+        The failures are only logged.
+        """
+        try:
+            self.load()
+            entry = self.hosts.setdefault(host_key, {})
+            if fingerprint:
+                entry.setdefault("keys", {})[fingerprint] = time.time()
+            else:
+                entry["failed_at"] = time.time()
+            self.save()
+        except OSError as err:
+            logging.debug(f"HostTable.record failed: {err}")
+            #
+
+    def save(self) -> None:
+        """Atomically write the table.
+
+        Raises:
+            OSError: If the file cannot be written.
+        """
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # Unique per thread too: the threads of a process may write it concurrently
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"version": _TABLE_VERSION, "hosts": self.hosts}, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        #
+
+
+def select_identities(
+    identities: List[Identity], relevant: List[str], filtered: bool = True
+) -> List[Identity]:
+    """Choose the identities exposed to a client, in the order ssh offers them.
+
+    Args:
+        identities (List[Identity]): The identities stored by the agent.
+        relevant (List[str]): The fingerprints relevant to the target host, in order of preference.
+        filtered (bool): Whether to expose the relevant identities only, rather than first.
+
+    Returns:
+        List[Identity]: The exposed identities, all of them if none is relevant (unknown host).
+    """
+    by_fingerprint = {identity.fingerprint: identity for identity in identities}
+    chosen = [by_fingerprint[fp] for fp in dict.fromkeys(relevant) if fp in by_fingerprint]
+    if not chosen:
+        return identities
+    if filtered:
+        return chosen
+
+    return chosen + [identity for identity in identities if identity not in chosen]
+
+
+class FilteringProxy:
+    """Relay an agent to a single ssh connection, exposing only the identities of its host.
+
+    The relevant identities are those that have authenticated to the host before, the most recent
+    first, then those of its IdentityFile options in ~/.ssh/config. All the identities are exposed
+    to an unknown host, or after a filtered connection has failed. The other requests are relayed
+    as is.
+    """
+
+    def __init__(
+        self,
+        listener: socket.socket,
+        upstream: str,
+        target: Target,
+        table: Optional[HostTable] = None,
+        ssh_config: Optional[SSHConfig] = None,
+    ) -> None:
+        """Set the socket to answer on and the agent to relay.
+
+        Args:
+            listener (socket.socket): The listening proxy socket.
+            upstream (str): The agent socket path.
+            target (Target): The destination of the ssh connection.
+            table (Optional[HostTable]): The learned host table, loaded by default.
+            ssh_config (Optional[SSHConfig]): The ssh configuration, loaded from its cache by
+                default.
+        """
+        self.listener = listener
+        self.upstream = upstream
+        self.table = table or HostTable()
+
+        ssh_config = ssh_config or SSHConfig.load()
+        options = ssh_config.resolve(target.host, target.user, target.port)
+        port = options["port"][0]
+        self.host_key = f"{options['user'][0]}@{target.host.lower()}"
+        if port != "22":
+            self.host_key += f":{port}"
+
+        self.configured: List[str] = []
+        if "identityfile" in options:
+            self.configured = _fingerprints(
+                ssh_config.identity_files(target.host, target.user, target.port)
+            )
+
+        logging.debug(f"FilteringProxy for {self.host_key}, configured keys: {self.configured}")
+        #
+
+    def run(self, parent_pid: int = 0) -> None:
+        """Answer the connections until the parent process (ssh) exits or a signal is received.
+
+        Args:
+            parent_pid (int): The pid of the ssh process, 0 to run until a signal is received.
+        """
+        self.listener.setblocking(False)
+        try:
+            while not parent_pid or os.getppid() == parent_pid:
+                if cancellation.wait([self.listener.fileno()], PROXY_POLL_INTERVAL):
+                    try:
+                        conn, _ = self.listener.accept()
+                    except BlockingIOError:
+                        continue
+                    # ssh-agent forwarding may open several connections at once
+                    threading.Thread(target=self.relay, args=(conn,), daemon=True).start()
+
+        except SignalException as err:
+            logging.debug(f"FilteringProxy stopped: {err}")
+            #
+
+    def relay(self, conn: socket.socket) -> None:
+        """Relay the requests of a client connection until it is closed."""
+        # Connected on the first request, so that an agent failure is answered to the client
+        client = AgentClient(self.upstream)
+        filtered = signed = False
+
+        with conn:
+            conn.setblocking(True)
+            try:
+                while True:
+                    request = _recv_message(conn)
+                    if not request:
+                        break
+
+                    msg_type, payload = request[0], request[1:]
+                    try:
+                        if msg_type == SSH_AGENTC_REQUEST_IDENTITIES:
+                            reply_type, reply, filtered = self.list_identities(client)
+                        else:
+                            reply_type, reply = client.request(msg_type, payload)
+                    except AgentError as err:
+                        logging.debug(f"FilteringProxy.relay agent failure: {err}")
+                        reply_type, reply = SSH_AGENT_FAILURE, b""
+
+                    if reply_type == SSH_AGENT_SIGN_RESPONSE:
+                        signed = True
+                        self.record_success(payload)
+
+                    conn.sendall(struct.pack(">IB", len(reply) + 1, reply_type) + reply)
+
+            except OSError as err:
+                logging.debug(f"FilteringProxy.relay connection ended: {err}")
+
+            finally:
+                client.close()
+
+        if filtered and not signed:
+            logging.debug(f"FilteringProxy: no filtered identity authenticated {self.host_key}")
+            self.table.record(self.host_key)
+            #
+
+    def list_identities(self, client: AgentClient) -> Tuple[int, bytes, bool]:
+        """List the identities of the agent exposed to the host.
+
+        Raises:
+            AgentError: If the agent request fails.
+
+        Returns:
+            Tuple[int, bytes, bool]: The reply message number and content, and whether some
+                identities have been hidden.
+        """
+        msg_type, payload = client.request(SSH_AGENTC_REQUEST_IDENTITIES)
+        if msg_type != SSH_AGENT_IDENTITIES_ANSWER:
+            return msg_type, payload, False
+
+        # The identities are relayed as is, comments included
+        try:
+            reader = WireReader(payload)
+            identities = []
+            for _ in range(reader.read_uint32()):
+                blob, comment = reader.read_string(), reader.read_string()
+                identities.append(Identity(blob, comment, PublicKey.from_blob(blob).fingerprint))
+        except ValueError as err:
+            logging.debug(f"FilteringProxy relays a malformed identities answer: {err}")
+            return msg_type, payload, False
+
+        self.table.load()
+        relevant = self.table.successes(self.host_key) + self.configured
+        exposed = select_identities(identities, relevant, not self.table.has_failed(self.host_key))
+        logging.debug(f"FilteringProxy exposes {len(exposed)}/{len(identities)} identities")
+
+        reply = pack_uint32(len(exposed)) + b"".join(
+            pack_string(identity.blob) + pack_string(identity.comment) for identity in exposed
+        )
+        return SSH_AGENT_IDENTITIES_ANSWER, reply, len(exposed) < len(identities)
+
+    def record_success(self, sign_request: bytes) -> None:
+        """Learn that the identity of a signature request has authenticated to the host."""
+        try:
+            fingerprint = PublicKey.from_blob(WireReader(sign_request).read_string()).fingerprint
+        except ValueError as err:
+            logging.debug(f"FilteringProxy cannot read the signature request: {err}")
+            return
+
+        logging.debug(f"FilteringProxy: {fingerprint} authenticated {self.host_key}")
+        self.table.record(self.host_key, fingerprint)
+
+
+def run_proxy(command: List[str], host: Optional[str] = None) -> NoReturn:
+    """Execute an ssh command through a proxy agent exposing only the identities of its host.
+
+    The proxy socket is bound to this ssh connection: a forked process answers on it until ssh
+    exits, while ssh replaces the current process. Without agent or target, or if the proxy cannot
+    be set up, the command is executed as is.
+
+    Args:
+        command (List[str]): The ssh command and its arguments.
+        host (Optional[str]): The ``[user@]host[:port]`` target, else $SSH_AGENT_ADD_ID_HOST, else
+            the destination of the ssh command.
+
+    Raises:
+        OSError: If the command cannot be executed.
+    """
+    env = dict(os.environ)
+    upstream = os.getenv("SSH_AUTH_SOCK")
+    host = host or os.getenv(HOST_ENV)
+    try:
+        target = parse_target(host) if host else parse_ssh_target(command)
+    except ValueError as err:
+        logging.debug(f"run_proxy cannot parse the target: {err}")
+        target = None
+
+    if upstream and target:
+        try:
+            env["SSH_AUTH_SOCK"] = _fork_proxy(upstream, target)
+        except OSError as err:
+            sys.stderr.write(f"{APP_NAME}: cannot start the agent proxy: {err}{os.linesep}")
+
+    logging.debug(f"run_proxy command: {command}")
+
+    # The process is replaced: the profile must be written now, and the deadline timer would
+    # survive the exec
+    profiling.stop()
+    deadline.clear()
+    history.flush()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvpe(command[0], command, env)
+
+
+def _fork_proxy(upstream: str, target: Target) -> str:
+    """Start the proxy process of the current one, which is about to execute ssh.
+
+    Raises:
+        OSError: If the proxy socket cannot be bound or the process cannot be forked.
+
+    Returns:
+        str: The proxy socket path.
+    """
+    path = state_dir() / f"proxy-{os.getpid()}.sock"
+    path.unlink(missing_ok=True)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    parent_pid = os.getpid()
+    try:
+        listener.bind(str(path))
+        os.chmod(path, 0o600)
+        listener.listen()
+        pid = os.fork()
+    except OSError:
+        listener.close()
+        path.unlink(missing_ok=True)
+        raise
+
+    if pid:
+        # Only the proxy process keeps listening
+        listener.close()
+        return str(path)
+
+    _proxy_main(listener, path, upstream, target, parent_pid)
+
+
+def _proxy_main(
+    listener: socket.socket, path: Path, upstream: str, target: Target, parent_pid: int
+) -> NoReturn:
+    """Run the forked proxy process, detached from the terminal and from the outputs of ssh."""
+    status = 0
+    try:
+        # The outputs of ssh are pipes read by git until all their writers have closed them
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.setsid()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # The proxy lives as long as ssh, which the deadline does not bound
+        deadline.clear()
+
+        FilteringProxy(listener, upstream, target).run(parent_pid)
+    except BaseException:
+        status = 1
+    finally:
+        path.unlink(missing_ok=True)
+        os._exit(status)
+
+
+def _fingerprints(identity_files: List[str]) -> List[str]:
+    """Get the fingerprints of the public keys and certificates of some identity files."""
+    fingerprints = []
+    for priv_key_path in identity_files:
+        for pub_key_path in (certificate_path(priv_key_path), f"{priv_key_path}.pub"):
+            try:
+                fingerprints.append(load_public_key(pub_key_path).fingerprint)
+            except (OSError, ValueError):
+                continue
+    return fingerprints
+
+
+def _recv_message(conn: socket.socket) -> bytes:
+    """Read a message of the agent protocol from a client, empty once the client has closed.
+
+    Raises:
+        OSError: If the connection fails or the message is invalid.
+    """
+    header = _recv_exact(conn, 4)
+    if not header:
+        return b""
+    length = struct.unpack(">I", header)[0]
+    if not 0 < length <= MAX_MESSAGE_LEN:
+        raise OSError(f"Invalid SSH agent request length: {length}")
+
+    message = _recv_exact(conn, length)
+    if len(message) != length:
+        raise OSError("Truncated SSH agent request")
+    return message
+
+
+def _recv_exact(conn: socket.socket, size: int) -> bytes:
+    """Read `size` bytes, or less if the client closes the connection."""
+    chunks = []
+    while size:
+        chunk = conn.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
@@ -0,0 +1,312 @@
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import random
+from subprocess import CalledProcessError
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from ssh_agent_add_id import cancellation, deadline
+from ssh_agent_add_id.agent_client import AgentError, TransientAgentError
+from ssh_agent_add_id.constants import (
+    AGENT_BREAKER_COOLDOWN,
+    AGENT_BREAKER_THRESHOLD,
+    AGENT_RETRY_ATTEMPTS,
+    AGENT_RETRY_BASE_DELAY,
+    AGENT_RETRY_MAX_DELAY,
+)
+from ssh_agent_add_id.state import sock_id, state_dir
+
+
+CLOSED = "closed"
+HALF_OPEN = "half-open"
+OPEN = "open"
+
+T = TypeVar("T")
+
+# What ssh-add prints when the agent (or its relay) is busy or restarting
+_SSH_ADD_TRANSIENT = (
+    b"Broken pipe",
+    b"Connection refused",
+    b"Connection reset",
+    b"Resource temporarily unavailable",
+    b"communication with agent failed",
+    b"error fetching identities",
+)
+
+
+class CircuitOpenError(AgentError):
+    """Raised without agent I/O while the circuit breaker of the agent socket is open."""
+
+
+@dataclass
+class RetryStats:
+    """What the agent operations of the process have met on an agent socket."""
+
+    calls: int = 0
+    retries: int = 0
+    failures: int = 0
+    """The transient failures, retried or not."""
+    rejected: int = 0
+    """The calls failing fast because of an open circuit breaker."""
+    state: str = CLOSED
+    """The last known state of the circuit breaker."""
+
+
+_stats: Dict[str, RetryStats] = {}
+_stats_lock = threading.Lock()
+
+_breakers: Dict[Tuple[str, str], "CircuitBreaker"] = {}
+
+
+class CircuitBreaker:
+    """Make the callers fail fast while an SSH agent keeps failing.
+
+    After :data:`AGENT_BREAKER_THRESHOLD` consecutive transient failures, the breaker opens: the
+    agent is not queried anymore for :data:`AGENT_BREAKER_COOLDOWN` seconds. Then a single caller
+    probes it (half-open): a success closes the breaker, a failure opens it again.
+
+    The breaker is saved in the state directory and bound to the agent socket like the agent
+    state, so it is shared by the many processes started at once, and a restarted agent starts
+    with a closed one. Concurrent updates may lose a failure, which only delays the opening.
+
+    A process reads the saved breaker when it loads it, then again only once it is failing: a
+    breaker opened meanwhile by the other processes is met at the next transient failure.
+    """
+
+    def __init__(self, sock_path: str) -> None:
+        """Load the breaker of an agent socket.
+
+        The breaker does nothing if the socket cannot be identified, e.g. if it does not exist:
+        connecting to it is not a transient failure anyway.
+
+        Args:
+            sock_path (str): The agent socket path.
+        """
+        self.sock_path = sock_path
+        self.failures = 0
+        self.open_until = 0.0
+
+        try:
+            self.path: Optional[Path] = state_dir() / f"breaker-{sock_id(sock_path)}.json"
+        except OSError as err:
+            logging.debug(f"CircuitBreaker disabled for {sock_path}: {err}")
+            self.path = None
+
+        self.load()
+        #
+
+    @property
+    def state(self) -> str:
+        """str: :data:`CLOSED`, :data:`OPEN` or :data:`HALF_OPEN` (the cooldown has passed)."""
+        if self.failures < AGENT_BREAKER_THRESHOLD:
+            return CLOSED
+        return OPEN if time.time() < self.open_until else HALF_OPEN
+
+    def load(self) -> None:
+        """Read the breaker saved by the last failing process, if any."""
+        if not self.path:
+            return
+
+        self.failures, self.open_until = 0, 0.0
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+            self.failures = int(data["failures"])
+            self.open_until = float(data["open_until"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logging.debug(f"CircuitBreaker.load ignored invalid breaker file: {err}")
+            #
+
+    def allow(self) -> bool:
+        """Check if the agent may be queried, claiming the probe if the breaker is half-open.
+
+        Returns:
+            bool: False if the caller must fail fast.
+        """
+        if self.failures:
+            # Another process may have closed it, or be probing the agent
+            self.load()
+        state = self.state
+        if state == HALF_OPEN:
+            # The other processes keep failing fast during the probe
+            self.open_until = time.time() + AGENT_BREAKER_COOLDOWN
+            self.save()
+
+        return state != OPEN
+
+    def record_success(self) -> None:
+        """Close the breaker."""
+        if self.failures:
+            self.failures, self.open_until = 0, 0.0
+            self.save()
+            #
+
+    def record_failure(self) -> None:
+        """Count a transient failure, opening the breaker at the threshold."""
+        self.load()
+        self.failures += 1
+        if self.failures >= AGENT_BREAKER_THRESHOLD:
+            self.open_until = time.time() + AGENT_BREAKER_COOLDOWN
+
+        self.save()
+        #
+
+    def save(self) -> None:
+        """Atomically write the breaker, or remove it once closed."""
+        if not self.path:
+            return
+
+        try:
+            if not self.failures:
+                self.path.unlink(missing_ok=True)
+                return
+
+            # Unique per thread too: the threads of a process may save it concurrently
+            tmp_path = self.path.with_name(
+                f".{self.path.name}.{os.getpid()}.{threading.get_ident()}"
+            )
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump({"failures": self.failures, "open_until": self.open_until}, file)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            logging.debug(f"CircuitBreaker.save failed: {err}")
+
+
+def is_transient(err: BaseException) -> bool:
+    """Check if an agent operation has failed in a way that a retry may not meet again.
+
+    Args:
+        err (BaseException): The failure, from the agent socket or an ssh-add process.
+
+    Returns:
+        bool: True for a busy or restarting agent (or relay), False otherwise.
+    """
+    if isinstance(err, CalledProcessError):
+        stderr = err.stderr or b""
+        if isinstance(stderr, str):
+            stderr = stderr.encode(errors="replace")
+        return any(marker in stderr for marker in _SSH_ADD_TRANSIENT)
+
+    return isinstance(err, TransientAgentError)
+
+
+def backoff(attempt: int) -> float:
+    """Get the delay before a retry: exponential, with full jitter to spread the callers apart.
+
+    Args:
+        attempt (int): The number of the failed attempt, from 0.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    return random.uniform(0, min(AGENT_RETRY_MAX_DELAY, AGENT_RETRY_BASE_DELAY * 2**attempt))
+
+
+def call(sock_path: str, operation: Callable[[], T], attempts: int = AGENT_RETRY_ATTEMPTS) -> T:
+    """Run an agent operation, retrying its transient failures within the deadline.
+
+    The operation must be safe to repeat, e.g. a listing of the identities. The other failures are
+    raised at once, without counting for the circuit breaker since the agent has answered.
+
+    Args:
+        sock_path (str): The agent socket path, which the circuit breaker is bound to.
+        operation (Callable[[], T]): The agent operation.
+        attempts (int): The maximal number of attempts.
+
+    Raises:
+        CircuitOpenError: If the circuit breaker of the agent socket is open.
+        DeadlineExceededError: If the deadline has passed.
+        SignalException: If a signal has been received.
+        Exception: Any failure of the operation, once no attempt is left for a transient one.
+
+    Returns:
+        T: The result of the operation.
+    """
+    breaker = _breaker_of(sock_path)
+    stats = _stats_of(sock_path)
+    stats.calls += 1
+
+    try:
+        if not breaker.allow():
+            stats.rejected += 1
+            left = breaker.open_until - time.time()
+            raise CircuitOpenError(
+                f"The SSH agent at {sock_path} keeps failing, "
+                + f"not queried again before {max(left, 0):.1f}s"
+            )
+
+        for attempt in range(attempts):
+            try:
+                result = operation()
+            except Exception as err:
+                if not is_transient(err):
+                    raise
+
+                stats.failures += 1
+                breaker.record_failure()
+                # The breaker may have been opened by this failure or by other processes
+                if attempt + 1 == attempts or breaker.state == OPEN:
+                    raise
+
+                delay = deadline.remaining(backoff(attempt)) or 0.0
+                logging.debug(f"retry.call retries in {delay:.3f}s after: {err}")
+                stats.retries += 1
+                cancellation.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+
+        raise ValueError(f"Invalid number of attempts: {attempts}")
+
+    finally:
+        stats.state = breaker.state
+        #
+
+
+def summary_lines() -> List[str]:
+    """Describe the retries and the circuit breaker of each agent queried by the process.
+
+    Returns:
+        List[str]: The summary lines, empty if no agent has been queried with :func:`call`.
+    """
+    with _stats_lock:
+        items = sorted(_stats.items())
+
+    lines = []
+    for sock_path, stats in items:
+        lines.append(
+            f"  agent retries ({sock_path}): {stats.calls} calls, {stats.retries} retries, "
+            + f"{stats.failures} transient failures, {stats.rejected} failed fast, "
+            + f"circuit breaker {stats.state}"
+        )
+
+    return lines
+
+
+def _breaker_of(sock_path: str) -> CircuitBreaker:
+    """Get the breaker of an agent socket, loaded once by the process for each socket id."""
+    try:
+        key = (sock_path, sock_id(sock_path))
+    except OSError:
+        key = (sock_path, "")
+
+    with _stats_lock:
+        breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = CircuitBreaker(sock_path)
+        with _stats_lock:
+            breaker = _breakers.setdefault(key, breaker)
+
+    return breaker
+
+
+def _stats_of(sock_path: str) -> RetryStats:
+    with _stats_lock:
+        return _stats.setdefault(sock_path, RetryStats())
@@ -0,0 +1,310 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.certificates import with_certificate
+from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.fanout import ADDED, FAILED, STORED
+from ssh_agent_add_id.keys import (
+    OPENSSH_PRIVATE_BEGIN,
+    PublicKey,
+    load_private_key,
+    load_public_key,
+    unlock_private_key,
+)
+from ssh_agent_add_id.passphrase import PassphraseChain, add_identity_unattended
+from ssh_agent_add_id.ppk import PPK_MAGIC
+from ssh_agent_add_id.ssh_agent import SSHAgent
+from ssh_agent_add_id.state import AgentState, agent_pid
+
+
+# Private keys only read by ssh-add (PEM and PKCS#8), whose public key is in <path>.pub
+_PEM_PRIVATE_BEGIN = re.compile(rb"-----BEGIN (?:RSA |DSA |EC |ENCRYPTED )?PRIVATE KEY-----")
+_SNIFF_SIZE = 64
+
+
+@dataclass(frozen=True)
+class ScannedKey:
+    """A private key file found by a directory scan, with its public key."""
+
+    priv_key_path: str
+    public_key: PublicKey
+
+
+@dataclass
+class KeyResult:
+    """The outcome of ensuring that a scanned key is stored by the agent."""
+
+    priv_key_path: str
+    status: str
+    """One of :data:`STORED`, :data:`ADDED` or :data:`FAILED`."""
+    error: str = ""
+    fingerprint: str = field(default="", compare=False)
+    latency: float = field(default=0.0, compare=False)
+    """The seconds elapsed since the start of the operation until the key was resolved."""
+
+    def __str__(self) -> str:  # noqa: D105
+        return f"{self.priv_key_path}: {self.status}" + (f" ({self.error})" if self.error else "")
+
+
+def scan_keys(roots: List[str]) -> List[ScannedKey]:
+    """Find the private keys under some directories, whatever their file names.
+
+    The files are recognized by their content. The public key is read from the private key file
+    itself (OpenSSH and PuTTY formats) or from <priv_key_path>.pub. The files are read and parsed
+    in a thread pool.
+
+    Args:
+        roots (List[str]): The directories to scan recursively.
+
+    Raises:
+        FileNotFoundError: If a directory does not exist.
+
+    Returns:
+        List[ScannedKey]: The keys sorted by path, each public key being listed only once.
+    """
+    paths = []
+    for root in roots:
+        root = os.path.expanduser(root)
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f"{root} not found")
+        paths.extend(walk_files(root))
+
+    with ThreadPoolExecutor() as pool:
+        sniffed = cancellation.pool_map(pool, sniff_key_file, sorted(set(paths)))
+        scanned = [key for key in sniffed if key]
+
+    keys = {}
+    for key in scanned:
+        keys.setdefault(key.public_key.fingerprint, key)
+
+    logging.debug(f"scan_keys found {len(keys)} key(s) among {len(paths)} file(s)")
+
+    return list(keys.values())
+
+
+def ensure_scanned_identities(
+    sock_path: str,
+    keys: List[ScannedKey],
+    lifetime: Optional[int] = None,
+    confirm: bool = False,
+    passphrase_chain: Optional[PassphraseChain] = None,
+    on_result: Optional[Callable[[KeyResult], None]] = None,
+) -> List[KeyResult]:
+    """Add the scanned keys missing from the agent.
+
+    The agent identities are listed once, then only the missing keys are added. The keys that can
+    be decrypted in-process are added with pipelined requests over the same connection, the other
+    ones with ssh-add, one after the other since their passphrases may be prompted.
+
+    With passphrase providers, the passphrases of all the missing keys are first fetched
+    concurrently, each key being unlocked (or added by ssh-add) as soon as its passphrases are
+    available. Only the keys that no provider can unlock are left to the prompt.
+
+    Each result is passed to `on_result` as soon as its key is resolved, possibly from another
+    thread, whereas the returned list is only complete at the end.
+
+    Args:
+        sock_path (str): The agent socket path.
+        keys (List[ScannedKey]): The scanned keys.
+        lifetime (Optional[int]): The lifetime constraint of the identities, in seconds.
+        confirm (bool): Whether to add the identities with the confirm constraint.
+        passphrase_chain (Optional[PassphraseChain]): The passphrase providers to try before
+            prompting.
+        on_result (Optional[Callable[[KeyResult], None]]): Called with each result as soon as it
+            is known.
+
+    Raises:
+        AgentError: If the identities cannot be listed.
+        ExitCodeError: If a signal has been received.
+        OSError: If the agent socket cannot be read.
+
+    Returns:
+        List[KeyResult]: The result for each key, in the order of `keys`.
+    """
+    started_at = time.perf_counter()
+    state = AgentState.load(sock_path)
+    results: Dict[str, KeyResult] = {}
+
+    def resolve(key: ScannedKey, result: KeyResult) -> None:
+        result.fingerprint = key.public_key.fingerprint
+        result.latency = time.perf_counter() - started_at
+        results[key.priv_key_path] = result
+        if on_result:
+            on_result(result)
+
+    def unlock_unattended(key: ScannedKey) -> Union[bytes, KeyResult, None]:
+        assert passphrase_chain
+        unlocked = _unlock_unattended(sock_path, key, passphrase_chain, lifetime, confirm)
+        # Added by ssh-add or failed: no need to wait for the other keys
+        if isinstance(unlocked, KeyResult):
+            resolve(key, unlocked)
+        return unlocked
+
+    with AgentClient(sock_path) as client:
+        identities = client.list_identities()
+        state.update((identity.fingerprint for identity in identities), agent_pid(client))
+
+        missing = []
+        for key in keys:
+            if key.public_key.fingerprint in state.fingerprints:
+                resolve(key, KeyResult(key.priv_key_path, STORED))
+            else:
+                missing.append(key)
+
+        unlocked: List[Union[bytes, KeyResult, None]] = [None] * len(missing)
+        if passphrase_chain and missing:
+            with ThreadPoolExecutor() as pool:
+                unlocked = cancellation.pool_map(pool, unlock_unattended, missing)
+
+        native: List[Tuple[ScannedKey, bytes]] = []
+        for key, prefetched in zip(missing, unlocked):
+            if isinstance(prefetched, bytes):
+                native.append((key, prefetched))
+                continue
+            if isinstance(prefetched, KeyResult):
+                continue
+
+            try:
+                private_key = unlock_private_key(key.priv_key_path)
+            except ValueError as err:
+                resolve(key, KeyResult(key.priv_key_path, FAILED, str(err)))
+                continue
+
+            if private_key:
+                native.append((key, private_key.identity))
+            else:
+                resolve(key, _add_with_ssh_add(key.priv_key_path, lifetime, confirm))
+
+        # A single round trip for all the keys decrypted in-process, with their certificates
+        requests = [
+            (key, identity)
+            for key, private_identity in native
+            for identity in with_certificate(
+                key.priv_key_path, private_identity, key.public_key.blob
+            )
+        ]
+        try:
+            accepted = client.add_identities(
+                [identity for _, identity in requests], lifetime, confirm
+            )
+            # Only the refusal of a key matters, which comes first
+            first: Dict[str, bool] = {}
+            for (key, _), ok in zip(requests, accepted):
+                first.setdefault(key.priv_key_path, ok)
+            errors = [
+                "" if first[key.priv_key_path] else "The SSH agent refused to add the identity"
+                for key, _ in native
+            ]
+        except AgentError as err:
+            errors = [str(err)] * len(native)
+
+        for (key, _), error in zip(native, errors):
+            resolve(key, KeyResult(key.priv_key_path, FAILED if error else ADDED, error))
+
+    for key in keys:
+        if results[key.priv_key_path].status == ADDED:
+            state.add(key.public_key.fingerprint, lifetime)
+
+    return [results[key.priv_key_path] for key in keys]
+
+
+def walk_files(root: str) -> Iterator[str]:
+    """Yield the regular files under a directory, without following symbolic links to dirs."""
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            if os.path.isfile(path):
+                yield path
+
+
+def sniff_key_file(path: str) -> Optional[ScannedKey]:
+    """Recognize a private key file from its first bytes and get its public key.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        Optional[ScannedKey]: The key, or None if the file is not a readable private key.
+    """
+    try:
+        with open(path, "rb") as file:
+            head = file.read(_SNIFF_SIZE).lstrip()
+
+        if head.startswith(OPENSSH_PRIVATE_BEGIN.encode()) or head.startswith(PPK_MAGIC.encode()):
+            return ScannedKey(path, load_private_key(path).public_key)
+
+        if _PEM_PRIVATE_BEGIN.match(head):
+            return ScannedKey(path, load_public_key(path + ".pub"))
+
+    except (OSError, ValueError) as err:
+        logging.debug(f"sniff_key_file skips {path}: {err}")
+
+    return None
+
+
+def _unlock_unattended(
+    sock_path: str,
+    key: ScannedKey,
+    passphrase_chain: PassphraseChain,
+    lifetime: Optional[int],
+    confirm: bool,
+) -> Union[bytes, KeyResult, None]:
+    """Unlock a key with the passphrase providers, without prompting.
+
+    Raises:
+        ExitCodeError: If a signal has been received.
+
+    Returns:
+        Union[bytes, KeyResult, None]: The identity of a key decrypted in-process, the result of a
+            key added by ssh-add, or None if no passphrase has been accepted.
+    """
+    passphrases = passphrase_chain.passphrases(key.priv_key_path, key.public_key.fingerprint)
+
+    try:
+        private_key = unlock_private_key(key.priv_key_path, passphrases, prompt=False)
+    except ValueError:
+        return None
+
+    if private_key:
+        return private_key.identity
+
+    try:
+        if add_identity_unattended(sock_path, key.priv_key_path, passphrases, lifetime, confirm):
+            return KeyResult(key.priv_key_path, ADDED)
+
+    except ExitCodeError as err:
+        if err.exit_code == 130:
+            raise
+        return KeyResult(key.priv_key_path, FAILED, str(err))
+
+    except (AgentError, OSError, RuntimeError) as err:
+        return KeyResult(key.priv_key_path, FAILED, str(err))
+
+    return None
+
+
+def _add_with_ssh_add(priv_key_path: str, lifetime: Optional[int], confirm: bool) -> KeyResult:
+    """Add a private key to the agent with ssh-add.
+
+    Raises:
+        ExitCodeError: If a signal has been received.
+    """
+    try:
+        SSHAgent().add_identity(priv_key_path, lifetime, confirm)
+
+    except ExitCodeError as err:
+        if err.exit_code == 130:
+            raise
+        return KeyResult(priv_key_path, FAILED, str(err))
+
+    except (OSError, RuntimeError, ValueError) as err:
+        return KeyResult(priv_key_path, FAILED, str(err))
+
+    return KeyResult(priv_key_path, ADDED)
@@ -0,0 +1,99 @@
+import hashlib
+import shlex
+import shutil
+import sys
+from typing import Dict, Optional
+
+from ssh_agent_add_id.constants import APP_NAME
+from ssh_agent_add_id.keys import load_public_key
+from ssh_agent_add_id.state import state_dir
+
+
+# The hooks run at each prompt. They only fork a `stat` of the agent socket and call
+# ssh-agent-add-id when the socket changed and its state file does not list the identity (or
+# belongs to a dead agent). Everything else is done with shell builtins.
+_POSIX_HOOK = """\
+@FUNC@() {
+    [ -n "${SSH_AUTH_SOCK-}" ] || return 0
+    local sock_id line re='"pid": ([1-9][0-9]*)'
+    sock_id=$(@STAT@ "$SSH_AUTH_SOCK" 2>/dev/null) || return 0
+    if [ "$sock_id" = "${@VAR@_sock_id-}" ] && kill -0 "${@VAR@_pid:-$$}" 2>/dev/null; then
+        return 0
+    fi
+    @VAR@_sock_id=$sock_id
+    @VAR@_pid=
+    { IFS= read -r line < @STATE_DIR@/agent-"$sock_id".json; } 2>/dev/null
+    [[ $line =~ $re ]] && @VAR@_pid=@MATCH@
+    case $line in
+        *"\\"socket\\": \\"$SSH_AUTH_SOCK\\""*'"@FINGERPRINT@"'*)
+            kill -0 "${@VAR@_pid:-$$}" 2>/dev/null && return 0 ;;
+    esac
+    command @COMMAND@
+    @VAR@_pid=
+    { IFS= read -r line < @STATE_DIR@/agent-"$sock_id".json; } 2>/dev/null
+    [[ $line =~ $re ]] && @VAR@_pid=@MATCH@
+    return 0
+}
+"""
+
+_HOOKS: Dict[str, str] = {
+    "bash": _POSIX_HOOK.replace("@MATCH@", "${BASH_REMATCH[1]}")
+    + 'PROMPT_COMMAND="@FUNC@${PROMPT_COMMAND:+;$PROMPT_COMMAND}"\n',
+    "zsh": _POSIX_HOOK.replace("@MATCH@", "${match[1]}")
+    + "typeset -ga precmd_functions\nprecmd_functions+=(@FUNC@)\n",
+    "fish": """\
+function @FUNC@ --on-event fish_prompt
+    set -q SSH_AUTH_SOCK; or return 0
+    set -l sock_id (@STAT@ $SSH_AUTH_SOCK 2>/dev/null); or return 0
+    test "$sock_id" = "$@VAR@_sock_id"; and return 0
+    set -g @VAR@_sock_id $sock_id
+    set -l state @STATE_DIR@/agent-$sock_id.json
+    set -l line
+    test -r $state; and read line < $state
+    string match -q -- "*\\"socket\\": \\"$SSH_AUTH_SOCK\\"*\\"@FINGERPRINT@\\"*" "$line"
+    or command @COMMAND@
+    return 0
+end
+""",
+}
+
+SHELLS = tuple(_HOOKS)
+
+
+def generate_hook(shell: str, priv_key_path: str, pub_key_path: Optional[str] = None) -> str:
+    """Generate the prompt hook ensuring that an identity is stored by the SSH agent.
+
+    Args:
+        shell (str): The shell name, one of :data:`SHELLS`.
+        priv_key_path (str): The private key path of the identity.
+        pub_key_path (Optional[str]): The public key path, if not <priv_key_path>.pub.
+
+    Raises:
+        KeyError: If the shell is not supported.
+        OSError: If the public key cannot be read.
+        ValueError: If the public key is not valid.
+
+    Returns:
+        str: The hook source code to evaluate in the shell.
+    """
+    template = _HOOKS[shell]
+    fingerprint = load_public_key(pub_key_path or priv_key_path + ".pub").fingerprint
+
+    # Unique names, so several hooks (one per identity) can be installed in the same shell
+    suffix = hashlib.sha256(fingerprint.encode()).hexdigest()[:8]
+
+    command = [shutil.which(APP_NAME) or APP_NAME, priv_key_path]
+    if pub_key_path:
+        command.append(pub_key_path)
+
+    # Same format as AgentState.sock_id, but GNU and BSD stat have different options
+    stat = "stat -L -c %d-%i-%Z" if sys.platform.startswith("linux") else "stat -L -f %d-%i-%c"
+
+    return (
+        template.replace("@FUNC@", f"__ssh_agent_add_id_{suffix}")
+        .replace("@VAR@", f"__ssh_agent_add_id_{suffix}")
+        .replace("@STAT@", stat)
+        .replace("@STATE_DIR@", shlex.quote(str(state_dir())))
+        .replace("@FINGERPRINT@", fingerprint)
+        .replace("@COMMAND@", shlex.join(command))
+    )
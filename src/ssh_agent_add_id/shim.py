@@ -0,0 +1,152 @@
+from contextlib import redirect_stdout
+import logging
+import os
+import sys
+from typing import NoReturn
+
+from ssh_agent_add_id import deadline, history, profiling
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.certificates import add_with_certificate, cache_lifetime, paired_certificate
+from ssh_agent_add_id.cli_arguments import CliArguments
+from ssh_agent_add_id.constants import APP_NAME
+from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.keys import load_public_key, unlock_private_key
+from ssh_agent_add_id.passphrase import add_identity_unattended
+from ssh_agent_add_id.ssh_agent import SSHAgent
+from ssh_agent_add_id.state import AgentState, agent_pid, is_identity_cached
+
+
+def run_exec(args: CliArguments) -> NoReturn:
+    """Ensure that the identity is stored by the SSH agent, then execute the given command.
+
+    This is intended to be used as GIT_SSH_COMMAND: failing to ensure the identity is reported
+    but does not prevent the command (ssh) from running, except if a signal has been received.
+
+    Args:
+        args (CliArguments): The parsed CLI arguments of the exec subcommand.
+
+    Raises:
+        ExitCodeError: If a signal has been received while adding the identity.
+        OSError: If the command cannot be executed.
+    """
+    try:
+        ensure_identity(args)
+
+    except ExitCodeError as err:
+        if err.exit_code == 130:
+            raise
+        _warn(str(err))
+
+    except (AgentError, deadline.DeadlineExceededError, OSError, ValueError) as err:
+        _warn(str(err))
+
+    logging.debug(f"run_exec command: {args.exec_command}")
+
+    # The process is replaced: the profile must be written now, and the deadline timer would
+    # survive the exec
+    profiling.stop()
+    deadline.clear()
+    history.flush()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(args.exec_command[0], args.exec_command)
+
+
+def ensure_identity(args: CliArguments) -> None:
+    """Add the identity to the SSH agent unless the cached state or the agent already has it.
+
+    The membership check runs in-process: a fresh state file bound to the agent socket (or the
+    expiry deadline it records for an identity added with a lifetime) answers without any I/O with
+    the agent, otherwise the identities are listed through the agent socket. A missing identity is
+    added with the passphrase providers if possible, or else by prompting on the terminal.
+
+    A key paired with a valid certificate (``<priv_key_path>-cert.pub``) is checked through the
+    certificate instead: a renewed certificate is then added as soon as it is on disk, and the
+    certificate is trusted by the state until shortly before it expires.
+
+    Args:
+        args (CliArguments): The parsed CLI arguments.
+
+    Raises:
+        AgentError: If the SSH agent cannot be queried.
+        ExitCodeError: If ssh-add fails or a signal has been received.
+        OSError: If a key file or the agent socket cannot be read.
+        ValueError: If SSH_AUTH_SOCK is not set, the public key is invalid or the passphrase of a
+            PuTTY key has been rejected.
+    """
+    agent_sock = os.getenv("SSH_AUTH_SOCK")
+    if not agent_sock:
+        raise ValueError("SSH_AUTH_SOCK not found")
+
+    priv_key_path = str(args.resolve_priv_key_path())
+    public_key = load_public_key(str(args.resolve_pub_key_path()))
+    cert = paired_certificate(priv_key_path, public_key.blob)
+    fingerprint = cert.fingerprint if cert else public_key.fingerprint
+    if is_identity_cached(agent_sock, fingerprint):
+        logging.debug(f"ensure_identity segment hit: {fingerprint}")
+        return
+
+    state = AgentState.load(agent_sock)
+
+    if state.has_identity(fingerprint):
+        logging.debug(f"ensure_identity cache hit: {fingerprint}")
+        return
+
+    with AgentClient(agent_sock) as client:
+        identities = client.list_identities()
+        state.update((identity.fingerprint for identity in identities), agent_pid(client))
+
+    if fingerprint in state.fingerprints:
+        logging.debug(f"ensure_identity found by agent: {fingerprint}")
+        if cert:
+            state.add(fingerprint, cache_lifetime(cert))
+        return
+
+    lifetime = cache_lifetime(cert, args.lifetime) if cert else args.lifetime
+
+    # The passphrase providers do not need a terminal
+    passphrases = args.passphrase_chain.passphrases(priv_key_path, public_key.fingerprint)
+    if add_identity_unattended(agent_sock, priv_key_path, passphrases, args.lifetime, args.confirm):
+        state.add(fingerprint, lifetime)
+        return
+
+    if not _has_terminal():
+        raise ValueError("The identity has not been added: no terminal to prompt for passphrase")
+
+    # Keys decrypted in-process (unencrypted OpenSSH keys, PuTTY keys) do not need ssh-add
+    private_key = unlock_private_key(priv_key_path)
+    if private_key:
+        with AgentClient(agent_sock) as client:
+            add_with_certificate(
+                client,
+                priv_key_path,
+                private_key.identity,
+                private_key.public_key.blob,
+                args.lifetime,
+                args.confirm,
+            )
+
+    else:
+        agent = SSHAgent()
+        agent.check()
+
+        # The standard output belongs to the executed command
+        with redirect_stdout(sys.stderr):
+            agent.add_identity(priv_key_path, args.lifetime, args.confirm)
+
+    state.add(fingerprint, lifetime)
+
+
+def _has_terminal() -> bool:
+    """Check if the process has a controlling terminal to prompt the user with."""
+    try:
+        os.close(os.open("/dev/tty", os.O_RDWR))
+        return True
+    except OSError:
+        return False
+
+
+def _warn(message: str) -> None:
+    """Write a warning message to stderr."""
+    sys.stderr.write(f"{APP_NAME}: {message}{os.linesep}")
@@ -3,29 +3,46 @@ from typing import Any
 
 from pydantic import ConfigDict, validate_call
 
+from ssh_agent_add_id import cancellation
 from ssh_agent_add_id.errors import SignalException
 
 
 class SignalHandler:
-    """Raise a SignalException when some signals are received."""
+    """Cancel the running operations when some signals are received."""
 
     def __init__(self) -> None:
-        """Define a custom handler for some signals."""
+        """Define a custom handler for some signals, feeding the cancellation token."""
+        # Created now: the handler must not take the token lock, which the interrupted code may hold
+        token = cancellation.current()
+
         signal.signal(signal.SIGHUP, SignalHandler._handler)
         signal.signal(signal.SIGINT, SignalHandler._handler)
         signal.signal(signal.SIGTERM, SignalHandler._handler)
+
+        # Wake the main thread up even if a signal is delivered to another thread
+        signal.set_wakeup_fd(token.wakeup_fd, warn_on_full_buffer=False)
         #
 
     @staticmethod
     @validate_call(config=ConfigDict(strict=True))
     def _handler(signum: int, frame: Any) -> None:  # noqa: ANN401
-        """The signal handler throws a `SignalException` when it is called.
+        """The signal handler cancels the token that the blocking operations watch.
+
+        A `SignalException` is thrown at once only within :func:`cancellation.interruptible`
+        code, e.g. a passphrase prompt.
 
         Args:
             signum (int): The integer value of a signal.
             frame (Any): Required by the signal handler signature.
 
         Raises:
+            SignalException: If the interrupted code is interruptible, or if there is no token.
             ValidationError: If an argument type is not valid.
         """
-        raise SignalException(signum)
+        token = cancellation._token
+        if token is None:
+            raise SignalException(signum)
+
+        token.cancel(signum)
+        if token.interruptible:
+            raise SignalException(signum)
@@ -1,17 +1,22 @@
+import functools
 import getpass
 import logging
 import os
 import shlex
 import shutil
 from signal import SIGINT
-from subprocess import PIPE, CalledProcessError, Popen
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, TimeoutExpired
 import sys
-from typing import Optional, Union
+from typing import List, Optional, Tuple, Union
 
 from pexpect import EOF, TIMEOUT, spawn
-from pydantic import ConfigDict, validate_call
+from pydantic import ConfigDict, PositiveInt, validate_call
 
+from ssh_agent_add_id import backend, cancellation, deadline, profiling, retry
+from ssh_agent_add_id.agent_client import AgentClient, AgentError, TransientAgentError
 from ssh_agent_add_id.errors import ExitCodeError, SignalException
+from ssh_agent_add_id.keys import load_public_key, parse_openssh_public_key
+from ssh_agent_add_id.state import AgentState, agent_pid, is_identity_cached
 
 
 class SSHAgent:
@@ -43,48 +48,82 @@ class SSHAgent:
         #
 
     @validate_call(config=ConfigDict(strict=True))
-    def add_identity(self, priv_key_path: str) -> None:
+    def add_identity(
+        self,
+        priv_key_path: str,
+        lifetime: Optional[PositiveInt] = None,
+        confirm: bool = False,
+        passphrase: Optional[str] = None,
+        sock_path: Optional[str] = None,
+    ) -> None:
         """Add identity to the SSH agent.
 
         Args:
             priv_key_path (str): The private key path of the identity.
+            lifetime (Optional[int]): The maximum lifetime of the identity in the agent, in
+                seconds (ssh-add -t).
+            confirm (bool): Whether the agent must confirm each use of the identity (ssh-add -c).
+            passphrase (Optional[str]): The passphrase to answer ssh-add with, instead of
+                prompting the user. ssh-add output is not printed in that case.
+            sock_path (Optional[str]): The agent socket to add the identity to, instead of
+                SSH_AUTH_SOCK.
 
         Raises:
+            DeadlineExceededError: If the deadline has passed.
             ExitCodeError: If ssh-add exit code is not zero or a signal has been received.
             SignalException: If a signal has been received.
             RuntimeError: If ssh-add does not run as expected.
+            ValueError: If the given passphrase is rejected by ssh-add.
             ValidationError: If an argument type is not valid.
         """
-        cmd = f"ssh-add {priv_key_path}"
+        cmd = shlex.join(self._ssh_add_cmd(priv_key_path, lifetime, confirm))
         logging.debug(f"add_identity command: {cmd}")
 
+        # ssh-add is answered without prompting the user, so its output is not relevant
+        quiet = passphrase is not None
         child: Optional[spawn] = None
 
         try:
-            child = spawn(cmd, encoding="utf-8")
+            env = dict(os.environ, SSH_AUTH_SOCK=sock_path) if sock_path else None
+            child = spawn(cmd, encoding="utf-8", env=env)
 
             while True:
                 try:
-                    index = child.expect(
-                        [
-                            "Enter passphrase for.*",
-                            "Bad passphrase, try again for.*",
-                            "Identity added.*",
-                        ],
-                        timeout=1,  # fails with 0
-                    )
+                    with profiling.blocked(profiling.SUBPROCESS):
+                        timeout = deadline.remaining(1)  # fails with 0
+
+                        # pexpect cannot watch the cancellation token: wait for the output first
+                        if not child.buffer and not cancellation.wait([child.child_fd], timeout):
+                            raise TIMEOUT("Timeout exceeded.")
+
+                        index = child.expect(
+                            [
+                                "Enter passphrase for.*",
+                                "Bad passphrase, try again for.*",
+                                "Identity added.*",
+                            ],
+                            timeout=timeout,
+                        )
 
                     logging.debug(f"add_identity expect index: {index}")
                     logging.debug(f"add_identity before: {child.before}")
                     logging.debug(f"add_identity after: {child.after}")
 
+                    if quiet:
+                        if index == 1:
+                            raise ValueError(f"Bad passphrase for {priv_key_path}")
+                        if index == 0:
+                            child.sendline(passphrase)
+                        continue
+
                     sys.stdout.write(str(child.after))
 
                     # Calling flush() is required in order for printing to work
                     sys.stdout.flush()
 
                     if index in [0, 1]:
-                        passphrase = getpass.getpass("")
+                        with profiling.blocked(profiling.PROMPT), cancellation.interruptible():
+                            passphrase = getpass.getpass("")
                         if not passphrase:
                             # Since ssh-add stops if the passphrase is empty, we send it a bad one.
                             passphrase = ">P_F&DFdbob20m5wl`e;ARviU@Lb>*(Uuw_?A~0cILXPlDU8f;"
@@ -96,9 +135,14 @@ class SSHAgent:
                 except (EOF, TIMEOUT) as err:
                     logging.debug(f"add_identity expect exception: {type(err).__name__}")
 
-                    child.close()
+                    with profiling.blocked(profiling.SUBPROCESS):
+                        child.close()
+
+                    if isinstance(err, TIMEOUT):
+                        deadline.timed_out()
 
-                    if child.before:  # Get message from stderr before exception
+                    # Get message from stderr before exception
+                    if child.before and not quiet:
                         sys.stderr.write(child.before)
 
                     if child.exitstatus:
@@ -129,14 +173,83 @@ class SSHAgent:
                 child.close()
                 #
 
+    @validate_call(config=ConfigDict(strict=True))
+    def add_identity_askpass(
+        self, priv_key_path: str, lifetime: Optional[PositiveInt] = None, confirm: bool = False
+    ) -> None:
+        """Add identity to the SSH agent, prompting for the passphrase with SSH_ASKPASS.
+
+        This is meant for processes without terminal. It requires OpenSSH 8.4+ for
+        SSH_ASKPASS_REQUIRE.
+
+        Args:
+            priv_key_path (str): The private key path of the identity.
+            lifetime (Optional[int]): The maximum lifetime of the identity in the agent, in
+                seconds (ssh-add -t).
+            confirm (bool): Whether the agent must confirm each use of the identity (ssh-add -c).
+
+        Raises:
+            DeadlineExceededError: If the deadline has passed.
+            ExitCodeError: If ssh-add exit code is not zero or a signal has been received.
+            ValueError: If SSH_ASKPASS environment variable is not set.
+            ValidationError: If an argument type is not valid.
+        """
+        if not os.getenv("SSH_ASKPASS"):
+            raise ValueError("SSH_ASKPASS is not set, cannot prompt for the passphrase")
+
+        cmd = self._ssh_add_cmd(priv_key_path, lifetime, confirm)
+        logging.debug(f"add_identity_askpass command: {cmd}")
+
+        try:
+            # ssh-add waits for the askpass program, i.e. for the user
+            with profiling.blocked(profiling.PROMPT):
+                completed = cancellation.run(
+                    cmd,
+                    stdin=DEVNULL,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    env=dict(os.environ, SSH_ASKPASS_REQUIRE="force"),
+                    timeout=deadline.remaining(),
+                )
+
+        # The deadline has been reached (cancellation.run has already killed ssh-add)
+        except TimeoutExpired as err:
+            deadline.timed_out()
+            raise RuntimeError("ssh-add did not terminate as expected") from err
+
+        # A signal has been received (cancellation.run has already killed ssh-add)
+        except SignalException as err:
+            sys.stderr.write(f"{os.linesep}{err}{os.linesep}")
+            raise ExitCodeError(130)
+
+        logging.debug(f"add_identity_askpass returncode: {completed.returncode}")
+
+        if completed.stdout:
+            sys.stdout.write(self._append_nl(completed.stdout))
+        if completed.stderr:
+            sys.stderr.write(self._append_nl(completed.stderr))
+        if completed.returncode != 0:
+            raise ExitCodeError(completed.returncode, cmd)
+            #
+
     @validate_call(config=ConfigDict(strict=True))
     def is_identity_stored(self, pub_key_path: str) -> bool:
         """Search for the given identity among all those currently stored by the SSH agent.
 
+        An identity published as stored in the shared segment of the agent state is trusted
+        without querying the agent. Otherwise, the agent socket is queried directly if the doctor
+        subcommand has chosen the native backend, ssh-add being the fallback. An ssh-add without
+        -T lists the identities instead.
+
+        A busy or restarting agent (or relay) is queried again after a jittered backoff, and the
+        callers fail fast while it keeps failing (see :func:`ssh_agent_add_id.retry.call`).
+
         Args:
             pub_key_path (str): The public key path of the identity.
 
         Raises:
+            AgentError: If the agent keeps failing, or its circuit breaker is open.
+            DeadlineExceededError: If the deadline has passed.
             ExitCodeError: If ssh-add exit code is not zero or a signal has been received.
             RuntimeError: If ssh-add process is still alive.
             CalledProcessError: If ssh-add process fails.
@@ -146,23 +259,92 @@ class SSHAgent:
         Returns:
             bool: True if the given public key matches an identity stored by the SSH agent.
         """
-        cmd = f"ssh-add -T {pub_key_path}"
-        logging.debug(f"is_identity_stored command: {cmd}")
+        sock_path = os.getenv("SSH_AUTH_SOCK", "")
+        agent_backend = backend.current(sock_path)
+
+        try:
+            if self._is_identity_cached(pub_key_path):
+                logging.debug("is_identity_stored found by the agent state segment")
+                print("This identity has already been added to the SSH agent.")
+                return True
+
+            stored = None
+            if agent_backend.agent_io == backend.NATIVE:
+                stored = self._is_identity_stored_native(pub_key_path)
+            if stored is None:
+                stored = retry.call(
+                    sock_path,
+                    functools.partial(
+                        self._is_identity_stored_ssh_add, pub_key_path, agent_backend.ssh_add_test
+                    ),
+                )
+
+            if stored:
+                print("This identity has already been added to the SSH agent.")
+            return stored
+
+        except CalledProcessError as err:
+            if err.stdout:
+                sys.stdout.write(self._append_nl(err.stdout))
+            if err.stderr:
+                sys.stderr.write(self._append_nl(err.stderr))
+
+            raise ExitCodeError(err.returncode, shlex.join(err.cmd))
+
+        # The deadline has been reached (ssh-add is terminated below)
+        except TimeoutExpired as err:
+            deadline.timed_out()
+            raise RuntimeError("ssh-add did not terminate as expected") from err
+
+        # A signal has been received (ssh-add has already been interrupted)
+        except SignalException as err:
+            sys.stderr.write(f"{os.linesep}{err}{os.linesep}")
+            raise ExitCodeError(130)
 
+        # Rethrow all unknown exceptions
+        except:
+            raise
+            #
+
+    def _is_identity_stored_ssh_add(self, pub_key_path: str, ssh_add_test: bool) -> bool:
+        """Search for an identity with ssh-add -T, or else by listing the identities with -L.
+
+        Raises:
+            CalledProcessError: If ssh-add process fails.
+            RuntimeError: If ssh-add process is still alive.
+            SignalException: If a signal has been received (ssh-add is interrupted).
+            TimeoutExpired: If the deadline has been reached (ssh-add is terminated).
+            ValueError: If :attr:`subprocess.Popen.returncode` value is not an `int` or `None`.
+
+        Returns:
+            bool: Whether the identity is stored.
+        """
+        cmd = f"ssh-add -T {pub_key_path}" if ssh_add_test else "ssh-add -L"
         popen: Optional[Popen] = None
 
         try:
+            logging.debug(f"is_identity_stored command: {cmd}")
             popen = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE)
-            stdout, stderr = popen.communicate()
+            with profiling.blocked(profiling.SUBPROCESS):
+                stdout, stderr = cancellation.communicate(popen, deadline.remaining())
 
             logging.debug(f"is_identity_stored returncode: {popen.returncode}")
             logging.debug(f"is_identity_stored stdout: {stdout}")
             logging.debug(f"is_identity_stored stderr: {stderr}")
 
+            # The listed identities, or "The agent has no identities."
+            if not ssh_add_test and (
+                popen.returncode == 0 or popen.returncode == 1 and b"no identities" in stdout
+            ):
+                return popen.returncode == 0 and self._is_listed(stdout, pub_key_path)
+
             if popen.returncode == 0:
-                print("This identity has already been added to the SSH agent.")
                 return True
-            elif popen.returncode == 1 and "Agent signature failed for" in str(stderr):
+            elif (
+                popen.returncode == 1
+                and "Agent signature failed for" in str(stderr)
+                and "communication with agent failed" not in str(stderr)
+            ):
                 # ID not stored by agent
                 return False
             elif popen.returncode and popen.returncode >= 1:
@@ -175,25 +357,10 @@ class SSHAgent:
                     + f"[{type(popen.returncode).__name__}] {popen.returncode}"
                 )
 
-        except CalledProcessError as err:
-            if err.stdout:
-                sys.stdout.write(self._append_nl(err.stdout))
-            if err.stderr:
-                sys.stderr.write(self._append_nl(err.stderr))
-
-            raise ExitCodeError(err.returncode, shlex.join(err.cmd))
-
-        # A signal has been received
-        except SignalException as err:
+        except SignalException:
             if popen and popen.poll() is None:
                 popen.send_signal(SIGINT)
                 popen.wait()
-
-            sys.stderr.write(f"{os.linesep}{err}{os.linesep}")
-            raise ExitCodeError(130)
-
-        # Rethrow all unknown exceptions
-        except:
             raise
 
         finally:
@@ -201,6 +368,76 @@ class SSHAgent:
                 popen.terminate()
                 #
 
+    @staticmethod
+    def _is_identity_cached(pub_key_path: str) -> bool:
+        """Check the shared segment of the agent state, without agent I/O."""
+        sock_path = os.getenv("SSH_AUTH_SOCK")
+        if not sock_path:
+            return False
+
+        try:
+            fingerprint = load_public_key(pub_key_path).fingerprint
+        except (OSError, ValueError) as err:
+            logging.debug(f"is_identity_stored cannot check the agent state: {err}")
+            return False
+
+        return is_identity_cached(sock_path, fingerprint)
+
+    @staticmethod
+    def _is_identity_stored_native(pub_key_path: str) -> Optional[bool]:
+        """Search for an identity by listing those of the agent through its socket.
+
+        Raises:
+            AgentError: If the agent keeps failing, or its circuit breaker is open.
+            DeadlineExceededError: If the deadline has passed.
+            SignalException: If a signal has been received.
+
+        Returns:
+            Optional[bool]: Whether the identity is stored, or None if ssh-add must be used instead.
+        """
+
+        def list_fingerprints(sock_path: str) -> Tuple[List[str], int]:
+            with AgentClient(sock_path) as client:
+                fingerprints = [identity.fingerprint for identity in client.list_identities()]
+                return fingerprints, agent_pid(client)
+
+        try:
+            fingerprint = load_public_key(pub_key_path).fingerprint
+            sock_path = os.environ["SSH_AUTH_SOCK"]
+            fingerprints, pid = retry.call(
+                sock_path, functools.partial(list_fingerprints, sock_path)
+            )
+        # ssh-add would meet the same busy agent
+        except (retry.CircuitOpenError, TransientAgentError):
+            raise
+        except (AgentError, KeyError, OSError, ValueError) as err:
+            logging.debug(f"is_identity_stored falls back to ssh-add: {err}")
+            return None
+
+        SSHAgent._record_listing(fingerprints, pid)
+        return fingerprint in fingerprints
+
+    @staticmethod
+    def _is_listed(output: bytes, pub_key_path: str) -> bool:
+        """Search for a public key in the output of ssh-add -L."""
+        fingerprints = []
+        for line in output.decode(errors="replace").splitlines():
+            try:
+                fingerprints.append(parse_openssh_public_key(line).fingerprint)
+            except ValueError:
+                continue
+
+        SSHAgent._record_listing(fingerprints)
+        return load_public_key(pub_key_path).fingerprint in fingerprints
+
+    @staticmethod
+    def _record_listing(fingerprints: List[str], pid: int = 0) -> None:
+        """Save a complete listing of the agent identities into its state (and shared segment)."""
+        try:
+            AgentState.load(os.environ["SSH_AUTH_SOCK"]).update(fingerprints, pid)
+        except (KeyError, OSError) as err:
+            logging.debug(f"is_identity_stored cannot record the listing: {err}")
+
     @validate_call(config=ConfigDict(strict=True))
     def _append_nl(self, message: Union[bytes, str]) -> str:
         """Append a newline at the end of the message if there is none.
@@ -223,3 +460,15 @@ class SSHAgent:
             return out
         else:
             return out + os.linesep
+
+    @staticmethod
+    def _ssh_add_cmd(priv_key_path: str, lifetime: Optional[int], confirm: bool) -> List[str]:
+        """Build the ssh-add command adding an identity with the given constraints."""
+        cmd = ["ssh-add"]
+        if lifetime is not None:
+            cmd += ["-t", str(lifetime)]
+        if confirm:
+            cmd.append("-c")
+        cmd.append(priv_key_path)
+
+        return cmd
@@ -0,0 +1,407 @@
+import getpass
+import glob
+import json
+import logging
+import os
+import re
+import socket
+from typing import Any, Dict, List, Optional
+
+from ssh_agent_add_id.state import state_dir
+
+
+# The identity files tried by ssh when no IdentityFile applies to a host
+DEFAULT_IDENTITY_FILES = (
+    "~/.ssh/id_rsa",
+    "~/.ssh/id_ecdsa",
+    "~/.ssh/id_ecdsa_sk",
+    "~/.ssh/id_ed25519",
+    "~/.ssh/id_ed25519_sk",
+    "~/.ssh/id_xmss",
+)
+SYSTEM_CONFIG_PATH = "/etc/ssh/ssh_config"
+USER_CONFIG_PATH = "~/.ssh/config"
+
+_CACHE_FILE_NAME = "ssh_config.json"
+_CACHE_VERSION = 1
+_INCLUDE_MAX_DEPTH = 16
+_LINE_RE = re.compile(r"\s*([A-Za-z]+)\s*(?:=\s*|\s+)(.*)")
+_TOKEN_RE = re.compile(r"%(.)")
+_ENV_RE = re.compile(r"\$\{(\w+)\}")
+
+# The options whose values accumulate instead of the first one winning
+_MULTI_OPTIONS = {"identityfile"}
+
+Condition = List[Any]
+"""A Host condition ``["host", patterns]`` or a Match one ``["match", [[criterion, arg], ...]]``."""
+
+
+class SSHConfig:
+    """The parsed ssh_config(5) files of the user, to resolve the identity files of a host.
+
+    The files are parsed once into blocks of options, each bound to the Host and Match conditions
+    that apply to it, the Include directives being followed. The parsed blocks are cached in the
+    state directory along with the modification times and sizes of the files read, so that the next
+    invocations reuse them until a file changes.
+
+    Only the Match criteria that can be evaluated without side effects are supported: ``exec`` and
+    ``localnetwork`` never match.
+    """
+
+    def __init__(self, blocks: List[Dict[str, Any]], sources: List[List[Any]]) -> None:
+        """Set the parsed configuration.
+
+        Args:
+            blocks (List[Dict[str, Any]]): The blocks of options, each a dict with the "conditions"
+                that must all match and the "options" as [keyword, value] pairs.
+            sources (List[List[Any]]): The ["file", path, mtime_ns, size] of the files read and the
+                ["glob", pattern, matches] of the Include directives, to validate the cache.
+        """
+        self.blocks = blocks
+        self.sources = sources
+        #
+
+    @classmethod
+    def parse(cls, paths: Optional[List[str]] = None) -> "SSHConfig":
+        """Parse some ssh_config files, in order of precedence.
+
+        Args:
+            paths (Optional[List[str]]): The config file paths, the user one then the system one by
+                default. The missing files are skipped.
+
+        Raises:
+            ValueError: If the Include directives are nested too deeply.
+
+        Returns:
+            SSHConfig: The parsed configuration.
+        """
+        config = cls([], [])
+        for path in paths or _default_paths():
+            path = os.path.expanduser(path)
+            base_dir = os.path.dirname(path)
+            config._parse_file(path, base_dir, [], 0)
+
+        return config
+        #
+
+    @classmethod
+    def load(cls, paths: Optional[List[str]] = None) -> "SSHConfig":
+        """Get the parsed ssh_config files from the cache, parsing them again if any has changed.
+
+        Args:
+            paths (Optional[List[str]]): The config file paths, the user one then the system one by
+                default.
+
+        Raises:
+            ValueError: If the Include directives are nested too deeply.
+
+        Returns:
+            SSHConfig: The parsed configuration.
+        """
+        paths = [os.path.expanduser(path) for path in paths or _default_paths()]
+
+        try:
+            cache_path = state_dir() / _CACHE_FILE_NAME
+        except OSError as err:
+            logging.debug(f"SSHConfig.load cannot use the cache: {err}")
+            return cls.parse(paths)
+
+        try:
+            with open(cache_path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data["version"] == _CACHE_VERSION and data["paths"] == paths:
+                config = cls(data["blocks"], data["sources"])
+                if config.is_fresh():
+                    return config
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logging.debug(f"SSHConfig.load ignored invalid cache file: {err}")
+
+        config = cls.parse(paths)
+        logging.debug(f"SSHConfig.load parsed {len(config.sources)} source(s)")
+
+        data = {
+            "version": _CACHE_VERSION,
+            "paths": paths,
+            "blocks": config.blocks,
+            "sources": config.sources,
+        }
+        try:
+            tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}")
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(data, file, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        except OSError as err:
+            logging.debug(f"SSHConfig.load cannot write the cache: {err}")
+
+        return config
+        #
+
+    def is_fresh(self) -> bool:
+        """Check if none of the files read has changed, and no Include glob matches other files."""
+        for source in self.sources:
+            if source[0] == "glob":
+                if _glob(source[1]) != source[2]:
+                    return False
+            elif _stat(source[1]) != source[2:]:
+                return False
+
+        return True
+        #
+
+    def resolve(
+        self, host: str, user: Optional[str] = None, port: Optional[int] = None
+    ) -> Dict[str, List[str]]:
+        """Get the options that apply to a host, like ``ssh -G`` does.
+
+        Args:
+            host (str): The host, as given to ssh (possibly an alias).
+            user (Optional[str]): The remote user, if given along with the host.
+            port (Optional[int]): The remote port, if given along with the host.
+
+        Returns:
+            Dict[str, List[str]]: The values of each option, by lowercase keyword. The first value
+                wins, except for the options which accumulate (e.g. identityfile).
+        """
+        options: Dict[str, List[str]] = {}
+        if user:
+            options["user"] = [user]
+        if port:
+            options["port"] = [str(port)]
+
+        original_host = host.lower()
+        for block in self.blocks:
+            hostname = options.get("hostname", [original_host])[0].replace("%h", original_host)
+            remote_user = options.get("user", [getpass.getuser()])[0]
+            if not all(
+                _match_condition(condition, original_host, hostname, remote_user, options)
+                for condition in block["conditions"]
+            ):
+                continue
+
+            for keyword, value in block["options"]:
+                if keyword in _MULTI_OPTIONS:
+                    options.setdefault(keyword, []).append(value)
+                else:
+                    options.setdefault(keyword, [value])
+
+        options.setdefault("hostname", [original_host])
+        options["hostname"] = [options["hostname"][0].replace("%h", original_host).lower()]
+        options.setdefault("user", [getpass.getuser()])
+        options.setdefault("port", ["22"])
+        options["host"] = [original_host]
+
+        return options
+        #
+
+    def identity_files(
+        self, host: str, user: Optional[str] = None, port: Optional[int] = None
+    ) -> List[str]:
+        """Get the identity files that ssh would use to connect to a host.
+
+        Args:
+            host (str): The host, as given to ssh (possibly an alias).
+            user (Optional[str]): The remote user, if given along with the host.
+            port (Optional[int]): The remote port, if given along with the host.
+
+        Returns:
+            List[str]: The expanded identity file paths (existing or not), without duplicates. The
+                default ones if no IdentityFile applies to the host.
+        """
+        options = self.resolve(host, user, port)
+        values = options.get("identityfile")
+        if values is None:
+            values = list(DEFAULT_IDENTITY_FILES)
+
+        paths: List[str] = []
+        for value in values:
+            # "IdentityFile none" disables the default identity files
+            if value.lower() == "none":
+                continue
+            path = _expand_path(value, options)
+            if path not in paths:
+                paths.append(path)
+
+        logging.debug(f"SSHConfig.identity_files for {host}: {paths}")
+
+        return paths
+        #
+
+    def _parse_file(
+        self, path: str, base_dir: str, conditions: List[Condition], depth: int
+    ) -> None:
+        """Parse a config file into blocks, applying the conditions of the including block."""
+        self.sources.append(["file", path, *_stat(path)])
+        try:
+            with open(path, encoding="utf-8", errors="replace") as file:
+                lines = file.read().splitlines()
+        except OSError as err:
+            logging.debug(f"SSHConfig skips {path}: {err}")
+            return
+
+        block: Dict[str, Any] = {"conditions": conditions, "options": []}
+        self.blocks.append(block)
+
+        for line in lines:
+            match = _LINE_RE.match(line)
+            if not match or line.lstrip().startswith("#"):
+                continue
+
+            keyword = match.group(1).lower()
+            args = _split_args(match.group(2))
+            if not args:
+                continue
+
+            if keyword in ("host", "match"):
+                condition = (
+                    ["host", args] if keyword == "host" else ["match", _parse_match_args(args)]
+                )
+                block = {"conditions": [*conditions, condition], "options": []}
+                self.blocks.append(block)
+
+            elif keyword == "include":
+                if depth >= _INCLUDE_MAX_DEPTH:
+                    raise ValueError(f"Too many nested Include directives in {path}")
+
+                for pattern in args:
+                    pattern = os.path.join(base_dir, os.path.expanduser(pattern))
+                    included = _glob(pattern)
+                    self.sources.append(["glob", pattern, included])
+                    for included_path in included:
+                        self._parse_file(included_path, base_dir, block["conditions"], depth + 1)
+
+                # The options following the Include still belong to the enclosing block
+                block = {"conditions": block["conditions"], "options": []}
+                self.blocks.append(block)
+
+            else:
+                block["options"].append([keyword, " ".join(args)])
+                #
+
+
+def _default_paths() -> List[str]:
+    """Get the user and system config file paths."""
+    return [USER_CONFIG_PATH, SYSTEM_CONFIG_PATH]
+
+
+def _stat(path: str) -> List[int]:
+    """Get the modification time and size of a file, or [-1, -1] if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [-1, -1]
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _glob(pattern: str) -> List[str]:
+    """Get the files matching an Include pattern, in lexical order like ssh."""
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+def _split_args(value: str) -> List[str]:
+    """Split the arguments of a config line, honoring the double quotes and trailing comments."""
+    args = []
+    for quoted, bare in re.findall(r'"([^"]*)"|(\S+)', value):
+        if not quoted and bare.startswith("#"):
+            break
+        args.append(quoted or bare)
+    return args
+
+
+def _parse_match_args(args: List[str]) -> List[List[str]]:
+    """Group the arguments of a Match line into [criterion, argument] pairs."""
+    criteria = []
+    index = 0
+    while index < len(args):
+        criterion = args[index].lower()
+        index += 1
+        if criterion.lstrip("!") in ("all", "canonical", "final"):
+            criteria.append([criterion, ""])
+        elif index < len(args):
+            criteria.append([criterion, args[index]])
+            index += 1
+    return criteria
+
+
+def _match_pattern(name: str, pattern: str) -> bool:
+    """Match a name against an ssh pattern, where * and ? are the only wildcards."""
+    regex = "".join(
+        ".*" if char == "*" else "." if char == "?" else re.escape(char) for char in pattern
+    )
+    return re.fullmatch(regex, name, re.IGNORECASE) is not None
+
+
+def _match_pattern_list(name: str, patterns: List[str]) -> bool:
+    """Match a name against some patterns: any negated (!) match rejects it."""
+    matched = False
+    for pattern in patterns:
+        if pattern.startswith("!"):
+            if _match_pattern(name, pattern[1:]):
+                return False
+        elif _match_pattern(name, pattern):
+            matched = True
+    return matched
+
+
+def _match_condition(
+    condition: Condition,
+    original_host: str,
+    hostname: str,
+    user: str,
+    options: Dict[str, List[str]],
+) -> bool:
+    """Evaluate a Host or Match condition."""
+    kind, args = condition
+    if kind == "host":
+        return _match_pattern_list(original_host, args)
+
+    for criterion, arg in args:
+        negated = criterion.startswith("!")
+        criterion = criterion.lstrip("!")
+        patterns = arg.split(",")
+
+        if criterion in ("all", "final"):
+            result = True
+        elif criterion == "host":
+            result = _match_pattern_list(hostname, patterns)
+        elif criterion == "originalhost":
+            result = _match_pattern_list(original_host, patterns)
+        elif criterion == "user":
+            result = _match_pattern_list(user, patterns)
+        elif criterion == "localuser":
+            result = _match_pattern_list(getpass.getuser(), patterns)
+        elif criterion == "tagged":
+            result = _match_pattern_list(options.get("tag", [""])[0], patterns)
+        else:
+            # exec, localnetwork and canonical need ssh itself
+            logging.debug(f"SSHConfig does not evaluate Match {criterion}")
+            result = False
+
+        if result == negated:
+            return False
+
+    return True
+
+
+def _expand_path(value: str, options: Dict[str, List[str]]) -> str:
+    """Expand the ~, ${VAR} and %-tokens of an IdentityFile value."""
+    home = os.path.expanduser("~")
+    local_hostname = socket.gethostname()
+    tokens = {
+        "%": "%",
+        "d": home,
+        "h": options["hostname"][0],
+        "i": str(os.getuid()),
+        "k": options["host"][0],
+        "L": local_hostname.split(".")[0],
+        "l": local_hostname,
+        "n": options["host"][0],
+        "p": options["port"][0],
+        "r": options["user"][0],
+        "u": getpass.getuser(),
+    }
+
+    value = _ENV_RE.sub(lambda match: os.getenv(match.group(1), ""), value)
+    value = _TOKEN_RE.sub(lambda match: tokens.get(match.group(1), match.group(0)), value)
+    return os.path.expanduser(value)
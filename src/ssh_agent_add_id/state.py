@@ -0,0 +1,389 @@
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from ssh_agent_add_id import backend, history, state_segment
+from ssh_agent_add_id.agent_client import AgentClient
+from ssh_agent_add_id.constants import APP_NAME, STATE_EXPIRY_MARGIN
+from ssh_agent_add_id.keys import load_public_key
+
+
+def state_dir() -> Path:
+    """Get the private directory holding the state files, creating it if needed.
+
+    It is located under $XDG_RUNTIME_DIR when defined, or the temporary directory otherwise.
+
+    Raises:
+        PermissionError: If the directory is owned by another user.
+
+    Returns:
+        Path: The state directory path.
+    """
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        path = Path(runtime_dir) / APP_NAME
+    else:
+        # Only imported without XDG_RUNTIME_DIR, for the startup of the fast path
+        import tempfile
+
+        path = Path(tempfile.gettempdir()) / f"{APP_NAME}-{os.getuid()}"
+
+    path.mkdir(mode=0o700, exist_ok=True)
+    if path.stat().st_uid != os.getuid():
+        raise PermissionError(f"{path} is not owned by the current user")
+
+    return path
+
+
+class AgentState:
+    """The cached view of the identities stored by an SSH agent.
+
+    A state file is bound to the device, inode and ctime of the agent socket, so a restarted agent
+    (which creates a new socket) never matches the state of its predecessor, even if the inode
+    number is reused.
+
+    The state also records the expiry deadline of the identities added with a lifetime
+    constraint, so their membership is known without querying the agent until shortly before
+    they expire. The other identities are trusted for a TTL learned from the history of their
+    losses (see :mod:`ssh_agent_add_id.history`), or else the one of the backend.
+
+    Each save also publishes the state into a memory-mapped segment, read by
+    :func:`is_identity_cached` without locking nor JSON parsing.
+    """
+
+    def __init__(
+        self,
+        sock_path: str,
+        sock_id: str,
+        fingerprints: Optional[Iterable[str]] = None,
+        updated_at: float = 0.0,
+        pid: int = 0,
+        expires: Optional[Dict[str, float]] = None,
+        ttls: Optional[Dict[str, float]] = None,
+    ) -> None:
+        """Initialize the state of an agent.
+
+        Args:
+            sock_path (str): The agent socket path.
+            sock_id (str): The ``<device>-<inode>-<ctime>`` identifier of the agent socket.
+            fingerprints (Optional[Iterable[str]]): The fingerprints of the stored identities.
+            updated_at (float): The timestamp of the last agent query, 0 if never queried.
+            pid (int): The pid of the agent process, 0 if unknown.
+            expires (Optional[Dict[str, float]]): The expiry timestamps of the stored identities
+                added with a lifetime constraint, by fingerprint.
+            ttls (Optional[Dict[str, float]]): The TTLs learned for the stored identities, by
+                fingerprint.
+        """
+        self.sock_path = sock_path
+        self.sock_id = sock_id
+        self.pid = pid
+        self.fingerprints: Set[str] = set(fingerprints or [])
+        self.updated_at = updated_at
+        self.expires: Dict[str, float] = dict(expires or {})
+        self.ttls: Dict[str, float] = dict(ttls or {})
+        #
+
+    @property
+    def path(self) -> Path:
+        """Path: The state file path."""
+        return state_dir() / f"agent-{self.sock_id}.json"
+        #
+
+    @property
+    def segment_path(self) -> Path:
+        """Path: The shared segment path."""
+        return state_dir() / f"agent-{self.sock_id}.seg"
+        #
+
+    @classmethod
+    def load(cls, sock_path: str) -> "AgentState":
+        """Load the state bound to the given agent socket.
+
+        An empty state is returned if there is no state file or if it cannot be parsed.
+
+        Args:
+            sock_path (str): The agent socket path.
+
+        Raises:
+            OSError: If the agent socket does not exist.
+
+        Returns:
+            AgentState: The agent state.
+        """
+        state = cls(sock_path, sock_id(sock_path))
+
+        try:
+            with open(state.path, encoding="utf-8") as file:
+                data = json.load(file)
+            pid = int(data.get("pid", 0))
+            if data["socket"] != sock_path or (pid and not _is_alive(pid)):
+                logging.debug(f"AgentState.load ignored the state of another agent: {data}")
+                return state
+            state.pid = pid
+            state.fingerprints = set(data["fingerprints"])
+            state.updated_at = float(data["updated_at"])
+            state.expires = {
+                fp: float(deadline) for fp, deadline in data.get("expires", {}).items()
+            }
+            state.ttls = {fp: float(ttl) for fp, ttl in data.get("ttls", {}).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logging.debug(f"AgentState.load ignored invalid state file: {err}")
+
+        return state
+        #
+
+    def is_fresh(self, ttl: Optional[float] = None) -> bool:
+        """Check if the state has been updated from the agent less than `ttl` seconds ago.
+
+        The TTL defaults to the one of the backend chosen by the doctor subcommand.
+        """
+        return _is_trusted(self.sock_path, self.updated_at, None, ttl)
+        #
+
+    def has_identity(self, fingerprint: str, ttl: Optional[float] = None) -> bool:
+        """Check if the state tells, without querying the agent, that it stores an identity.
+
+        An identity with an expiry deadline is trusted until shortly before this deadline, any
+        other one only while the state is fresh. A positive answer is recorded as a hit into the
+        history.
+
+        Args:
+            fingerprint (str): The fingerprint of the identity.
+            ttl (Optional[float]): The maximal age of the state for the identities without
+                deadline, the learned one or else the backend one by default.
+
+        Returns:
+            bool: True if the identity is known to be stored, False if the agent must be queried.
+        """
+        if fingerprint not in self.fingerprints:
+            return False
+
+        if ttl is None:
+            ttl = self.ttls.get(fingerprint)
+        if not _is_trusted(self.sock_path, self.updated_at, self.expires.get(fingerprint), ttl):
+            return False
+
+        history.record(history.HIT, self.sock_path, fingerprint)
+        return True
+        #
+
+    def add(self, fingerprint: str, lifetime: Optional[int] = None) -> None:
+        """Record that an identity has just been added to the agent, then save.
+
+        Args:
+            fingerprint (str): The fingerprint of the identity.
+            lifetime (Optional[int]): The lifetime constraint of the identity in seconds, if any.
+        """
+        if fingerprint not in self.fingerprints:
+            history.record(history.APPEARED, self.sock_path, fingerprint)
+        self.fingerprints.add(fingerprint)
+        if lifetime:
+            self.expires[fingerprint] = time.time() + lifetime
+        self.save()
+        #
+
+    def update(self, fingerprints: Iterable[str], pid: int = 0) -> None:
+        """Replace the stored fingerprints with those just listed by the agent, then save.
+
+        The expiry deadlines of the identities no longer listed, or already past, are dropped. The
+        listing is recorded into the history, from which the TTLs of the identities are learned
+        again.
+
+        Args:
+            fingerprints (Iterable[str]): The fingerprints listed by the agent.
+            pid (int): The pid of the agent process, 0 to keep the current one.
+        """
+        listed = set(fingerprints)
+        history.record_listing(self.sock_path, self.fingerprints, self.updated_at, listed)
+
+        self.fingerprints = listed
+        self.updated_at = time.time()
+        self.expires = {
+            fp: deadline
+            for fp, deadline in self.expires.items()
+            if fp in self.fingerprints and deadline > self.updated_at
+        }
+        self.ttls = history.learned_ttls(
+            self.sock_path, self.fingerprints, backend.current(self.sock_path).state_ttl
+        )
+        if pid:
+            self.pid = pid
+        self.save()
+        #
+
+    def save(self) -> None:
+        """Atomically write the state file.
+
+        The JSON content is written on a single line, so shell hooks can read it with a builtin.
+        """
+        data = {
+            "socket": self.sock_path,
+            "pid": self.pid,
+            "fingerprints": sorted(self.fingerprints),
+            "updated_at": self.updated_at,
+            "expires": self.expires,
+            "ttls": self.ttls,
+        }
+
+        path = self.path
+        # Unique per thread too: the threads of a process may save it concurrently
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        # The segment is only a faster path: the state file remains the reference
+        try:
+            sock_key = tuple(int(part) for part in self.sock_id.split("-"))
+            if len(sock_key) != 3:
+                raise ValueError(f"invalid socket id: {self.sock_id}")
+            identities = (
+                (fp, self.expires.get(fp, 0.0), self.ttls.get(fp, 0.0)) for fp in self.fingerprints
+            )
+            state_segment.publish(
+                self.segment_path, sock_key, self.pid, self.updated_at, identities
+            )
+        except (OSError, ValueError) as err:
+            logging.debug(f"AgentState.save cannot publish the segment: {err}")
+
+
+def is_identity_cached(sock_path: str, fingerprint: str, ttl: Optional[float] = None) -> bool:
+    """Check with the shared segment of the agent state that an identity is stored.
+
+    This is the fast path for the many processes started at once (git shims, prompt hooks): the
+    segment is mapped and its sorted fingerprints bisected, without agent I/O nor JSON parsing.
+    The identity is trusted like in :meth:`AgentState.has_identity`, a positive answer being
+    recorded as a hit into the history.
+
+    Args:
+        sock_path (str): The agent socket path.
+        fingerprint (str): The fingerprint of the identity.
+        ttl (Optional[float]): The maximal age of the state for the identities without deadline,
+            the learned one or else the backend one by default.
+
+    Returns:
+        bool: True if the identity is known to be stored, False if the state file or the agent
+            must be queried.
+    """
+    try:
+        sock_key = _sock_key(sock_path)
+        path = state_dir() / f"agent-{sock_id(sock_path, sock_key)}.seg"
+    except OSError as err:
+        logging.debug(f"is_identity_cached failed: {err}")
+        return False
+
+    snapshot = state_segment.lookup(path, sock_key, fingerprint)
+    if not snapshot or not snapshot.found:
+        return False
+    if snapshot.pid and not _is_alive(snapshot.pid):
+        return False
+
+    if ttl is None:
+        ttl = snapshot.ttl or None
+    if not _is_trusted(sock_path, snapshot.updated_at, snapshot.deadline or None, ttl):
+        return False
+
+    history.record(history.HIT, sock_path, fingerprint)
+    return True
+
+
+def sock_id(sock_path: str, sock_key: Optional[state_segment.SockKey] = None) -> str:
+    """Get the ``<device>-<inode>-<ctime>`` identifier of an agent socket, which names its files.
+
+    Args:
+        sock_path (str): The agent socket path.
+        sock_key (Optional[SockKey]): The device, inode and ctime of the socket, if already known.
+
+    Raises:
+        OSError: If the agent socket does not exist.
+
+    Returns:
+        str: The socket identifier.
+    """
+    return "-".join(str(part) for part in sock_key or _sock_key(sock_path))
+
+
+def _sock_key(sock_path: str) -> state_segment.SockKey:
+    """Get the device, inode and ctime of an agent socket.
+
+    Raises:
+        OSError: If the agent socket does not exist.
+    """
+    st = os.stat(sock_path)
+    return st.st_dev, st.st_ino, int(st.st_ctime)
+
+
+def _is_trusted(
+    sock_path: str, updated_at: float, deadline: Optional[float], ttl: Optional[float]
+) -> bool:
+    """Check if a listed identity can be trusted, until shortly before its deadline if any."""
+    if deadline is not None:
+        return time.time() < deadline - STATE_EXPIRY_MARGIN
+
+    if ttl is None:
+        ttl = backend.current(sock_path).state_ttl
+    return 0 <= time.time() - updated_at < ttl
+
+
+def _is_alive(pid: int) -> bool:
+    """Check if a process exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def agent_pid(client: AgentClient) -> int:
+    """Get the pid of a running agent process.
+
+    ssh-agent listens on its socket before forking, so the pid from the socket peer credentials
+    may belong to a process that has already exited. SSH_AGENT_PID is used in that case.
+
+    Args:
+        client (AgentClient): The agent client.
+
+    Raises:
+        AgentError: If the agent connection fails.
+
+    Returns:
+        int: The agent pid, or 0 if it cannot be found.
+    """
+    env_pid = os.getenv("SSH_AGENT_PID", "")
+    for pid in (client.peer_pid(), int(env_pid) if env_pid.isdigit() else 0):
+        if pid and _is_alive(pid):
+            return pid
+
+    return 0
+
+
+def record_identity(sock_path: str, pub_key_path: str, lifetime: Optional[int] = None) -> None:
+    """Record into the agent state that an identity is stored by the agent.
+
+    Args:
+        sock_path (str): The agent socket path.
+        pub_key_path (str): The public key path of the identity.
+        lifetime (Optional[int]): The lifetime constraint in seconds, if the identity has just
+            been added with one.
+
+    Raises:
+        AgentError: If the agent pid cannot be queried.
+        OSError: If the agent socket or the public key cannot be read.
+        ValueError: If the public key is not valid.
+    """
+    fingerprint = load_public_key(pub_key_path).fingerprint
+    state = AgentState.load(sock_path)
+
+    if not state.pid:
+        with AgentClient(sock_path) as client:
+            state.pid = agent_pid(client)
+
+    state.add(fingerprint, lifetime)
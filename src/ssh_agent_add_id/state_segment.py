@@ -0,0 +1,199 @@
+import base64
+import bisect
+import fcntl
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+import time
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+
+# magic, version, header size, sequence, socket device, inode and ctime, pid, count, updated_at
+_HEADER = struct.Struct("<4sHHQQQqIId")
+_MAGIC = b"SAAS"
+_VERSION = 2
+_SEQ_OFFSET = 8
+_SEQ = struct.Struct("<Q")
+_DIGEST_SIZE = 32
+# The expiry deadline and the learned TTL of each identity
+_FLOAT = struct.Struct("<d")
+_ENTRY_SIZE = _DIGEST_SIZE + 2 * _FLOAT.size
+# A reader gives up (and falls back to the state file or the agent) after so many torn reads
+_READ_ATTEMPTS = 64
+
+SockKey = Tuple[int, int, int]
+"""The device, inode and ctime of an agent socket."""
+
+
+class Snapshot(NamedTuple):
+    """What a segment tells about one identity."""
+
+    generation: int
+    """Increased by each snapshot published into the segment."""
+    pid: int
+    updated_at: float
+    found: bool
+    deadline: float
+    """The expiry timestamp of the identity, 0.0 if it has none (or is not found)."""
+    ttl: float
+    """The TTL learned for the identity, 0.0 for the default one."""
+
+
+def fingerprint_digest(fingerprint: str) -> bytes:
+    """Convert a ``SHA256:<base64>`` fingerprint into its 32-byte digest.
+
+    Raises:
+        ValueError: If the fingerprint is not a SHA256 one.
+    """
+    algorithm, _, encoded = fingerprint.partition(":")
+    digest = base64.b64decode(encoded + "=" * (-len(encoded) % 4), validate=True)
+    if algorithm != "SHA256" or len(digest) != _DIGEST_SIZE:
+        raise ValueError(f"Not a SHA256 fingerprint: {fingerprint}")
+    return digest
+
+
+def publish(
+    path: Path,
+    sock_key: SockKey,
+    pid: int,
+    updated_at: float,
+    identities: Iterable[Tuple[str, float, float]],
+) -> None:
+    """Write the latest identities snapshot of an agent into its shared segment.
+
+    The segment is a memory-mapped file holding a header, the sorted fingerprint digests, then
+    their expiry deadlines and learned TTLs. The writers are serialized by a lock on the file,
+    whereas the readers never lock: the sequence counter of the header is odd while the snapshot is
+    being written (seqlock), so a reader retries when it changes under it. The file never shrinks,
+    the readers may still map its previous size.
+
+    Args:
+        path (Path): The segment path.
+        sock_key (SockKey): The device, inode and ctime of the agent socket.
+        pid (int): The pid of the agent process, 0 if unknown.
+        updated_at (float): The timestamp of the last agent query.
+        identities (Iterable[Tuple[str, float, float]]): The fingerprints of the stored
+            identities with their expiry timestamps and learned TTLs (0.0 for none).
+
+    Raises:
+        OSError: If the segment cannot be written.
+    """
+    entries = []
+    for fingerprint, deadline, ttl in identities:
+        try:
+            entries.append((fingerprint_digest(fingerprint), deadline, ttl))
+        except ValueError as err:
+            logging.debug(f"state_segment.publish skips {fingerprint}: {err}")
+    entries.sort()
+
+    count = len(entries)
+    size = _HEADER.size + count * _ENTRY_SIZE
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+
+        with mmap.mmap(fd, size) as segment:
+            seq = _SEQ.unpack_from(segment, _SEQ_OFFSET)[0] if segment[:4] == _MAGIC else 0
+            # Odd: a previous writer died in the middle of a write
+            seq += 1 if seq % 2 == 0 else 2
+            _SEQ.pack_into(segment, _SEQ_OFFSET, seq)
+
+            _HEADER.pack_into(
+                segment, 0, _MAGIC, _VERSION, _HEADER.size, seq, *sock_key, pid, count, updated_at
+            )
+            offset = _HEADER.size
+            segment[offset : offset + count * _DIGEST_SIZE] = b"".join(d for d, _, _ in entries)
+            offset += count * _DIGEST_SIZE
+            for index, (_, deadline, ttl) in enumerate(entries):
+                _FLOAT.pack_into(segment, offset + index * _FLOAT.size, deadline)
+                _FLOAT.pack_into(segment, offset + (count + index) * _FLOAT.size, ttl)
+
+            _SEQ.pack_into(segment, _SEQ_OFFSET, seq + 1)
+
+    finally:
+        os.close(fd)
+        #
+
+
+def lookup(path: Path, sock_key: SockKey, fingerprint: str) -> Optional[Snapshot]:
+    """Search for an identity in the shared segment of an agent, without locking.
+
+    Args:
+        path (Path): The segment path.
+        sock_key (SockKey): The device, inode and ctime of the agent socket.
+        fingerprint (str): The fingerprint of the identity.
+
+    Returns:
+        Optional[Snapshot]: What the latest snapshot tells about the identity, or None if there is
+            no valid snapshot for this socket.
+    """
+    try:
+        digest = fingerprint_digest(fingerprint)
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < _HEADER.size:
+                return None
+            with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as segment:
+                return _read(segment, sock_key, digest)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        logging.debug(f"state_segment.lookup failed: {err}")
+        return None
+
+
+def _read(segment: mmap.mmap, sock_key: SockKey, digest: bytes) -> Optional[Snapshot]:
+    """Read a consistent answer from a mapped segment, retrying on concurrent writes."""
+    for _ in range(_READ_ATTEMPTS):
+        seq = _SEQ.unpack_from(segment, _SEQ_OFFSET)[0]
+        if seq % 2:
+            time.sleep(0)
+            continue
+
+        magic, version, header_size, _, dev, ino, ctime, pid, count, updated_at = (
+            _HEADER.unpack_from(segment, 0)
+        )
+        if magic != _MAGIC or version != _VERSION or header_size != _HEADER.size:
+            return None
+        if header_size + count * _ENTRY_SIZE > len(segment):
+            # Grown by a writer after the mapping: torn read
+            continue
+
+        digests = _Digests(segment, header_size, count)
+        index = bisect.bisect_left(digests, digest)
+        found = index < count and digests[index] == digest
+        deadline = ttl = 0.0
+        if found:
+            offset = header_size + count * _DIGEST_SIZE + index * _FLOAT.size
+            deadline = _FLOAT.unpack_from(segment, offset)[0]
+            ttl = _FLOAT.unpack_from(segment, offset + count * _FLOAT.size)[0]
+
+        if _SEQ.unpack_from(segment, _SEQ_OFFSET)[0] != seq:
+            continue
+        if (dev, ino, ctime) != sock_key:
+            return None
+        return Snapshot(seq // 2, pid, updated_at, found, deadline, ttl)
+
+    logging.debug("state_segment.lookup gave up on concurrent writes")
+    return None
+
+
+class _Digests:
+    """The sorted fingerprint digests of a mapped segment, as a sequence for bisect."""
+
+    def __init__(self, segment: mmap.mmap, offset: int, count: int) -> None:
+        self._segment = segment
+        self._offset = offset
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> bytes:
+        start = self._offset + index * _DIGEST_SIZE
+        return self._segment[start : start + _DIGEST_SIZE]
@@ -0,0 +1,312 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+import time
+from typing import FrozenSet, List, Optional, Tuple
+
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.certificates import add_with_certificate
+from ssh_agent_add_id.constants import WATCH_MAX_INTERVAL, WATCH_MIN_INTERVAL
+from ssh_agent_add_id.errors import ExitCodeError, SignalException
+from ssh_agent_add_id.keys import load_public_key, unlock_private_key
+from ssh_agent_add_id.passphrase import PassphraseChain, add_identity_unattended
+from ssh_agent_add_id.ssh_agent import SSHAgent
+from ssh_agent_add_id.state import AgentState, agent_pid
+
+
+class Inotify:
+    """Watch the entries of a directory with the Linux inotify API (through ctypes)."""
+
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, dir_path: str) -> None:
+        """Start watching the entries created, deleted, moved or modified in a directory.
+
+        Args:
+            dir_path (str): The directory path.
+
+        Raises:
+            OSError: If inotify is not available or the directory cannot be watched.
+        """
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if not libc or not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self._fd: int = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = self.IN_ATTRIB | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self._fd, os.fsencode(dir_path), mask | self.IN_DELETE) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"Cannot watch {dir_path}")
+            #
+
+    def fileno(self) -> int:
+        """int: The inotify file descriptor, readable when events are pending."""
+        return self._fd
+        #
+
+    def close(self) -> None:
+        """Stop watching."""
+        os.close(self._fd)
+        #
+
+    def read_names(self) -> List[str]:
+        """Read the pending events.
+
+        Returns:
+            List[str]: The names of the directory entries that have changed.
+        """
+        names = []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(data):
+            _, _, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            names.append(os.fsdecode(data[offset : offset + name_len].rstrip(b"\0")))
+            offset += name_len
+
+        return names
+
+
+class IdentityWatcher:
+    """Keep an identity stored by the SSH agent, re-adding it when it disappears.
+
+    The identities are polled over a single agent connection, with an interval that doubles while
+    nothing changes. On Linux, inotify wakes the watcher up as soon as the agent socket is
+    replaced (e.g. the agent restarted), so it costs almost nothing while idle. An identity added
+    with a lifetime is checked again as soon as it expires. After a failed add (e.g. a cancelled
+    prompt), the identity is not added again until the agent or its identities change.
+    """
+
+    def __init__(
+        self,
+        sock_path: str,
+        priv_key_path: str,
+        pub_key_path: str,
+        min_interval: float = WATCH_MIN_INTERVAL,
+        max_interval: float = WATCH_MAX_INTERVAL,
+        lifetime: Optional[int] = None,
+        confirm: bool = False,
+        passphrase_chain: Optional[PassphraseChain] = None,
+    ) -> None:
+        """Set the identity to watch.
+
+        Args:
+            sock_path (str): The agent socket path.
+            priv_key_path (str): The private key path of the identity.
+            pub_key_path (str): The public key path of the identity.
+            min_interval (float): The poll interval after a change, in seconds.
+            max_interval (float): The maximal poll interval, in seconds.
+            lifetime (Optional[int]): The lifetime constraint to add the identity with, in seconds.
+            confirm (bool): Whether to add the identity with the confirm constraint.
+            passphrase_chain (Optional[PassphraseChain]): The passphrase providers to try before
+                prompting.
+
+        Raises:
+            OSError: If the public key cannot be read.
+            ValueError: If the public key is not valid.
+        """
+        self.sock_path = sock_path
+        self.priv_key_path = priv_key_path
+        self.fingerprint = load_public_key(pub_key_path).fingerprint
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lifetime = lifetime
+        self.confirm = confirm
+        self.passphrase_chain = passphrase_chain or PassphraseChain()
+
+        self._client = AgentClient(sock_path)
+        self._sock_id: Optional[str] = None
+        self._inotify: Optional[Inotify] = None
+        self._expires_at: Optional[float] = None
+        # The agent socket and identities at the last failed add
+        self._failed_add: Optional[Tuple[str, FrozenSet[str]]] = None
+        #
+
+    def run(self) -> None:
+        """Watch the identity until a signal is received.
+
+        Raises:
+            ExitCodeError: If a signal has been received.
+        """
+        try:
+            self._inotify = Inotify(os.path.dirname(os.path.abspath(self.sock_path)))
+        except OSError as err:
+            logging.debug(f"IdentityWatcher falls back to polling only: {err}")
+
+        interval = self.min_interval
+
+        try:
+            while True:
+                changed = self.check()
+                interval = self.min_interval if changed else min(interval * 2, self.max_interval)
+
+                # Do not sleep past the expiry of the identity
+                timeout = interval
+                if self._expires_at:
+                    timeout = min(timeout, max(self._expires_at - time.time(), self.min_interval))
+
+                logging.debug(f"IdentityWatcher next check in {timeout}s")
+                self.wait(timeout)
+
+        except SignalException as err:
+            sys.stderr.write(f"{os.linesep}{err}{os.linesep}")
+            raise ExitCodeError(130)
+
+        finally:
+            self._client.close()
+            if self._inotify:
+                self._inotify.close()
+                #
+
+    def check(self) -> bool:
+        """Check that the agent has the identity and add it if it is missing.
+
+        Raises:
+            ExitCodeError: If a signal has been received while adding the identity.
+
+        Returns:
+            bool: True if the agent or its identities have changed since the previous check, or
+                if the identity has been added.
+        """
+        try:
+            state = AgentState.load(self.sock_path)
+        except OSError as err:
+            logging.debug(f"IdentityWatcher agent socket not found: {err}")
+            self._client.close()
+            self._sock_id = None
+            return False
+
+        # The agent socket has been replaced: reconnect
+        changed = state.sock_id != self._sock_id
+        if changed:
+            self._client.close()
+            self._sock_id = state.sock_id
+
+        try:
+            fingerprints = {identity.fingerprint for identity in self._client.list_identities()}
+            changed |= fingerprints != state.fingerprints
+            state.update(fingerprints, agent_pid(self._client))
+        except AgentError as err:
+            logging.debug(f"IdentityWatcher agent error: {err}")
+            return changed
+
+        self._expires_at = state.expires.get(self.fingerprint)
+
+        if self.fingerprint not in fingerprints:
+            agent_identities = (state.sock_id, frozenset(fingerprints))
+            if agent_identities == self._failed_add:
+                logging.debug(
+                    "IdentityWatcher does not add the identity again until the agent changes"
+                )
+                return changed
+
+            sys.stdout.write(
+                f"The identity {self.priv_key_path} is no longer stored by the agent." + os.linesep
+            )
+            sys.stdout.flush()
+            if not self.add_identity():
+                self._failed_add = agent_identities
+                return changed
+
+            state.add(self.fingerprint, self.lifetime)
+            self._expires_at = state.expires.get(self.fingerprint)
+            self._failed_add = None
+            return True
+
+        return changed
+        #
+
+    def add_identity(self) -> bool:
+        """Add the identity with the passphrase providers, or prompt for the passphrase.
+
+        The passphrase is prompted with the terminal if any, or SSH_ASKPASS otherwise.
+
+        Raises:
+            ExitCodeError: If a signal has been received.
+
+        Returns:
+            bool: True if the identity has been added.
+        """
+        agent = SSHAgent()
+
+        try:
+            passphrases = self.passphrase_chain.passphrases(self.priv_key_path, self.fingerprint)
+            if add_identity_unattended(
+                self.sock_path, self.priv_key_path, passphrases, self.lifetime, self.confirm
+            ):
+                return True
+
+            if sys.stdin.isatty():
+                # Keys decrypted in-process (e.g. PuTTY keys) do not need ssh-add
+                private_key = unlock_private_key(self.priv_key_path)
+                if private_key:
+                    add_with_certificate(
+                        self._client,
+                        self.priv_key_path,
+                        private_key.identity,
+                        private_key.public_key.blob,
+                        self.lifetime,
+                        self.confirm,
+                    )
+                else:
+                    agent.add_identity(self.priv_key_path, self.lifetime, self.confirm)
+            else:
+                agent.add_identity_askpass(self.priv_key_path, self.lifetime, self.confirm)
+
+        except ExitCodeError as err:
+            if err.exit_code == 130:
+                raise
+            sys.stderr.write(str(err) + os.linesep)
+            return False
+
+        except (AgentError, OSError, RuntimeError, ValueError) as err:
+            sys.stderr.write(str(err) + os.linesep)
+            return False
+
+        return True
+        #
+
+    def wait(self, timeout: float) -> None:
+        """Sleep until the timeout expires or the agent socket is replaced.
+
+        Args:
+            timeout (float): The maximal sleep duration, in seconds.
+
+        Raises:
+            SignalException: If a signal has been received.
+        """
+        if not self._inotify:
+            cancellation.sleep(timeout)
+            return
+
+        sock_name = os.path.basename(self.sock_path)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            readable = cancellation.wait([self._inotify.fileno()], remaining)
+            if readable and sock_name in self._inotify.read_names():
+                logging.debug("IdentityWatcher agent socket changed")
+                return
@@ -0,0 +1,98 @@
+import struct
+
+
+class WireReader:
+    """Read values encoded with the SSH wire format (RFC 4251) from a bytes buffer."""
+
+    def __init__(self, data: bytes) -> None:
+        """Wrap the given buffer.
+
+        Args:
+            data (bytes): The encoded data.
+        """
+        self._data = data
+        self._pos = 0
+        #
+
+    @property
+    def remaining(self) -> int:
+        """int: The number of bytes that have not been read yet."""
+        return len(self._data) - self._pos
+        #
+
+    def read_bytes(self, size: int) -> bytes:
+        """Read a fixed number of raw bytes.
+
+        Args:
+            size (int): The number of bytes to read.
+
+        Raises:
+            ValueError: If the buffer is too short.
+
+        Returns:
+            bytes: The read bytes.
+        """
+        if size < 0 or self.remaining < size:
+            raise ValueError("Truncated SSH wire data")
+
+        value = self._data[self._pos : self._pos + size]
+        self._pos += size
+        return value
+        #
+
+    def read_byte(self) -> int:
+        """Read a single byte.
+
+        Raises:
+            ValueError: If the buffer is too short.
+
+        Returns:
+            int: The value of the byte.
+        """
+        return self.read_bytes(1)[0]
+        #
+
+    def read_uint32(self) -> int:
+        """Read a big-endian unsigned 32-bit integer.
+
+        Raises:
+            ValueError: If the buffer is too short.
+
+        Returns:
+            int: The integer value.
+        """
+        return struct.unpack(">I", self.read_bytes(4))[0]
+        #
+
+    def read_uint64(self) -> int:
+        """Read a big-endian unsigned 64-bit integer.
+
+        Raises:
+            ValueError: If the buffer is too short.
+
+        Returns:
+            int: The integer value.
+        """
+        return struct.unpack(">Q", self.read_bytes(8))[0]
+        #
+
+    def read_string(self) -> bytes:
+        """Read a length-prefixed string.
+
+        Raises:
+            ValueError: If the buffer is too short.
+
+        Returns:
+            bytes: The string content.
+        """
+        return self.read_bytes(self.read_uint32())
+
+
+def pack_uint32(value: int) -> bytes:
+    """Encode a big-endian unsigned 32-bit integer."""
+    return struct.pack(">I", value)
+
+
+def pack_string(data: bytes) -> bytes:
+    """Encode a length-prefixed string."""
+    return struct.pack(">I", len(data)) + data
@@ -0,0 +1,251 @@
+from dataclasses import dataclass
+import logging
+import os
+from pathlib import Path
+import re
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from ssh_agent_add_id.scan import ScannedKey, sniff_key_file
+from ssh_agent_add_id.ssh_config import SSHConfig
+
+
+_SECTION_RE = re.compile(r'\[\s*([\w.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+_ENTRY_RE = re.compile(r"([A-Za-z][\w-]*)\s*(?:=\s*(.*))?")
+_SSH_SCHEMES = ("ssh", "git+ssh", "ssh+git")
+
+
+@dataclass(frozen=True)
+class SSHRemote:
+    """The SSH destination of a git remote URL."""
+
+    host: str
+    user: Optional[str] = None
+    port: Optional[int] = None
+
+
+def find_git_config(workspace_dir: str) -> Path:
+    """Find the config file of the git repository holding a directory.
+
+    The parent directories are searched like git does. A ``.git`` file (worktree or submodule)
+    points to the git directory, whose config may be in the common directory.
+
+    Args:
+        workspace_dir (str): A directory in the working tree.
+
+    Raises:
+        FileNotFoundError: If the directory is not in a git repository.
+
+    Returns:
+        Path: The path of the repository config file.
+    """
+    start = Path(workspace_dir).expanduser().resolve()
+    if not start.is_dir():
+        raise FileNotFoundError(f"{start} not found")
+
+    for directory in (start, *start.parents):
+        git_path = directory / ".git"
+        if git_path.is_file():
+            content = git_path.read_text(encoding="utf-8", errors="replace").strip()
+            if not content.startswith("gitdir:"):
+                continue
+            git_dir = directory / content[len("gitdir:") :].strip()
+            common_dir_path = git_dir / "commondir"
+            if common_dir_path.is_file():
+                git_dir = git_dir / common_dir_path.read_text(encoding="utf-8").strip()
+            return git_dir / "config"
+
+        if git_path.is_dir():
+            return git_path / "config"
+
+    raise FileNotFoundError(f"{start} is not in a git repository")
+
+
+def read_git_config(path: str) -> List[Tuple[str, str, str]]:
+    """Read the entries of a git config file.
+
+    Args:
+        path (str): The config file path. A missing file has no entries.
+
+    Returns:
+        List[Tuple[str, str, str]]: The (section, key, value) entries in file order. The section
+            and key names are lowercase, the section including its subsection, e.g.
+            ``remote.origin``.
+    """
+    try:
+        with open(os.path.expanduser(path), encoding="utf-8", errors="replace") as file:
+            lines = file.read().splitlines()
+    except OSError as err:
+        logging.debug(f"read_git_config skips {path}: {err}")
+        return []
+
+    entries = []
+    section = ""
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+
+        match = _SECTION_RE.match(line)
+        if match:
+            name, subsection = match.groups()
+            section = name.lower()
+            if subsection is not None:
+                section += "." + re.sub(r"\\(.)", r"\1", subsection)
+            continue
+
+        match = _ENTRY_RE.match(line)
+        if match and section:
+            entries.append((section, match.group(1).lower(), _git_value(match.group(2) or "")))
+
+    return entries
+
+
+def git_remote_urls(config_path: str) -> List[str]:
+    """Get the URLs of the remotes of a git repository, as rewritten by the insteadOf rules.
+
+    Args:
+        config_path (str): The repository config file path.
+
+    Returns:
+        List[str]: The fetch and push URLs of all the remotes, without duplicates.
+    """
+    entries = [
+        entry
+        for path in (*_global_git_config_paths(), config_path)
+        for entry in read_git_config(path)
+    ]
+
+    # url.<base>.insteadOf rules rewrite all the URLs, pushInsteadOf ones only the push URLs
+    rewrites: Dict[str, List[Tuple[str, str]]] = {"insteadof": [], "pushinsteadof": []}
+    for section, key, value in entries:
+        if section.startswith("url.") and key in rewrites:
+            rewrites[key].append((value, section[len("url.") :]))
+
+    urls: List[str] = []
+    for section, key, value in entries:
+        if not section.startswith("remote.") or key not in ("url", "pushurl"):
+            continue
+
+        candidates = [_rewrite_url(value, rewrites["insteadof"]) or value]
+        if key == "url":
+            candidates.append(_rewrite_url(value, rewrites["pushinsteadof"]) or candidates[0])
+        for url in candidates:
+            if url not in urls:
+                urls.append(url)
+
+    return urls
+
+
+def parse_ssh_remote(url: str) -> Optional[SSHRemote]:
+    """Get the SSH destination of a git remote URL.
+
+    Both the ``ssh://[user@]host[:port]/path`` URLs and the scp-like ``[user@]host:path`` syntax
+    are recognized.
+
+    Args:
+        url (str): The remote URL.
+
+    Returns:
+        Optional[SSHRemote]: The SSH destination, or None if the URL does not use SSH (e.g. HTTPS
+            or a local path).
+    """
+    if "://" in url:
+        parts = urlsplit(url)
+        if parts.scheme.lower() not in _SSH_SCHEMES or not parts.hostname:
+            return None
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        return SSHRemote(parts.hostname, parts.username, port)
+
+    # git treats a colon after a slash as a local path, e.g. ./foo:bar
+    colon = url.find(":")
+    if colon <= 0 or "/" in url[:colon]:
+        return None
+
+    destination = url[:colon]
+    user, _, host = destination.rpartition("@")
+    host = host.strip("[]")
+    if not host:
+        return None
+    return SSHRemote(host, user or None)
+
+
+def workspace_keys(workspace_dir: str, ssh_config: Optional[SSHConfig] = None) -> List[ScannedKey]:
+    """Get the keys that ssh would use for the SSH remotes of a git workspace.
+
+    The remote hosts are resolved through the ssh_config files (host aliases, IdentityFile), so
+    only the keys the remotes actually need are returned.
+
+    Args:
+        workspace_dir (str): A directory in the working tree.
+        ssh_config (Optional[SSHConfig]): The ssh configuration, the cached user and system one by
+            default.
+
+    Raises:
+        FileNotFoundError: If the directory is not in a git repository.
+        ValueError: If the ssh_config files cannot be parsed.
+
+    Returns:
+        List[ScannedKey]: The existing private keys, each public key being listed only once.
+    """
+    remotes: List[SSHRemote] = []
+    for url in git_remote_urls(str(find_git_config(workspace_dir))):
+        remote = parse_ssh_remote(url)
+        logging.debug(f"workspace_keys remote {url}: {remote}")
+        if remote and remote not in remotes:
+            remotes.append(remote)
+
+    if not remotes:
+        return []
+
+    if ssh_config is None:
+        ssh_config = SSHConfig.load()
+
+    keys = {}
+    for remote in remotes:
+        for path in ssh_config.identity_files(remote.host, remote.user, remote.port):
+            if not os.path.isfile(path):
+                continue
+            key = sniff_key_file(path)
+            if key:
+                keys.setdefault(key.public_key.fingerprint, key)
+
+    return list(keys.values())
+
+
+def _global_git_config_paths() -> List[str]:
+    """Get the global git config files, whose insteadOf rules also rewrite the remote URLs."""
+    config_home = os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return [os.path.join(config_home, "git", "config"), "~/.gitconfig"]
+
+
+def _rewrite_url(url: str, rewrites: List[Tuple[str, str]]) -> Optional[str]:
+    """Rewrite a URL with the (prefix, base) rule of the longest matching prefix, if any."""
+    matching = [rewrite for rewrite in rewrites if url.startswith(rewrite[0])]
+    if not matching:
+        return None
+    prefix, base = max(matching, key=lambda rewrite: len(rewrite[0]))
+    return base + url[len(prefix) :]
+
+
+def _git_value(value: str) -> str:
+    """Unquote a git config value and strip its trailing comment."""
+    result = []
+    quoted = False
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char == "\\" and index + 1 < len(value):
+            index += 1
+            result.append({"n": "\n", "t": "\t", "b": "\b"}.get(value[index], value[index]))
+        elif char == '"':
+            quoted = not quoted
+        elif char in "#;" and not quoted:
+            break
+        else:
+            result.append(char)
+        index += 1
+    return "".join(result).strip()
@@ -1,17 +1,17 @@
 import os
-import re
 import subprocess
 from subprocess import STDOUT, CalledProcessError
 import sys
 from typing import Dict, Iterator, List, cast
 
-from pexpect import EOF
 import pytest
 from pytest import CaptureFixture
 from pytest_mock import MockerFixture
+from ssh_agent_add_id.bcrypt_pbkdf import has_native_engine
 from ssh_agent_add_id.cli import main
 from ssh_agent_add_id.constants import APP_NAME
 from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.keys import load_public_key, unlock_private_key
 
 
 PREFIX = "tests/functional/ids/"
@@ -43,7 +43,7 @@ def test_invalid_public_key(capsys: CaptureFixture) -> None:
     """Return an error if public key is invalid."""
     sys.argv = [
         APP_NAME,
-        PREFIX + "putty_ed25519.ppk",
+        PREFIX + "id_ed25519",
         PREFIX + "putty_ed25519_ssh2.pub",
     ]
 
@@ -68,29 +68,28 @@ def test_invalid_public_key(capsys: CaptureFixture) -> None:
     assert out[1].endswith("returned exit code 1\n")
 
 
-def test_invalid_private_key(capsys: CaptureFixture) -> None:
-    """Return an error if private key is invalid."""
-    sys.argv = [
-        APP_NAME,
-        PREFIX + "putty_ed25519.ppk",
-        PREFIX + "putty_ed25519_openssh.pub",
-    ]
+def test_putty_private_key(mocker: MockerFixture, capsys: CaptureFixture) -> None:
+    """Add a PuTTY private key without ssh-add, then find it."""
+    mocker.patch("getpass.getpass", return_value="fake")
+    sys.argv = [APP_NAME, PREFIX + "putty_ed25519.ppk"]
 
-    with pytest.raises(SystemExit) as exc_info:
-        main()
+    main()
 
-    assert exc_info.value.code == 1
+    assert capsys.readouterr().out.endswith(f"{PREFIX}putty_ed25519.ppk{os.linesep}")
 
-    assert isinstance(exc_info.value.__context__, ExitCodeError)
-    exit_code_error = cast(ExitCodeError, exc_info.value.__context__)
-    assert exit_code_error.exit_code == 1
-    assert exit_code_error.command and exit_code_error.command.startswith("ssh-add")
-    assert isinstance(exit_code_error.__context__, EOF)
+    main()
 
-    out: List[str] = cast(str, capsys.readouterr().err).split("\r\n")
-    assert len(out) == 2
-    assert re.match(r"^Error loading key.+invalid format$", out[0])
-    assert out[1].endswith("returned exit code 1\n")
+    assert capsys.readouterr().out.endswith("already been added to the SSH agent." + os.linesep)
+
+
+@pytest.mark.skipif(not has_native_engine(), reason="the bcrypt extension is not installed")
+@pytest.mark.parametrize("key", [key for key in PRIV_KEYS if key.startswith("id_")])
+def test_decrypt_openssh_key(key: str) -> None:
+    """Decrypt an OpenSSH private key in-process, as ssh-add does."""
+    private_key = unlock_private_key(PREFIX + key, ["bad", "fake"], prompt=False)
+
+    assert private_key and private_key.identity
+    assert private_key.public_key.blob == load_public_key(PREFIX + key + ".pub").blob
 
 
 @pytest.mark.parametrize("key", PRIV_KEYS)
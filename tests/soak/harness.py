@@ -0,0 +1,573 @@
+"""Soak and load test harness: many concurrent clients against a stand-in SSH agent.
+
+The clients run a weighted mix of operations for a long time, and the latency percentiles,
+throughput, resident memory and open file descriptors are sampled at a regular interval:
+
+- ensure: the in-process ensure of an identity (agent state, listing and adding if missing).
+- list: an identities listing through the agent socket.
+- sign: a sign request passed through the agent socket. A refusal is a valid answer (e.g. once
+  the identity has been forgotten), only the I/O errors and malformed answers are failures.
+
+The clients target the stand-in agent itself by default. To soak a long-lived process in front of
+it (e.g. a daemon or proxy), pass its command, which is started with SSH_AUTH_SOCK set to the
+stand-in agent, and the socket it serves. Its process is then the measured one:
+
+    python -m tests.soak.harness --target-command "COMMAND" --target /tmp/soak.sock
+
+The exit code is 1 if a threshold has been exceeded. The agent state of the clients is isolated
+in a temporary directory.
+
+Usage: python -m tests.soak.harness [--duration S] [--clients N] [--interval S] [--mix MIX] ...
+"""
+
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+import logging
+import math
+import os
+from pathlib import Path
+import random
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from ssh_agent_add_id.agent_client import (
+    SSH_AGENT_FAILURE,
+    SSH_AGENT_IDENTITIES_ANSWER,
+    SSH_AGENT_SUCCESS,
+    SSH_AGENTC_ADD_ID_CONSTRAINED,
+    SSH_AGENTC_ADD_IDENTITY,
+    SSH_AGENTC_REQUEST_IDENTITIES,
+    AgentClient,
+    AgentError,
+)
+from ssh_agent_add_id.fanout import FAILED, ensure_identity_on_agents
+from ssh_agent_add_id.wire import WireReader, pack_string, pack_uint32
+
+from tests.unit.conftest import ED25519_BLOB, ED25519_PUBLIC_LINE, openssh_private_key
+
+
+ENSURE = "ensure"
+LIST = "list"
+SIGN = "sign"
+OPERATIONS = (ENSURE, LIST, SIGN)
+
+SSH_AGENTC_SIGN_REQUEST = 13
+SSH_AGENT_SIGN_RESPONSE = 14
+
+# The histogram buckets grow by 2% from 1 µs, up to hours
+_BUCKET_BASE = 1e-6
+_BUCKET_GROWTH = 1.02
+_BUCKETS = 1300
+# The time given to a target command to serve its socket
+_TARGET_START_TIMEOUT = 10.0
+
+
+class StandInAgent:
+    """A thread-safe SSH agent storing ed25519 identities in memory, for long runs.
+
+    Unlike the agent of the unit tests, it does not keep the requests, so that its memory stays
+    flat whatever the duration.
+    """
+
+    def __init__(self, sock_path: str, forget_every: float = 0.0) -> None:
+        """Setup the agent, without serving yet.
+
+        Args:
+            sock_path (str): The socket path to serve.
+            forget_every (float): The period in seconds after which all the identities are
+                removed, like lifetime constraints expiring (0 to keep them).
+        """
+        self.sock_path = sock_path
+        self.forget_every = forget_every
+        self._identities: Dict[bytes, bytes] = {}
+        self._lock = threading.Lock()
+        self._forgotten_at = time.monotonic()
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        #
+
+    def start(self) -> None:
+        """Serve the socket from a background thread."""
+        self._server.bind(self.sock_path)
+        self._server.listen(128)
+        threading.Thread(target=self._serve, daemon=True).start()
+        #
+
+    def close(self) -> None:
+        """Stop serving."""
+        self._server.close()
+        #
+
+    def handle(self, msg_type: int, payload: bytes) -> Tuple[int, bytes]:
+        """Answer a request.
+
+        Args:
+            msg_type (int): The request message number.
+            payload (bytes): The request content.
+
+        Returns:
+            Tuple[int, bytes]: The reply message number and its content.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.forget_every and now - self._forgotten_at >= self.forget_every:
+                self._identities.clear()
+                self._forgotten_at = now
+
+            try:
+                if msg_type == SSH_AGENTC_REQUEST_IDENTITIES:
+                    answer = pack_uint32(len(self._identities)) + b"".join(
+                        pack_string(blob) + pack_string(comment)
+                        for blob, comment in self._identities.items()
+                    )
+                    return SSH_AGENT_IDENTITIES_ANSWER, answer
+
+                if msg_type in (SSH_AGENTC_ADD_IDENTITY, SSH_AGENTC_ADD_ID_CONSTRAINED):
+                    reader = WireReader(payload)
+                    key_type = reader.read_string()
+                    if key_type != b"ssh-ed25519":
+                        return SSH_AGENT_FAILURE, b""
+                    blob = pack_string(key_type) + pack_string(reader.read_string())
+                    reader.read_string()  # Private key
+                    self._identities[blob] = reader.read_string()
+                    return SSH_AGENT_SUCCESS, b""
+
+                if msg_type == SSH_AGENTC_SIGN_REQUEST:
+                    blob = WireReader(payload).read_string()
+                    if blob not in self._identities:
+                        return SSH_AGENT_FAILURE, b""
+                    signature = pack_string(b"ssh-ed25519") + pack_string(bytes(64))
+                    return SSH_AGENT_SIGN_RESPONSE, pack_string(signature)
+
+            except ValueError as err:
+                logging.debug(f"StandInAgent rejected a request: {err}")
+
+        return SSH_AGENT_FAILURE, b""
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn: socket.socket) -> None:
+        with conn:
+            try:
+                while True:
+                    header = conn.recv(4, socket.MSG_WAITALL)
+                    if len(header) < 4:
+                        return
+                    message = conn.recv(struct.unpack(">I", header)[0], socket.MSG_WAITALL)
+                    if not message:
+                        return
+                    msg_type, payload = self.handle(message[0], message[1:])
+                    conn.sendall(pack_uint32(len(payload) + 1) + bytes([msg_type]) + payload)
+            except OSError as err:
+                logging.debug(f"StandInAgent connection error: {err}")
+
+
+class LatencyHistogram:
+    """Latencies in logarithmic buckets (2% wide), whose memory does not grow with the count."""
+
+    def __init__(self) -> None:  # noqa: D107
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        #
+
+    def record(self, seconds: float) -> None:
+        """Count a latency."""
+        index = 0
+        if seconds > _BUCKET_BASE:
+            index = min(
+                int(math.log(seconds / _BUCKET_BASE) / math.log(_BUCKET_GROWTH)) + 1, _BUCKETS - 1
+            )
+        self.counts[index] += 1
+        self.count += 1
+        #
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Add the latencies of another histogram."""
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        #
+
+    def percentile(self, fraction: float) -> float:
+        """Get the latency (upper bound of its bucket) below which a fraction of them are.
+
+        Args:
+            fraction (float): The fraction, e.g. 0.99 for the p99.
+
+        Returns:
+            float: The latency in seconds, 0.0 if there is none.
+        """
+        if not self.count:
+            return 0.0
+        target = max(math.ceil(fraction * self.count), 1)
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= target:
+                return _BUCKET_BASE * _BUCKET_GROWTH**index
+        return _BUCKET_BASE * _BUCKET_GROWTH ** (_BUCKETS - 1)
+
+
+@dataclass
+class Sample:
+    """The measurements of a sampling interval."""
+
+    elapsed: float
+    ops: int
+    errors: int
+    throughput: float
+    p50: float
+    p99: float
+    p999: float
+    rss: Optional[int]
+    """The resident memory of the measured process in bytes, None if unknown."""
+    fds: Optional[int]
+    """The open file descriptors of the measured process, None if unknown."""
+
+    def __str__(self) -> str:  # noqa: D105
+        rss = f"{self.rss / 2**20:.1f} MiB" if self.rss is not None else "n/a"
+        fds = self.fds if self.fds is not None else "n/a"
+        return (
+            f"{self.elapsed:7.0f}s: {self.ops} ops ({self.throughput:.0f}/s), "
+            + f"{self.errors} errors, "
+            + f"p50 {self.p50 * 1000:.2f} ms, p99 {self.p99 * 1000:.2f} ms, "
+            + f"p999 {self.p999 * 1000:.2f} ms, rss {rss}, fds {fds}"
+        )
+
+
+@dataclass
+class Thresholds:
+    """The limits of a passing soak run."""
+
+    p99: float = 0.05
+    """The overall p99 latency, in seconds."""
+    rss_growth: int = 16 * 2**20
+    """The resident memory growth after the first interval, in bytes."""
+    fd_growth: int = 8
+    """The open file descriptors growth after the first interval."""
+    error_rate: float = 0.0
+
+
+@dataclass
+class SoakReport:
+    """The samples of a soak run and its overall latencies."""
+
+    samples: List[Sample] = field(default_factory=list)
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+    errors: int = 0
+    duration: float = 0.0
+
+    @property
+    def rss_growth(self) -> int:
+        """int: The resident memory growth since the first sample (the warm up), in bytes."""
+        rss = [sample.rss for sample in self.samples if sample.rss is not None]
+        return rss[-1] - rss[0] if rss else 0
+        #
+
+    @property
+    def fd_growth(self) -> int:
+        """int: The open file descriptors growth since the first sample."""
+        fds = [sample.fds for sample in self.samples if sample.fds is not None]
+        return fds[-1] - fds[0] if fds else 0
+        #
+
+    def violations(self, thresholds: Thresholds) -> List[str]:
+        """Check the run against some thresholds.
+
+        Returns:
+            List[str]: The exceeded thresholds, empty if the run passes.
+        """
+        violations = []
+        p99 = self.histogram.percentile(0.99)
+        if p99 > thresholds.p99:
+            violations.append(f"p99 {p99 * 1000:.2f} ms > {thresholds.p99 * 1000:.2f} ms")
+        if self.rss_growth > thresholds.rss_growth:
+            violations.append(
+                f"rss growth {self.rss_growth / 2**20:.1f} MiB "
+                + f"> {thresholds.rss_growth / 2**20:.1f} MiB"
+            )
+        if self.fd_growth > thresholds.fd_growth:
+            violations.append(f"fd growth {self.fd_growth} > {thresholds.fd_growth}")
+        error_rate = self.errors / self.histogram.count if self.histogram.count else 0.0
+        if error_rate > thresholds.error_rate:
+            violations.append(f"error rate {error_rate:.2%} > {thresholds.error_rate:.2%}")
+        return violations
+
+    def summary_lines(self) -> List[str]:
+        """Describe the whole run."""
+        histogram = self.histogram
+        return [
+            f"duration {self.duration:.0f}s, {histogram.count} ops "
+            + f"({histogram.count / self.duration if self.duration else 0:.0f}/s), "
+            + f"{self.errors} errors",
+            f"latency p50 {histogram.percentile(0.5) * 1000:.2f} ms, "
+            + f"p99 {histogram.percentile(0.99) * 1000:.2f} ms, "
+            + f"p999 {histogram.percentile(0.999) * 1000:.2f} ms",
+            f"rss growth {self.rss_growth / 2**20:.1f} MiB, fd growth {self.fd_growth}",
+        ]
+
+
+def process_usage(pid: int) -> Tuple[Optional[int], Optional[int]]:
+    """Get the resident memory (bytes) and open file descriptors of a process, from /proc.
+
+    Returns:
+        Tuple[Optional[int], Optional[int]]: None for what cannot be read (e.g. not on Linux).
+    """
+    rss: Optional[int] = None
+    fds: Optional[int] = None
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (OSError, ValueError) as err:
+        logging.debug(f"process_usage failed: {err}")
+    return rss, fds
+
+
+def write_key_files(directory: Path) -> Tuple[str, str]:
+    """Write the unencrypted ed25519 key pair ensured by the clients.
+
+    Returns:
+        Tuple[str, str]: The private and public key paths.
+    """
+    priv_key_path = directory / "id_soak"
+    priv_key_path.write_text(openssh_private_key())
+    priv_key_path.chmod(0o600)
+    pub_key_path = directory / "id_soak.pub"
+    pub_key_path.write_text(ED25519_PUBLIC_LINE)
+    return str(priv_key_path), str(pub_key_path)
+
+
+def run_soak(
+    sock_path: str,
+    priv_key_path: str,
+    pub_key_path: str,
+    duration: float,
+    clients: int = 16,
+    interval: float = 10.0,
+    pid: Optional[int] = None,
+    mix: Optional[Dict[str, float]] = None,
+    on_sample: Optional[Callable[[Sample], None]] = None,
+) -> SoakReport:
+    """Drive concurrent clients against an agent socket and sample the measured process.
+
+    Args:
+        sock_path (str): The socket the clients connect to.
+        priv_key_path (str): The private key ensured by the clients.
+        pub_key_path (str): Its public key.
+        duration (float): The run duration in seconds.
+        clients (int): The concurrent clients, each one in its own thread.
+        interval (float): The sampling interval in seconds.
+        pid (Optional[int]): The measured process, this one by default.
+        mix (Optional[Dict[str, float]]): The weight of each operation, ensure only by default.
+        on_sample (Optional[Callable[[Sample], None]]): Called with each sample.
+
+    Returns:
+        SoakReport: The samples and overall latencies of the run.
+    """
+    mix = mix or {ENSURE: 1.0}
+    operations: Dict[str, Callable[[], bool]] = {
+        ENSURE: lambda: _ensure(sock_path, priv_key_path, pub_key_path),
+        LIST: lambda: _list(sock_path),
+        SIGN: lambda: _sign(sock_path),
+    }
+    # The first signs would be refused otherwise
+    _ensure(sock_path, priv_key_path, pub_key_path)
+    names: Sequence[str] = list(mix)
+    weights = [mix[name] for name in names]
+
+    report = SoakReport()
+    interval_histogram = LatencyHistogram()
+    interval_errors = 0
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def client(seed: int) -> None:
+        nonlocal interval_errors
+        rng = random.Random(seed)
+        while not stop.is_set():
+            name = rng.choices(names, weights)[0]
+            started_at = time.perf_counter()
+            try:
+                ok = operations[name]()
+            except (AgentError, OSError, ValueError) as err:
+                logging.debug(f"run_soak {name} failed: {err}")
+                ok = False
+            latency = time.perf_counter() - started_at
+            with lock:
+                interval_histogram.record(latency)
+                if not ok:
+                    interval_errors += 1
+
+    threads = [
+        threading.Thread(target=client, args=(seed,), daemon=True) for seed in range(clients)
+    ]
+    started_at = sampled_at = time.monotonic()
+    for thread in threads:
+        thread.start()
+
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            stop.wait(max(min(sampled_at + interval, started_at + duration) - now, 0.0))
+            if time.monotonic() >= started_at + duration:
+                stop.set()
+
+            with lock:
+                histogram, errors = interval_histogram, interval_errors
+                interval_histogram, interval_errors = LatencyHistogram(), 0
+            now = time.monotonic()
+            rss, fds = process_usage(pid or os.getpid())
+            sample = Sample(
+                now - started_at,
+                histogram.count,
+                errors,
+                histogram.count / (now - sampled_at) if now > sampled_at else 0.0,
+                histogram.percentile(0.5),
+                histogram.percentile(0.99),
+                histogram.percentile(0.999),
+                rss,
+                fds,
+            )
+            sampled_at = now
+            report.samples.append(sample)
+            report.histogram.merge(histogram)
+            report.errors += errors
+            if on_sample:
+                on_sample(sample)
+
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        report.duration = time.monotonic() - started_at
+
+    return report
+
+
+def _ensure(sock_path: str, priv_key_path: str, pub_key_path: str) -> bool:
+    return ensure_identity_on_agents([sock_path], priv_key_path, pub_key_path)[0].status != FAILED
+
+
+def _list(sock_path: str) -> bool:
+    with AgentClient(sock_path) as client:
+        client.list_identities()
+    return True
+
+
+def _sign(sock_path: str) -> bool:
+    payload = pack_string(ED25519_BLOB) + pack_string(os.urandom(32)) + pack_uint32(0)
+    with AgentClient(sock_path) as client:
+        msg_type, _ = client.request(SSH_AGENTC_SIGN_REQUEST, payload)
+    return msg_type in (SSH_AGENT_SIGN_RESPONSE, SSH_AGENT_FAILURE)
+
+
+def _parse_mix(value: str) -> Dict[str, float]:
+    """Parse an operation mix like ``ensure=6,list=2,sign=2``."""
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _wait_for_socket(sock_path: str, process: subprocess.Popen) -> None:
+    """Wait for a target command to serve its socket."""
+    deadline = time.monotonic() + _TARGET_START_TIMEOUT
+    while not os.path.exists(sock_path):
+        if process.poll() is not None:
+            raise RuntimeError(f"The target command exited with {process.returncode}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"The target command does not serve {sock_path}")
+        time.sleep(0.05)
+
+
+def main() -> None:
+    """Command line entry point."""
+    parser = ArgumentParser(description="Soak an agent socket with concurrent clients.")
+    parser.add_argument("--duration", type=float, default=3600.0, help="in seconds")
+    parser.add_argument("--clients", type=int, default=16, help="the concurrent clients")
+    parser.add_argument("--interval", type=float, default=10.0, help="the sampling interval")
+    parser.add_argument(
+        "--mix", type=_parse_mix, default="ensure=6,list=2,sign=2", help="the operation weights"
+    )
+    parser.add_argument(
+        "--forget-every", type=float, default=0.0, help="clear the stand-in agent periodically"
+    )
+    parser.add_argument("--target", help="the socket of the target command")
+    parser.add_argument("--target-command", help="the command serving --target")
+    parser.add_argument("--max-p99-ms", type=float, default=Thresholds.p99 * 1000)
+    parser.add_argument("--max-rss-growth-mb", type=float, default=Thresholds.rss_growth / 2**20)
+    parser.add_argument("--max-fd-growth", type=int, default=Thresholds.fd_growth)
+    parser.add_argument("--max-error-rate", type=float, default=Thresholds.error_rate)
+    args = parser.parse_args()
+    if bool(args.target) != bool(args.target_command):
+        parser.error("--target and --target-command go together")
+
+    thresholds = Thresholds(
+        args.max_p99_ms / 1000,
+        int(args.max_rss_growth_mb * 2**20),
+        args.max_fd_growth,
+        args.max_error_rate,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="ssh-agent-add-id-soak-") as directory:
+        # The agent state and history of the user are left alone
+        for name in ("XDG_RUNTIME_DIR", "XDG_STATE_HOME", "XDG_CACHE_HOME"):
+            os.environ[name] = directory
+        priv_key_path, pub_key_path = write_key_files(Path(directory))
+
+        agent = StandInAgent(os.path.join(directory, "agent.sock"), args.forget_every)
+        agent.start()
+        target: Optional[subprocess.Popen] = None
+        sock_path, pid = agent.sock_path, None
+        try:
+            if args.target_command:
+                target = subprocess.Popen(
+                    shlex.split(args.target_command),
+                    env={**os.environ, "SSH_AUTH_SOCK": agent.sock_path},
+                )
+                _wait_for_socket(args.target, target)
+                sock_path, pid = args.target, target.pid
+
+            report = run_soak(
+                sock_path,
+                priv_key_path,
+                pub_key_path,
+                args.duration,
+                args.clients,
+                args.interval,
+                pid,
+                args.mix,
+                lambda sample: print(sample, flush=True),
+            )
+        finally:
+            if target:
+                target.terminate()
+                target.wait()
+            agent.close()
+
+    for line in report.summary_lines():
+        print(line)
+    violations = report.violations(thresholds)
+    for violation in violations:
+        sys.stderr.write(f"FAILED: {violation}{os.linesep}")
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
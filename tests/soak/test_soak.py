@@ -0,0 +1,123 @@
+import os
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from ssh_agent_add_id.agent_client import AgentClient
+from ssh_agent_add_id.wire import pack_string, pack_uint32
+
+from tests.soak.harness import (
+    ENSURE,
+    LIST,
+    SIGN,
+    LatencyHistogram,
+    Sample,
+    SoakReport,
+    StandInAgent,
+    Thresholds,
+    run_soak,
+    write_key_files,
+)
+from tests.unit.conftest import ED25519_BLOB, ED25519_IDENTITY
+
+
+# The soak run is opt-in: its duration in seconds, e.g. SSH_AGENT_ADD_ID_SOAK=3600 pdm test_soak
+SOAK_SECONDS = float(os.getenv("SSH_AGENT_ADD_ID_SOAK") or 0)
+
+
+@pytest.fixture
+def isolated_state(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Keep the agent state and history of the clients in a temporary directory."""
+    for name in ("XDG_RUNTIME_DIR", "XDG_STATE_HOME", "XDG_CACHE_HOME"):
+        monkeypatch.setenv(name, str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def stand_in_agent(isolated_state: Path) -> Iterator[StandInAgent]:
+    """A fixture that returns a running StandInAgent."""
+    agent = StandInAgent(str(isolated_state / "agent.sock"))
+    agent.start()
+    yield agent
+    agent.close()
+
+
+class TestLatencyHistogram:
+    """LatencyHistogram class"""  # noqa: D415
+
+    def test_percentiles(self) -> None:
+        """Get the percentiles within the 2% resolution of the buckets."""
+        histogram = LatencyHistogram()
+        for index in range(1, 1001):
+            histogram.record(index / 1000)
+
+        assert histogram.percentile(0.5) == pytest.approx(0.5, rel=0.02)
+        assert histogram.percentile(0.999) == pytest.approx(0.999, rel=0.02)
+        assert LatencyHistogram().percentile(0.5) == 0.0
+        #
+
+    def test_merge(self) -> None:
+        """Add the counts of another histogram."""
+        histogram, other = LatencyHistogram(), LatencyHistogram()
+        histogram.record(0.001)
+        other.record(1.0)
+
+        histogram.merge(other)
+
+        assert histogram.count == 2
+        assert histogram.percentile(1.0) == pytest.approx(1.0, rel=0.02)
+
+
+class TestSoakReport:
+    """SoakReport class"""  # noqa: D415
+
+    def test_violations(self) -> None:
+        """Report the exceeded thresholds, the growths being measured after the first sample."""
+        report = SoakReport(
+            [
+                Sample(10, 100, 0, 10, 0.001, 0.01, 0.02, 40 * 2**20, 10),
+                Sample(20, 100, 1, 10, 0.001, 0.01, 0.02, 80 * 2**20, 12),
+            ],
+            errors=1,
+        )
+        for _ in range(100):
+            report.histogram.record(0.001)
+
+        assert report.violations(Thresholds(error_rate=0.05)) == ["rss growth 40.0 MiB > 16.0 MiB"]
+        assert report.violations(Thresholds(rss_growth=2**30, fd_growth=1)) == [
+            "fd growth 2 > 1",
+            "error rate 1.00% > 0.00%",
+        ]
+
+
+class TestStandInAgent:
+    """StandInAgent class"""  # noqa: D415
+
+    def test_add_sign(self, stand_in_agent: StandInAgent) -> None:
+        """Sign only with the identities that have been added."""
+        with AgentClient(stand_in_agent.sock_path) as client:
+            sign = (13, pack_string(ED25519_BLOB) + pack_string(b"data") + pack_uint32(0))
+            refused = client.request(*sign)
+            client.add_identity(ED25519_IDENTITY)
+
+            assert [key.blob for key in client.list_identities()] == [ED25519_BLOB]
+            assert (refused[0], client.request(*sign)[0]) == (5, 14)
+
+
+@pytest.mark.skipif(not SOAK_SECONDS, reason="set SSH_AGENT_ADD_ID_SOAK to the duration")
+def test_soak(stand_in_agent: StandInAgent, isolated_state: Path) -> None:
+    """Keep the latencies, memory and file descriptors within the thresholds for a long run."""
+    priv_key_path, pub_key_path = write_key_files(isolated_state)
+
+    report = run_soak(
+        stand_in_agent.sock_path,
+        priv_key_path,
+        pub_key_path,
+        SOAK_SECONDS,
+        interval=min(SOAK_SECONDS / 10, 60.0),
+        mix={ENSURE: 6, LIST: 2, SIGN: 2},
+        on_sample=print,
+    )
+
+    print(*report.summary_lines(), sep="\n")
+    assert report.violations(Thresholds()) == []
@@ -0,0 +1,76 @@
+import pytest
+from ssh_agent_add_id.aes import aes_cbc_decrypt, aes_ctr_decrypt
+
+
+PLAINTEXT = bytes.fromhex("00112233445566778899aabbccddeeff")
+
+
+class TestAesCbcDecrypt:
+    """aes_cbc_decrypt function"""  # noqa: D415
+
+    @pytest.mark.parametrize(
+        "key_len, ciphertext",
+        [
+            (16, "69c4e0d86a7b0430d8cdb78070b4c55a"),
+            (24, "dda97ca4864cdfe06eaf70a0ec0d7191"),
+            (32, "8ea2b7ca516745bfeafc49904b496089"),
+        ],
+    )
+    def test_fips_197(self, key_len: int, ciphertext: str) -> None:
+        """Decrypt the FIPS-197 example vectors."""
+        key = bytes(range(key_len))
+
+        assert aes_cbc_decrypt(key, bytes(16), bytes.fromhex(ciphertext)) == PLAINTEXT
+        #
+
+    def test_chaining(self) -> None:
+        """XOR each decrypted block with the previous ciphertext block."""
+        key = bytes(range(32))
+        block = bytes.fromhex("8ea2b7ca516745bfeafc49904b496089")
+        iv = bytes([1] * 16)
+
+        out = aes_cbc_decrypt(key, iv, block + block)
+
+        assert out[:16] == bytes(a ^ 1 for a in PLAINTEXT)
+        assert out[16:] == bytes(a ^ b for a, b in zip(PLAINTEXT, block))
+        #
+
+    @pytest.mark.parametrize(
+        "key, iv, data", [(bytes(8), bytes(16), b""), (bytes(16), bytes(16), b"1")]
+    )
+    def test_invalid_length(self, key: bytes, iv: bytes, data: bytes) -> None:
+        """Throw a ValueError if a length is not valid."""
+        with pytest.raises(ValueError):
+            aes_cbc_decrypt(key, iv, data)
+
+
+class TestAesCtrDecrypt:
+    """aes_ctr_decrypt function"""  # noqa: D415
+
+    def test_sp800_38a(self) -> None:
+        """Decrypt the SP 800-38A CTR-AES256 example vector, the last block being truncated."""
+        key = bytes.fromhex("603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4")
+        iv = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff")
+        ciphertext = bytes.fromhex(
+            "601ec313775789a5b7a7f504bbf3d228f443e3ca4d62b59aca84e990cacaf5c5"
+        )
+
+        assert aes_ctr_decrypt(key, iv, ciphertext[:28]) == bytes.fromhex(
+            "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac"
+        )
+        #
+
+    def test_counter_carry(self) -> None:
+        """Increment the whole counter as a big-endian integer."""
+        key = bytes(16)
+        iv = bytes(15) + b"\xff"
+
+        out = aes_ctr_decrypt(key, iv, bytes(32))
+
+        assert out[16:] == aes_ctr_decrypt(key, bytes(14) + b"\x01\x00", bytes(16))
+        #
+
+    def test_invalid_length(self) -> None:
+        """Throw a ValueError if the counter length is not valid."""
+        with pytest.raises(ValueError):
+            aes_ctr_decrypt(bytes(16), bytes(8), b"data")
@@ -0,0 +1,239 @@
+import os
+from pathlib import Path
+import socket
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import deadline
+from ssh_agent_add_id.agent_client import AgentClient, AgentError, TransientAgentError
+from ssh_agent_add_id.deadline import DeadlineExceededError
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.wire import pack_string, pack_uint32
+
+from tests.unit.conftest import FakeAgent
+
+
+BLOB = pack_string(b"ssh-ed25519") + pack_string(b"\x01" * 32)
+
+
+class TestConnect:
+    """connect method"""  # noqa: D415
+
+    def test_connection_error(self, tmp_path: Path) -> None:
+        """Throw an AgentError if the socket cannot be connected."""
+        client = AgentClient(str(tmp_path / "missing.sock"))
+
+        with pytest.raises(AgentError) as exc_info:
+            client.connect()
+
+        assert str(exc_info.value).startswith("Cannot connect to the SSH agent at ")
+        assert not isinstance(exc_info.value, TransientAgentError)
+        #
+
+    def test_refused(self, tmp_path: Path) -> None:
+        """Throw a TransientAgentError if the agent socket refuses the connection."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(tmp_path / "agent.sock"))  # bound but not listening
+
+            with pytest.raises(TransientAgentError):
+                AgentClient(str(tmp_path / "agent.sock")).connect()
+        #
+
+    def test_context_manager(self, fake_agent: FakeAgent) -> None:
+        """Connect on enter and close on exit."""
+        with AgentClient(fake_agent.sock_path) as client:
+            assert client._sock is not None
+
+        assert client._sock is None
+
+
+class TestPeerPid:
+    """peer_pid method"""  # noqa: D415
+
+    def test_success(self, fake_agent: FakeAgent) -> None:
+        """Return the pid of the process serving the socket."""
+        with AgentClient(fake_agent.sock_path) as client:
+            assert client.peer_pid() == os.getpid()
+        #
+
+    def test_unsupported(self, mocker: MockerFixture) -> None:
+        """Return 0 if the platform has no SO_PEERCRED."""
+        mocker.patch("socket.SO_PEERCRED", None)
+
+        assert AgentClient("/test/fake.sock").peer_pid() == 0
+
+
+class TestRequest:
+    """request method"""  # noqa: D415
+
+    def test_failure_reply(self, fake_agent: FakeAgent) -> None:
+        """Return the reply of an unsupported request."""
+        with AgentClient(fake_agent.sock_path) as client:
+            assert client.request(42, b"fake") == (5, b"")
+
+        assert fake_agent.requests == [(42, b"fake")]
+        #
+
+    def test_connection_closed(self, mocker: MockerFixture) -> None:
+        """Throw an AgentError and close the connection if the agent hangs up."""
+        client = AgentClient("/test/fake.sock")
+        client._sock = mocker.Mock()
+        client._sock.recv.return_value = b""
+        mocker.patch("ssh_agent_add_id.cancellation.wait", side_effect=lambda fds, timeout: fds)
+
+        with pytest.raises(AgentError) as exc_info:
+            client.request(11)
+
+        assert exc_info.value.args[0] == "SSH agent closed the connection"
+        assert isinstance(exc_info.value, TransientAgentError)
+        assert client._sock is None
+        #
+
+    def test_invalid_length(self, mocker: MockerFixture) -> None:
+        """Throw an AgentError if the reply length is invalid."""
+        client = AgentClient("/test/fake.sock")
+        client._sock = mocker.Mock()
+        client._sock.recv.return_value = pack_uint32(0)
+        mocker.patch("ssh_agent_add_id.cancellation.wait", side_effect=lambda fds, timeout: fds)
+
+        with pytest.raises(AgentError) as exc_info:
+            client.request(11)
+
+        assert exc_info.value.args[0] == "Invalid SSH agent reply length: 0"
+
+
+class TestRequestMany:
+    """request_many method"""  # noqa: D415
+
+    def test_pipelining(self, fake_agent: FakeAgent, mocker: MockerFixture) -> None:
+        """Write the requests back-to-back, up to the depth, and read the replies in order."""
+        fake_agent.handlers[42] = lambda payload: (6, payload)
+
+        with AgentClient(fake_agent.sock_path) as client:
+            client._sock = mocker.Mock(wraps=client._sock)
+            replies = client.request_many([(42, bytes([i])) for i in range(5)], depth=2)
+
+            sent = [len(call.args[0]) for call in client._sock.sendall.call_args_list]
+
+        assert replies == [(6, bytes([i])) for i in range(5)]
+        assert sent == [12, 6, 6, 6]
+        #
+
+    def test_io_error(self, mocker: MockerFixture) -> None:
+        """Throw an AgentError and close the connection if a write fails."""
+        client = AgentClient("/test/fake.sock")
+        client._sock = mocker.Mock()
+        client._sock.sendall.side_effect = BrokenPipeError("Fake")
+
+        with pytest.raises(AgentError) as exc_info:
+            client.request_many([(11, b""), (11, b"")])
+
+        assert exc_info.value.args[0] == "SSH agent I/O error: Fake"
+        assert isinstance(exc_info.value, TransientAgentError)
+        assert client._sock is None
+        #
+
+    def test_deadline(self, tmp_path: Path) -> None:
+        """Throw a DeadlineExceededError and close the connection if the agent hangs."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(tmp_path / "agent.sock"))
+            server.listen()  # connections are never accepted, so nothing is replied
+            client = AgentClient(str(tmp_path / "agent.sock"))
+
+            with pytest.raises(DeadlineExceededError):
+                with deadline.bounded(0.1):
+                    client.request_many([(11, b"")])
+
+        assert client._sock is None
+
+
+class TestListIdentities:
+    """list_identities method"""  # noqa: D415
+
+    def test_success(self, fake_agent: FakeAgent) -> None:
+        """Return the stored identities."""
+        fake_agent.identities[BLOB] = "fake@test"
+
+        with AgentClient(fake_agent.sock_path) as client:
+            identities = client.list_identities()
+
+        assert identities == [PublicKey("ssh-ed25519", BLOB, "fake@test")]
+        #
+
+    def test_failure_reply(self, fake_agent: FakeAgent) -> None:
+        """Throw a TransientAgentError if the agent answers with a failure."""
+        fake_agent.handlers[11] = lambda payload: (5, b"")
+
+        with AgentClient(fake_agent.sock_path) as client:
+            with pytest.raises(TransientAgentError) as exc_info:
+                client.list_identities()
+
+        assert exc_info.value.args[0] == "The SSH agent failed to list its identities"
+        #
+
+    def test_unexpected_reply(self, fake_agent: FakeAgent) -> None:
+        """Throw an AgentError if the agent does not answer with the identities."""
+        fake_agent.handlers[11] = lambda payload: (14, b"")
+
+        with AgentClient(fake_agent.sock_path) as client:
+            with pytest.raises(AgentError) as exc_info:
+                client.list_identities()
+
+        assert exc_info.value.args[0] == "Unexpected SSH agent reply to identities request: 14"
+        #
+
+    def test_malformed_answer(self, fake_agent: FakeAgent) -> None:
+        """Throw an AgentError if the answer is truncated."""
+        fake_agent.handlers[11] = lambda payload: (12, pack_uint32(1))
+
+        with AgentClient(fake_agent.sock_path) as client:
+            with pytest.raises(AgentError) as exc_info:
+                client.list_identities()
+
+        assert str(exc_info.value).startswith("Malformed SSH agent identities answer")
+        #
+
+
+class TestAddIdentity:
+    """add_identity method"""  # noqa: D415
+
+    def test_success(self, fake_agent: FakeAgent) -> None:
+        """Send an add identity request without constraints."""
+        fake_agent.handlers[17] = lambda payload: (6, b"")
+
+        with AgentClient(fake_agent.sock_path) as client:
+            client.add_identity(b"identity")
+
+        assert fake_agent.requests == [(17, b"identity")]
+        #
+
+    def test_constraints(self, fake_agent: FakeAgent) -> None:
+        """Append the lifetime and confirm constraints to a constrained request."""
+        fake_agent.handlers[25] = lambda payload: (6, b"")
+
+        with AgentClient(fake_agent.sock_path) as client:
+            client.add_identity(b"identity", 3600, True)
+
+        assert fake_agent.requests == [(25, b"identity\x01" + pack_uint32(3600) + b"\x02")]
+        #
+
+    def test_refused(self, fake_agent: FakeAgent) -> None:
+        """Throw an AgentError if the agent replies with a failure."""
+        with AgentClient(fake_agent.sock_path) as client:
+            with pytest.raises(AgentError) as exc_info:
+                client.add_identity(b"identity")
+
+        assert exc_info.value.args[0] == "The SSH agent refused to add the identity"
+
+
+class TestAddIdentities:
+    """add_identities method"""  # noqa: D415
+
+    def test_success(self, fake_agent: FakeAgent) -> None:
+        """Report whether each identity has been accepted by the agent."""
+        fake_agent.handlers[17] = lambda payload: (6 if payload == b"ok" else 5, b"")
+
+        with AgentClient(fake_agent.sock_path) as client:
+            assert client.add_identities([b"ok", b"fake", b"ok"]) == [True, False, True]
+
+        assert fake_agent.requests == [(17, b"ok"), (17, b"fake"), (17, b"ok")]
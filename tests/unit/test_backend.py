@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import backend
+from ssh_agent_add_id.backend import NATIVE, SUBPROCESS, Backend
+from ssh_agent_add_id.constants import STATE_TTL
+
+
+@pytest.fixture
+def config_home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, mocker: MockerFixture) -> Path:
+    """An empty XDG_CONFIG_HOME, the backend not being read yet."""
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    mocker.patch("ssh_agent_add_id.backend._backend", None)
+    return tmp_path / "config"
+
+
+class TestCurrent:
+    """current function"""  # noqa: D415
+
+    def test_defaults(self, config_home: Path) -> None:
+        """Keep using ssh-add until the doctor has chosen a backend."""
+        assert backend.current() == Backend(SUBPROCESS, True, STATE_TTL, False, "")
+        #
+
+    def test_saved(
+        self, config_home: Path, mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+        """Read the saved choice once per process."""
+        monkeypatch.setenv("SSH_AUTH_SOCK", "/test/fake.sock")
+        Backend(NATIVE, state_ttl=300, sock_path="/test/fake.sock").save()
+        mocker.patch("ssh_agent_add_id.backend._backend", None)
+
+        current = backend.current()
+
+        assert (current.agent_io, current.state_ttl) == (NATIVE, 300)
+        assert (config_home / "ssh-agent-add-id" / "backend.json").exists()
+        assert backend.current() is current
+        #
+
+    def test_other_agent(self, config_home: Path, mocker: MockerFixture) -> None:
+        """Use the defaults with another agent than the measured one, but its ssh-add -T support."""
+        Backend(NATIVE, ssh_add_test=False, state_ttl=300, sock_path="/test/fake.sock").save()
+        mocker.patch("ssh_agent_add_id.backend._backend", None)
+
+        assert backend.current("/test/other.sock") == Backend(ssh_add_test=False)
+        assert backend.current("/test/fake.sock").state_ttl == 300
+        #
+
+    def test_invalid_file(self, config_home: Path) -> None:
+        """Ignore an invalid file and its unknown fields."""
+        (config_home / "ssh-agent-add-id").mkdir(parents=True)
+        (config_home / "ssh-agent-add-id" / "backend.json").write_text("[]")
+
+        assert backend.current() == Backend()
@@ -0,0 +1,114 @@
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import bcrypt_pbkdf as module
+from ssh_agent_add_id.bcrypt_pbkdf import (
+    CancelledDerivationError,
+    bcrypt_pbkdf,
+    has_native_engine,
+)
+from ssh_agent_add_id.errors import SignalException
+
+
+# Derived by the bcrypt C extension
+ONE_ROUND_KEY = bytes.fromhex(
+    "7aecf4a3148069a4e52b28a060c4da05492ede72bf0caa4f6a2a4e5f1252a24ccb8a85077baa90b6"
+)
+
+
+@pytest.fixture
+def pure_engine(mocker: MockerFixture) -> None:
+    """A fixture that disables the bcrypt C extension."""
+    mocker.patch.object(module, "_native_kdf", return_value=None)
+
+
+class TestInitialState:
+    """_initial_state function"""  # noqa: D415
+
+    def test_pi_digits(self) -> None:
+        """Start the P-array and each S-box with the right hex digits of pi."""
+        p, s0, s1, s2, s3 = module._initial_state()
+
+        assert (len(p), len(s3)) == (18, 256)
+        assert (p[0], p[17]) == (0x243F6A88, 0x8979FB1B)
+        assert (s0[0], s1[0], s2[0], s3[0]) == (0xD1310BA6, 0x4B7A70E9, 0xE93D5A68, 0x3A39CE37)
+        assert s3[255] == 0x3AC372E6
+
+
+class TestBcryptPbkdf:
+    """bcrypt_pbkdf function"""  # noqa: D415
+
+    @pytest.mark.usefixtures("pure_engine")
+    def test_pure(self, mocker: MockerFixture) -> None:
+        """Interleave the output blocks, derived in worker processes if there are several CPUs."""
+        mocker.patch("os.cpu_count", return_value=2)
+
+        assert bcrypt_pbkdf(b"password", b"salt", 1, 40) == ONE_ROUND_KEY
+        assert not has_native_engine()
+        #
+
+    @pytest.mark.usefixtures("pure_engine")
+    def test_sequential(self, mocker: MockerFixture) -> None:
+        """Derive the blocks in the current process, checking for signals between two rounds."""
+        mocker.patch("os.cpu_count", return_value=1)
+        bcrypt_hash = mocker.spy(module, "bcrypt_hash")
+        hashed = []
+        mocker.patch(
+            "ssh_agent_add_id.cancellation.check",
+            side_effect=lambda: hashed.append(bcrypt_hash.call_count),
+        )
+
+        assert len(bcrypt_pbkdf(b"password", b"salt", 3, 8)) == 8
+        # Once after each round but the last
+        assert hashed == [1, 2]
+        #
+
+    @pytest.mark.usefixtures("pure_engine")
+    def test_sequential_signal(self, mocker: MockerFixture) -> None:
+        """Stop the derivation in the current process as soon as a signal is caught."""
+        mocker.patch("os.cpu_count", return_value=1)
+        bcrypt_hash = mocker.spy(module, "bcrypt_hash")
+        check = mocker.patch(
+            "ssh_agent_add_id.cancellation.check", side_effect=[None, SignalException(15)]
+        )
+
+        with pytest.raises(SignalException):
+            bcrypt_pbkdf(b"password", b"salt", 16, 64)
+
+        assert check.call_count == 2
+        assert bcrypt_hash.call_count == 2
+        #
+
+    def test_native(self, mocker: MockerFixture) -> None:
+        """Use the bcrypt C extension if it is installed, even for a few rounds."""
+        kdf = mocker.patch.object(module, "_native_kdf")
+
+        assert bcrypt_pbkdf(b"password", b"salt", 16, 48) == kdf.return_value.return_value
+        kdf.return_value.assert_called_once_with(
+            b"password", b"salt", 48, 16, ignore_few_rounds=True
+        )
+        assert has_native_engine()
+        #
+
+    @pytest.mark.parametrize(
+        "password, salt, rounds, length",
+        [(b"", b"salt", 1, 32), (b"pw", b"", 1, 32), (b"pw", b"salt", 0, 32), (b"pw", b"s", 1, 0)],
+    )
+    def test_invalid(self, password: bytes, salt: bytes, rounds: int, length: int) -> None:
+        """Throw a ValueError if a parameter is not valid."""
+        with pytest.raises(ValueError):
+            bcrypt_pbkdf(password, salt, rounds, length)
+
+
+class TestDeriveBlock:
+    """_derive_block function"""  # noqa: D415
+
+    def test_stop(self, mocker: MockerFixture) -> None:
+        """Stop between two rounds once the parent has been cancelled."""
+        bcrypt_hash = mocker.patch.object(module, "bcrypt_hash", return_value=bytes(32))
+        stop = mocker.Mock()
+        mocker.patch.object(module, "_stop", stop)
+
+        with pytest.raises(CancelledDerivationError):
+            module._derive_block(bytes(64), b"salt", 16, 0)
+
+        assert bcrypt_hash.call_count == 1
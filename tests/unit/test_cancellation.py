@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import signal
+from subprocess import PIPE, TimeoutExpired
+import sys
+import threading
+import time
+from typing import Iterator
+
+import pytest
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.cancellation import CancelToken
+from ssh_agent_add_id.errors import SignalException
+
+
+SLEEPER = [sys.executable, "-c", "import time; time.sleep(10)"]
+
+
+def cancel_later(token: CancelToken, delay: float = 0.05) -> None:
+    """Cancel a token from another thread, like a signal received while waiting."""
+    threading.Timer(delay, token.cancel, (signal.SIGINT,)).start()
+
+
+class TestCancelToken:
+    """CancelToken class"""  # noqa: D415
+
+    @pytest.fixture
+    def pipe(self) -> Iterator[tuple]:
+        """A fixture that returns a pipe."""
+        read_fd, write_fd = os.pipe()
+        yield read_fd, write_fd
+        os.close(read_fd)
+        os.close(write_fd)
+        #
+
+    def test_wait(self, cancel_token: CancelToken, pipe: tuple) -> None:
+        """Return the readable file descriptors, or none when the timeout expires."""
+        assert cancel_token.wait([pipe[0]], 0.01) == []
+
+        os.write(pipe[1], b"x")
+
+        assert cancel_token.wait([pipe[0]]) == [pipe[0]]
+        #
+
+    def test_cancel(self, cancel_token: CancelToken, pipe: tuple) -> None:
+        """Throw a SignalException in all the waits once cancelled."""
+        cancel_later(cancel_token)
+        started_at = time.monotonic()
+
+        with pytest.raises(SignalException) as exc_info:
+            cancel_token.wait([pipe[0]])
+
+        assert exc_info.value.signal_num == signal.SIGINT
+        assert time.monotonic() - started_at < 1
+        with pytest.raises(SignalException):
+            cancel_token.wait([pipe[0]], 0)
+        #
+
+    def test_signal(self, cancel_token: CancelToken) -> None:
+        """Wake the main thread up when a signal is delivered, to run the handler."""
+        previous_handler = signal.signal(
+            signal.SIGUSR1, lambda signum, _: cancel_token.cancel(signum)
+        )
+        previous_fd = signal.set_wakeup_fd(cancel_token.wakeup_fd, warn_on_full_buffer=False)
+
+        try:
+            threading.Timer(0.05, os.kill, (os.getpid(), signal.SIGUSR1)).start()
+            with pytest.raises(SignalException) as exc_info:
+                cancel_token.wait([], 5)
+        finally:
+            signal.set_wakeup_fd(previous_fd)
+            signal.signal(signal.SIGUSR1, previous_handler)
+
+        assert exc_info.value.signal_num == signal.SIGUSR1
+
+
+class TestInterruptible:
+    """interruptible function"""  # noqa: D415
+
+    def test_cancelled(self, cancel_token: CancelToken) -> None:
+        """Throw a SignalException before starting if a signal has already been received."""
+        cancel_token.cancel(signal.SIGTERM)
+
+        with pytest.raises(SignalException):
+            with cancellation.interruptible():
+                pass
+
+        assert not cancel_token.interruptible
+
+
+class TestRead:
+    """read function"""  # noqa: D415
+
+    def test_until(self) -> None:
+        """Read until the end of the file, or until the given bytes."""
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"first\nsecond\n")
+
+        try:
+            assert cancellation.read(read_fd, 1, b"\n") == b"first\nsecond\n"
+            os.write(write_fd, b"third")
+            os.close(write_fd)
+            assert cancellation.read(read_fd) == b"third"
+        finally:
+            os.close(read_fd)
+        #
+
+    def test_timeout(self) -> None:
+        """Throw a TimeoutError if the writer keeps the file descriptor open."""
+        read_fd, write_fd = os.pipe()
+
+        try:
+            with pytest.raises(TimeoutError):
+                cancellation.read(read_fd, 0.01)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+class TestRun:
+    """run function"""  # noqa: D415
+
+    def test_success(self) -> None:
+        """Return the outputs and the exit code of the command."""
+        completed = cancellation.run(
+            [sys.executable, "-c", "import sys; print('out'); sys.exit('err')"],
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+
+        assert completed.returncode == 1
+        assert completed.stdout.strip() == b"out"
+        assert completed.stderr.strip() == b"err"
+        #
+
+    def test_cancel(self, cancel_token: CancelToken) -> None:
+        """Kill the command as soon as a signal is received."""
+        cancel_later(cancel_token)
+        started_at = time.monotonic()
+
+        with pytest.raises(SignalException):
+            cancellation.run(SLEEPER, stdout=PIPE)
+
+        assert time.monotonic() - started_at < 5
+        #
+
+    def test_timeout(self) -> None:
+        """Kill the command when the timeout expires."""
+        with pytest.raises(TimeoutExpired):
+            cancellation.run(SLEEPER, timeout=0.05, stdout=PIPE)
+
+
+class TestPoolMap:
+    """pool_map function"""  # noqa: D415
+
+    def test_results(self) -> None:
+        """Return the results in item order."""
+        with ThreadPoolExecutor() as pool:
+            assert cancellation.pool_map(pool, lambda item: item * 2, [3, 1, 2]) == [6, 2, 4]
+        #
+
+    def test_cancel(self, cancel_token: CancelToken) -> None:
+        """Stop waiting and cancel the pending jobs as soon as a signal is received."""
+        started = []
+
+        # The worker picks the next job as soon as this one returns on the signal
+        def job(item: int) -> int:
+            started.append(item)
+            cancellation.sleep(5)
+            return item
+
+        cancel_later(cancel_token)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            with pytest.raises(SignalException):
+                cancellation.pool_map(pool, job, [1, 2, 3])
+
+        assert started == [1]
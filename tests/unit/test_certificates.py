@@ -0,0 +1,176 @@
+import base64
+from pathlib import Path
+import struct
+import time
+
+import pytest
+from ssh_agent_add_id.agent_client import AgentClient, AgentError
+from ssh_agent_add_id.certificates import (
+    FOREVER,
+    add_with_certificate,
+    cache_lifetime,
+    certificate_identity,
+    paired_certificate,
+    parse_certificate,
+    with_certificate,
+)
+from ssh_agent_add_id.constants import CERT_RENEW_MARGIN
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.wire import pack_string, pack_uint32
+
+from tests.unit.conftest import ED25519_BLOB, ED25519_IDENTITY, ED25519_PUBLIC, FakeAgent
+
+
+CERT_TYPE = b"ssh-ed25519-cert-v01@openssh.com"
+
+
+def cert_blob(
+    valid_after: int = 0, valid_before: int = FOREVER, public: bytes = ED25519_PUBLIC
+) -> bytes:
+    """Build an unsigned ed25519 user certificate blob."""
+    return (
+        pack_string(CERT_TYPE)
+        + pack_string(b"nonce")
+        + pack_string(public)
+        + struct.pack(">Q", 7)
+        + pack_uint32(1)
+        + pack_string(b"fake-id")
+        + pack_string(pack_string(b"alice") + pack_string(b"deploy"))
+        + struct.pack(">QQ", valid_after, valid_before)
+        + pack_string(b"")
+        + pack_string(b"")
+        + pack_string(b"")
+        + pack_string(b"fake-ca")
+        + pack_string(b"fake-signature")
+    )
+
+
+def write_cert(priv_key_path: Path, blob: bytes) -> None:
+    """Write the certificate file paired with a private key."""
+    Path(f"{priv_key_path}-cert.pub").write_text(
+        f"{CERT_TYPE.decode()} {base64.b64encode(blob).decode()} fake@test\n"
+    )
+
+
+class TestParseCertificate:
+    """parse_certificate function"""  # noqa: D415
+
+    def test_fields(self) -> None:
+        """Read the certified key and the validity window."""
+        cert = parse_certificate(PublicKey(CERT_TYPE.decode(), cert_blob(10, 20), ""))
+
+        assert cert.key_blob == ED25519_BLOB
+        assert (cert.key_id, cert.principals) == ("fake-id", ("alice", "deploy"))
+        assert (cert.valid_after, cert.valid_before) == (10, 20)
+        assert cert.is_valid(10) and not cert.is_valid(20)
+        #
+
+    def test_not_certificate(self) -> None:
+        """Reject a plain public key."""
+        with pytest.raises(ValueError, match="Unsupported certificate type"):
+            parse_certificate(PublicKey("ssh-ed25519", ED25519_BLOB, ""))
+
+
+class TestPairedCertificate:
+    """paired_certificate function"""  # noqa: D415
+
+    def test_valid(self, tmp_path: Path) -> None:
+        """Load the certificate paired with a key."""
+        write_cert(tmp_path / "id", cert_blob())
+
+        cert = paired_certificate(str(tmp_path / "id"), ED25519_BLOB)
+
+        assert cert and cert.valid_before == FOREVER
+        #
+
+    @pytest.mark.parametrize(
+        "blob",
+        [
+            cert_blob(valid_before=int(time.time()) - 1),
+            cert_blob(valid_after=int(time.time()) + 3600),
+            cert_blob(public=bytes(32)),
+        ],
+        ids=["expired", "not yet valid", "other key"],
+    )
+    def test_ignored(self, blob: bytes, tmp_path: Path) -> None:
+        """Ignore a certificate that cannot be used with the key."""
+        write_cert(tmp_path / "id", blob)
+
+        assert paired_certificate(str(tmp_path / "id"), ED25519_BLOB) is None
+        #
+
+    def test_missing(self, tmp_path: Path) -> None:
+        """Return None for a key without certificate."""
+        assert paired_certificate(str(tmp_path / "id")) is None
+
+
+class TestCacheLifetime:
+    """cache_lifetime function"""  # noqa: D415
+
+    def test_expiry(self) -> None:
+        """Trust the certificate until the renewal margin before its expiry."""
+        valid_before = int(time.time() + CERT_RENEW_MARGIN + 3600)
+        cert = parse_certificate(PublicKey(CERT_TYPE.decode(), cert_blob(0, valid_before), ""))
+
+        assert 3590 <= (cache_lifetime(cert) or 0) <= 3600
+        assert cache_lifetime(cert, 60) == 60
+        #
+
+    def test_no_expiry(self) -> None:
+        """Keep the lifetime of a certificate that never expires or is about to."""
+        forever = parse_certificate(PublicKey(CERT_TYPE.decode(), cert_blob(), ""))
+        soon = parse_certificate(
+            PublicKey(CERT_TYPE.decode(), cert_blob(0, int(time.time()) + 10), "")
+        )
+
+        assert cache_lifetime(forever) is None
+        assert cache_lifetime(soon, 60) == 60
+
+
+class TestCertificateIdentity:
+    """certificate_identity and with_certificate functions"""  # noqa: D415
+
+    def test_ed25519(self) -> None:
+        """Replace the key type and keep all the private fields of an ed25519 key."""
+        blob = cert_blob()
+        cert = parse_certificate(PublicKey(CERT_TYPE.decode(), blob, ""))
+
+        assert certificate_identity(ED25519_IDENTITY, cert) == (
+            pack_string(CERT_TYPE) + pack_string(blob) + ED25519_IDENTITY[15:]
+        )
+        #
+
+    def test_with_certificate(self, tmp_path: Path) -> None:
+        """Add the certificate after the key, only if there is one."""
+        assert with_certificate(str(tmp_path / "id"), ED25519_IDENTITY, ED25519_BLOB) == [
+            ED25519_IDENTITY
+        ]
+
+        write_cert(tmp_path / "id", cert_blob())
+        identities = with_certificate(str(tmp_path / "id"), ED25519_IDENTITY, ED25519_BLOB)
+
+        assert len(identities) == 2
+        assert identities[1].startswith(pack_string(CERT_TYPE))
+
+
+class TestAddWithCertificate:
+    """add_with_certificate function"""  # noqa: D415
+
+    def test_refused_certificate(self, fake_agent: FakeAgent, tmp_path: Path) -> None:
+        """Add both identities with a single round trip, tolerating a refused certificate."""
+        write_cert(tmp_path / "id", cert_blob())
+        fake_agent.handlers[17] = lambda payload: (
+            5 if payload.startswith(pack_string(CERT_TYPE)) else 6,
+            b"",
+        )
+
+        with AgentClient(fake_agent.sock_path) as client:
+            add_with_certificate(client, str(tmp_path / "id"), ED25519_IDENTITY, ED25519_BLOB)
+
+        assert [msg_type for msg_type, _ in fake_agent.requests] == [17, 17]
+        #
+
+    def test_refused_key(self, fake_agent: FakeAgent, tmp_path: Path) -> None:
+        """Raise an AgentError if the agent refuses the key itself."""
+        with AgentClient(fake_agent.sock_path) as client, pytest.raises(AgentError):
+            add_with_certificate(client, str(tmp_path / "id"), ED25519_IDENTITY, ED25519_BLOB)
@@ -1,11 +1,18 @@
+import json
 import os
 from pathlib import Path
+from typing import Any, List
 
 import pytest
 from pytest import CaptureFixture
 from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id import cancellation, deadline
 from ssh_agent_add_id.cli import main
 from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.fanout import AgentResult
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.passphrase import EnvProvider, PassphraseChain
+from ssh_agent_add_id.scan import KeyResult
 
 
 class TestMain:
@@ -18,6 +25,18 @@ class TestMain:
             self.mocker = mocker
 
             self.cli_args: MockType = mocker.patch("ssh_agent_add_id.cli.CliArguments").return_value
+            self.cli_args.command = None
+            self.cli_args.watch = False
+            self.cli_args.lifetime = None
+            self.cli_args.confirm = False
+            self.cli_args.agent_socks = []
+            self.cli_args.scan_dirs = []
+            self.cli_args.workspace_dir = None
+            self.cli_args.output = "text"
+            self.cli_args.passphrase_chain = PassphraseChain()
+            self.cli_args.profile_path = None
+            self.cli_args.deadline = None
+            self.cli_args.profile_memory = False
             self.cli_args.resolve_priv_key_path.return_value = Path("/test/fake/priv")
             self.cli_args.resolve_pub_key_path.return_value = Path("/test/fake/pub")
 
@@ -26,6 +45,27 @@ class TestMain:
             self.ssh_agent: MockType = mocker.patch("ssh_agent_add_id.cli.SSHAgent")
             self.add_identity: MockType = self.ssh_agent.return_value.add_identity
             self.is_identity_stored: MockType = self.ssh_agent.return_value.is_identity_stored
+
+            self.record_identity: MockType = mocker.patch("ssh_agent_add_id.cli.record_identity")
+            self.generate_hook: MockType = mocker.patch("ssh_agent_add_id.cli.generate_hook")
+
+            self.run_exec: MockType = mocker.patch("ssh_agent_add_id.cli.run_exec")
+            self.run_exec.side_effect = SystemExit(0)  # run_exec never returns
+
+            self.watcher: MockType = mocker.patch("ssh_agent_add_id.cli.IdentityWatcher")
+            self.ensure_identity_on_agents: MockType = mocker.patch(
+                "ssh_agent_add_id.cli.ensure_identity_on_agents"
+            )
+            self.add_identity_unattended: MockType = mocker.patch(
+                "ssh_agent_add_id.cli.add_identity_unattended", return_value=False
+            )
+            self.run_doctor: MockType = mocker.patch("ssh_agent_add_id.cli.run_doctor")
+            self.list_identities: MockType = mocker.patch("ssh_agent_add_id.cli.list_identities")
+            self.scan_keys: MockType = mocker.patch("ssh_agent_add_id.cli.scan_keys")
+            self.workspace_keys: MockType = mocker.patch("ssh_agent_add_id.cli.workspace_keys")
+            self.ensure_scanned_identities: MockType = mocker.patch(
+                "ssh_agent_add_id.cli.ensure_scanned_identities"
+            )
             #
 
     @pytest.fixture
@@ -46,6 +86,19 @@ class TestMain:
         assert isinstance(exc_info.value.__context__, ExitCodeError)
         #
 
+    def test_deadline(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Exit with a distinct code when the deadline is exceeded, and clear it."""
+        mocks.cli_args.deadline = 0.05
+        mocks.is_identity_stored.side_effect = lambda path: cancellation.sleep(5)
+
+        with pytest.raises(SystemExit) as exc_info:
+            main()
+
+        assert exc_info.value.args[0] == 124
+        assert capsys.readouterr().err == "Deadline of 0.05s exceeded" + os.linesep
+        assert deadline.remaining() is None
+        #
+
     def test_unknown_exception(self, mocks: Mocks, capsys: CaptureFixture) -> None:
         """Catch all unknown exceptions."""
         mocks.ssh_agent.side_effect = Exception("Fake error")
@@ -68,6 +121,17 @@ class TestMain:
         mocks.add_identity.assert_not_called()
         #
 
+    def test_profile(self, mocks: Mocks, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Profile the run and write the pstats file when --profile is given."""
+        mocks.is_identity_stored.return_value = True
+        mocks.cli_args.profile_path = str(tmp_path / "fake.pstats")
+
+        main()
+
+        assert (tmp_path / "fake.pstats").is_file()
+        assert f"Profile written to {tmp_path / 'fake.pstats'}" in capsys.readouterr().err
+        #
+
     def test_is_identity_stored_false(self, mocks: Mocks) -> None:
         """Call add_identity when is_identity_stored returns False."""
         mocks.is_identity_stored.return_value = False
@@ -76,3 +140,325 @@ class TestMain:
 
         mocks.is_identity_stored.assert_called_once()
         mocks.add_identity.assert_called_once()
+        #
+
+    def test_record_identity(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Record the identity into the agent state."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+
+        main()
+
+        mocks.record_identity.assert_called_once_with("/test/fake.sock", "/test/fake/pub", None)
+        #
+
+    def test_constraints(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Add the identity with the constraints and record its lifetime."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.lifetime = 3600
+        mocks.cli_args.confirm = True
+        mocks.is_identity_stored.return_value = False
+
+        main()
+
+        mocks.add_identity.assert_called_once_with("/test/fake/priv", 3600, True)
+        mocks.record_identity.assert_called_once_with("/test/fake.sock", "/test/fake/pub", 3600)
+        #
+
+    def test_passphrase_providers(
+        self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture
+    ) -> None:
+        """Add the identity with the passphrase providers without prompting."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocker.patch(
+            "ssh_agent_add_id.cli.load_public_key", return_value=PublicKey("ssh-ed25519", b"fake")
+        )
+        mocks.cli_args.passphrase_chain = PassphraseChain([EnvProvider("FAKE_PASSPHRASE")])
+        mocker.patch.dict("os.environ", {"FAKE_PASSPHRASE": "fake"})
+        mocks.is_identity_stored.return_value = False
+        mocks.add_identity_unattended.return_value = True
+
+        main()
+
+        mocks.add_identity_unattended.assert_called_once_with(
+            "/test/fake.sock", "/test/fake/priv", ["fake"], None, False
+        )
+        mocks.add_identity.assert_not_called()
+        assert capsys.readouterr().out == f"Identity added: /test/fake/priv{os.linesep}"
+        #
+
+    def test_jsonl_output(
+        self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture
+    ) -> None:
+        """Write only the record of the key to stdout, the messages going to stderr."""
+        mocker.patch(
+            "ssh_agent_add_id.cli.load_public_key", return_value=PublicKey("ssh-ed25519", b"fake")
+        )
+        mocks.cli_args.output = "jsonl"
+        mocks.is_identity_stored.return_value = False
+        mocks.add_identity_unattended.return_value = True
+
+        main()
+
+        captured = capsys.readouterr()
+        record = json.loads(captured.out)
+        assert (record["path"], record["action"], record["error"]) == (
+            "/test/fake/priv",
+            "added",
+            None,
+        )
+        assert record["fingerprint"] == PublicKey("ssh-ed25519", b"fake").fingerprint
+        assert captured.err == f"Identity added: /test/fake/priv{os.linesep}"
+        #
+
+    def test_jsonl_output_failure(
+        self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture
+    ) -> None:
+        """Write the record of a failed key before exiting."""
+        mocker.patch("ssh_agent_add_id.cli.load_public_key", side_effect=OSError("Fake"))
+        mocks.cli_args.output = "jsonl"
+        mocks.is_identity_stored.return_value = False
+        mocks.add_identity.side_effect = ValueError("Bad passphrase")
+
+        with pytest.raises(SystemExit) as exc_info:
+            main()
+
+        captured = capsys.readouterr()
+        assert exc_info.value.args[0] == 1
+        assert json.loads(captured.out)["error"] == "Bad passphrase"
+        assert json.loads(captured.out)["fingerprint"] is None
+        assert captured.err == "Bad passphrase" + os.linesep
+        #
+
+    def test_record_identity_failure(self, mocks: Mocks) -> None:
+        """Ignore the failures of record_identity."""
+        mocks.record_identity.side_effect = OSError("Fake")
+
+        main()
+
+        mocks.record_identity.assert_called_once()
+        #
+
+    def test_hook_command(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Print the shell hook for the hook subcommand."""
+        mocks.cli_args.command = "hook"
+        mocks.cli_args.shell = "bash"
+        mocks.generate_hook.return_value = "fake hook"
+
+        main()
+
+        mocks.generate_hook.assert_called_once_with("bash", "/test/fake/priv", "/test/fake/pub")
+        assert capsys.readouterr().out == "fake hook"
+        mocks.ssh_agent.assert_not_called()
+        #
+
+    def test_exec_command(self, mocks: Mocks) -> None:
+        """Call run_exec for the exec subcommand."""
+        mocks.cli_args.command = "exec"
+
+        with pytest.raises(SystemExit):
+            main()
+
+        mocks.run_exec.assert_called_once_with(mocks.cli_args)
+        mocks.is_identity_stored.assert_not_called()
+        #
+
+    def test_watch(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Run the identity watcher once the identity has been added."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.watch = True
+
+        main()
+
+        mocks.watcher.assert_called_once_with(
+            "/test/fake.sock",
+            "/test/fake/priv",
+            "/test/fake/pub",
+            lifetime=None,
+            confirm=False,
+            passphrase_chain=mocks.cli_args.passphrase_chain,
+        )
+        mocks.watcher.return_value.run.assert_called_once()
+        #
+
+    def test_agent_socks(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Ensure the identity on all the given agents and print the result for each one."""
+        mocks.cli_args.agent_socks = ["/test/a.sock", "/test/b.sock"]
+        mocks.ensure_identity_on_agents.return_value = [
+            AgentResult("/test/a.sock", "stored"),
+            AgentResult("/test/b.sock", "added"),
+        ]
+
+        main()
+
+        mocks.ensure_identity_on_agents.assert_called_once_with(
+            ["/test/a.sock", "/test/b.sock"],
+            "/test/fake/priv",
+            "/test/fake/pub",
+            None,
+            False,
+            mocks.cli_args.passphrase_chain,
+            None,
+        )
+        assert (
+            capsys.readouterr().out
+            == f"/test/a.sock: stored{os.linesep}/test/b.sock: added{os.linesep}"
+        )
+        mocks.ssh_agent.assert_not_called()
+        #
+
+    def test_agent_socks_failure(self, mocks: Mocks) -> None:
+        """Exit with code 1 if the identity could not be ensured on an agent."""
+        mocks.cli_args.agent_socks = ["/test/a.sock"]
+        mocks.ensure_identity_on_agents.return_value = [AgentResult("/test/a.sock", "failed")]
+
+        with pytest.raises(SystemExit) as exc_info:
+            main()
+
+        assert exc_info.value.args[0] == 1
+        #
+
+    @pytest.mark.parametrize(
+        "status, out, err",
+        [
+            ("stored", "This identity has already been added to the SSH agent.", ""),
+            ("added", "Identity added: /test/fake/priv.ppk", ""),
+            ("failed", "", "Bad passphrase"),
+        ],
+    )
+    def test_ppk_key(
+        self,
+        mocks: Mocks,
+        mocker: MockerFixture,
+        capsys: CaptureFixture,
+        status: str,
+        out: str,
+        err: str,
+    ) -> None:
+        """Report a PuTTY key on the default agent with the messages of the other keys."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocker.patch("ssh_agent_add_id.cli.is_ppk_file", return_value=True)
+        mocks.cli_args.resolve_priv_key_path.return_value = Path("/test/fake/priv.ppk")
+        error = "Bad passphrase" if status == "failed" else ""
+        mocks.ensure_identity_on_agents.return_value = [
+            AgentResult("/test/fake.sock", status, error)
+        ]
+
+        if status == "failed":
+            with pytest.raises(SystemExit):
+                main()
+        else:
+            main()
+
+        captured = capsys.readouterr()
+        assert captured.out == (out + os.linesep if out else "")
+        assert captured.err == (err + os.linesep if err else "")
+        #
+
+    def test_scan(self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture) -> None:
+        """Ensure the scanned keys and print the result for each one."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.scan_dirs = ["/test/dir"]
+        mocks.ensure_scanned_identities.return_value = [KeyResult("/test/dir/id", "added")]
+
+        main()
+
+        mocks.scan_keys.assert_called_once_with(["/test/dir"])
+        mocks.ensure_scanned_identities.assert_called_once_with(
+            "/test/fake.sock",
+            mocks.scan_keys.return_value,
+            None,
+            False,
+            mocks.cli_args.passphrase_chain,
+            None,
+        )
+        assert capsys.readouterr().out == f"/test/dir/id: added{os.linesep}"
+        mocks.cli_args.resolve_priv_key_path.assert_not_called()
+        #
+
+    def test_scan_jsonl_output(
+        self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture
+    ) -> None:
+        """Stream the records of the scanned keys instead of printing the results at the end."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.scan_dirs = ["/test/dir"]
+        mocks.cli_args.output = "jsonl"
+
+        def ensure(*args: Any) -> List[KeyResult]:  # noqa: ANN401
+            result = KeyResult("/test/dir/id", "stored", "", "SHA256:fake", 0.001)
+            args[-1](result)
+            return [result]
+
+        mocks.ensure_scanned_identities.side_effect = ensure
+
+        main()
+
+        assert json.loads(capsys.readouterr().out)["fingerprint"] == "SHA256:fake"
+        #
+
+    def test_scan_no_key(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Exit with code 1 if no private key has been found."""
+        mocks.cli_args.scan_dirs = ["/test/dir"]
+        mocks.scan_keys.return_value = []
+
+        with pytest.raises(SystemExit) as exc_info:
+            main()
+
+        assert exc_info.value.args[0] == 1
+        assert capsys.readouterr().err == "No private key found" + os.linesep
+        mocks.ensure_scanned_identities.assert_not_called()
+        #
+
+    @pytest.mark.parametrize("save", [True, False])
+    def test_doctor(self, mocks: Mocks, mocker: MockerFixture, save: bool) -> None:
+        """Print the doctor report and save the chosen backend unless --no-save is given."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.command = "doctor"
+        mocks.cli_args.priv_key_paths = ["/test/key"]
+        mocks.cli_args.save = save
+
+        main()
+
+        mocks.run_doctor.assert_called_once_with("/test/fake.sock", ["/test/key"])
+        assert mocks.run_doctor.return_value.backend.save.called is save
+        mocks.ssh_agent.assert_not_called()
+        #
+
+    def test_list(self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture) -> None:
+        """Print each identity of the agent with its local key files."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.command = "list"
+        mocks.cli_args.key_dirs = ["/test/keys"]
+        mocks.list_identities.return_value = ["fake identity"]
+
+        main()
+
+        mocks.list_identities.assert_called_once_with("/test/fake.sock", ["/test/keys"])
+        assert capsys.readouterr().out == "fake identity" + os.linesep
+        #
+
+    def test_workspace(self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture) -> None:
+        """Ensure only the keys needed by the remotes of the workspace."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+        mocks.cli_args.workspace_dir = "/test/repo"
+        mocks.ensure_scanned_identities.return_value = [KeyResult("/test/id", "stored")]
+
+        main()
+
+        mocks.workspace_keys.assert_called_once_with("/test/repo")
+        mocks.scan_keys.assert_not_called()
+        assert mocks.ensure_scanned_identities.call_args[0][:2] == (
+            "/test/fake.sock",
+            mocks.workspace_keys.return_value,
+        )
+        assert capsys.readouterr().out == f"/test/id: stored{os.linesep}"
+        #
+
+    def test_workspace_no_key(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Succeed without adding anything if the remotes need no key (e.g. HTTPS remotes)."""
+        mocks.cli_args.workspace_dir = "."
+        mocks.workspace_keys.return_value = []
+
+        main()
+
+        assert capsys.readouterr().out == f"No key needed by the remotes of .{os.linesep}"
+        mocks.ensure_scanned_identities.assert_not_called()
@@ -6,6 +6,7 @@ from pytest import CaptureFixture
 from pytest_mock.plugin import MockerFixture
 from ssh_agent_add_id.cli_arguments import CliArguments
 from ssh_agent_add_id.constants import APP_NAME
+from ssh_agent_add_id.passphrase import EnvProvider, StoreProvider
 
 
 def init_cli_args() -> CliArguments:
@@ -46,6 +47,262 @@ class TestInit:
 
         assert args._args.priv_key_path == "/test/fake"
         assert args._args.pub_key_path == "/test/fake.pub"
+        #
+
+    def test_watch_flag(self) -> None:
+        """Handle the --watch flag."""
+        sys.argv = [APP_NAME, "--watch", "/test/fake"]
+
+        args = CliArguments()
+
+        assert args.watch is True
+        assert args._args.priv_key_path == "/test/fake"
+        #
+
+    def test_agent_socks(self) -> None:
+        """Collect the repeated --agent-sock arguments."""
+        sys.argv = [
+            APP_NAME,
+            "--agent-sock",
+            "/test/a.sock",
+            "--agent-sock=/test/b.sock",
+            "/test/fake",
+        ]
+
+        args = CliArguments()
+
+        assert args.agent_socks == ["/test/a.sock", "/test/b.sock"]
+        #
+
+    def test_scan(self) -> None:
+        """Collect the --scan directories, ~/.ssh by default, without priv_key_path."""
+        sys.argv = [APP_NAME, "--scan", "/test/dir", "--scan"]
+
+        args = CliArguments()
+
+        assert args.scan_dirs == ["/test/dir", "~/.ssh"]
+        #
+
+    def test_workspace(self) -> None:
+        """Get the --workspace directory, the current one by default, without priv_key_path."""
+        sys.argv = [APP_NAME, "--workspace"]
+
+        args = CliArguments()
+
+        assert args.workspace_dir == "."
+        assert args.scan_dirs == []
+        assert args.output == "text"
+        #
+
+    def test_output(self) -> None:
+        """Get the --output format."""
+        sys.argv = [APP_NAME, "--scan", "--output", "jsonl"]
+
+        assert CliArguments().output == "jsonl"
+        #
+
+    @pytest.mark.parametrize(
+        "argv, message",
+        [
+            (["--scan", "/test/dir", "/test/fake"], "--scan cannot be used with priv_key_path"),
+            (["--watch", "--scan"], "--scan cannot be used with --watch or --agent-sock"),
+            (["--watch"], "the following arguments are required: priv_key_path"),
+            (["--workspace", "--scan"], "--scan cannot be used with --workspace"),
+            (["--workspace", "/test/repo", "/test/fake"], "--workspace cannot be used with priv"),
+            (["--agent-sock", "/a.sock", "--workspace"], "--workspace cannot be used with --watch"),
+            (
+                ["--watch", "--output", "jsonl", "/test/fake"],
+                "--watch cannot be used with --output",
+            ),
+        ],
+    )
+    def test_scan_invalid(self, argv: list, message: str, capsys: CaptureFixture) -> None:
+        """Throw a SystemExit error if --scan is misused or priv_key_path is missing."""
+        sys.argv = [APP_NAME, *argv]
+
+        with pytest.raises(SystemExit) as exc_info:
+            CliArguments()
+
+        assert exc_info.value.args[0] == 2
+        assert message in capsys.readouterr().err
+        #
+
+    def test_agent_socks_watch(self, capsys: CaptureFixture) -> None:
+        """Throw a SystemExit error if --watch is used with --agent-sock."""
+        sys.argv = [APP_NAME, "--watch", "--agent-sock", "/test/a.sock", "/test/fake"]
+
+        with pytest.raises(SystemExit):
+            CliArguments()
+
+        assert "--watch cannot be used with --agent-sock" in capsys.readouterr().err
+        #
+
+    @pytest.mark.parametrize("value, seconds", [("90", 90), ("1h30m", 5400), ("2W", 1209600)])
+    def test_lifetime(self, value: str, seconds: int) -> None:
+        """Convert the lifetime argument into seconds."""
+        sys.argv = [APP_NAME, "-t", value, "-c", "/test/fake"]
+
+        args = CliArguments()
+
+        assert args.lifetime == seconds
+        assert args.confirm is True
+        #
+
+    @pytest.mark.parametrize("value", ["0", "1x", "-5", "h"])
+    def test_invalid_lifetime(self, value: str, capsys: CaptureFixture) -> None:
+        """Throw a SystemExit error if the lifetime is not valid."""
+        sys.argv = [APP_NAME, f"--lifetime={value}", "/test/fake"]
+
+        with pytest.raises(SystemExit):
+            CliArguments()
+
+        assert "invalid lifetime" in capsys.readouterr().err
+        #
+
+    def test_deadline(self) -> None:
+        """Parse the deadline in seconds, for the exec subcommand too."""
+        sys.argv = [APP_NAME, "exec", "--deadline", "2.5", "/test/fake", "--", "ssh"]
+
+        assert CliArguments().deadline == 2.5
+        #
+
+    @pytest.mark.parametrize(
+        "argv, message",
+        [
+            (["--deadline=0", "/test/fake"], "invalid deadline: '0'"),
+            (["--deadline=nan", "/test/fake"], "invalid deadline: 'nan'"),
+            (["--deadline=5", "--watch", "/test/fake"], "--watch cannot be used with --deadline"),
+        ],
+    )
+    def test_invalid_deadline(self, argv: list, message: str, capsys: CaptureFixture) -> None:
+        """Throw a SystemExit error if the deadline is not valid."""
+        sys.argv = [APP_NAME, *argv]
+
+        with pytest.raises(SystemExit):
+            CliArguments()
+
+        assert message in capsys.readouterr().err
+        #
+
+    def test_passphrase_from(self, mocker: MockerFixture) -> None:
+        """Build the passphrase chain from the repeated --passphrase-from arguments."""
+        mocker.patch.dict("os.environ", {"FAKE_PASSPHRASE": "fake"})
+        sys.argv = [
+            APP_NAME,
+            "--passphrase-from",
+            "env:FAKE_PASSPHRASE",
+            "--passphrase-from=store",
+            "/test/fake",
+        ]
+
+        args = CliArguments()
+
+        assert [type(provider) for provider in args.passphrase_chain.providers] == [
+            EnvProvider,
+            StoreProvider,
+        ]
+        #
+
+    def test_invalid_passphrase_from(self, capsys: CaptureFixture) -> None:
+        """Throw a SystemExit error if a passphrase source is not valid."""
+        sys.argv = [APP_NAME, "--passphrase-from", "fake", "/test/fake"]
+
+        with pytest.raises(SystemExit):
+            CliArguments()
+
+        assert "invalid passphrase source: 'fake'" in capsys.readouterr().err
+        #
+
+    def test_profile(self) -> None:
+        """Extract the profiling options before parsing the other arguments."""
+        sys.argv = [APP_NAME, "--profile=/test/fake.pstats", "/test/fake"]
+
+        args = CliArguments()
+
+        assert args.profile_path == "/test/fake.pstats"
+        assert not args.profile_memory
+        assert args._args.priv_key_path == "/test/fake"
+        #
+
+    def test_exec_command(self) -> None:
+        """Split the exec subcommand arguments and the command to execute."""
+        sys.argv = [APP_NAME, "exec", "/test/fake", "--", "ssh", "--", "git@fake"]
+
+        args = CliArguments()
+
+        assert args.command == "exec"
+        assert args._args.priv_key_path == "/test/fake"
+        assert args.exec_command == ["ssh", "--", "git@fake"]
+        #
+
+    def test_doctor_command(self) -> None:
+        """Parse the key paths and the --no-save flag of the doctor subcommand."""
+        sys.argv = [APP_NAME, "doctor", "/test/a", "/test/b", "--no-save"]
+
+        args = CliArguments()
+
+        assert args.command == "doctor"
+        assert args.priv_key_paths == ["/test/a", "/test/b"]
+        assert not args.save
+        assert args.lifetime is None
+        #
+
+    @pytest.mark.parametrize(
+        "argv, key_dirs", [([], ["~/.ssh"]), (["/test/a", "/test/b"], ["/test/a", "/test/b"])]
+    )
+    def test_list_command(self, argv: list, key_dirs: list) -> None:
+        """Parse the key directories of the list subcommand, ~/.ssh by default."""
+        sys.argv = [APP_NAME, "list", *argv]
+
+        args = CliArguments()
+
+        assert args.command == "list"
+        assert args.key_dirs == key_dirs
+        assert args.lifetime is None
+        #
+
+    @pytest.mark.parametrize("argv, idle_timeout", [([], 900), (["--idle-timeout", "1h"], 3600)])
+    def test_daemon_command(self, argv: list, idle_timeout: int) -> None:
+        """Parse the idle timeout of the daemon subcommand."""
+        sys.argv = [APP_NAME, "daemon", *argv]
+
+        args = CliArguments()
+
+        assert args.command == "daemon"
+        assert args.idle_timeout == idle_timeout
+        #
+
+    def test_hook_command(self) -> None:
+        """Parse the shell argument of the hook subcommand."""
+        sys.argv = [APP_NAME, "hook", "zsh", "/test/fake"]
+
+        args = CliArguments()
+
+        assert args.command == "hook"
+        assert args.shell == "zsh"
+        assert args._args.priv_key_path == "/test/fake"
+        #
+
+    def test_proxy_command(self) -> None:
+        """Parse the --host option of the proxy subcommand and the ssh command after '--'."""
+        sys.argv = [APP_NAME, "proxy", "--host", "git@fake", "--", "ssh", "-p", "22", "fake"]
+
+        args = CliArguments()
+
+        assert args.command == "proxy"
+        assert args.host == "git@fake"
+        assert args.exec_command == ["ssh", "-p", "22", "fake"]
+        #
+
+    def test_exec_command_missing(self, capsys: CaptureFixture) -> None:
+        """Throw a SystemExit error if there is no command to execute."""
+        sys.argv = [APP_NAME, "exec", "/test/fake", "--"]
+
+        with pytest.raises(SystemExit) as exc_info:
+            CliArguments()
+
+        assert exc_info.value.args[0] == 2
+        assert "the command to execute is missing after '--'" in capsys.readouterr().err
 
 
 class TestResolvePrivKeyPath:
@@ -136,6 +393,17 @@ class TestResolvePubKeyPath:
         mock_resolve.assert_called_once()
         #
 
+    def test_ppk_file(self, tmp_path: Path) -> None:
+        """Use the private key path of a PuTTY key file without <priv_key_path>.pub."""
+        priv_key_path = tmp_path / "fake.ppk"
+        priv_key_path.write_text("PuTTY-User-Key-File-2: ssh-ed25519")
+
+        args = init_cli_args()
+        args._priv_key_path = priv_key_path
+
+        assert args.resolve_pub_key_path() == priv_key_path
+        #
+
     def test_file_not_found(self, mocker: MockerFixture) -> None:
         """Throw FileNotFoundError if the resolved key path does not exist."""
         mocker.patch.object(Path, "exists", return_value=False)
@@ -0,0 +1,152 @@
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+from typing import Iterator
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import daemon
+from ssh_agent_add_id.daemon import Daemon, DaemonAnswer, ask, daemon_sock_path, listen_fds, serve
+
+from tests.unit.conftest import (
+    ED25519_BLOB,
+    ED25519_IDENTITY,
+    ED25519_PUBLIC_LINE,
+    FakeAgent,
+    openssh_private_key,
+)
+
+
+@pytest.fixture
+def key_paths(tmp_path: Path) -> Iterator[tuple]:
+    """A fixture that returns the paths of an unencrypted key and of its public key."""
+    (tmp_path / "id").write_text(openssh_private_key())
+    (tmp_path / "id.pub").write_text(ED25519_PUBLIC_LINE)
+    yield str(tmp_path / "id"), str(tmp_path / "id.pub")
+    #
+
+
+@pytest.fixture
+def running_daemon(fake_agent: FakeAgent) -> Iterator[Daemon]:
+    """A fixture that returns a Daemon answering on the daemon socket from a thread."""
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(daemon_sock_path()))
+    listener.listen()
+    instance = Daemon([listener], idle_timeout=0.5)
+    thread = threading.Thread(target=instance.run)
+    thread.start()
+    yield instance
+    thread.join()
+    listener.close()
+    #
+
+
+class TestListenFds:
+    """listen_fds function"""  # noqa: D415
+
+    def test_activated(self, mocker: MockerFixture, tmp_path: Path) -> None:
+        """Take the sockets passed to the current process, and hide them from the children."""
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(str(tmp_path / "daemon.sock"))
+        mocker.patch.object(daemon, "_LISTEN_FDS_START", os.dup(listener.fileno()))
+        mocker.patch.dict("os.environ", {"LISTEN_PID": str(os.getpid()), "LISTEN_FDS": "1"})
+
+        socks = listen_fds()
+
+        assert [sock.getsockname() for sock in socks] == [str(tmp_path / "daemon.sock")]
+        assert "LISTEN_FDS" not in os.environ
+        socks[0].close()
+        listener.close()
+        #
+
+    def test_other_process(self, mocker: MockerFixture) -> None:
+        """Ignore the sockets passed to another process (e.g. the parent)."""
+        mocker.patch.dict("os.environ", {"LISTEN_PID": str(os.getpid() + 1), "LISTEN_FDS": "1"})
+
+        assert listen_fds() == []
+        assert "LISTEN_PID" not in os.environ
+
+
+class TestDaemon:
+    """Daemon class"""  # noqa: D415
+
+    def test_stored(self, running_daemon: Daemon, fake_agent: FakeAgent, key_paths: tuple) -> None:
+        """Answer from the agent, then from its state."""
+        fake_agent.identities[ED25519_BLOB] = "fake"
+
+        assert ask(*key_paths, fake_agent.sock_path) == DaemonAnswer(True)
+        assert ask(*key_paths, fake_agent.sock_path) == DaemonAnswer(True)
+        assert fake_agent.requests == [(11, b"")]
+        #
+
+    def test_added(self, running_daemon: Daemon, fake_agent: FakeAgent, key_paths: tuple) -> None:
+        """Add a key that needs no passphrase."""
+        fake_agent.handlers[17] = lambda payload: (6, b"")
+
+        assert ask(*key_paths, fake_agent.sock_path) == DaemonAnswer(True, added=True)
+        assert fake_agent.requests[-1] == (17, ED25519_IDENTITY)
+        #
+
+    def test_passphrase(
+        self, running_daemon: Daemon, fake_agent: FakeAgent, key_paths: tuple
+    ) -> None:
+        """Leave to the client a key that needs a passphrase."""
+        Path(key_paths[0]).write_text(openssh_private_key(b"aes256-ctr"))
+
+        assert ask(*key_paths, fake_agent.sock_path) == DaemonAnswer(False)
+        #
+
+    def test_agent_error(self, running_daemon: Daemon, key_paths: tuple, tmp_path: Path) -> None:
+        """Report an agent that cannot be reached."""
+        answer = ask(*key_paths, str(tmp_path / "missing.sock"))
+
+        assert answer and not answer.stored and answer.error
+        #
+
+    def test_snapshot(self, fake_agent: FakeAgent, key_paths: tuple, tmp_path: Path) -> None:
+        """Save the parsed public keys and the agents on idle exit, and start from them."""
+        fake_agent.identities[ED25519_BLOB] = "fake"
+        first = Daemon([], idle_timeout=0.01, snapshot_path=tmp_path / "daemon.json")
+        first.ensure(*key_paths, fake_agent.sock_path)
+        first.run()
+
+        data = json.loads((tmp_path / "daemon.json").read_text())
+        assert list(data["public_keys"]) == [key_paths[1]]
+        assert data["agents"] == [fake_agent.sock_path]
+
+        second = Daemon([], idle_timeout=0.01, snapshot_path=tmp_path / "daemon.json")
+        second.load_snapshot()
+
+        assert second.public_key(key_paths[1]).blob == ED25519_BLOB
+        assert fake_agent.sock_path in second._sock_ids
+
+
+class TestServe:
+    """serve and ask functions"""  # noqa: D415
+
+    def test_spawn(self, mocker: MockerFixture, fake_agent: FakeAgent, key_paths: tuple) -> None:
+        """Start the daemon on the first connection, which removes its socket on idle exit."""
+        fake_agent.identities[ED25519_BLOB] = "fake"
+        threads = []
+
+        def start_daemon(*args: object, **kwargs: object) -> None:
+            threads.append(threading.Thread(target=serve, args=(0.2,)))
+            threads[0].start()
+
+        popen = mocker.patch("subprocess.Popen", side_effect=start_daemon)
+
+        assert ask(*key_paths, fake_agent.sock_path) is None
+        assert ask(*key_paths, fake_agent.sock_path, spawn=True) == DaemonAnswer(True)
+
+        threads[0].join()
+        assert popen.call_args.args[0][-1] == "daemon"
+        assert not daemon_sock_path().exists()
+        #
+
+    def test_already_running(self, mocker: MockerFixture) -> None:
+        """Return False if another daemon holds the lock."""
+        mocker.patch("fcntl.flock", side_effect=BlockingIOError)
+
+        assert not serve(0.01)
@@ -0,0 +1,86 @@
+import signal
+import time
+
+import pytest
+from ssh_agent_add_id import cancellation, deadline
+from ssh_agent_add_id.deadline import Deadline, DeadlineExceededError
+
+
+class TestDeadline:
+    """Deadline class"""  # noqa: D415
+
+    def test_remaining(self) -> None:
+        """Return the time left, then throw a DeadlineExceededError once it has passed."""
+        bounded = Deadline(60)
+
+        assert 59 < bounded.remaining() <= 60
+
+        bounded.expires_at = time.monotonic()
+        with pytest.raises(DeadlineExceededError) as exc_info:
+            bounded.remaining()
+
+        assert exc_info.value.args[0] == "Deadline of 60s exceeded"
+
+
+class TestBounded:
+    """bounded function"""  # noqa: D415
+
+    def test_timeouts(self) -> None:
+        """Bound the operation timeouts by the time left, only within the block."""
+        assert deadline.remaining(5) == 5
+
+        with deadline.bounded(60):
+            timeout = deadline.remaining()
+            assert timeout is not None and 59 < timeout <= 60
+            assert deadline.remaining(5) == 5
+
+        assert deadline.remaining() is None
+        #
+
+    def test_no_deadline(self) -> None:
+        """Do nothing without a number of seconds."""
+        with deadline.bounded(None):
+            assert deadline.remaining() is None
+        #
+
+    def test_waits(self) -> None:
+        """Stop the waits watching the cancellation token once the deadline has passed."""
+        with pytest.raises(DeadlineExceededError):
+            with deadline.bounded(0.05):
+                cancellation.sleep(5)
+        #
+
+    def test_alarm(self) -> None:
+        """Interrupt the interruptible code at once, then restore the SIGALRM handler."""
+        handler = signal.getsignal(signal.SIGALRM)
+
+        with pytest.raises(DeadlineExceededError):
+            with deadline.bounded(0.05), cancellation.interruptible():
+                time.sleep(5)
+
+        assert signal.getsignal(signal.SIGALRM) == handler
+        assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+        #
+
+    def test_alarm_deferred(self) -> None:
+        """Let the other code run on until it checks the deadline."""
+        with deadline.bounded(0.05):
+            time.sleep(0.1)
+            with pytest.raises(DeadlineExceededError):
+                cancellation.check()
+
+
+class TestTimedOut:
+    """timed_out function"""  # noqa: D415
+
+    def test_timed_out(self) -> None:
+        """Throw a DeadlineExceededError only if the timeout was the deadline."""
+        deadline.timed_out()
+
+        with deadline.bounded(60):
+            deadline.timed_out()
+
+            assert deadline._deadline
+            deadline._deadline.expires_at = time.monotonic()
+            with pytest.raises(DeadlineExceededError):
+                deadline.timed_out()
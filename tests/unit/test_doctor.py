@@ -0,0 +1,142 @@
+import os
+from pathlib import Path
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.backend import NATIVE, SUBPROCESS
+from ssh_agent_add_id.constants import STATE_SLOW_AGENT_TTL, STATE_TTL
+from ssh_agent_add_id.doctor import (
+    Measurement,
+    choose_backend,
+    measure_agent,
+    measure_kdf,
+    measure_ssh_add,
+    run_doctor,
+)
+
+from tests.unit.conftest import ED25519_BLOB, FakeAgent, openssh_private_key
+from tests.unit.test_ppk import PPK_V2
+
+
+SSH_ADD = Measurement("ssh-add round trip", 0.008)
+
+
+class TestChooseBackend:
+    """choose_backend function"""  # noqa: D415
+
+    def test_native(self, mocker: MockerFixture) -> None:
+        """Choose the agent socket when it is faster than ssh-add."""
+        mocker.patch.dict("os.environ", {"SSH_CONNECTION": ""})
+        backend, _ = choose_backend(
+            "/test/fake.sock", SSH_ADD, Measurement("", 0.0001), Measurement("", 0.0001), True
+        )
+
+        assert (backend.agent_io, backend.state_ttl, backend.proxy) == (NATIVE, STATE_TTL, False)
+        assert backend.sock_path == "/test/fake.sock"
+        #
+
+    def test_no_socket(self) -> None:
+        """Choose ssh-add when the agent socket cannot be used (e.g. a relayed Windows agent)."""
+        backend, reasons = choose_backend("", SSH_ADD, Measurement(""), Measurement(""), False)
+
+        assert (backend.agent_io, backend.ssh_add_test) == (SUBPROCESS, False)
+        assert reasons == ["the agent socket cannot be used directly, ssh-add is used"]
+        #
+
+    def test_slow_forwarded_agent(self, mocker: MockerFixture) -> None:
+        """Trust the state longer and recommend a proxy for a slow or forwarded agent."""
+        mocker.patch.dict("os.environ", {"SSH_CONNECTION": "10.0.0.1 22 10.0.0.2 22"})
+        ssh_add = Measurement("ssh-add round trip", 0.02)
+        backend, reasons = choose_backend(
+            "/tmp/ssh-XXXX/agent.42", ssh_add, Measurement("", 0.001), Measurement("", 0.01), True
+        )
+
+        assert (backend.agent_io, backend.state_ttl) == (NATIVE, STATE_SLOW_AGENT_TTL)
+        assert backend.proxy
+        assert reasons[-1] == "the agent is forwarded"
+
+
+class TestMeasurements:
+    """measure_* functions"""  # noqa: D415
+
+    def test_agent(self, fake_agent: FakeAgent) -> None:
+        """Measure the agent socket latencies."""
+        fake_agent.identities[ED25519_BLOB] = "fake"
+
+        connect, list_rtt = measure_agent(fake_agent.sock_path)
+
+        assert connect.seconds is not None
+        assert list_rtt.detail == "identities: 1"
+        assert len(fake_agent.requests) == 5
+        #
+
+    def test_agent_unreachable(self) -> None:
+        """Report that the agent socket cannot be used."""
+        connect, list_rtt = measure_agent("")
+
+        assert str(connect) == "agent connect: SSH_AUTH_SOCK not set"
+        assert list_rtt.seconds is None
+        #
+
+    def test_ssh_add(self, mocker: MockerFixture) -> None:
+        """Detect the ssh-add versions without -T from their usage message."""
+        mocker.patch("shutil.which", return_value="/usr/bin/ssh-add")
+        mocker.patch("ssh_agent_add_id.doctor._timings", return_value=[0.01, 0.03, 0.02])
+        mocker.patch(
+            "ssh_agent_add_id.doctor._capture",
+            side_effect=[("", "OpenSSH_8.1p1, OpenSSL\n"), ("", "unknown option -- T\nusage:")],
+        )
+
+        ssh_add, version, test_supported = measure_ssh_add()
+
+        assert ssh_add.seconds == 0.02
+        assert version.detail == "OpenSSH_8.1p1, OpenSSL"
+        assert not test_supported
+        #
+
+    @pytest.mark.parametrize(
+        "content, detail",
+        [
+            (openssh_private_key(), "not encrypted"),
+            (openssh_private_key(b"aes256-ctr"), "bcrypt, 16 rounds, derived by ssh-add"),
+            (PPK_V2, "PuTTY 2"),
+            ("fake", "Invalid OpenSSH private key"),
+        ],
+    )
+    def test_kdf(self, content: str, detail: str, mocker: MockerFixture, tmp_path: Path) -> None:
+        """Measure the key derivation of the keys decrypted in-process, describe the others."""
+        mocker.patch("ssh_agent_add_id.bcrypt_pbkdf.has_native_engine", return_value=False)
+        (tmp_path / "key").write_text(content)
+
+        assert measure_kdf(str(tmp_path / "key")).detail == detail
+        #
+
+    def test_kdf_native(self, mocker: MockerFixture, tmp_path: Path) -> None:
+        """Measure the key derivation of an OpenSSH key by the bcrypt extension."""
+        mocker.patch("ssh_agent_add_id.bcrypt_pbkdf.has_native_engine", return_value=True)
+        kdf = mocker.patch("ssh_agent_add_id.bcrypt_pbkdf.bcrypt_pbkdf")
+        (tmp_path / "key").write_text(openssh_private_key(b"aes256-ctr"))
+
+        measurement = measure_kdf(str(tmp_path / "key"))
+
+        assert measurement.seconds is not None
+        assert measurement.detail == "bcrypt, 16 rounds, derived in-process"
+        kdf.assert_called_once_with(b"\0", bytes(16), 16, 48)
+
+
+class TestRunDoctor:
+    """run_doctor function"""  # noqa: D415
+
+    def test_report(self, mocker: MockerFixture, fake_agent: FakeAgent) -> None:
+        """Report all the measurements and the backend choice."""
+        mocker.patch("ssh_agent_add_id.doctor._timings", return_value=[0.01])
+        mocker.patch("ssh_agent_add_id.doctor._capture", return_value=("", "OpenSSH_9.6p1\n"))
+        mocker.patch("shutil.which", return_value="/usr/bin/ssh-add")
+
+        report = run_doctor(fake_agent.sock_path, [])
+
+        lines = str(report).split(os.linesep)
+        assert lines[0] == "import time: 0.0 ms"
+        assert lines[1] == "OpenSSH version: OpenSSH_9.6p1"
+        assert lines[-3].startswith("backend: native agent I/O, state TTL 60s")
+        assert lines[-2] == "proxy: not needed"
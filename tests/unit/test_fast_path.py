@@ -0,0 +1,97 @@
+from pathlib import Path
+from typing import List
+
+import pytest
+from pytest import CaptureFixture
+from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id import fast_path
+from ssh_agent_add_id.daemon import DaemonAnswer
+
+from tests.unit.conftest import ED25519_PUBLIC_LINE
+
+
+class TestRun:
+    """run function"""  # noqa: D415
+
+    class Mocks:
+        """Mocks for the tests of this class."""
+
+        def __init__(self, mocker: MockerFixture, tmp_path: Path) -> None:  # noqa: D107
+            (tmp_path / "id").write_text("fake private key")
+            (tmp_path / "id.pub").write_text(ED25519_PUBLIC_LINE)
+            mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/fake.sock"})
+
+            self.priv_key_path = str(tmp_path / "id")
+            self.is_identity_cached: MockType = mocker.patch(
+                "ssh_agent_add_id.fast_path.is_identity_cached", return_value=True
+            )
+            self.execvp: MockType = mocker.patch("os.execvp")
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture, tmp_path: Path) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestRun.Mocks(mocker, tmp_path)
+        #
+
+    def test_stored(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Answer from the agent state segment, like the CLI does."""
+        assert fast_path.run([mocks.priv_key_path])
+
+        assert capsys.readouterr().out == "This identity has already been added to the SSH agent.\n"
+        assert mocks.is_identity_cached.call_args.args[0] == "/test/fake.sock"
+        #
+
+    def test_exec(self, mocks: Mocks) -> None:
+        """Execute the command of the exec subcommand."""
+        fast_path.run(["exec", mocks.priv_key_path, "--", "ssh", "git@fake"])
+
+        mocks.execvp.assert_called_once_with("ssh", ["ssh", "git@fake"])
+        #
+
+    def test_miss(self, mocks: Mocks) -> None:
+        """Leave the identities not known to be stored to the CLI."""
+        mocks.is_identity_cached.return_value = False
+
+        assert not fast_path.run(["exec", mocks.priv_key_path, "--", "ssh"])
+        mocks.execvp.assert_not_called()
+        #
+
+    def test_daemon(self, mocks: Mocks, mocker: MockerFixture, capsys: CaptureFixture) -> None:
+        """Ask the daemon on a miss, starting it only if requested."""
+        mocks.is_identity_cached.return_value = False
+        mocker.patch.dict("os.environ", {"SSH_AGENT_ADD_ID_DAEMON": "1"})
+        ask = mocker.patch(
+            "ssh_agent_add_id.daemon.ask", return_value=DaemonAnswer(True, added=True)
+        )
+
+        assert fast_path.run([mocks.priv_key_path])
+
+        assert capsys.readouterr().out == f"Identity added: {mocks.priv_key_path}\n"
+        assert ask.call_args.args[2:] == ("/test/fake.sock", True)
+        #
+
+    @pytest.mark.parametrize(
+        "argv",
+        [
+            ["--watch", "{key}"],
+            ["{key}", "-t", "1h"],
+            ["--scan"],
+            ["list"],
+            ["exec", "{key}", "ssh"],
+            ["exec", "{key}", "--"],
+            ["{key}.missing"],
+            ["{key}", "{key}.missing"],
+        ],
+    )
+    def test_cli(self, mocks: Mocks, argv: List[str]) -> None:
+        """Leave the options, the other commands and the missing files to the CLI."""
+        assert not fast_path.run([arg.format(key=mocks.priv_key_path) for arg in argv])
+        mocks.execvp.assert_not_called()
+        #
+
+    def test_no_agent(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Leave to the CLI the report of a missing SSH_AUTH_SOCK."""
+        mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": ""})
+
+        assert not fast_path.run([mocks.priv_key_path])
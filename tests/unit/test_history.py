@@ -0,0 +1,205 @@
+import json
+from pathlib import Path
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import history
+from ssh_agent_add_id.constants import APP_NAME, HISTORY_MIN_TTL
+
+
+SOCK_PATH = "/test/fake.sock"
+
+
+@pytest.fixture
+def clock(mocker: MockerFixture) -> MockerFixture:
+    """A fixture that returns the mocked time module of the history."""
+    mock = mocker.patch("ssh_agent_add_id.history.time")
+    mock.time.return_value = 1000.0
+    return mock
+
+
+def events() -> list:
+    """Read the raw events of the history log."""
+    return [json.loads(line) for line in history.history_path().read_text().splitlines()]
+
+
+class TestHistoryPath:
+    """history_path function"""  # noqa: D415
+
+    def test_xdg_state_home(self, tmp_path: Path) -> None:
+        """Keep the history into XDG_STATE_HOME, which survives reboots."""
+        assert history.history_path() == tmp_path / "state" / APP_NAME / "history.log"
+
+
+class TestRecord:
+    """record and flush functions"""  # noqa: D415
+
+    def test_hits(self, clock: MockerFixture) -> None:
+        """Count the hits without I/O, then write them as a single event per agent."""
+        for _ in range(3):
+            history.record(history.HIT, SOCK_PATH, "SHA256:a")
+
+        assert not history.history_path().exists()
+
+        history.flush()
+        history.flush()
+
+        assert [(e["ev"], e["hits"], e["queries"]) for e in events()] == [(history.COUNTS, 3, 0)]
+        #
+
+    def test_compaction(self, clock: MockerFixture, mocker: MockerFixture) -> None:
+        """Compact the log once too large, whatever the event appended."""
+        history.record(history.APPEARED, SOCK_PATH, "SHA256:a")
+        history.record(history.HIT, SOCK_PATH, "SHA256:a")
+        mocker.patch("ssh_agent_add_id.history.HISTORY_MAX_SIZE", 0)
+
+        history.flush()
+
+        assert [e["ev"] for e in events()] == [history.COUNTS, history.APPEARED]
+
+
+class TestRecordListing:
+    """record_listing function"""  # noqa: D415
+
+    def test_events(self, clock: MockerFixture) -> None:
+        """Record the query, the new identities and the ones lost since the previous listing."""
+        history.record_listing(SOCK_PATH, ["SHA256:a", "SHA256:b"], 900.0, ["SHA256:b", "SHA256:c"])
+
+        assert [(e["ev"], e["fp"]) for e in events()] == [
+            (history.QUERY, ""),
+            (history.APPEARED, "SHA256:c"),
+            (history.LOST, "SHA256:a"),
+        ]
+        assert events()[-1]["seen"] == 900.0
+        assert history.history_path().stat().st_mode & 0o777 == 0o600
+        #
+
+    def test_first_listing(self, clock: MockerFixture) -> None:
+        """Do not record losses without a previous listing."""
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 0.0, [])
+
+        assert [e["ev"] for e in events()] == [history.QUERY]
+        #
+
+    def test_restarted_agent(self, clock: MockerFixture) -> None:
+        """Record the losses of a restarted agent, whose new socket has no previous listing."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a", "SHA256:b"])
+        clock.time.return_value = 1200.0
+        history.record_listing(SOCK_PATH, ["SHA256:a", "SHA256:b"], 1000.0, ["SHA256:a"])
+        clock.time.return_value = 1400.0
+
+        history.record_listing(SOCK_PATH, [], 0.0, [])
+
+        assert [(e["ev"], e["fp"], e.get("seen")) for e in events()[-2:]] == [
+            (history.QUERY, "", None),
+            (history.LOST, "SHA256:a", 1200.0),
+        ]
+        assert history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0) == {"SHA256:a": 50.0}
+        #
+
+    def test_compaction(self, clock: MockerFixture, mocker: MockerFixture) -> None:
+        """Compact the log once too large, keeping the counts and the learned lifetimes."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a"])
+        history.record(history.HIT, SOCK_PATH, "SHA256:a")
+        clock.time.return_value = 1400.0
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 1200.0, [])
+        ttls = history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0)
+        mocker.patch("ssh_agent_add_id.history.HISTORY_MAX_SIZE", 0)
+
+        history.record_listing(SOCK_PATH, [], 1400.0, [])
+
+        assert [e["ev"] for e in events()] == [history.COUNTS, history.LOST]
+        assert (events()[0]["hits"], events()[0]["queries"]) == (1, 3)
+        assert events()[1]["lifetime"] == 200.0
+        assert history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0) == ttls
+
+
+class TestLearnedTtls:
+    """learned_ttls function"""  # noqa: D415
+
+    def test_lost(self, clock: MockerFixture) -> None:
+        """Trust a fraction of the shortest lifetime of an identity, within the bounds."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a", "SHA256:b"])
+        clock.time.return_value = 5000.0
+        history.record_listing(SOCK_PATH, ["SHA256:a", "SHA256:b"], 1200.0, [])
+        history.record_listing(SOCK_PATH, [], 5000.0, ["SHA256:a"])
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 5004.0, [])
+
+        ttls = history.learned_ttls(SOCK_PATH, ["SHA256:a", "SHA256:b", "SHA256:c"], 60.0)
+
+        assert ttls == {"SHA256:a": HISTORY_MIN_TTL, "SHA256:b": 50.0}
+        assert history.learned_ttls("/test/other.sock", ["SHA256:a"], 60.0) == {}
+        #
+
+    def test_never_lost(self, clock: MockerFixture) -> None:
+        """Leave the default TTL to an identity never lost, however long it has been loaded."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a"])
+
+        clock.time.return_value = 1000.0 + 86400.0
+        assert history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0) == {}
+        #
+
+    def test_long_lifetime(self, clock: MockerFixture) -> None:
+        """Never trust an identity longer than the default TTL, whatever its lifetimes."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a"])
+        clock.time.return_value = 1000.0 + 86400.0
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 1000.0 + 86400.0, [])
+
+        assert history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0) == {"SHA256:a": 60.0}
+        #
+
+    def test_cached_summary(self, clock: MockerFixture, mocker: MockerFixture) -> None:
+        """Read the log again only once changed by another process, updating it on appends."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a"])
+        read = mocker.spy(history, "_read")
+
+        history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0)
+        history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0)
+        assert read.call_count == 1
+
+        clock.time.return_value = 1200.0
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 1200.0, [])
+        assert history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0) == {"SHA256:a": 50.0}
+        assert read.call_count == 1
+
+        with open(history.history_path(), "a") as file:
+            file.write(json.dumps({"t": 1300.0, "ev": history.QUERY, "agent": SOCK_PATH, "fp": ""}))
+            file.write("\n")
+        history.record(history.HIT, SOCK_PATH, "SHA256:a")
+        history.flush()
+        history.summary_lines()
+        assert read.call_count == 2
+        assert history._summary().counts[SOCK_PATH] == (1, 3)
+        #
+
+    def test_invalid_lines(self, clock: MockerFixture) -> None:
+        """Skip the invalid lines, e.g. torn by a crash."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a"])
+        with open(history.history_path(), "a") as file:
+            file.write('{"ev": "lost", "agent"\n[]\n{"ev": "lost"}\n')
+        clock.time.return_value = 1400.0
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 1200.0, [])
+
+        assert history.learned_ttls(SOCK_PATH, ["SHA256:a"], 60.0) == {"SHA256:a": 50.0}
+
+
+class TestSummaryLines:
+    """summary_lines function"""  # noqa: D415
+
+    def test_hit_rate(self, clock: MockerFixture) -> None:
+        """Describe the hit rate of each agent and the lifetime of its identities."""
+        history.record_listing(SOCK_PATH, [], 0.0, ["SHA256:a"])
+        for _ in range(3):
+            history.record(history.HIT, SOCK_PATH, "SHA256:a")
+        history.record_listing(SOCK_PATH, ["SHA256:a"], 1120.0, [])
+
+        assert history.summary_lines() == [
+            f"  agent state history ({history.history_path()}):",
+            f"    {SOCK_PATH}: 3 hits, 2 agent queries (60% hit rate)",
+            "      SHA256:a: 1 losses, shortest lifetime 120s, learned TTL 30s",
+        ]
+        #
+
+    def test_empty(self) -> None:
+        """Describe nothing without history."""
+        assert history.summary_lines() == []
@@ -0,0 +1,122 @@
+import os
+from pathlib import Path
+
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.constants import APP_NAME
+from ssh_agent_add_id.inventory import KeyIndex, index_path, list_identities
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.wire import pack_string
+
+from tests.unit.conftest import ED25519_BLOB, FakeAgent, openssh_private_key
+from tests.unit.test_certificates import CERT_TYPE, cert_blob
+
+
+FAKE_BLOB = pack_string(b"ssh-fake")
+FINGERPRINT = PublicKey.from_blob(ED25519_BLOB).fingerprint
+
+
+class TestKeyIndex:
+    """KeyIndex class"""  # noqa: D415
+
+    def test_refresh(self, tmp_path: Path) -> None:
+        """Index the private keys by fingerprint, whatever their file names."""
+        (tmp_path / "keys" / "sub").mkdir(parents=True)
+        (tmp_path / "keys" / "id_work").write_text(openssh_private_key())
+        (tmp_path / "keys" / "sub" / "copy").write_text(openssh_private_key())
+        (tmp_path / "keys" / "config").write_text("Host *\n")
+        index = KeyIndex()
+
+        assert index.refresh([str(tmp_path / "keys")])
+
+        assert index.paths_by_fingerprint() == {
+            FINGERPRINT: [
+                str(tmp_path / "keys" / "id_work"),
+                str(tmp_path / "keys" / "sub" / "copy"),
+            ]
+        }
+        assert index.entries[str(tmp_path / "keys" / "config")].fingerprint == ""
+        #
+
+    def test_incremental(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        """Read again only the new or modified files, and drop the removed ones."""
+        keys = tmp_path / "keys"
+        keys.mkdir()
+        (keys / "id_a").write_text(openssh_private_key())
+        (keys / "id_b").write_text(openssh_private_key())
+        index = KeyIndex()
+        index.refresh([str(keys)])
+        index.save()
+        sniff = mocker.patch("ssh_agent_add_id.inventory.sniff_key_file", return_value=None)
+
+        index = KeyIndex.load()
+        assert not index.refresh([str(keys)])
+        sniff.assert_not_called()
+
+        (keys / "id_a").write_text("modified")
+        (keys / "id_b").unlink()
+        assert index.refresh([str(keys)])
+
+        sniff.assert_called_once_with(str(keys / "id_a"))
+        assert list(index.entries) == [str(keys / "id_a")]
+        assert index.paths_by_fingerprint() == {}
+        #
+
+    def test_load_invalid(self) -> None:
+        """Start from an empty index if the saved one is invalid or from another version."""
+        index_path().parent.mkdir(parents=True)
+
+        for content in ("{", '{"version": 0, "files": {}}', '{"version": 1, "files": []}'):
+            index_path().write_text(content)
+            assert KeyIndex.load().entries == {}
+        #
+
+    def test_index_path(self, tmp_path: Path) -> None:
+        """Keep the index into XDG_CACHE_HOME, since it can be rebuilt."""
+        assert KeyIndex().path == tmp_path / "cache" / APP_NAME / "key-index.json"
+
+
+class TestListIdentities:
+    """list_identities function"""  # noqa: D415
+
+    def test_list(self, fake_agent: FakeAgent, tmp_path: Path) -> None:
+        """List the agent identities with their local key files, and save the index."""
+        (tmp_path / "keys").mkdir()
+        (tmp_path / "keys" / "id_ed25519").write_text(openssh_private_key())
+        fake_agent.identities[ED25519_BLOB] = "user@host"
+        fake_agent.identities[FAKE_BLOB] = ""
+
+        identities = list_identities(fake_agent.sock_path, [str(tmp_path / "keys")])
+
+        assert [str(identity) for identity in identities] == [
+            f"256 {FINGERPRINT} user@host (ssh-ed25519){os.linesep}"
+            + f"  {tmp_path / 'keys' / 'id_ed25519'}",
+            f"0 {PublicKey.from_blob(FAKE_BLOB).fingerprint} (no comment) (ssh-fake){os.linesep}"
+            + "  (no local key file)",
+        ]
+        assert index_path().is_file()
+        #
+
+    def test_certificate(self, fake_agent: FakeAgent, tmp_path: Path) -> None:
+        """List a certificate with the key file of the key it certifies."""
+        (tmp_path / "keys").mkdir()
+        (tmp_path / "keys" / "id_ed25519").write_text(openssh_private_key())
+        fake_agent.identities[cert_blob()] = "user@host"
+
+        identities = list_identities(fake_agent.sock_path, [str(tmp_path / "keys")])
+
+        assert identities[0].public_key.key_type == CERT_TYPE.decode()
+        assert identities[0].priv_key_paths == [str(tmp_path / "keys" / "id_ed25519")]
+        #
+
+    def test_unchanged_index(
+        self, fake_agent: FakeAgent, mocker: MockerFixture, tmp_path: Path
+    ) -> None:
+        """Do not rewrite an unchanged index."""
+        (tmp_path / "keys").mkdir()
+        (tmp_path / "keys" / "id_ed25519").write_text(openssh_private_key())
+        list_identities(fake_agent.sock_path, [str(tmp_path / "keys")])
+        save = mocker.spy(KeyIndex, "save")
+
+        list_identities(fake_agent.sock_path, [str(tmp_path / "keys")])
+
+        save.assert_not_called()
@@ -0,0 +1,39 @@
+import io
+import json
+
+from ssh_agent_add_id.fanout import AgentResult
+from ssh_agent_add_id.output import JsonlWriter
+from ssh_agent_add_id.scan import KeyResult
+
+
+class TestJsonlWriter:
+    """JsonlWriter class"""  # noqa: D415
+
+    def test_write_key_result(self) -> None:
+        """Write one record per line, without agent for a single agent operation."""
+        stream = io.StringIO()
+        writer = JsonlWriter(stream)
+
+        writer.write_key_result(KeyResult("/test/id", "added", "", "SHA256:fake", 0.0123456789))
+        writer.write_key_result(KeyResult("/test/other", "failed", "Fake error"))
+
+        lines = stream.getvalue().splitlines()
+        assert json.loads(lines[0]) == {
+            "path": "/test/id",
+            "fingerprint": "SHA256:fake",
+            "action": "added",
+            "latency": 0.012346,
+            "error": None,
+        }
+        assert json.loads(lines[1])["error"] == "Fake error"
+        assert json.loads(lines[1])["fingerprint"] is None
+        #
+
+    def test_write_agent_result(self) -> None:
+        """Write the agent of the operations on several agents."""
+        stream = io.StringIO()
+
+        JsonlWriter(stream).write_agent_result("/test/id", AgentResult("/test/a.sock", "stored"))
+
+        assert json.loads(stream.getvalue())["agent"] == "/test/a.sock"
+        assert stream.getvalue().endswith("}\n")
@@ -0,0 +1,253 @@
+import json
+import os
+from pathlib import Path
+import signal
+import sys
+import threading
+
+import pytest
+from pytest import CaptureFixture
+from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id.cancellation import CancelToken
+from ssh_agent_add_id.errors import SignalException
+from ssh_agent_add_id.passphrase import (
+    CommandProvider,
+    EnvProvider,
+    FdProvider,
+    PassphraseChain,
+    StoreProvider,
+    add_identity_unattended,
+    default_store_path,
+    parse_passphrase_source,
+)
+
+from tests.unit.conftest import FakeAgent, openssh_private_key
+from tests.unit.test_ppk import PPK_V2
+
+
+FINGERPRINT = "SHA256:fake"
+
+
+class TestEnvProvider:
+    """EnvProvider class"""  # noqa: D415
+
+    def test_get(self, mocker: MockerFixture) -> None:
+        """Return the variable value, if not empty."""
+        mocker.patch.dict("os.environ", {"FAKE_PASSPHRASE": "fake", "FAKE_EMPTY": ""})
+
+        assert EnvProvider("FAKE_PASSPHRASE").get("/test/id", FINGERPRINT) == ["fake"]
+        assert EnvProvider("FAKE_EMPTY").get("/test/id", FINGERPRINT) == []
+        assert EnvProvider("FAKE_MISSING").get("/test/id", FINGERPRINT) == []
+
+
+class TestFdProvider:
+    """FdProvider class"""  # noqa: D415
+
+    def test_get(self) -> None:
+        """Read the non-empty lines of the file descriptor only once."""
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"first\n\nsecond\n")
+        os.close(write_fd)
+        provider = FdProvider(read_fd)
+
+        try:
+            assert provider.get("/test/a", FINGERPRINT) == ["first", "second"]
+            assert provider.get("/test/b", FINGERPRINT) == ["first", "second"]
+        finally:
+            os.close(read_fd)
+
+    def test_cancel(self, cancel_token: CancelToken) -> None:
+        """Stop waiting for the writer to close the file descriptor when a signal is received."""
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"first\n")
+        threading.Timer(0.05, cancel_token.cancel, (signal.SIGINT,)).start()
+
+        try:
+            with pytest.raises(SignalException):
+                FdProvider(read_fd).get("/test/a", FINGERPRINT)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+class TestCommandProvider:
+    """CommandProvider class"""  # noqa: D415
+
+    def test_get(self) -> None:
+        """Return the first output line of the command called with the key path."""
+        provider = CommandProvider(
+            f'{sys.executable} -c "import os, sys; print(sys.argv[1]); '
+            + "print(os.environ['SSH_AGENT_ADD_ID_FINGERPRINT'])\""
+        )
+
+        assert provider.get("/test/id", FINGERPRINT) == ["/test/id"]
+        #
+
+    def test_failure(self) -> None:
+        """Return no passphrase if the command fails."""
+        provider = CommandProvider(f'{sys.executable} -c "print(1); exit(1)"')
+
+        assert provider.get("/test/id", FINGERPRINT) == []
+        #
+
+    def test_empty(self) -> None:
+        """Throw a ValueError if the command is empty."""
+        with pytest.raises(ValueError):
+            CommandProvider(" ")
+
+
+class TestStoreProvider:
+    """StoreProvider class"""  # noqa: D415
+
+    @pytest.fixture
+    def store_path(self, tmp_path: Path) -> Path:
+        """A fixture that returns the path of a passphrase store only readable by its owner."""
+        path = tmp_path / "passphrases.json"
+        path.write_text(json.dumps({FINGERPRINT: "by-fp", str(tmp_path / "id"): "by-path"}))
+        path.chmod(0o600)
+        return path
+        #
+
+    def test_get(self, store_path: Path, tmp_path: Path) -> None:
+        """Find the passphrase by key fingerprint, then by key path."""
+        provider = StoreProvider(str(store_path))
+
+        assert provider.get("/test/id", FINGERPRINT) == ["by-fp"]
+        assert provider.get(str(tmp_path / "." / "id"), "SHA256:other") == ["by-path"]
+        assert provider.get("/test/id", "SHA256:other") == []
+        #
+
+    def test_permissions(self, store_path: Path) -> None:
+        """Throw a PermissionError if the store can be read by other users."""
+        store_path.chmod(0o644)
+
+        with pytest.raises(PermissionError):
+            StoreProvider(str(store_path)).get("/test/id", FINGERPRINT)
+        #
+
+    def test_invalid(self, store_path: Path) -> None:
+        """Throw a ValueError if the store is not a JSON object."""
+        store_path.write_text("[]")
+
+        with pytest.raises(ValueError):
+            StoreProvider(str(store_path)).get("/test/id", FINGERPRINT)
+        #
+
+    def test_default_path(self, mocker: MockerFixture) -> None:
+        """Default to a file under $XDG_CONFIG_HOME."""
+        mocker.patch.dict("os.environ", {"XDG_CONFIG_HOME": "/test/config"})
+
+        assert StoreProvider().path == default_store_path()
+        assert default_store_path() == Path("/test/config/ssh-agent-add-id/passphrases.json")
+
+
+class TestPassphraseChain:
+    """PassphraseChain class"""  # noqa: D415
+
+    def test_passphrases(self, mocker: MockerFixture, capsys: CaptureFixture) -> None:
+        """Collect the distinct passphrases in order, reporting and skipping failing providers."""
+        mocker.patch.dict("os.environ", {"FAKE_A": "a", "FAKE_B": "b"})
+        failing = mocker.Mock()
+        failing.get.side_effect = OSError("Fake")
+        chain = PassphraseChain(
+            [EnvProvider("FAKE_A"), failing, EnvProvider("FAKE_B"), EnvProvider("FAKE_A")]
+        )
+
+        assert chain
+        assert chain.passphrases("/test/id", FINGERPRINT) == ["a", "b"]
+        assert capsys.readouterr().err == "Passphrase provider error: Fake" + os.linesep
+        assert not PassphraseChain()
+
+
+class TestParsePassphraseSource:
+    """parse_passphrase_source function"""  # noqa: D415
+
+    @pytest.mark.parametrize(
+        "source, provider_type",
+        [
+            ("env:FAKE", EnvProvider),
+            ("fd:3", FdProvider),
+            ("cmd:pass show ssh", CommandProvider),
+            ("store", StoreProvider),
+            ("store:/test/store.json", StoreProvider),
+        ],
+    )
+    def test_success(self, source: str, provider_type: type) -> None:
+        """Build the provider matching the source kind."""
+        assert isinstance(parse_passphrase_source(source), provider_type)
+        #
+
+    @pytest.mark.parametrize("source", ["env:", "fd:fake", "cmd:", "fake:value"])
+    def test_invalid(self, source: str) -> None:
+        """Throw a ValueError if the source is not valid."""
+        with pytest.raises(ValueError) as exc_info:
+            parse_passphrase_source(source)
+
+        assert exc_info.value.args[0] == f"invalid passphrase source: '{source}'"
+
+
+class TestAddIdentityUnattended:
+    """add_identity_unattended function"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture, fake_agent: FakeAgent) -> None:  # noqa: D107
+            self.agent = fake_agent
+            self.agent.handlers[17] = lambda payload: (6, b"")
+            self.ssh_agent: MockType = mocker.patch("ssh_agent_add_id.passphrase.SSHAgent")
+            self.add_identity: MockType = self.ssh_agent.return_value.add_identity
+            self.getpass: MockType = mocker.patch("getpass.getpass")
+            # Even with the bcrypt extension, the encrypted OpenSSH keys are left to ssh-add
+            mocker.patch("ssh_agent_add_id.keys.can_decrypt_openssh", return_value=False)
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture, fake_agent: FakeAgent) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestAddIdentityUnattended.Mocks(mocker, fake_agent)
+        #
+
+    def test_no_passphrase(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Return False without any I/O if there is no passphrase."""
+        assert not add_identity_unattended(mocks.agent.sock_path, str(tmp_path / "id"), [])
+        assert mocks.agent.requests == []
+        #
+
+    def test_ppk(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Decrypt a PuTTY key with the first accepted passphrase and add it natively."""
+        path = tmp_path / "id.ppk"
+        path.write_text(PPK_V2)
+
+        assert add_identity_unattended(mocks.agent.sock_path, str(path), ["bad", "fake"])
+        assert [msg_type for msg_type, _ in mocks.agent.requests] == [17]
+        mocks.getpass.assert_not_called()
+        mocks.add_identity.assert_not_called()
+        #
+
+    def test_ppk_rejected(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Return False without prompting if no passphrase decrypts a PuTTY key."""
+        path = tmp_path / "id.ppk"
+        path.write_text(PPK_V2)
+
+        assert not add_identity_unattended(mocks.agent.sock_path, str(path), ["bad"])
+        mocks.getpass.assert_not_called()
+        #
+
+    def test_ssh_add(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Answer ssh-add with each passphrase until one is accepted."""
+        path = tmp_path / "id"
+        path.write_text(openssh_private_key(b"aes256-ctr"))
+        mocks.add_identity.side_effect = [ValueError("Bad passphrase"), None]
+
+        assert add_identity_unattended(mocks.agent.sock_path, str(path), ["bad", "fake"], 60)
+        mocks.add_identity.assert_called_with(str(path), 60, False, "fake", mocks.agent.sock_path)
+        #
+
+    def test_ssh_add_rejected(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Return False if ssh-add rejects all the passphrases."""
+        path = tmp_path / "id"
+        path.write_text(openssh_private_key(b"aes256-ctr"))
+        mocks.add_identity.side_effect = ValueError("Bad passphrase")
+
+        assert not add_identity_unattended(mocks.agent.sock_path, str(path), ["bad"])
@@ -0,0 +1,145 @@
+import base64
+import builtins
+import hashlib
+import hmac
+from typing import Any
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.ppk import BadPassphraseError, PPKFile
+from ssh_agent_add_id.wire import pack_string
+
+
+# putty_ed25519.ppk of the functional tests, whose passphrase is "fake"
+PPK_V2 = """PuTTY-User-Key-File-2: ssh-ed25519
+Encryption: aes256-cbc
+Comment: ed25519-key-20231209
+Public-Lines: 2
+AAAAC3NzaC1lZDI1NTE5AAAAICS79gq8k0iz8ve8aLBJgzWdsZpY6SyGNmPoIrn2
+5zld
+Private-Lines: 1
+h3BlS8v4FGcgIWDMu0E1vusV+JITR2JKjQc4Rn3P5se6MOQA4D0IYS28DPuT1IwJ
+Private-MAC: e2ff97a1e533a6c1212251ab97d48ddace3641e0
+"""
+ED25519_PUBLIC = bytes.fromhex("24bbf60abc9348b3f2f7bc68b04983359db19a58e92c863663e822b9f6e7395d")
+
+
+def unencrypted_ppk(version: int, key_type: str, public: bytes, private: bytes) -> str:
+    """Build an unencrypted PPK file content."""
+    public_blob = pack_string(key_type.encode()) + public
+    mac_data = b"".join(
+        pack_string(value) for value in (key_type.encode(), b"none", b"fake", public_blob, private)
+    )
+    if version == 2:
+        mac_key = hashlib.sha1(b"putty-private-key-file-mac-key").digest()
+        mac = hmac.new(mac_key, mac_data, "sha1").hexdigest()
+    else:
+        mac = hmac.new(b"", mac_data, "sha256").hexdigest()
+
+    return (
+        f"PuTTY-User-Key-File-{version}: {key_type}\nEncryption: none\nComment: fake\n"
+        + f"Public-Lines: 1\n{base64.b64encode(public_blob).decode()}\n"
+        + f"Private-Lines: 1\n{base64.b64encode(private).decode()}\n"
+        + f"Private-MAC: {mac}\n"
+    )
+
+
+class TestPPKFile:
+    """PPKFile class"""  # noqa: D415
+
+    def test_parse(self) -> None:
+        """Parse the headers and the blobs."""
+        ppk = PPKFile(PPK_V2)
+
+        assert ppk.version == 2
+        assert ppk.key_type == "ssh-ed25519"
+        assert ppk.encrypted
+        assert ppk.comment == "ed25519-key-20231209"
+        assert ppk.public_blob == pack_string(b"ssh-ed25519") + pack_string(ED25519_PUBLIC)
+        #
+
+    @pytest.mark.parametrize(
+        "content",
+        [
+            PPK_V2.replace("Private-MAC", "Fake"),
+            PPK_V2.replace("File-2", "File-1"),
+            PPK_V2.replace("aes256-cbc", "fake"),
+            "fake",
+        ],
+    )
+    def test_invalid(self, content: str) -> None:
+        """Throw a ValueError if the content is not a supported PPK file."""
+        with pytest.raises(ValueError):
+            PPKFile(content)
+        #
+
+    def test_decrypt_v2(self) -> None:
+        """Decrypt a version 2 file into the agent identity format."""
+        identity = PPKFile(PPK_V2).decrypt("fake")
+
+        assert identity.startswith(
+            pack_string(b"ssh-ed25519") + pack_string(ED25519_PUBLIC) + pack_string(b"")[:3] + b"@"
+        )
+        assert identity.endswith(ED25519_PUBLIC + pack_string(b"ed25519-key-20231209"))
+        #
+
+    def test_bad_passphrase(self) -> None:
+        """Throw a BadPassphraseError if the MAC does not match."""
+        with pytest.raises(BadPassphraseError):
+            PPKFile(PPK_V2).decrypt("bad")
+        #
+
+    def test_decrypt_v3_unencrypted(self) -> None:
+        """Check the MAC of an unencrypted version 3 file with an empty key."""
+        public = pack_string(bytes(32))
+        ppk = PPKFile(unencrypted_ppk(3, "ssh-ed25519", public, pack_string(b"\x01" * 31)))
+
+        identity = ppk.decrypt()
+
+        assert identity == (
+            pack_string(b"ssh-ed25519")
+            + public
+            + pack_string(b"\x01" * 31 + bytes(33))
+            + pack_string(b"fake")
+        )
+        #
+
+    def test_decrypt_rsa(self) -> None:
+        """Reorder the RSA fields as expected by the agent."""
+        e, n, d, p, q, iqmp = (pack_string(bytes([i])) for i in range(1, 7))
+
+        ppk = PPKFile(unencrypted_ppk(2, "ssh-rsa", e + n, d + p + q + iqmp))
+
+        assert ppk.decrypt() == pack_string(b"ssh-rsa") + n + e + d + iqmp + p + q + (
+            pack_string(b"fake")
+        )
+        #
+
+    def test_unsupported_key_type(self) -> None:
+        """Throw a ValueError if the key type is not supported."""
+        ppk = PPKFile(unencrypted_ppk(2, "ssh-ed448", pack_string(bytes(57)), pack_string(b"1")))
+
+        with pytest.raises(ValueError) as exc_info:
+            ppk.decrypt()
+
+        assert exc_info.value.args[0] == "Unsupported PuTTY key type: ssh-ed448"
+        #
+
+    def test_argon2_not_installed(self, mocker: MockerFixture) -> None:
+        """Throw a ValueError if argon2-cffi is required but not installed."""
+        content = PPK_V2.replace("File-2", "File-3").replace(
+            "Private-Lines", "Key-Derivation: Argon2id\nPrivate-Lines"
+        )
+        real_import = builtins.__import__
+
+        def fake_import(name: str, *args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+            if name.startswith("argon2"):
+                raise ImportError(name)
+            return real_import(name, *args, **kwargs)
+
+        mocker.patch("builtins.__import__", side_effect=fake_import)
+
+        with pytest.raises(ValueError) as exc_info:
+            PPKFile(content).decrypt("fake")
+
+        assert "requires argon2-cffi" in exc_info.value.args[0]
@@ -0,0 +1,106 @@
+from pathlib import Path
+import pstats
+
+import pytest
+from pytest import CaptureFixture
+from ssh_agent_add_id import history, profiling
+from ssh_agent_add_id.profiling import blocked, is_active, profile, split_profile_args
+
+
+class TestProfile:
+    """profile function"""  # noqa: D415
+
+    def test_stats(self, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Write the pstats file and a summary to stderr, even if the code exits."""
+        path = tmp_path / "fake.pstats"
+
+        with pytest.raises(SystemExit):
+            with profile(str(path)):
+                assert is_active()
+                sorted(range(1000))
+                raise SystemExit(1)
+
+        assert not is_active()
+        assert pstats.Stats(str(path)).total_calls > 0
+        err = capsys.readouterr().err
+        assert "s wall time, " in err
+        assert f"Profile written to {path}" in err
+        #
+
+    def test_memory(self, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Add the memory peak and the top allocations to the summary."""
+        with profile(str(tmp_path / "fake.pstats"), memory=True):
+            _ = [bytes(1024) for _ in range(100)]
+
+        assert "memory peak: " in capsys.readouterr().err
+        #
+
+    def test_history(self, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Add the agent state history to the summary, to audit its hit rate."""
+        history.record(history.HIT, "/test/fake.sock", "SHA256:a")
+
+        with profile(str(tmp_path / "fake.pstats")):
+            pass
+
+        assert "/test/fake.sock: 1 hits, 0 agent queries (100% hit rate)" in capsys.readouterr().err
+        #
+
+    def test_write_error(self, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Report a pstats file which cannot be written."""
+        with profile(str(tmp_path / "missing" / "fake.pstats")):
+            pass
+
+        assert "Cannot write the profile: " in capsys.readouterr().err
+        #
+
+    def test_stopped(self, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Write the results only once if the session has been stopped early (before exec)."""
+        with profile(str(tmp_path / "fake.pstats")):
+            profiling.stop()
+
+        assert capsys.readouterr().err.count("Profile written to") == 1
+
+
+class TestBlocked:
+    """blocked function"""  # noqa: D415
+
+    def test_accounting(self, capsys: CaptureFixture, tmp_path: Path) -> None:
+        """Accumulate the wall time per blocking cause."""
+        with profile(str(tmp_path / "fake.pstats")) as session:
+            with blocked(profiling.AGENT):
+                pass
+            with blocked(profiling.AGENT):
+                pass
+
+            assert list(session.blocked) == [profiling.AGENT]
+            assert session.blocked[profiling.AGENT] > 0
+
+        assert "blocked on agent socket: " in capsys.readouterr().err
+        #
+
+    def test_inactive(self) -> None:
+        """Do nothing when not profiling."""
+        with blocked(profiling.PROMPT):
+            assert not is_active()
+
+
+class TestSplitProfileArgs:
+    """split_profile_args function"""  # noqa: D415
+
+    @pytest.mark.parametrize(
+        "argv, expected",
+        [
+            (["/test/fake"], (["/test/fake"], None, False)),
+            (["--profile", "/test/fake"], (["/test/fake"], "", False)),
+            (["--profile=/test/p", "/test/fake"], (["/test/fake"], "/test/p", False)),
+            (["--profile-memory", "/test/fake"], (["/test/fake"], "", True)),
+            (["--profile=/test/p", "--profile-memory"], ([], "/test/p", True)),
+            (
+                ["exec", "/test/fake", "--", "cmd", "--profile"],
+                (["exec", "/test/fake", "--", "cmd", "--profile"], None, False),
+            ),
+        ],
+    )
+    def test_split(self, argv: list, expected: tuple) -> None:
+        """Extract the profiling options, leaving the command to execute untouched."""
+        assert split_profile_args(argv) == expected
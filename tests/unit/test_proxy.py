@@ -0,0 +1,290 @@
+import json
+import os
+from pathlib import Path
+import socket
+import struct
+import threading
+from typing import Iterator, Tuple
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.proxy import (
+    HOST_ENV,
+    FilteringProxy,
+    HostTable,
+    Identity,
+    Target,
+    parse_ssh_target,
+    parse_target,
+    run_proxy,
+    select_identities,
+)
+from ssh_agent_add_id.ssh_config import SSHConfig
+from ssh_agent_add_id.state import state_dir
+from ssh_agent_add_id.wire import WireReader, pack_string
+
+from tests.unit.conftest import ED25519_BLOB, ED25519_PUBLIC_LINE, FakeAgent
+
+
+OTHER_BLOB = pack_string(b"ssh-ed25519") + pack_string(bytes(range(1, 33)))
+ED25519_FP = PublicKey.from_blob(ED25519_BLOB).fingerprint
+OTHER_FP = PublicKey.from_blob(OTHER_BLOB).fingerprint
+
+
+def exchange(conn: socket.socket, msg_type: int, payload: bytes = b"") -> Tuple[int, bytes]:
+    """Send a request to the proxy and read its reply."""
+    conn.sendall(struct.pack(">IB", len(payload) + 1, msg_type) + payload)
+    length = struct.unpack(">I", conn.recv(4))[0]
+    message = b""
+    while len(message) < length:
+        message += conn.recv(length - len(message))
+    return message[0], message[1:]
+
+
+def listed_blobs(payload: bytes) -> list:
+    """Get the key blobs of an identities answer."""
+    reader = WireReader(payload)
+    blobs = []
+    for _ in range(reader.read_uint32()):
+        blobs.append(reader.read_string())
+        reader.read_string()
+    return blobs
+
+
+class TestParseTarget:
+    """parse_target function"""  # noqa: D415
+
+    @pytest.mark.parametrize(
+        "value, target",
+        [
+            ("fake.example", Target("fake.example")),
+            ("git@fake.example:2222", Target("fake.example", "git", 2222)),
+            ("ssh://git@fake.example/", Target("fake.example", "git")),
+        ],
+    )
+    def test_targets(self, value: str, target: Target) -> None:
+        """Parse the user, host and port of a target or of an ssh URL."""
+        assert parse_target(value) == target
+        #
+
+    def test_invalid_port(self) -> None:
+        """Raise a ValueError if the port is not a number."""
+        with pytest.raises(ValueError):
+            parse_target("fake.example:ssh")
+
+
+class TestParseSshTarget:
+    """parse_ssh_target function"""  # noqa: D415
+
+    @pytest.mark.parametrize(
+        "command, target",
+        [
+            (
+                ["ssh", "-o", "SendEnv=GIT_PROTOCOL", "git@fake.example", "git-upload-pack 'x'"],
+                Target("fake.example", "git"),
+            ),
+            (["ssh", "-vp2222", "-l", "git", "fake.example"], Target("fake.example", "git", 2222)),
+            (["ssh", "-oUser=git", "-o", "Port 2222", "fake"], Target("fake", "git", 2222)),
+            (
+                ["ssh", "-4", "--", "ssh://git@fake.example:2222"],
+                Target("fake.example", "git", 2222),
+            ),
+        ],
+    )
+    def test_targets(self, command: list, target: Target) -> None:
+        """Find the destination after the options, completed by -l, -p and -o."""
+        assert parse_ssh_target(command) == target
+        #
+
+    def test_no_destination(self) -> None:
+        """Return None if the command has no destination."""
+        assert parse_ssh_target(["ssh", "-p", "2222"]) is None
+
+
+class TestHostTable:
+    """HostTable class"""  # noqa: D415
+
+    def test_record(self, tmp_path: Path) -> None:
+        """Learn the successes, the most recent first, and the failure of a host."""
+        table = HostTable(tmp_path / "hosts.json")
+        table.record("git@fake", ED25519_FP)
+        table.record("git@fake", OTHER_FP)
+
+        assert HostTable(tmp_path / "hosts.json").successes("git@fake") == [OTHER_FP, ED25519_FP]
+        assert not table.has_failed("git@fake")
+
+        table.record("git@fake")
+
+        assert HostTable(tmp_path / "hosts.json").has_failed("git@fake")
+        assert table.successes("other@fake") == []
+        #
+
+    def test_invalid_file(self, tmp_path: Path) -> None:
+        """Start from an empty table if the file cannot be parsed or has another version."""
+        (tmp_path / "hosts.json").write_text("{")
+        assert HostTable(tmp_path / "hosts.json").hosts == {}
+
+        (tmp_path / "hosts.json").write_text(json.dumps({"version": 0, "hosts": {"a": {}}}))
+        assert HostTable(tmp_path / "hosts.json").hosts == {}
+
+
+class TestSelectIdentities:
+    """select_identities function"""  # noqa: D415
+
+    identities = [Identity(ED25519_BLOB, b"a", ED25519_FP), Identity(OTHER_BLOB, b"b", OTHER_FP)]
+
+    def test_filtered(self) -> None:
+        """Expose the relevant identities only, in order of preference."""
+        assert select_identities(self.identities, [OTHER_FP]) == self.identities[1:]
+        #
+
+    def test_unfiltered(self) -> None:
+        """Expose the relevant identities first after a failure."""
+        expected = self.identities[::-1]
+
+        assert select_identities(self.identities, [OTHER_FP], filtered=False) == expected
+        #
+
+    def test_unknown_host(self) -> None:
+        """Expose all the identities if none is relevant."""
+        assert select_identities(self.identities, ["SHA256:missing"]) == self.identities
+
+
+class TestFilteringProxy:
+    """FilteringProxy class"""  # noqa: D415
+
+    @pytest.fixture
+    def proxy(self, fake_agent: FakeAgent, tmp_path: Path) -> FilteringProxy:
+        """A fixture that returns a FilteringProxy relaying the fake agent to git@fake.example."""
+        fake_agent.identities[ED25519_BLOB] = "a"
+        fake_agent.identities[OTHER_BLOB] = "b"
+        (tmp_path / "config").write_text("")
+        return FilteringProxy(
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+            fake_agent.sock_path,
+            Target("fake.example", "git"),
+            HostTable(tmp_path / "hosts.json"),
+            SSHConfig.parse([str(tmp_path / "config")]),
+        )
+
+    @pytest.fixture
+    def client(self, proxy: FilteringProxy) -> Iterator[socket.socket]:
+        """A fixture that returns a client connection relayed by the proxy from a thread."""
+        conn, proxy_conn = socket.socketpair()
+        thread = threading.Thread(target=proxy.relay, args=(proxy_conn,))
+        thread.start()
+        yield conn
+        conn.close()
+        thread.join()
+        #
+
+    def test_unknown_host(self, proxy: FilteringProxy, client: socket.socket) -> None:
+        """Expose all the identities to an unknown host, without recording anything."""
+        msg_type, payload = exchange(client, 11)
+
+        assert msg_type == 12
+        assert listed_blobs(payload) == [ED25519_BLOB, OTHER_BLOB]
+        assert proxy.host_key == "git@fake.example"
+        #
+
+    def test_learned(
+        self, proxy: FilteringProxy, client: socket.socket, fake_agent: FakeAgent
+    ) -> None:
+        """Expose the identities that have authenticated, and learn from the signatures."""
+        proxy.table.record(proxy.host_key, OTHER_FP)
+        fake_agent.handlers[13] = lambda payload: (14, pack_string(b"fake signature"))
+
+        assert listed_blobs(exchange(client, 11)[1]) == [OTHER_BLOB]
+        assert exchange(client, 13, pack_string(ED25519_BLOB) + pack_string(b"data")) == (
+            14,
+            pack_string(b"fake signature"),
+        )
+        assert proxy.table.successes(proxy.host_key) == [ED25519_FP, OTHER_FP]
+        #
+
+    def test_failed(self, proxy: FilteringProxy, fake_agent: FakeAgent) -> None:
+        """Record a failure if no filtered identity has signed, then expose all the identities."""
+        proxy.table.record(proxy.host_key, OTHER_FP)
+
+        for expected in ([OTHER_BLOB], [OTHER_BLOB, ED25519_BLOB]):
+            conn, proxy_conn = socket.socketpair()
+            thread = threading.Thread(target=proxy.relay, args=(proxy_conn,))
+            thread.start()
+            assert listed_blobs(exchange(conn, 11)[1]) == expected
+            conn.close()
+            thread.join()
+
+        assert proxy.table.has_failed(proxy.host_key)
+        #
+
+    def test_configured(self, fake_agent: FakeAgent, tmp_path: Path) -> None:
+        """Take the IdentityFile options of the host as relevant."""
+        (tmp_path / "id.pub").write_text(ED25519_PUBLIC_LINE)
+        (tmp_path / "config").write_text(
+            f"Host work\n  HostName fake.example\n  Port 2222\n  IdentityFile {tmp_path}/id\n"
+        )
+
+        proxy = FilteringProxy(
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+            fake_agent.sock_path,
+            Target("work", "git"),
+            HostTable(tmp_path / "hosts.json"),
+            SSHConfig.parse([str(tmp_path / "config")]),
+        )
+
+        assert proxy.host_key == "git@work:2222"
+        assert proxy.configured == [ED25519_FP]
+        #
+
+    def test_agent_error(self, proxy: FilteringProxy, tmp_path: Path) -> None:
+        """Answer a failure if the agent cannot be reached."""
+        proxy.upstream = str(tmp_path / "missing.sock")
+        conn, proxy_conn = socket.socketpair()
+        thread = threading.Thread(target=proxy.relay, args=(proxy_conn,))
+        thread.start()
+
+        assert exchange(conn, 11) == (5, b"")
+        conn.close()
+        thread.join()
+
+
+class TestRunProxy:
+    """run_proxy function"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture) -> None:  # noqa: D107
+            self.fork = mocker.patch("os.fork", return_value=1)
+            self.execvpe = mocker.patch("os.execvpe")
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestRunProxy.Mocks(mocker)
+        #
+
+    def test_proxied(self, mocks: Mocks, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Execute ssh with the socket of the forked proxy as agent."""
+        monkeypatch.setenv("SSH_AUTH_SOCK", "/test/agent.sock")
+        command = ["ssh", "git@fake.example", "git-upload-pack"]
+
+        run_proxy(command)
+
+        mocks.fork.assert_called_once()
+        env = mocks.execvpe.call_args.args[2]
+        assert mocks.execvpe.call_args.args[:2] == ("ssh", command)
+        assert env["SSH_AUTH_SOCK"] == str(state_dir() / f"proxy-{os.getpid()}.sock")
+        #
+
+    def test_no_target(self, mocks: Mocks, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Execute the command as is without target."""
+        monkeypatch.setenv("SSH_AUTH_SOCK", "/test/agent.sock")
+        monkeypatch.setenv(HOST_ENV, "fake.example:ssh")
+
+        run_proxy(["ssh", "-V"])
+
+        mocks.fork.assert_not_called()
+        assert mocks.execvpe.call_args.args[2]["SSH_AUTH_SOCK"] == "/test/agent.sock"
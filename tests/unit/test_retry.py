@@ -0,0 +1,167 @@
+from pathlib import Path
+from subprocess import CalledProcessError
+import time
+from unittest.mock import Mock
+
+import pytest
+from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id import retry
+from ssh_agent_add_id.agent_client import AgentError, TransientAgentError
+from ssh_agent_add_id.constants import AGENT_BREAKER_THRESHOLD, AGENT_RETRY_MAX_DELAY
+from ssh_agent_add_id.retry import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    backoff,
+    call,
+    is_transient,
+    summary_lines,
+)
+
+from tests.unit.conftest import FakeAgent
+
+
+class TestIsTransient:
+    """is_transient function"""  # noqa: D415
+
+    def test_agent_errors(self) -> None:
+        """Retry the transient agent errors only."""
+        assert is_transient(TransientAgentError("fake"))
+        assert not is_transient(AgentError("fake"))
+        assert not is_transient(ValueError("fake"))
+        #
+
+    def test_ssh_add_errors(self) -> None:
+        """Retry the ssh-add failures of a busy agent, from their error output."""
+        busy = b"error fetching identities: communication with agent failed\n"
+
+        assert is_transient(CalledProcessError(1, ["ssh-add", "-L"], b"", busy))
+        assert is_transient(CalledProcessError(2, ["ssh-add"], "", "Connection refused"))
+        assert not is_transient(CalledProcessError(2, ["ssh-add"], b"", b"No such file"))
+
+
+class TestBackoff:
+    """backoff function"""  # noqa: D415
+
+    def test_bounds(self) -> None:
+        """Double the maximal delay at each attempt, up to AGENT_RETRY_MAX_DELAY."""
+        assert all(0 <= backoff(0) <= 0.05 for _ in range(100))
+        assert all(0 <= backoff(20) <= AGENT_RETRY_MAX_DELAY for _ in range(100))
+
+
+class TestCall:
+    """call function"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture) -> None:  # noqa: D107
+            self.sleep: MockType = mocker.patch("ssh_agent_add_id.cancellation.sleep")
+            mocker.patch.dict(retry._stats, clear=True)
+            mocker.patch.dict(retry._breakers, clear=True)
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestCall.Mocks(mocker)
+        #
+
+    def test_retry(self, mocks: Mocks, fake_agent: FakeAgent) -> None:
+        """Retry the transient failures after a backoff, then close the breaker."""
+        operation = Mock(side_effect=[TransientAgentError("fake"), "fake result"])
+
+        assert call(fake_agent.sock_path, operation) == "fake result"
+        assert operation.call_count == 2
+        mocks.sleep.assert_called_once()
+        assert CircuitBreaker(fake_agent.sock_path).failures == 0
+        assert retry._stats[fake_agent.sock_path] == retry.RetryStats(1, 1, 1, 0, CLOSED)
+        #
+
+    def test_not_transient(self, mocks: Mocks, fake_agent: FakeAgent) -> None:
+        """Raise the other failures at once."""
+        operation = Mock(side_effect=AgentError("fake"))
+
+        with pytest.raises(AgentError):
+            call(fake_agent.sock_path, operation)
+
+        assert operation.call_count == 1
+        assert CircuitBreaker(fake_agent.sock_path).failures == 0
+        #
+
+    def test_exhausted(self, mocks: Mocks, fake_agent: FakeAgent) -> None:
+        """Raise the last transient failure once no attempt is left."""
+        operation = Mock(side_effect=TransientAgentError("fake"))
+
+        with pytest.raises(TransientAgentError):
+            call(fake_agent.sock_path, operation, attempts=3)
+
+        assert operation.call_count == 3
+        assert mocks.sleep.call_count == 2
+        assert CircuitBreaker(fake_agent.sock_path).failures == 3
+        #
+
+    def test_fail_fast(self, mocks: Mocks, fake_agent: FakeAgent) -> None:
+        """Stop retrying once the breaker opens, then fail fast without calling the operation."""
+        operation = Mock(side_effect=TransientAgentError("fake"))
+
+        with pytest.raises(TransientAgentError):
+            call(fake_agent.sock_path, operation, attempts=AGENT_BREAKER_THRESHOLD + 1)
+        with pytest.raises(CircuitOpenError):
+            call(fake_agent.sock_path, operation)
+
+        assert operation.call_count == AGENT_BREAKER_THRESHOLD
+        assert CircuitBreaker(fake_agent.sock_path).state == OPEN
+        assert summary_lines() == [
+            f"  agent retries ({fake_agent.sock_path}): 2 calls, {AGENT_BREAKER_THRESHOLD - 1} "
+            + f"retries, {AGENT_BREAKER_THRESHOLD} transient failures, 1 failed fast, "
+            + "circuit breaker open"
+        ]
+        #
+
+    def test_probe(self, mocks: Mocks, fake_agent: FakeAgent) -> None:
+        """Let a single caller probe the agent after the cooldown, closing the breaker."""
+        breaker = CircuitBreaker(fake_agent.sock_path)
+        breaker.failures = AGENT_BREAKER_THRESHOLD
+        breaker.save()
+        assert breaker.state == HALF_OPEN
+
+        other = CircuitBreaker(fake_agent.sock_path)
+        operation = Mock(side_effect=lambda: other.allow())
+
+        assert call(fake_agent.sock_path, operation) is False
+        assert CircuitBreaker(fake_agent.sock_path).state == CLOSED
+        assert breaker.path and not breaker.path.exists()
+        #
+
+    def test_breaker_loaded_once(
+        self, mocks: Mocks, fake_agent: FakeAgent, mocker: MockerFixture
+    ) -> None:
+        """Read the saved breaker once per socket, then again only after a transient failure."""
+        load = mocker.spy(CircuitBreaker, "load")
+        operation = Mock(side_effect=["fake result", "fake result", TransientAgentError("fake")])
+
+        call(fake_agent.sock_path, operation)
+        call(fake_agent.sock_path, operation)
+        assert load.call_count == 1
+
+        other = CircuitBreaker(fake_agent.sock_path)
+        other.failures = AGENT_BREAKER_THRESHOLD
+        other.open_until = time.time() + 60
+        other.save()
+
+        with pytest.raises(TransientAgentError):
+            call(fake_agent.sock_path, operation)
+        with pytest.raises(CircuitOpenError):
+            call(fake_agent.sock_path, operation)
+        assert operation.call_count == 3
+        #
+
+    def test_missing_socket(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Retry without breaker if the socket cannot be identified."""
+        operation = Mock(side_effect=[TransientAgentError("fake"), "fake result"])
+
+        assert call(str(tmp_path / "missing.sock"), operation) == "fake result"
+        assert CircuitBreaker(str(tmp_path / "missing.sock")).path is None
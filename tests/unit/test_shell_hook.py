@@ -0,0 +1,66 @@
+from pathlib import Path
+import subprocess
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.shell_hook import SHELLS, generate_hook
+from ssh_agent_add_id.state import AgentState, state_dir
+
+
+PUB_KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAICS79gq8k0iz8ve8aLBJgzWdsZpY6SyGNmPoIrn25zld fake"
+FINGERPRINT = "SHA256:asg19kcNCSJQFsISVZ7Z7bEnDLO9/EVhCQjW/zQ48yE"
+
+
+class TestGenerateHook:
+    """generate_hook function"""  # noqa: D415
+
+    @pytest.fixture
+    def priv_key_path(self, tmp_path: Path) -> str:
+        """A fixture that returns a private key path with its .pub file."""
+        (tmp_path / "id.pub").write_text(PUB_KEY)
+        return str(tmp_path / "id")
+        #
+
+    @pytest.mark.parametrize("shell", SHELLS)
+    def test_placeholders(self, shell: str, priv_key_path: str) -> None:
+        """Replace all the placeholders."""
+        hook = generate_hook(shell, priv_key_path)
+
+        assert "@" not in hook.replace(FINGERPRINT, "")
+        assert FINGERPRINT in hook
+        assert str(state_dir()) in hook
+        assert f"{priv_key_path}\n" in hook
+        #
+
+    def test_pub_key_path(self, priv_key_path: str) -> None:
+        """Pass the public key path to the command."""
+        hook = generate_hook("bash", priv_key_path, priv_key_path + ".pub")
+
+        assert f"{priv_key_path} {priv_key_path}.pub\n" in hook
+        #
+
+    def test_unknown_shell(self, priv_key_path: str) -> None:
+        """Throw a KeyError if the shell is not supported."""
+        with pytest.raises(KeyError):
+            generate_hook("csh", priv_key_path)
+        #
+
+    @pytest.mark.skipif(not Path("/bin/bash").exists(), reason="bash is not installed")
+    def test_bash_hook(self, mocker: MockerFixture, priv_key_path: str, tmp_path: Path) -> None:
+        """Only run the command when the agent socket has no state with the identity."""
+        sock_path = tmp_path / "agent.sock"
+        sock_path.touch()
+        hook = generate_hook("bash", priv_key_path).replace(
+            "command ", "echo called >> " + str(tmp_path / "calls") + " # "
+        )
+        script = hook + 'eval "$PROMPT_COMMAND"; eval "$PROMPT_COMMAND"'
+        env = {"SSH_AUTH_SOCK": str(sock_path), "PATH": "/usr/bin:/bin"}
+
+        # No state: run the command once, then rely on the unchanged socket
+        subprocess.run(["/bin/bash", "-c", script], env=env, check=True)
+        assert (tmp_path / "calls").read_text() == "called\n"
+
+        # A new shell finds the identity into the state of the agent
+        AgentState.load(str(sock_path)).update([FINGERPRINT])
+        subprocess.run(["/bin/bash", "-c", script], env=env, check=True)
+        assert (tmp_path / "calls").read_text() == "called\n"
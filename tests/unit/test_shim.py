@@ -0,0 +1,248 @@
+import base64
+import os
+from pathlib import Path
+import time
+
+import pytest
+from pytest import CaptureFixture
+from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id.agent_client import AgentError
+from ssh_agent_add_id.deadline import DeadlineExceededError
+from ssh_agent_add_id.errors import ExitCodeError
+from ssh_agent_add_id.keys import parse_openssh_public_key
+from ssh_agent_add_id.passphrase import EnvProvider, PassphraseChain
+from ssh_agent_add_id.shim import ensure_identity, run_exec
+from ssh_agent_add_id.state import AgentState
+
+from tests.unit.conftest import FakeAgent
+from tests.unit.test_certificates import cert_blob, write_cert
+
+
+PUB_KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAICS79gq8k0iz8ve8aLBJgzWdsZpY6SyGNmPoIrn25zld fake"
+
+
+class TestRunExec:
+    """run_exec function"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture) -> None:  # noqa: D107
+            self.args: MockType = mocker.Mock()
+            self.args.exec_command = ["ssh", "-T", "git@fake"]
+            self.ensure_identity: MockType = mocker.patch("ssh_agent_add_id.shim.ensure_identity")
+            self.execvp: MockType = mocker.patch("os.execvp")
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestRunExec.Mocks(mocker)
+        #
+
+    def test_success(self, mocks: Mocks) -> None:
+        """Execute the command once the identity is ensured."""
+        run_exec(mocks.args)
+
+        mocks.ensure_identity.assert_called_once_with(mocks.args)
+        mocks.execvp.assert_called_once_with("ssh", ["ssh", "-T", "git@fake"])
+        #
+
+    @pytest.mark.parametrize(
+        "err",
+        [
+            AgentError("Fake"),
+            DeadlineExceededError("Fake"),
+            OSError("Fake"),
+            ValueError("Fake"),
+            ExitCodeError(1),
+        ],
+    )
+    def test_ensure_failure(self, err: Exception, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Warn but still execute the command if the identity cannot be ensured."""
+        mocks.ensure_identity.side_effect = err
+
+        run_exec(mocks.args)
+
+        assert capsys.readouterr().err == f"ssh-agent-add-id: {err}" + os.linesep
+        mocks.execvp.assert_called_once()
+        #
+
+    def test_deadline(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Clear the deadline before executing the command, its timer surviving exec."""
+        clear: MockType = mocker.patch("ssh_agent_add_id.deadline.clear")
+        mocks.execvp.side_effect = lambda *args: clear.assert_called_once()
+
+        run_exec(mocks.args)
+
+        mocks.execvp.assert_called_once()
+        #
+
+    def test_signal(self, mocks: Mocks) -> None:
+        """Do not execute the command if a signal has been received."""
+        mocks.ensure_identity.side_effect = ExitCodeError(130)
+
+        with pytest.raises(ExitCodeError):
+            run_exec(mocks.args)
+
+        mocks.execvp.assert_not_called()
+
+
+class TestEnsureIdentity:
+    """ensure_identity function"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture, fake_agent: FakeAgent, tmp_path: Path) -> None:  # noqa: D107
+            self.fake_agent = fake_agent
+            mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": fake_agent.sock_path})
+
+            pub_key_path = tmp_path / "id.pub"
+            pub_key_path.write_text(PUB_KEY)
+            self.pub_key = parse_openssh_public_key(PUB_KEY)
+
+            self.args: MockType = mocker.Mock()
+            self.args.resolve_pub_key_path.return_value = pub_key_path
+            self.args.resolve_priv_key_path.return_value = tmp_path / "id"
+            self.args.lifetime = None
+            self.args.confirm = False
+            self.args.passphrase_chain = PassphraseChain()
+
+            self.has_terminal: MockType = mocker.patch(
+                "ssh_agent_add_id.shim._has_terminal", return_value=True
+            )
+            self.ssh_agent: MockType = mocker.patch("ssh_agent_add_id.shim.SSHAgent")
+            self.add_identity: MockType = self.ssh_agent.return_value.add_identity
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture, fake_agent: FakeAgent, tmp_path: Path) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestEnsureIdentity.Mocks(mocker, fake_agent, tmp_path)
+        #
+
+    def test_no_ssh_auth_sock(self, mocker: MockerFixture) -> None:
+        """Throw a ValueError if SSH_AUTH_SOCK is not set."""
+        mocker.patch.dict("os.environ", clear=True)
+
+        with pytest.raises(ValueError) as exc_info:
+            ensure_identity(mocker.Mock())
+
+        assert exc_info.value.args[0] == "SSH_AUTH_SOCK not found"
+        #
+
+    def test_cache_hit(self, mocks: Mocks) -> None:
+        """Do not query the agent if a fresh state has the identity."""
+        AgentState.load(mocks.fake_agent.sock_path).update([mocks.pub_key.fingerprint])
+
+        ensure_identity(mocks.args)
+
+        assert mocks.fake_agent.requests == []
+        mocks.add_identity.assert_not_called()
+        #
+
+    def test_stale_cache(self, mocks: Mocks) -> None:
+        """Query the agent if the state is outdated."""
+        state = AgentState.load(mocks.fake_agent.sock_path)
+        state.fingerprints.add(mocks.pub_key.fingerprint)
+        state.updated_at = time.time() - 3600
+        state.save()
+        mocks.fake_agent.identities[mocks.pub_key.blob] = "fake"
+
+        ensure_identity(mocks.args)
+
+        assert mocks.fake_agent.requests == [(11, b"")]
+        mocks.add_identity.assert_not_called()
+        #
+
+    def test_add_identity(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Add the identity, writing its output to stderr, then cache it."""
+        mocks.add_identity.side_effect = lambda *args: print("Identity added")
+
+        ensure_identity(mocks.args)
+
+        mocks.add_identity.assert_called_once_with(
+            str(mocks.args.resolve_priv_key_path()), None, False
+        )
+        assert capsys.readouterr().err == "Identity added\n"
+        state = AgentState.load(mocks.fake_agent.sock_path)
+        assert state.fingerprints == {mocks.pub_key.fingerprint}
+        #
+
+    def test_lifetime_cache_hit(self, mocks: Mocks) -> None:
+        """Do not query the agent before the identity added with a lifetime expires."""
+        mocks.args.lifetime = 3600
+        ensure_identity(mocks.args)
+        mocks.fake_agent.requests.clear()
+        state = AgentState.load(mocks.fake_agent.sock_path)
+        state.updated_at = time.time() - 3000
+        state.save()
+
+        ensure_identity(mocks.args)
+
+        assert mocks.fake_agent.requests == []
+        mocks.add_identity.assert_called_once()
+        #
+
+    def test_lifetime_near_expiry(self, mocks: Mocks) -> None:
+        """Query the agent shortly before the identity added with a lifetime expires."""
+        state = AgentState.load(mocks.fake_agent.sock_path)
+        state.add(mocks.pub_key.fingerprint, 1)
+        mocks.fake_agent.identities[mocks.pub_key.blob] = "fake"
+
+        ensure_identity(mocks.args)
+
+        assert mocks.fake_agent.requests == [(11, b"")]
+        mocks.add_identity.assert_not_called()
+        #
+
+    def test_no_terminal(self, mocks: Mocks) -> None:
+        """Throw a ValueError if there is no terminal to prompt for the passphrase."""
+        mocks.has_terminal.return_value = False
+
+        with pytest.raises(ValueError):
+            ensure_identity(mocks.args)
+
+        mocks.add_identity.assert_not_called()
+        #
+
+    def test_passphrase_providers(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Add the identity with the passphrase providers, even without terminal."""
+        mocks.has_terminal.return_value = False
+        mocks.args.passphrase_chain = PassphraseChain([EnvProvider("FAKE_PASSPHRASE")])
+        mocker.patch.dict("os.environ", {"FAKE_PASSPHRASE": "fake"})
+        add_identity_unattended: MockType = mocker.patch(
+            "ssh_agent_add_id.shim.add_identity_unattended", return_value=True
+        )
+
+        ensure_identity(mocks.args)
+
+        add_identity_unattended.assert_called_once_with(
+            mocks.fake_agent.sock_path,
+            str(mocks.args.resolve_priv_key_path()),
+            ["fake"],
+            None,
+            False,
+        )
+        mocks.add_identity.assert_not_called()
+        assert AgentState.load(mocks.fake_agent.sock_path).fingerprints == {
+            mocks.pub_key.fingerprint
+        }
+        #
+
+    def test_certificate(self, mocks: Mocks) -> None:
+        """Add a key whose renewed certificate is not stored, then trust it until it expires."""
+        valid_before = int(time.time()) + 7200
+        blob = cert_blob(valid_before=valid_before, public=mocks.pub_key.blob[-32:])
+        write_cert(mocks.args.resolve_priv_key_path(), blob)
+        mocks.fake_agent.identities[mocks.pub_key.blob] = "fake"
+
+        ensure_identity(mocks.args)
+
+        mocks.add_identity.assert_called_once()
+        state = AgentState.load(mocks.fake_agent.sock_path)
+        fingerprint = parse_openssh_public_key(
+            f"ssh-ed25519-cert-v01@openssh.com {base64.b64encode(blob).decode()}"
+        ).fingerprint
+        assert valid_before - 600 < state.expires[fingerprint] < valid_before
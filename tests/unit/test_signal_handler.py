@@ -1,9 +1,13 @@
+import os
+import signal
 from signal import Signals
 from typing import cast
 
 from pydantic import ValidationError
 import pytest
 from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import cancellation
+from ssh_agent_add_id.cancellation import CancelToken
 from ssh_agent_add_id.errors import SignalException
 from ssh_agent_add_id.signal_handler import SignalHandler
 
@@ -11,12 +15,15 @@ from ssh_agent_add_id.signal_handler import SignalHandler
 class TestInit:
     """__init__ method"""  # noqa: D415
 
-    def test_success(self, mocker: MockerFixture) -> None:
+    def test_success(self, mocker: MockerFixture, cancel_token: CancelToken) -> None:
         """Runs as expected."""
         mock_signal = mocker.patch("signal.signal")
+        set_wakeup_fd = mocker.patch("signal.set_wakeup_fd")
 
         SignalHandler()
 
+        set_wakeup_fd.assert_called_once_with(cancel_token.wakeup_fd, warn_on_full_buffer=False)
+
         assert mock_signal.call_count == 3
         assert mock_signal.mock_calls[0].args[0] == Signals.SIGHUP
         assert mock_signal.mock_calls[1].args[0] == Signals.SIGINT
@@ -37,9 +44,39 @@ class TestHandler:
         assert errs[0].get("type") == "int_type"
         #
 
-    def test_success(self) -> None:
-        """Runs as expected."""
+    def test_success(self, cancel_token: CancelToken) -> None:
+        """Cancel the token without interrupting the running code."""
+        SignalHandler._handler(2, None)
+
+        assert cancel_token.signal_num == 2
         with pytest.raises(SignalException) as exc_info:
-            SignalHandler._handler(2, None)
+            cancel_token.check()
 
         assert exc_info.value.signal_num == 2
+        #
+
+    def test_token_lock_held(self, cancel_token: CancelToken) -> None:
+        """Cancel the token even if the signal interrupts code holding the token lock."""
+        signums = (signal.SIGHUP, signal.SIGINT, signal.SIGTERM)
+        handlers = [signal.getsignal(signum) for signum in signums]
+        SignalHandler()
+
+        try:
+            with cancellation._token_lock:
+                os.kill(os.getpid(), signal.SIGTERM)
+                # The Python handler runs between two bytecode instructions
+                assert cancel_token.signal_num == Signals.SIGTERM
+        finally:
+            signal.set_wakeup_fd(-1)
+            for signum, handler in zip(signums, handlers):
+                signal.signal(signum, handler)
+        #
+
+    def test_interruptible(self, cancel_token: CancelToken) -> None:
+        """Throw a SignalException at once within interruptible code."""
+        with pytest.raises(SignalException) as exc_info:
+            with cancellation.interruptible():
+                SignalHandler._handler(15, None)
+
+        assert exc_info.value.signal_num == 15
+        assert cancel_token.cancelled
@@ -1,6 +1,8 @@
 import os
+from pathlib import Path
 from signal import SIGINT
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, CompletedProcess, TimeoutExpired
+import threading
 from typing import cast
 
 from pexpect import EOF, TIMEOUT
@@ -8,8 +10,17 @@ from pydantic import ValidationError
 import pytest
 from pytest import CaptureFixture
 from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id import deadline
+from ssh_agent_add_id.agent_client import TransientAgentError
+from ssh_agent_add_id.backend import NATIVE, Backend
+from ssh_agent_add_id.cancellation import CancelToken
+from ssh_agent_add_id.deadline import DeadlineExceededError
 from ssh_agent_add_id.errors import ExitCodeError, SignalException
+from ssh_agent_add_id.keys import PublicKey
 from ssh_agent_add_id.ssh_agent import SSHAgent
+from ssh_agent_add_id.state import AgentState
+
+from tests.unit.conftest import ED25519_BLOB, ED25519_PUBLIC_LINE, FakeAgent
 
 
 class TestCheck:
@@ -139,6 +150,59 @@ class TestAddIdentity:
         mocks.close.assert_called_once()  # This is into finally clause
         #
 
+    def test_constraints(self, mocks: Mocks) -> None:
+        """Pass the lifetime and confirm constraints to ssh-add."""
+        mocks.expect.side_effect = EOF("Fake")
+
+        SSHAgent().add_identity("/test/fake key", 3600, True)
+
+        mocks.spawn.assert_called_once_with(
+            "ssh-add -t 3600 -c '/test/fake key'", encoding="utf-8", env=None
+        )
+        #
+
+    def test_passphrase(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Answer with the given passphrase and the given agent, without printing anything."""
+        mocks.mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": "/test/default.sock"})
+        mocks.expect.side_effect = [0, 2, EOF("Fake")]
+        mocks.child.after = "Enter passphrase for /test/fake:"
+        mocks.child.before = "Lifetime set to 60 seconds"
+
+        SSHAgent().add_identity("/test/fake", passphrase="fake", sock_path="/test/agent.sock")
+
+        mocks.sendline.assert_called_once_with("fake")
+        assert mocks.spawn.call_args.kwargs["env"]["SSH_AUTH_SOCK"] == "/test/agent.sock"
+        assert capsys.readouterr() == ("", "")
+        #
+
+    def test_prompt_then_added(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Print ssh-add output once the prompted passphrase has been accepted."""
+        mocks.mocker.patch("getpass.getpass", return_value="fake")
+        mocks.expect.side_effect = [0, 2, EOF("Fake")]
+        mocks.child.after = "Identity added: /test/fake"
+
+        SSHAgent().add_identity("/test/fake")
+
+        assert capsys.readouterr().out.endswith("Identity added: /test/fake")
+        #
+
+    def test_bad_passphrase(self, mocks: Mocks) -> None:
+        """Throw a ValueError if the given passphrase is rejected."""
+        mocks.expect.side_effect = [0, 1]
+
+        with pytest.raises(ValueError) as exc_info:
+            SSHAgent().add_identity("/test/fake", passphrase="bad")
+
+        assert exc_info.value.args[0] == "Bad passphrase for /test/fake"
+        mocks.close.assert_called()
+        #
+
+    def test_lifetime_validation_error(self) -> None:
+        """Throw a ValidationError if lifetime argument is not positive."""
+        with pytest.raises(ValidationError):
+            SSHAgent().add_identity("/test/fake", 0)
+        #
+
     def test_expect_eof_with_before(self, mocks: Mocks, capsys: CaptureFixture) -> None:
         """Write to stderr if the before prop of closed child is not empty."""
         mocks.expect.side_effect = EOF("Fake")
@@ -194,6 +258,36 @@ class TestAddIdentity:
         assert cast(TIMEOUT, exc_info.value.__context__).args[0] == "Fake"
         #
 
+    def test_signal_while_waiting(self, mocks: Mocks, cancel_token: CancelToken) -> None:
+        """Interrupt ssh-add as soon as a signal is received while waiting for its output."""
+        read_fd, write_fd = os.pipe()
+        mocks.child.buffer = ""
+        mocks.child.child_fd = read_fd
+        threading.Timer(0.05, cancel_token.cancel, (SIGINT,)).start()
+
+        try:
+            with pytest.raises(ExitCodeError) as exc_info:
+                SSHAgent().add_identity("/test/fake")
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+        assert exc_info.value.exit_code == 130
+        mocks.expect.assert_not_called()
+        mocks.sendintr.assert_called_once()
+        #
+
+    def test_expect_deadline(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Throw a DeadlineExceededError and close ssh-add once the deadline has passed."""
+        mocks.expect.side_effect = TIMEOUT("Fake")
+        mocker.patch("ssh_agent_add_id.deadline._deadline", deadline.Deadline(0))
+
+        with pytest.raises(DeadlineExceededError):
+            SSHAgent().add_identity("/test/fake")
+
+        mocks.close.assert_called()
+        #
+
     def test_expect_stdout_write_only(self, mocks: Mocks, capsys: CaptureFixture) -> None:
         """Write only to stdout if expect returns 2."""
         mocks.expect.side_effect = [2, EOF("Fake")]
@@ -230,6 +324,72 @@ class TestAddIdentity:
         mocks.close.assert_called()
 
 
+class TestAddIdentityAskpass:
+    """add_identity_askpass method"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture) -> None:  # noqa: D107
+            mocker.patch.dict("os.environ", {"SSH_ASKPASS": "/test/askpass"})
+            self.run: MockType = mocker.patch("ssh_agent_add_id.cancellation.run")
+            self.run.return_value = CompletedProcess([], 0, b"", b"Identity added: fake")
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestAddIdentityAskpass.Mocks(mocker)
+        #
+
+    def test_arg_type_validation_error(self) -> None:
+        """Throw a ValidationError if priv_key_path argument is not a string."""
+        with pytest.raises(ValidationError) as exc_info:
+            SSHAgent().add_identity_askpass(cast(str, 42))
+
+        assert exc_info.value.errors()[0]["type"] == "string_type"
+        #
+
+    def test_askpass_not_set(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Throw a ValueError if SSH_ASKPASS is not set."""
+        mocker.patch.dict("os.environ", clear=True)
+
+        with pytest.raises(ValueError):
+            SSHAgent().add_identity_askpass("/test/fake")
+
+        mocks.run.assert_not_called()
+        #
+
+    def test_success(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Force ssh-add to use SSH_ASKPASS and forward its output."""
+        SSHAgent().add_identity_askpass("/test/fake")
+
+        assert mocks.run.call_args.args[0] == ["ssh-add", "/test/fake"]
+        assert mocks.run.call_args.kwargs["env"]["SSH_ASKPASS_REQUIRE"] == "force"
+        assert capsys.readouterr().err == "Identity added: fake" + os.linesep
+        #
+
+    def test_non_zero_returncode(self, mocks: Mocks) -> None:
+        """Throw an ExitCodeError if ssh-add fails."""
+        mocks.run.return_value = CompletedProcess([], 1, b"", b"Fake error")
+
+        with pytest.raises(ExitCodeError) as exc_info:
+            SSHAgent().add_identity_askpass("/test/fake")
+
+        assert exc_info.value.exit_code == 1
+        assert exc_info.value.command == "ssh-add /test/fake"
+        #
+
+    def test_signal_exception(self, mocks: Mocks) -> None:
+        """Throw an ExitCodeError(130) if a signal has been received."""
+        mocks.run.side_effect = SignalException(SIGINT)
+
+        with pytest.raises(ExitCodeError) as exc_info:
+            SSHAgent().add_identity_askpass("/test/fake")
+
+        assert exc_info.value.exit_code == 130
+
+
 class TestIsIdentityStored:
     """is_identity_stored method"""  # noqa: D415
 
@@ -240,7 +400,7 @@ class TestIsIdentityStored:
             self.mocker = mocker
 
             self.popen = mocker.patch("ssh_agent_add_id.ssh_agent.Popen")
-            self.communicate: MockType = self.popen.return_value.communicate
+            self.communicate: MockType = mocker.patch("ssh_agent_add_id.cancellation.communicate")
             self.communicate.return_value = (b"fake stdout", b"fake stderr")
             self.poll: MockType = self.popen.return_value.poll
             self.poll.return_value = None
@@ -306,6 +466,18 @@ class TestIsIdentityStored:
         mocks.terminate.assert_called_once()
         #
 
+    def test_deadline(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Throw a DeadlineExceededError and terminate ssh-add if it hangs until the deadline."""
+        mocks.communicate.side_effect = TimeoutExpired("ssh-add", 1)
+        mocker.patch("ssh_agent_add_id.deadline.remaining")
+        mocker.patch("ssh_agent_add_id.deadline._deadline", deadline.Deadline(0))
+
+        with pytest.raises(DeadlineExceededError):
+            SSHAgent().is_identity_stored("/test/fake")
+
+        mocks.terminate.assert_called_once()
+        #
+
     def test_rethrow_exception(self, mocks: Mocks) -> None:
         """Rethrow unknown exceptions."""
         mocks.communicate.side_effect = Exception("Fake")
@@ -387,6 +559,20 @@ class TestIsIdentityStored:
         assert called_process_err.stderr == b"fake stderr"
         #
 
+    def test_transient_error(self, mocks: Mocks) -> None:
+        """Run ssh-add again after a backoff if the agent is busy."""
+        sleep = mocks.mocker.patch("ssh_agent_add_id.cancellation.sleep")
+        mocks.popen.return_value.returncode = 1
+        mocks.communicate.side_effect = [
+            (b"", b"Agent signature failed for /test/fake: communication with agent failed"),
+            (b"", b"Agent signature failed for /test/fake: agent refused operation"),
+        ]
+
+        assert SSHAgent().is_identity_stored("/test/fake") is False
+        assert mocks.popen.call_count == 2
+        sleep.assert_called_once()
+        #
+
     def test_returncode_none(self, mocks: Mocks) -> None:
         """Throw a RuntimeError if returncode is None."""
         mocks.popen.return_value.returncode = None
@@ -409,6 +595,97 @@ class TestIsIdentityStored:
             agent.is_identity_stored("/test/fake")
 
         assert exc_info.value.args[0] == "Unexpected Popen returncode value: [int] -42"
+        #
+
+    def test_native(
+        self,
+        mocks: Mocks,
+        agent_backend: Backend,
+        fake_agent: FakeAgent,
+        tmp_path: Path,
+        capsys: CaptureFixture,
+    ) -> None:
+        """Query the agent socket without ssh-add if the doctor has chosen the native backend."""
+        agent_backend.agent_io = NATIVE
+        mocks.mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": fake_agent.sock_path})
+        pub_key_path = tmp_path / "id.pub"
+        pub_key_path.write_text(ED25519_PUBLIC_LINE)
+
+        assert SSHAgent().is_identity_stored(str(pub_key_path)) is False
+
+        fake_agent.identities[ED25519_BLOB] = "fake"
+        assert SSHAgent().is_identity_stored(str(pub_key_path)) is True
+        assert capsys.readouterr().out == "This identity has already been added to the SSH agent.\n"
+        mocks.popen.assert_not_called()
+        assert AgentState.load(fake_agent.sock_path).has_identity(
+            PublicKey.from_blob(ED25519_BLOB).fingerprint
+        )
+        #
+
+    def test_native_busy(
+        self, mocks: Mocks, agent_backend: Backend, fake_agent: FakeAgent, tmp_path: Path
+    ) -> None:
+        """Retry a busy agent, without falling back to ssh-add which would meet it too."""
+        agent_backend.agent_io = NATIVE
+        mocks.mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": fake_agent.sock_path})
+        mocks.mocker.patch("ssh_agent_add_id.cancellation.sleep")
+        fake_agent.handlers[11] = lambda payload: (5, b"")
+        pub_key_path = tmp_path / "id.pub"
+        pub_key_path.write_text(ED25519_PUBLIC_LINE)
+
+        with pytest.raises(TransientAgentError):
+            SSHAgent().is_identity_stored(str(pub_key_path))
+
+        assert len(fake_agent.requests) == 3
+        mocks.popen.assert_not_called()
+        #
+
+    def test_state_segment(
+        self, mocks: Mocks, fake_agent: FakeAgent, tmp_path: Path, capsys: CaptureFixture
+    ) -> None:
+        """Trust the shared segment of the agent state without querying the agent."""
+        mocks.mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": fake_agent.sock_path})
+        pub_key_path = tmp_path / "id.pub"
+        pub_key_path.write_text(ED25519_PUBLIC_LINE)
+        AgentState.load(fake_agent.sock_path).update(
+            [PublicKey.from_blob(ED25519_BLOB).fingerprint]
+        )
+
+        assert SSHAgent().is_identity_stored(str(pub_key_path)) is True
+        assert capsys.readouterr().out == "This identity has already been added to the SSH agent.\n"
+        mocks.popen.assert_not_called()
+        assert fake_agent.requests == []
+        #
+
+    def test_native_fallback(self, mocks: Mocks, agent_backend: Backend, tmp_path: Path) -> None:
+        """Fall back to ssh-add if the agent socket cannot be used."""
+        agent_backend.agent_io = NATIVE
+        mocks.mocker.patch.dict("os.environ", {"SSH_AUTH_SOCK": str(tmp_path / "missing.sock")})
+        mocks.popen.return_value.returncode = 0
+
+        assert SSHAgent().is_identity_stored("/test/fake") is True
+        assert mocks.popen.call_args[0][0] == ["ssh-add", "-T", "/test/fake"]
+        #
+
+    def test_without_test_option(
+        self, mocks: Mocks, agent_backend: Backend, tmp_path: Path
+    ) -> None:
+        """Search the identities listed by ssh-add -L if ssh-add does not support -T."""
+        agent_backend.ssh_add_test = False
+        pub_key_path = tmp_path / "id.pub"
+        pub_key_path.write_text(ED25519_PUBLIC_LINE)
+        mocks.popen.return_value.returncode = 0
+        mocks.communicate.return_value = (
+            f"ssh-rsa AAAA x{os.linesep}{ED25519_PUBLIC_LINE}".encode(),
+            b"",
+        )
+
+        assert SSHAgent().is_identity_stored(str(pub_key_path)) is True
+        assert mocks.popen.call_args[0][0] == ["ssh-add", "-L"]
+
+        mocks.popen.return_value.returncode = 1
+        mocks.communicate.return_value = (b"The agent has no identities.\n", b"")
+        assert SSHAgent().is_identity_stored(str(pub_key_path)) is False
 
 
 class TestAppendNl:
@@ -0,0 +1,137 @@
+import os
+from pathlib import Path
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.ssh_config import SSHConfig
+
+
+CONFIG = """\
+# Comment
+Host gh github.com
+    HostName github.com
+    User git
+    IdentityFile ~/.ssh/id_github
+
+Host *.corp.example !legacy.corp.example
+    IdentityFile "%d/.ssh/id_%r@%h"
+    IdentityFile=~/.ssh/id_shared  # trailing comment
+
+Match host github.com user git
+    IdentityFile ~/.ssh/id_match
+
+Match originalhost other !all
+    IdentityFile ~/.ssh/never
+
+Host *
+    IdentityFile ~/.ssh/id_shared
+    User nobody
+"""
+
+
+@pytest.fixture
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A fake home directory with an .ssh directory."""
+    home = tmp_path / "home"
+    (home / ".ssh").mkdir(parents=True)
+    monkeypatch.setenv("HOME", str(home))
+    return home
+
+
+class TestResolve:
+    """SSHConfig.identity_files method"""  # noqa: D415
+
+    @pytest.fixture
+    def config(self, home: Path) -> SSHConfig:
+        """The parsed test config."""
+        (home / ".ssh" / "config").write_text(CONFIG)
+        return SSHConfig.parse([str(home / ".ssh" / "config")])
+        #
+
+    def test_host_alias(self, config: SSHConfig, home: Path) -> None:
+        """Accumulate the identity files of the Host and Match blocks matching an alias."""
+        assert config.identity_files("gh") == [
+            f"{home}/.ssh/id_github",
+            f"{home}/.ssh/id_match",
+            f"{home}/.ssh/id_shared",
+        ]
+        assert config.resolve("gh")["user"] == ["git"]
+        #
+
+    def test_tokens_and_negation(self, config: SSHConfig, home: Path) -> None:
+        """Expand the tokens and skip the hosts excluded with a negated pattern."""
+        paths = config.identity_files("build.corp.example", "ci")
+
+        assert paths == [f"{home}/.ssh/id_ci@build.corp.example", f"{home}/.ssh/id_shared"]
+        assert config.identity_files("legacy.corp.example") == [f"{home}/.ssh/id_shared"]
+        #
+
+    def test_defaults(self, home: Path) -> None:
+        """Fall back to the default identity files, unless IdentityFile is none."""
+        (home / ".ssh" / "config").write_text("Host none.example\n  IdentityFile none\n")
+        config = SSHConfig.parse([str(home / ".ssh" / "config")])
+
+        assert config.identity_files("example.org")[3] == f"{home}/.ssh/id_ed25519"
+        assert config.identity_files("none.example") == []
+        #
+
+    def test_include(self, home: Path) -> None:
+        """Follow the Include directives, relative to ~/.ssh, within their enclosing block."""
+        (home / ".ssh" / "config.d").mkdir()
+        (home / ".ssh" / "config.d" / "work").write_text(
+            "IdentityFile ~/.ssh/id_work\nHost *\n  IdentityFile ~/.ssh/id_any_work\n"
+        )
+        (home / ".ssh" / "config").write_text(
+            "Host work\n  Include config.d/*\n  IdentityFile ~/.ssh/id_after\n"
+        )
+        config = SSHConfig.parse([str(home / ".ssh" / "config")])
+
+        assert config.identity_files("work") == [
+            f"{home}/.ssh/id_work",
+            f"{home}/.ssh/id_any_work",
+            f"{home}/.ssh/id_after",
+        ]
+        assert config.identity_files("home")[0] == f"{home}/.ssh/id_rsa"
+        #
+
+    def test_include_loop(self, home: Path) -> None:
+        """Throw a ValueError if a file includes itself."""
+        (home / ".ssh" / "config").write_text("Include config\n")
+
+        with pytest.raises(ValueError, match="Too many nested Include directives"):
+            SSHConfig.parse([str(home / ".ssh" / "config")])
+
+
+class TestLoad:
+    """SSHConfig.load method"""  # noqa: D415
+
+    def test_cache(self, home: Path, mocker: MockerFixture) -> None:
+        """Reuse the cached parse until a file changes or an Include glob matches a new one."""
+        config_path = home / ".ssh" / "config"
+        config_path.write_text("Include conf.d/*\nIdentityFile ~/.ssh/id_a\n")
+        parse = mocker.spy(SSHConfig, "parse")
+
+        assert SSHConfig.load([str(config_path)]).identity_files("x") == [f"{home}/.ssh/id_a"]
+        assert SSHConfig.load([str(config_path)]).identity_files("x") == [f"{home}/.ssh/id_a"]
+        assert parse.call_count == 1
+
+        (home / ".ssh" / "conf.d").mkdir()
+        (home / ".ssh" / "conf.d" / "b").write_text("IdentityFile ~/.ssh/id_b\n")
+        assert SSHConfig.load([str(config_path)]).identity_files("x")[0] == f"{home}/.ssh/id_b"
+        assert parse.call_count == 2
+
+        config_path.write_text("IdentityFile ~/.ssh/id_c\n")
+        os.utime(config_path, ns=(0, 0))
+        assert SSHConfig.load([str(config_path)]).identity_files("x") == [f"{home}/.ssh/id_c"]
+        assert parse.call_count == 3
+        #
+
+    def test_invalid_cache(self, home: Path, runtime_dir: Path) -> None:
+        """Parse the files again if the cache file cannot be read."""
+        (runtime_dir / "ssh-agent-add-id").mkdir()
+        (runtime_dir / "ssh-agent-add-id" / "ssh_config.json").write_text("{")
+        (home / ".ssh" / "config").write_text("IdentityFile ~/.ssh/id_a\n")
+
+        config = SSHConfig.load([str(home / ".ssh" / "config")])
+
+        assert config.identity_files("x") == [f"{home}/.ssh/id_a"]
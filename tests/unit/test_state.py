@@ -0,0 +1,313 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import time
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id import history
+from ssh_agent_add_id.backend import Backend
+from ssh_agent_add_id.constants import APP_NAME
+from ssh_agent_add_id.keys import PublicKey
+from ssh_agent_add_id.state import (
+    AgentState,
+    agent_pid,
+    is_identity_cached,
+    record_identity,
+    state_dir,
+)
+
+from tests.unit.conftest import ED25519_BLOB, FakeAgent
+
+
+class TestStateDir:
+    """state_dir function"""  # noqa: D415
+
+    def test_xdg_runtime_dir(self, runtime_dir: Path) -> None:
+        """Create a private directory into XDG_RUNTIME_DIR."""
+        path = state_dir()
+
+        assert path == runtime_dir / APP_NAME
+        assert path.stat().st_mode & 0o777 == 0o700
+        #
+
+    def test_tmp_dir(self, monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+        """Fall back to a per-user directory into the temporary directory."""
+        monkeypatch.delenv("XDG_RUNTIME_DIR")
+        monkeypatch.setattr("tempfile.tempdir", str(tmp_path))
+
+        assert state_dir() == tmp_path / f"{APP_NAME}-{os.getuid()}"
+        #
+
+    def test_not_owned(self, mocker: MockerFixture) -> None:
+        """Throw a PermissionError if the directory belongs to another user."""
+        mocker.patch("os.getuid", return_value=-1)
+
+        with pytest.raises(PermissionError):
+            state_dir()
+
+
+class TestAgentState:
+    """AgentState class"""  # noqa: D415
+
+    @pytest.fixture
+    def sock_path(self, tmp_path: Path) -> str:
+        """A fixture that returns the path of a fake agent socket."""
+        path = tmp_path / "agent.sock"
+        path.touch()
+        return str(path)
+        #
+
+    def test_load_missing_socket(self, tmp_path: Path) -> None:
+        """Throw an OSError if the agent socket does not exist."""
+        with pytest.raises(OSError):
+            AgentState.load(str(tmp_path / "missing.sock"))
+        #
+
+    def test_load_empty(self, sock_path: str) -> None:
+        """Return an empty and outdated state if there is no state file."""
+        state = AgentState.load(sock_path)
+
+        st = os.stat(sock_path)
+        assert state.sock_id == f"{st.st_dev}-{st.st_ino}-{int(st.st_ctime)}"
+        assert state.fingerprints == set()
+        assert not state.is_fresh()
+        #
+
+    def test_update_and_load(self, sock_path: str) -> None:
+        """Save the listed fingerprints and load them back."""
+        AgentState.load(sock_path).update(["SHA256:b", "SHA256:a"])
+
+        state = AgentState.load(sock_path)
+
+        assert state.fingerprints == {"SHA256:a", "SHA256:b"}
+        assert state.is_fresh()
+        assert json.loads(state.path.read_text())["fingerprints"] == ["SHA256:a", "SHA256:b"]
+        #
+
+    def test_new_socket_inode(self, sock_path: str) -> None:
+        """Do not reuse the state of a previous agent socket."""
+        AgentState.load(sock_path).update(["SHA256:a"])
+        Path(sock_path + ".new").touch()
+        os.replace(sock_path + ".new", sock_path)
+
+        assert AgentState.load(sock_path).fingerprints == set()
+        #
+
+    def test_invalid_file(self, sock_path: str) -> None:
+        """Ignore a state file that cannot be parsed."""
+        state = AgentState.load(sock_path)
+        state.path.write_text("{")
+
+        assert AgentState.load(sock_path).fingerprints == set()
+        #
+
+    def test_other_socket_path(self, sock_path: str) -> None:
+        """Ignore a state file written for another socket path."""
+        AgentState.load(sock_path).update(["SHA256:a"])
+        os.link(sock_path, sock_path + ".link")
+
+        assert AgentState.load(sock_path + ".link").fingerprints == set()
+        #
+
+    def test_dead_agent(self, mocker: MockerFixture, sock_path: str) -> None:
+        """Ignore a state file whose agent process has exited."""
+        AgentState.load(sock_path).update(["SHA256:a"], pid=42)
+        mocker.patch("os.kill", side_effect=ProcessLookupError)
+
+        assert AgentState.load(sock_path).fingerprints == set()
+        #
+
+    def test_pid(self, sock_path: str) -> None:
+        """Save the agent pid on the first line of the state file."""
+        AgentState.load(sock_path).update(["SHA256:a"], pid=os.getpid())
+        AgentState.load(sock_path).update(["SHA256:b"])
+
+        state = AgentState.load(sock_path)
+        assert state.pid == os.getpid()
+        assert f'"pid": {os.getpid()}' in state.path.read_text().splitlines()[0]
+        #
+
+    def test_is_fresh(self, sock_path: str) -> None:
+        """Check the age of the last update."""
+        state = AgentState(sock_path, "1-1", updated_at=time.time() - 10)
+
+        assert state.is_fresh(20)
+        assert not state.is_fresh(5)
+        #
+
+    def test_is_fresh_backend_ttl(self, sock_path: str, agent_backend: Backend) -> None:
+        """Use the state TTL of the backend chosen by the doctor subcommand by default."""
+        state = AgentState(sock_path, "1-1", updated_at=time.time() - 100)
+        assert not state.is_fresh()
+
+        agent_backend.state_ttl = 300
+        assert state.is_fresh()
+        #
+
+    def test_has_identity(self, sock_path: str) -> None:
+        """Trust an identity with a deadline until shortly before it, others within the TTL."""
+        state = AgentState(sock_path, "1-1", ["SHA256:a", "SHA256:b"], time.time() - 3000)
+        state.expires = {"SHA256:a": time.time() + 3600}
+
+        assert state.has_identity("SHA256:a")
+        assert not state.has_identity("SHA256:b")
+        assert not state.has_identity("SHA256:c")
+
+        state.expires["SHA256:a"] = time.time() + 1
+        assert not state.has_identity("SHA256:a")
+        #
+
+    def test_add_lifetime(self, sock_path: str) -> None:
+        """Save the expiry deadline of an identity added with a lifetime."""
+        AgentState.load(sock_path).add("SHA256:a", 3600)
+
+        state = AgentState.load(sock_path)
+
+        assert state.fingerprints == {"SHA256:a"}
+        assert 3590 < state.expires["SHA256:a"] - time.time() <= 3600
+        #
+
+    def test_update_drops_expires(self, sock_path: str) -> None:
+        """Drop the deadlines of the identities no longer listed by the agent."""
+        state = AgentState.load(sock_path)
+        state.add("SHA256:a", 3600)
+        state.add("SHA256:b", 3600)
+
+        state.update(["SHA256:a"])
+
+        assert list(AgentState.load(sock_path).expires) == ["SHA256:a"]
+        #
+
+    def test_concurrent_saves(self, sock_path: str) -> None:
+        """Save the state from several threads at once without clobbering the temporary file."""
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda i: AgentState.load(sock_path).add(f"SHA256:{i}"), range(200)))
+
+        assert len(AgentState.load(sock_path).fingerprints) >= 1
+        #
+
+    def test_learned_ttl(self, sock_path: str, mocker: MockerFixture) -> None:
+        """Trust an identity for the TTL learned from its history, and record the hits."""
+        mocker.patch("ssh_agent_add_id.history.learned_ttls", return_value={"SHA256:a": 10.0})
+        AgentState.load(sock_path).update(["SHA256:a", "SHA256:b"])
+
+        state = AgentState.load(sock_path)
+        state.updated_at = time.time() - 30
+
+        assert state.ttls == {"SHA256:a": 10.0}
+        assert not state.has_identity("SHA256:a")
+        assert state.has_identity("SHA256:b")
+        assert history.summary_lines()[1].endswith(": 1 hits, 1 agent queries (50% hit rate)")
+
+
+class TestIsIdentityCached:
+    """is_identity_cached function"""  # noqa: D415
+
+    @pytest.fixture
+    def sock_path(self, tmp_path: Path) -> str:
+        """A fixture that returns the path of a fake agent socket."""
+        path = tmp_path / "agent.sock"
+        path.touch()
+        return str(path)
+        #
+
+    def test_published(self, sock_path: str) -> None:
+        """Find the identities saved into the state through its shared segment."""
+        fingerprint = PublicKey.from_blob(ED25519_BLOB).fingerprint
+        assert not is_identity_cached(sock_path, fingerprint)
+
+        AgentState.load(sock_path).update([fingerprint], pid=os.getpid())
+
+        assert AgentState.load(sock_path).segment_path.is_file()
+        assert is_identity_cached(sock_path, fingerprint)
+        assert not is_identity_cached(sock_path, "SHA256:" + "A" * 43)
+        #
+
+    def test_trust(self, sock_path: str, mocker: MockerFixture) -> None:
+        """Trust the segment like the state file: deadline, TTL and agent process."""
+        fingerprint = PublicKey.from_blob(ED25519_BLOB).fingerprint
+        AgentState.load(sock_path).update([fingerprint], pid=42)
+        mocker.patch("ssh_agent_add_id.state._is_alive", return_value=True)
+
+        assert is_identity_cached(sock_path, fingerprint)
+        assert not is_identity_cached(sock_path, fingerprint, ttl=0)
+
+        AgentState.load(sock_path).add(fingerprint, 3600)
+        assert is_identity_cached(sock_path, fingerprint, ttl=0)
+
+        mocker.patch("ssh_agent_add_id.state._is_alive", return_value=False)
+        assert not is_identity_cached(sock_path, fingerprint)
+        #
+
+    def test_new_socket_inode(self, sock_path: str) -> None:
+        """Do not trust the segment of a previous agent socket."""
+        fingerprint = PublicKey.from_blob(ED25519_BLOB).fingerprint
+        AgentState.load(sock_path).update([fingerprint])
+        Path(sock_path + ".new").touch()
+        os.replace(sock_path + ".new", sock_path)
+
+        assert not is_identity_cached(sock_path, fingerprint)
+        #
+
+    def test_learned_ttl(self, sock_path: str, mocker: MockerFixture) -> None:
+        """Trust an identity for the TTL learned from its history, published into the segment."""
+        fingerprint = PublicKey.from_blob(ED25519_BLOB).fingerprint
+        mocker.patch("ssh_agent_add_id.history.learned_ttls", return_value={fingerprint: 10.0})
+        mocker.patch("time.time", return_value=1000.0)
+        AgentState.load(sock_path).update([fingerprint], pid=os.getpid())
+
+        mocker.patch("time.time", return_value=1030.0)
+        assert not is_identity_cached(sock_path, fingerprint)
+        assert is_identity_cached(sock_path, fingerprint, ttl=60)
+
+
+class TestAgentPid:
+    """agent_pid function"""  # noqa: D415
+
+    def test_peer_pid(self, mocker: MockerFixture) -> None:
+        """Return the pid from the peer credentials if the process is alive."""
+        client = mocker.Mock()
+        client.peer_pid.return_value = os.getpid()
+
+        assert agent_pid(client) == os.getpid()
+        #
+
+    def test_ssh_agent_pid(self, mocker: MockerFixture) -> None:
+        """Fall back to SSH_AGENT_PID if the peer process has exited."""
+        client = mocker.Mock()
+        client.peer_pid.return_value = 0
+        mocker.patch.dict("os.environ", {"SSH_AGENT_PID": str(os.getpid())})
+
+        assert agent_pid(client) == os.getpid()
+        #
+
+    def test_unknown(self, mocker: MockerFixture) -> None:
+        """Return 0 if no pid is found."""
+        client = mocker.Mock()
+        client.peer_pid.return_value = 0
+        mocker.patch.dict("os.environ", {"SSH_AGENT_PID": "fake"})
+
+        assert agent_pid(client) == 0
+
+
+class TestRecordIdentity:
+    """record_identity function"""  # noqa: D415
+
+    def test_success(self, fake_agent: FakeAgent, tmp_path: Path) -> None:
+        """Add the fingerprint to the agent state."""
+        pub_key_path = tmp_path / "id.pub"
+        pub_key_path.write_text(
+            "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAICS79gq8k0iz8ve8aLBJgzWdsZpY6SyGNmPoIrn25zld"
+        )
+        AgentState.load(fake_agent.sock_path).update(["SHA256:a"])
+
+        record_identity(fake_agent.sock_path, str(pub_key_path))
+
+        state = AgentState.load(fake_agent.sock_path)
+        assert state.fingerprints == {
+            "SHA256:a",
+            "SHA256:asg19kcNCSJQFsISVZ7Z7bEnDLO9/EVhCQjW/zQ48yE",
+        }
+        assert state.pid == os.getpid()  # The fake agent runs in this process
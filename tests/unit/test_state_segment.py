@@ -0,0 +1,84 @@
+import base64
+import hashlib
+from pathlib import Path
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+from ssh_agent_add_id.state_segment import fingerprint_digest, lookup, publish
+
+
+SOCK_KEY = (1, 2, 3)
+
+
+def _fingerprint(name: str) -> str:
+    """Get a fake SHA256 fingerprint."""
+    digest = hashlib.sha256(name.encode()).digest()
+    return "SHA256:" + base64.b64encode(digest).decode().rstrip("=")
+
+
+class TestFingerprintDigest:
+    """fingerprint_digest function"""  # noqa: D415
+
+    def test_sha256(self) -> None:
+        """Decode the unpadded base64 of a SHA256 fingerprint."""
+        assert fingerprint_digest(_fingerprint("a")) == hashlib.sha256(b"a").digest()
+        #
+
+    @pytest.mark.parametrize("fingerprint", ["SHA256:a", "MD5:" + _fingerprint("a")[7:], "x"])
+    def test_invalid(self, fingerprint: str) -> None:
+        """Throw a ValueError for the other fingerprints."""
+        with pytest.raises(ValueError):
+            fingerprint_digest(fingerprint)
+
+
+class TestLookup:
+    """publish and lookup functions"""  # noqa: D415
+
+    def test_round_trip(self, tmp_path: Path) -> None:
+        """Bisect the published fingerprints and get their deadlines and TTLs."""
+        identities = [(_fingerprint(str(i)), float(i), 2.0 * i) for i in range(50)]
+        publish(tmp_path / "seg", SOCK_KEY, 42, 1000.0, identities)
+
+        snapshot = lookup(tmp_path / "seg", SOCK_KEY, _fingerprint("7"))
+        assert snapshot
+        assert (snapshot.found, snapshot.deadline, snapshot.ttl) == (True, 7.0, 14.0)
+        assert (snapshot.pid, snapshot.updated_at) == (42, 1000.0)
+        assert snapshot.generation == 1
+
+        missing = lookup(tmp_path / "seg", SOCK_KEY, _fingerprint("missing"))
+        assert missing and not missing.found
+        #
+
+    def test_other_socket(self, tmp_path: Path) -> None:
+        """Ignore a segment published for another agent socket."""
+        publish(tmp_path / "seg", SOCK_KEY, 0, 1000.0, [(_fingerprint("a"), 0.0, 0.0)])
+
+        assert lookup(tmp_path / "seg", (1, 2, 4), _fingerprint("a")) is None
+        assert lookup(tmp_path / "missing", SOCK_KEY, _fingerprint("a")) is None
+        #
+
+    def test_never_shrinks(self, tmp_path: Path) -> None:
+        """Keep the size of the file for the readers still mapping it, bump the generation."""
+        publish(tmp_path / "seg", SOCK_KEY, 0, 1000.0, [(_fingerprint("a"), 0.0, 0.0)] * 3)
+        size = (tmp_path / "seg").stat().st_size
+        publish(tmp_path / "seg", SOCK_KEY, 0, 1000.0, [(_fingerprint("b"), 0.0, 0.0)])
+
+        snapshot = lookup(tmp_path / "seg", SOCK_KEY, _fingerprint("b"))
+        assert snapshot and snapshot.found and snapshot.generation == 2
+        assert (tmp_path / "seg").stat().st_size == size
+        #
+
+    def test_write_in_progress(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        """Give up after retrying while the sequence is odd, then recover on the next write."""
+        publish(tmp_path / "seg", SOCK_KEY, 0, 1000.0, [(_fingerprint("a"), 0.0, 0.0)])
+        with open(tmp_path / "seg", "r+b") as file:
+            file.seek(8)
+            file.write((3).to_bytes(8, "little"))
+        sleep = mocker.patch("time.sleep")
+
+        assert lookup(tmp_path / "seg", SOCK_KEY, _fingerprint("a")) is None
+        assert sleep.call_count == 64
+
+        publish(tmp_path / "seg", SOCK_KEY, 0, 1000.0, [(_fingerprint("a"), 0.0, 0.0)])
+        snapshot = lookup(tmp_path / "seg", SOCK_KEY, _fingerprint("a"))
+        assert snapshot and snapshot.found
@@ -0,0 +1,224 @@
+from pathlib import Path
+from signal import SIGINT
+import sys
+import threading
+import time
+
+import pytest
+from pytest import CaptureFixture
+from pytest_mock.plugin import MockerFixture, MockType
+from ssh_agent_add_id.errors import ExitCodeError, SignalException
+from ssh_agent_add_id.keys import parse_openssh_public_key
+from ssh_agent_add_id.state import AgentState
+from ssh_agent_add_id.watcher import IdentityWatcher, Inotify
+
+from tests.unit.conftest import ED25519_BLOB, FakeAgent
+
+
+PUB_KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAICS79gq8k0iz8ve8aLBJgzWdsZpY6SyGNmPoIrn25zld fake"
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify")
+
+
+@linux_only
+class TestInotify:
+    """Inotify class"""  # noqa: D415
+
+    def test_read_names(self, tmp_path: Path) -> None:
+        """Report the names of the created and deleted entries."""
+        inotify = Inotify(str(tmp_path))
+        (tmp_path / "fake").touch()
+        (tmp_path / "fake").unlink()
+
+        assert inotify.read_names() == ["fake", "fake"]
+        assert inotify.read_names() == []
+        inotify.close()
+        #
+
+    def test_directory_not_found(self, tmp_path: Path) -> None:
+        """Throw an OSError if the directory cannot be watched."""
+        with pytest.raises(OSError):
+            Inotify(str(tmp_path / "missing"))
+
+
+class TestIdentityWatcher:
+    """IdentityWatcher class"""  # noqa: D415
+
+    class Mocks:
+        """Some mocks for the tests."""
+
+        def __init__(self, mocker: MockerFixture, fake_agent: FakeAgent, tmp_path: Path) -> None:  # noqa: D107
+            self.fake_agent = fake_agent
+
+            pub_key_path = tmp_path / "id.pub"
+            pub_key_path.write_text(PUB_KEY)
+            self.pub_key = parse_openssh_public_key(PUB_KEY)
+
+            self.ssh_agent: MockType = mocker.patch("ssh_agent_add_id.watcher.SSHAgent")
+            self.add_identity: MockType = self.ssh_agent.return_value.add_identity
+            self.add_identity_askpass: MockType = self.ssh_agent.return_value.add_identity_askpass
+            self.isatty: MockType = mocker.patch("sys.stdin.isatty", return_value=True)
+
+            self.watcher = IdentityWatcher(
+                fake_agent.sock_path, str(tmp_path / "id"), str(pub_key_path), 0.01, 0.08
+            )
+            #
+
+    @pytest.fixture
+    def mocks(self, mocker: MockerFixture, fake_agent: FakeAgent, tmp_path: Path) -> Mocks:
+        """A fixture that returns a Mocks instance."""
+        return TestIdentityWatcher.Mocks(mocker, fake_agent, tmp_path)
+        #
+
+    def test_check_identity_stored(self, mocks: Mocks) -> None:
+        """Update the agent state over a single connection without adding the identity."""
+        mocks.fake_agent.identities[mocks.pub_key.blob] = "fake"
+
+        assert mocks.watcher.check() is True
+        assert mocks.watcher.check() is False
+
+        assert mocks.fake_agent.requests == [(11, b""), (11, b"")]
+        assert mocks.pub_key.fingerprint in AgentState.load(mocks.fake_agent.sock_path).fingerprints
+        mocks.add_identity.assert_not_called()
+        mocks.watcher._client.close()
+        #
+
+    def test_check_identity_missing(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Add the identity with the terminal when the agent does not have it."""
+        assert mocks.watcher.check() is True
+
+        mocks.add_identity.assert_called_once_with(mocks.watcher.priv_key_path, None, False)
+        assert "is no longer stored by the agent" in capsys.readouterr().out
+        mocks.watcher._client.close()
+        #
+
+    def test_check_add_failure(self, mocks: Mocks, capsys: CaptureFixture) -> None:
+        """Do not add the identity again after a failure until the agent identities change."""
+        mocks.add_identity.side_effect = ExitCodeError(1, "ssh-add")
+
+        assert mocks.watcher.check() is True
+        assert mocks.watcher.check() is False
+        assert mocks.add_identity.call_count == 1
+        assert capsys.readouterr().out.count("is no longer stored by the agent") == 1
+
+        mocks.fake_agent.identities[ED25519_BLOB] = "other"
+        mocks.watcher.check()
+        assert mocks.add_identity.call_count == 2
+        mocks.watcher._client.close()
+        #
+
+    def test_check_identity_lifetime(self, mocks: Mocks) -> None:
+        """Record the expiry deadline of the identity added with a lifetime."""
+        mocks.watcher.lifetime = 3600
+
+        mocks.watcher.check()
+
+        state = AgentState.load(mocks.fake_agent.sock_path)
+        assert state.has_identity(mocks.pub_key.fingerprint, ttl=0)
+        assert mocks.watcher._expires_at == state.expires[mocks.pub_key.fingerprint]
+        mocks.watcher._client.close()
+        #
+
+    def test_check_agent_not_found(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Do nothing while the agent socket does not exist."""
+        mocks.watcher.sock_path = str(tmp_path / "missing.sock")
+
+        assert mocks.watcher.check() is False
+        mocks.add_identity.assert_not_called()
+        #
+
+    def test_add_identity_askpass(self, mocks: Mocks) -> None:
+        """Prompt for the passphrase with SSH_ASKPASS when there is no terminal."""
+        mocks.isatty.return_value = False
+
+        mocks.watcher.add_identity()
+
+        mocks.add_identity.assert_not_called()
+        mocks.add_identity_askpass.assert_called_once_with(mocks.watcher.priv_key_path, None, False)
+        #
+
+    @pytest.mark.parametrize(
+        "err",
+        [
+            ExitCodeError(1, "ssh-add"),
+            ValueError("Fake"),
+            RuntimeError("ssh-add did not run as expected"),
+            OSError("Fake"),
+        ],
+    )
+    def test_add_identity_failure(
+        self, err: Exception, mocks: Mocks, capsys: CaptureFixture
+    ) -> None:
+        """Report the failures to add the identity and keep watching."""
+        mocks.add_identity.side_effect = err
+
+        assert mocks.watcher.add_identity() is False
+
+        assert str(err) in capsys.readouterr().err
+        #
+
+    def test_add_identity_signal(self, mocks: Mocks) -> None:
+        """Rethrow ExitCodeError(130)."""
+        mocks.add_identity.side_effect = ExitCodeError(130)
+
+        with pytest.raises(ExitCodeError):
+            mocks.watcher.add_identity()
+            #
+
+    def test_wait_polling(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Sleep for the whole timeout without inotify."""
+        sleep = mocker.patch("ssh_agent_add_id.cancellation.sleep")
+
+        mocks.watcher.wait(42)
+
+        sleep.assert_called_once_with(42)
+        #
+
+    @linux_only
+    def test_wait_socket_replaced(self, mocks: Mocks, tmp_path: Path) -> None:
+        """Wake up as soon as the agent socket is replaced."""
+        mocks.watcher._inotify = Inotify(str(tmp_path))
+        (tmp_path / "other").touch()
+        threading.Timer(0.05, (tmp_path / "agent.sock").unlink).start()
+
+        start = time.monotonic()
+        mocks.watcher.wait(10)
+
+        assert time.monotonic() - start < 5
+        mocks.watcher._inotify.close()
+        #
+
+    def test_run_expiry(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Do not sleep past the expiry of the identity."""
+        mocker.patch("ssh_agent_add_id.watcher.Inotify", side_effect=OSError("Fake"))
+        mocker.patch.object(mocks.watcher, "check", return_value=False)
+        mocks.watcher._expires_at = time.time() + 0.03
+        wait = mocker.patch.object(mocks.watcher, "wait")
+        wait.side_effect = [None, SignalException(SIGINT)]
+
+        with pytest.raises(ExitCodeError):
+            mocks.watcher.run()
+
+        assert 0.01 <= wait.call_args_list[0].args[0] <= 0.03
+        #
+
+    def test_run_backoff(self, mocks: Mocks, mocker: MockerFixture) -> None:
+        """Double the interval while nothing changes, up to the maximum."""
+        mocks.fake_agent.identities[mocks.pub_key.blob] = "fake"
+        mocker.patch("ssh_agent_add_id.watcher.Inotify", side_effect=OSError("Fake"))
+        wait = mocker.patch.object(mocks.watcher, "wait")
+        wait.side_effect = [None] * 5 + [SignalException(SIGINT)]
+
+        with pytest.raises(ExitCodeError) as exc_info:
+            mocks.watcher.run()
+
+        assert exc_info.value.exit_code == 130
+        assert [call.args[0] for call in wait.call_args_list] == [
+            0.01,
+            0.02,
+            0.04,
+            0.08,
+            0.08,
+            0.08,
+        ]
+        assert mocks.watcher._client._sock is None
@@ -0,0 +1,37 @@
+import pytest
+from ssh_agent_add_id.wire import WireReader, pack_string, pack_uint32
+
+
+class TestWireReader:
+    """WireReader class"""  # noqa: D415
+
+    def test_read_values(self) -> None:
+        """Read the values in sequence."""
+        reader = WireReader(
+            b"\x07" + pack_uint32(42) + (2**40).to_bytes(8, "big") + pack_string(b"ab")
+        )
+
+        assert reader.read_byte() == 7
+        assert reader.read_uint32() == 42
+        assert reader.read_uint64() == 2**40
+        assert reader.read_string() == b"ab"
+        assert reader.remaining == 0
+        #
+
+    def test_truncated(self) -> None:
+        """Throw a ValueError if the buffer is too short."""
+        reader = WireReader(pack_uint32(10) + b"short")
+
+        with pytest.raises(ValueError) as exc_info:
+            reader.read_string()
+
+        assert exc_info.value.args[0] == "Truncated SSH wire data"
+
+
+class TestPack:
+    """pack_uint32 and pack_string functions"""  # noqa: D415
+
+    def test_pack(self) -> None:
+        """Encode big-endian values."""
+        assert pack_uint32(258) == b"\x00\x00\x01\x02"
+        assert pack_string(b"ssh") == b"\x00\x00\x00\x03ssh"
@@ -0,0 +1,136 @@
+from pathlib import Path
+
+import pytest
+from ssh_agent_add_id.ssh_config import SSHConfig
+from ssh_agent_add_id.workspace import (
+    SSHRemote,
+    find_git_config,
+    git_remote_urls,
+    parse_ssh_remote,
+    workspace_keys,
+)
+
+from tests.unit.conftest import ED25519_BLOB, openssh_private_key
+
+
+GIT_CONFIG = """\
+[core]
+\tbare = false
+[remote "origin"]
+\turl = gh:owner/repo.git
+\tfetch = +refs/heads/*:refs/remotes/origin/*
+[remote "mirror"]
+\turl = "https://example.org/repo.git" ; comment
+\tpushurl = ssh://deploy@build.corp.example:2222/repo.git
+[url "git@github.com:"]
+\tinsteadOf = gh:
+"""
+
+
+@pytest.fixture
+def home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A fake home directory with an .ssh directory."""
+    home = tmp_path / "home"
+    (home / ".ssh").mkdir(parents=True)
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.delenv("XDG_CONFIG_HOME", raising=False)
+    return home
+
+
+@pytest.fixture
+def repo(tmp_path: Path) -> Path:
+    """A fake git working tree."""
+    repo = tmp_path / "repo"
+    (repo / ".git").mkdir(parents=True)
+    (repo / ".git" / "config").write_text(GIT_CONFIG)
+    (repo / "src").mkdir()
+    return repo
+
+
+class TestFindGitConfig:
+    """find_git_config function"""  # noqa: D415
+
+    def test_parent_dir(self, repo: Path) -> None:
+        """Find the repository config from a subdirectory."""
+        assert find_git_config(str(repo / "src")) == repo / ".git" / "config"
+        #
+
+    def test_worktree(self, repo: Path, tmp_path: Path) -> None:
+        """Follow the .git file of a worktree to the config of the common directory."""
+        git_dir = repo / ".git" / "worktrees" / "wt"
+        git_dir.mkdir(parents=True)
+        (git_dir / "commondir").write_text("../..\n")
+        (tmp_path / "wt").mkdir()
+        (tmp_path / "wt" / ".git").write_text(f"gitdir: {git_dir}\n")
+
+        assert find_git_config(str(tmp_path / "wt")).resolve() == repo / ".git" / "config"
+        #
+
+    def test_not_a_repository(self, tmp_path: Path) -> None:
+        """Throw a FileNotFoundError outside of a git repository."""
+        with pytest.raises(FileNotFoundError, match="is not in a git repository"):
+            find_git_config(str(tmp_path))
+
+
+class TestGitRemoteUrls:
+    """git_remote_urls function"""  # noqa: D415
+
+    def test_urls(self, repo: Path, home: Path) -> None:
+        """List the fetch and push URLs, rewritten by the local and global insteadOf rules."""
+        (home / ".gitconfig").write_text(
+            '[url "ssh://git@example.org/"]\n\tpushInsteadOf = https://example.org/\n'
+        )
+
+        assert git_remote_urls(str(repo / ".git" / "config")) == [
+            "git@github.com:owner/repo.git",
+            "https://example.org/repo.git",
+            "ssh://git@example.org/repo.git",
+            "ssh://deploy@build.corp.example:2222/repo.git",
+        ]
+
+
+class TestParseSSHRemote:
+    """parse_ssh_remote function"""  # noqa: D415
+
+    @pytest.mark.parametrize(
+        "url, remote",
+        [
+            ("git@github.com:owner/repo.git", SSHRemote("github.com", "git")),
+            ("gh:owner/repo.git", SSHRemote("gh")),
+            ("ssh://deploy@Build.example:2222/repo", SSHRemote("build.example", "deploy", 2222)),
+            ("git+ssh://[::1]/repo", SSHRemote("::1")),
+            ("https://example.org/repo.git", None),
+            ("file:///srv/repo.git", None),
+            ("./dir:with/colon", None),
+            ("/srv/repo.git", None),
+        ],
+    )
+    def test_urls(self, url: str, remote: SSHRemote) -> None:
+        """Get the destination of the SSH URLs only."""
+        assert parse_ssh_remote(url) == remote
+
+
+class TestWorkspaceKeys:
+    """workspace_keys function"""  # noqa: D415
+
+    def test_keys(self, repo: Path, home: Path) -> None:
+        """Get only the existing keys that the SSH remotes would use."""
+        (home / ".ssh" / "id_github").write_text(openssh_private_key())
+        (home / ".ssh" / "id_unused").write_text(openssh_private_key())
+        (home / ".ssh" / "config").write_text(
+            "Host github.com\n  IdentityFile ~/.ssh/id_github\n"
+            + "Host *.corp.example\n  IdentityFile ~/.ssh/id_missing\n"
+        )
+        config = SSHConfig.parse([str(home / ".ssh" / "config")])
+
+        keys = workspace_keys(str(repo), config)
+
+        assert [key.priv_key_path for key in keys] == [str(home / ".ssh" / "id_github")]
+        assert keys[0].public_key.blob == ED25519_BLOB
+        #
+
+    def test_no_ssh_remote(self, repo: Path, home: Path) -> None:
+        """Get no key without parsing the ssh config if no remote uses SSH."""
+        (repo / ".git" / "config").write_text('[remote "origin"]\n\turl = https://x.org/r.git\n')
+
+        assert workspace_keys(str(repo)) == []